@@ -15,8 +15,11 @@
 """BSON (Binary JSON) encoding and decoding.
 """
 
+import array
 import calendar
 import datetime
+import mmap
+import os
 import re
 import struct
 import sys
@@ -31,9 +34,15 @@ from bson.errors import (InvalidBSON,
 from bson.max_key import MaxKey
 from bson.min_key import MinKey
 from bson.objectid import ObjectId
-from bson.py3compat import b, binary_type
+# Must be imported after bson.objectid (see the end of bson/objectid.py).
+from bson.columns import decode_columns
+from bson.py3compat import b, binary_type, string_types, text_type
+from bson.raw_bson import RawBSONDocument
+from bson.record import Record
+from bson.regex import Regex, _compile, str_flags_to_int
 from bson.son import SON
 from bson.timestamp import Timestamp
+from bson.type_registry import TypeRegistry
 from bson.tz_util import utc
 
 
@@ -92,11 +101,61 @@ BSONMIN = b("\xFF") # Min key
 BSONMAX = b("\x7F") # Max key
 
 
+def _unpacker(format):
+    """Get a function unpacking `format` from a position in a string,
+    without slicing the string first.
+    """
+    try:
+        return struct.Struct(format).unpack_from
+    except AttributeError:
+        # Python 2.4 has no struct.Struct.
+        size = struct.calcsize(format)
+
+        def unpack_from(data, position=0):
+            return struct.unpack(format, data[position:position + size])
+        return unpack_from
+
+
+def _packer(format):
+    """Get a function packing values to `format`.
+    """
+    try:
+        return struct.Struct(format).pack
+    except AttributeError:
+        def pack(*values):
+            return struct.pack(format, *values)
+        return pack
+
+# Precompiled so that the format isn't parsed again for each value.
+_UNPACK_INT = _unpacker("<i")
+_UNPACK_UINT = _unpacker("<I")
+_UNPACK_LONG = _unpacker("<q")
+_UNPACK_FLOAT = _unpacker("<d")
+_PACK_INT = _packer("<i")
+_PACK_UINT = _packer("<I")
+_PACK_LONG = _packer("<q")
+_PACK_FLOAT = _packer("<d")
+
+# The typecode of the array.array that arrays of int64 values are decoded
+# to with typed_arrays, or None if no typecode has 8 byte items.
+_INT64_TYPECODE = None
+for _typecode in ("l", "q"):
+    try:
+        if array.array(_typecode).itemsize == 8:
+            _INT64_TYPECODE = _typecode
+            break
+    except ValueError:
+        # "q" is new in Python 3.3.
+        pass
+
+
 def _get_int(data, position, as_class=None,
              tz_aware=False, uuid_subtype=OLD_UUID_SUBTYPE, unsigned=False):
-    format = unsigned and "I" or "i"
     try:
-        value = struct.unpack("<%s" % format, data[position:position + 4])[0]
+        if unsigned:
+            value = _UNPACK_UINT(data, position)[0]
+        else:
+            value = _UNPACK_INT(data, position)[0]
     except struct.error:
         raise InvalidBSON()
     position += 4
@@ -136,46 +195,159 @@ def _make_c_string(string, check_null=False):
 
 
 def _get_number(data, position, as_class, tz_aware, uuid_subtype):
-    num = struct.unpack("<d", data[position:position + 8])[0]
-    position += 8
-    return num, position
+    return _UNPACK_FLOAT(data, position)[0], position + 8
 
 
 def _get_string(data, position, as_class, tz_aware, uuid_subtype):
-    length = struct.unpack("<i", data[position:position + 4])[0] - 1
+    length = _UNPACK_INT(data, position)[0] - 1
     position += 4
     return _get_c_string(data, position, length)
 
 
-def _get_object(data, position, as_class, tz_aware, uuid_subtype):
-    obj_size = struct.unpack("<i", data[position:position + 4])[0]
-    encoded = data[position + 4:position + obj_size - 1]
-    object = _elements_to_dict(encoded, as_class, tz_aware, uuid_subtype)
-    position += obj_size
-    if "$ref" in object:
+def _raw_document_class(as_class):
+    """Is `as_class` a :class:`~bson.raw_bson.RawBSONDocument` type?
+    """
+    return isinstance(as_class, type) and issubclass(as_class, RawBSONDocument)
+
+
+def _record_class(as_class):
+    """Is `as_class` a :class:`~bson.record.Record` type?
+    """
+    return isinstance(as_class, type) and issubclass(as_class, Record)
+
+
+def _get_object(data, position, as_class, tz_aware, uuid_subtype,
+                fields=None, decoders=None, compile_re=True, views=None,
+                typed_arrays=False):
+    obj_size = _UNPACK_INT(data, position)[0]
+    end = position + obj_size - 1
+    if obj_size < 5 or data[end:end + 1] != ZERO:
+        raise InvalidBSON("bad eoo")
+    if _raw_document_class(as_class):
+        object = as_class(data[position:end + 1], tz_aware, uuid_subtype,
+                          compile_re)
+        return object, end + 1
+    object = _elements_to_dict(data, position + 4, end, as_class, tz_aware,
+                               uuid_subtype, fields, decoders, compile_re,
+                               views, typed_arrays)
+    position = end + 1
+    if not isinstance(object, Record) and "$ref" in object:
         return (DBRef(object.pop("$ref"), object.pop("$id"),
                       object.pop("$db", None), object), position)
     return object, position
 
 
-def _get_array(data, position, as_class, tz_aware, uuid_subtype):
-    obj, position = _get_object(data, position,
-                                as_class, tz_aware, uuid_subtype)
+def _typed_array(data, position, end):
+    """Decode the elements in data[position:end] to an array.array if
+    they are all doubles ("d") or all integers ("i" if they are all
+    int32, else _INT64_TYPECODE). Returns ``None`` if they aren't, or
+    if there are none.
+    """
+    values = []
+    append = values.append
+    types = set()
+    index = data.index
+    while position < end:
+        element_type = data[position:position + 1]
+        try:
+            position = index(ZERO, position + 1, end) + 1
+        except ValueError:
+            return None
+        if element_type == BSONINT:
+            append(_UNPACK_INT(data, position)[0])
+            position += 4
+        elif element_type == BSONNUM:
+            append(_UNPACK_FLOAT(data, position)[0])
+            position += 8
+        elif element_type == BSONLON:
+            append(_UNPACK_LONG(data, position)[0])
+            position += 8
+        else:
+            return None
+        types.add(element_type)
+    if not values or position != end:
+        return None
+    if BSONNUM in types:
+        if len(types) > 1:
+            return None
+        return array.array("d", values)
+    if BSONLON not in types:
+        return array.array("i", values)
+    if _INT64_TYPECODE is None:
+        return None
+    return array.array(_INT64_TYPECODE, values)
+
+
+def _get_array(data, position, as_class, tz_aware, uuid_subtype,
+               fields=None, decoders=None, compile_re=True, views=None,
+               typed_arrays=False):
+    if fields is not None:
+        return _get_projected_array(data, position, as_class, tz_aware,
+                                    uuid_subtype, fields, decoders,
+                                    compile_re, views, typed_arrays)
+    size = _UNPACK_INT(data, position)[0]
+    end = position + size - 1
+    if size < 5 or data[end:end + 1] != ZERO:
+        raise InvalidBSON("bad eoo")
+    if typed_arrays:
+        result = _typed_array(data, position + 4, end)
+        if result is not None:
+            return result, end + 1
+    position += 4
     result = []
-    i = 0
-    while True:
+    append = result.append
+    index = data.index
+    # The element names are just the indexes, so skip over them.
+    while position < end:
+        element_type = data[position:position + 1]
         try:
-            result.append(obj[str(i)])
-            i += 1
-        except KeyError:
-            break
-    return result, position
+            position = index(ZERO, position + 1, end) + 1
+        except ValueError:
+            raise InvalidBSON()
+        value, position = _get_value(data, position, element_type, as_class,
+                                     tz_aware, uuid_subtype, decoders,
+                                     compile_re, views, typed_arrays)
+        append(value)
+    return result, end + 1
+
+
+def _get_projected_array(data, position, as_class, tz_aware,
+                         uuid_subtype, fields, decoders=None,
+                         compile_re=True, views=None, typed_arrays=False):
+    """Decode an array keeping only the `fields` of its embedded
+    documents. Elements that aren't documents or arrays are skipped.
+    """
+    end = position + _get_int(data, position)[0]
+    position += 4
+    result = []
+    while position < end - 1:
+        element_type = data[position:position + 1]
+        _, position = _get_c_string(data, position + 1)
+        if element_type == BSONOBJ:
+            value, position = _get_object(data, position, as_class,
+                                          tz_aware, uuid_subtype, fields,
+                                          decoders, compile_re, views,
+                                          typed_arrays)
+            result.append(_decode_custom(decoders, value))
+        elif element_type == BSONARR:
+            value, position = _get_projected_array(data, position, as_class,
+                                                   tz_aware, uuid_subtype,
+                                                   fields, decoders,
+                                                   compile_re, views,
+                                                   typed_arrays)
+            result.append(_decode_custom(decoders, value))
+        else:
+            position = _element_end(data, position, element_type)
+    return result, end
 
 
-def _get_binary(data, position, as_class, tz_aware, uuid_subtype):
+def _get_binary(data, position, as_class, tz_aware, uuid_subtype,
+                views=None):
     length, position = _get_int(data, position)
     subtype = ord(data[position:position + 1])
     position += 1
+    if views is not None and subtype == 0:
+        return views[position:position + length], position + length
     if subtype == 2:
         length2, position = _get_int(data, position)
         if length2 != length - 4:
@@ -217,7 +389,7 @@ def _get_boolean(data, position, as_class, tz_aware, uuid_subtype):
 
 
 def _get_date(data, position, as_class, tz_aware, uuid_subtype):
-    seconds = float(struct.unpack("<q", data[position:position + 8])[0]) / 1000.0
+    seconds = float(_UNPACK_LONG(data, position)[0]) / 1000.0
     position += 8
     if tz_aware:
         return EPOCH_AWARE + datetime.timedelta(seconds=seconds), position
@@ -235,7 +407,7 @@ def _get_code_w_scope(data, position, as_class, tz_aware, uuid_subtype):
     code, position = _get_string(data, position,
                                  as_class, tz_aware, uuid_subtype)
     scope, position = _get_object(data, position,
-                                  as_class, tz_aware, uuid_subtype)
+                                  dict, tz_aware, uuid_subtype)
     return Code(code, scope), position
 
 
@@ -243,23 +415,14 @@ def _get_null(data, position, as_class, tz_aware, uuid_subtype):
     return None, position
 
 
-def _get_regex(data, position, as_class, tz_aware, uuid_subtype):
+def _get_regex(data, position, as_class, tz_aware, uuid_subtype,
+               compile_re=True):
     pattern, position = _get_c_string(data, position)
     bson_flags, position = _get_c_string(data, position)
-    flags = 0
-    if "i" in bson_flags:
-        flags |= re.IGNORECASE
-    if "l" in bson_flags:
-        flags |= re.LOCALE
-    if "m" in bson_flags:
-        flags |= re.MULTILINE
-    if "s" in bson_flags:
-        flags |= re.DOTALL
-    if "u" in bson_flags:
-        flags |= re.UNICODE
-    if "x" in bson_flags:
-        flags |= re.VERBOSE
-    return re.compile(pattern, flags), position
+    flags = str_flags_to_int(bson_flags)
+    if compile_re:
+        return _compile(pattern, flags), position
+    return Regex(pattern, flags), position
 
 
 def _get_ref(data, position, as_class, tz_aware, uuid_subtype):
@@ -279,7 +442,7 @@ def _get_long(data, position, as_class, tz_aware, uuid_subtype):
     # Have to cast to long; on 32-bit unpack may return an int.
     # 2to3 will change long to int. That's fine since long doesn't
     # exist in python3.
-    value = long(struct.unpack("<q", data[position:position + 8])[0])
+    value = long(_UNPACK_LONG(data, position)[0])
     position += 8
     return value, position
 
@@ -307,40 +470,448 @@ _element_getter = {
     BSONMAX: lambda v, w, x, y, z: (MaxKey(), w)}
 
 
-def _element_to_dict(data, position, as_class, tz_aware, uuid_subtype):
+_fixed_element_size = {
+    BSONNUM: 8,
+    BSONUND: 0,
+    BSONOID: 12,
+    BSONBOO: 1,
+    BSONDAT: 8,
+    BSONNUL: 0,
+    BSONINT: 4,
+    BSONTIM: 8,
+    BSONLON: 8,
+    BSONMIN: 0,
+    BSONMAX: 0}
+
+
+def _element_end(data, position, element_type):
+    """Get the position just past the value of type `element_type`
+    starting at `position`, without decoding the value.
+    """
+    try:
+        end = position + _fixed_element_size[element_type]
+    except KeyError:
+        if element_type in (BSONSTR, BSONCOD, BSONSYM):
+            end = position + 4 + _get_int(data, position)[0]
+        elif element_type in (BSONOBJ, BSONARR, BSONCWS):
+            end = position + _get_int(data, position)[0]
+        elif element_type == BSONBIN:
+            end = position + 5 + _get_int(data, position)[0]
+        elif element_type == BSONRGX:
+            _, position = _get_c_string(data, position)
+            _, end = _get_c_string(data, position)
+        elif element_type == BSONREF:
+            end = position + 16 + _get_int(data, position)[0]
+        else:
+            raise InvalidBSON("unknown element type %r" % (element_type,))
+    if end < position or end > len(data):
+        raise InvalidBSON("bad element size")
+    return end
+
+
+def _check_registry(type_registry):
+    if (type_registry is not None and
+        not isinstance(type_registry, TypeRegistry)):
+        raise TypeError("type_registry must be an instance of "
+                        "bson.type_registry.TypeRegistry")
+    return type_registry
+
+
+def _decoders(type_registry):
+    """Get the decoders of `type_registry`, or ``None`` if there are none.
+    """
+    if _check_registry(type_registry) is None or not type_registry._decoders:
+        return None
+    return type_registry._decoders
+
+
+def _decode_custom(decoders, value):
+    """Apply the decoder in `decoders` for the type of `value`, if any.
+    """
+    if decoders is None:
+        return value
+    decoder = decoders.get(type(value))
+    if decoder is None:
+        return value
+    return decoder(value)
+
+
+def _get_value(data, position, element_type, as_class,
+               tz_aware, uuid_subtype, decoders, compile_re=True,
+               views=None, typed_arrays=False):
+    # The most common types are decoded inline.
+    if element_type == BSONSTR:
+        length = _UNPACK_INT(data, position)[0]
+        value = data[position + 4:position + length + 3].decode("utf-8")
+        position += length + 4
+    elif element_type == BSONINT:
+        value = _UNPACK_INT(data, position)[0]
+        position += 4
+    elif element_type == BSONNUM:
+        value = _UNPACK_FLOAT(data, position)[0]
+        position += 8
+    elif element_type == BSONOBJ:
+        value, position = _get_object(data, position, as_class, tz_aware,
+                                      uuid_subtype, None, decoders,
+                                      compile_re, views, typed_arrays)
+    elif element_type == BSONARR:
+        value, position = _get_array(data, position, as_class, tz_aware,
+                                     uuid_subtype, None, decoders, compile_re,
+                                     views, typed_arrays)
+    elif element_type == BSONRGX:
+        value, position = _get_regex(data, position, as_class, tz_aware,
+                                     uuid_subtype, compile_re)
+    elif element_type == BSONBIN:
+        value, position = _get_binary(data, position, as_class, tz_aware,
+                                      uuid_subtype, views)
+    else:
+        value, position = _element_getter[element_type](data, position,
+                                                        as_class, tz_aware,
+                                                        uuid_subtype)
+    if decoders is not None:
+        value = _decode_custom(decoders, value)
+    return value, position
+
+
+def _decode_element(data, position, as_class,
+                    tz_aware, uuid_subtype, decoders, compile_re=True):
     element_type = data[position:position + 1]
     position += 1
     element_name, position = _get_c_string(data, position)
-    value, position = _element_getter[element_type](data, position, as_class,
-                                                    tz_aware, uuid_subtype)
+    value, position = _get_value(data, position, element_type, as_class,
+                                 tz_aware, uuid_subtype, decoders, compile_re)
     return element_name, value, position
 
 
-def _elements_to_dict(data, as_class, tz_aware, uuid_subtype):
-    result = as_class()
-    position = 0
-    end = len(data) - 1
+def _element_to_dict(data, position, as_class, tz_aware, uuid_subtype,
+                     type_registry=None, compile_re=True):
+    return _decode_element(data, position, as_class, tz_aware,
+                           uuid_subtype, _decoders(type_registry), compile_re)
+if _use_c:
+    _element_to_dict = _cbson._element_to_dict
+
+
+def _elements_to_dict(data, position, end, as_class, tz_aware, uuid_subtype,
+                      fields=None, decoders=None, compile_re=True,
+                      views=None, typed_arrays=False):
+    """Decode the elements in data[position:end] to an `as_class`.
+
+    Works on offsets into `data`, so embedded documents aren't copied
+    out of it before they are decoded.
+    """
+    if fields is not None:
+        return _projected_elements_to_dict(data, position, end, as_class,
+                                           tz_aware, uuid_subtype, fields,
+                                           decoders, compile_re, views,
+                                           typed_arrays)
+    record_class = None
+    if _record_class(as_class):
+        # Collect the elements, then make the record from them.
+        # Embedded documents are decoded to its document_class.
+        record_class = as_class
+        as_class = record_class._document_class
+        result = {}
+    else:
+        result = as_class()
+    index = data.index
     while position < end:
-        (key, value, position) = _element_to_dict(data, position, as_class,
-                                                  tz_aware, uuid_subtype)
+        element_type = data[position:position + 1]
+        try:
+            name_end = index(ZERO, position + 1, end)
+        except ValueError:
+            raise InvalidBSON()
+        key = data[position + 1:name_end].decode("utf-8")
+        position = name_end + 1
+        value, position = _get_value(data, position, element_type, as_class,
+                                     tz_aware, uuid_subtype, decoders,
+                                     compile_re, views, typed_arrays)
         result[key] = value
+    if record_class is not None:
+        return record_class(result)
     return result
 
-def _bson_to_dict(data, as_class, tz_aware, uuid_subtype):
-    obj_size = struct.unpack("<i", data[:4])[0]
+
+def _projected_elements_to_dict(data, position, end, as_class, tz_aware,
+                                uuid_subtype, fields, decoders=None,
+                                compile_re=True, views=None,
+                                typed_arrays=False):
+    """Decode only the elements named in the `fields` tree (see
+    :func:`_fields_tree`), skipping over all others without decoding them.
+    """
+    record_class = None
+    if _record_class(as_class):
+        record_class = as_class
+        as_class = record_class._document_class
+        result = {}
+    else:
+        result = as_class()
+    while position < end:
+        element_type = data[position:position + 1]
+        try:
+            name_end = data.index(ZERO, position + 1, end)
+        except ValueError:
+            raise InvalidBSON()
+        name = data[position + 1:name_end]
+        position = name_end + 1
+        if name not in fields:
+            position = _element_end(data, position, element_type)
+            continue
+        subfields = fields[name]
+        if subfields is None:
+            value, position = _get_value(data, position, element_type,
+                                         as_class, tz_aware, uuid_subtype,
+                                         decoders, compile_re, views,
+                                         typed_arrays)
+        elif element_type == BSONOBJ:
+            value, position = _get_object(data, position, as_class,
+                                          tz_aware, uuid_subtype, subfields,
+                                          decoders, compile_re, views,
+                                          typed_arrays)
+            value = _decode_custom(decoders, value)
+        elif element_type == BSONARR:
+            value, position = _get_projected_array(data, position, as_class,
+                                                   tz_aware, uuid_subtype,
+                                                   subfields, decoders,
+                                                   compile_re, views,
+                                                   typed_arrays)
+            value = _decode_custom(decoders, value)
+        else:
+            # The path continues below a value that isn't a document.
+            position = _element_end(data, position, element_type)
+            continue
+        result[name.decode("utf-8")] = value
+    if record_class is not None:
+        return record_class(result)
+    return result
+
+
+def _fields_tree(fields):
+    """Turn an iterable of key paths (like ``"a.b"``) into a tree of
+    dicts keyed by UTF-8 encoded key names.
+
+    A key that maps to ``None`` is decoded in full, a key that maps
+    to a dict only has the keys in that dict decoded.
+    """
+    if isinstance(fields, basestring):
+        raise TypeError("fields must be an iterable of key paths, "
+                        "not a single string")
+    tree = {}
+    for field in fields:
+        if not isinstance(field, basestring):
+            raise TypeError("each key path in fields must be an instance "
+                            "of %s" % (basestring.__name__,))
+        if isinstance(field, unicode):
+            field = field.encode("utf-8")
+        names = field.split(b("."))
+        node = tree
+        for name in names[:-1]:
+            child = node.setdefault(name, {})
+            if child is None:
+                # An ancestor is already decoded in full.
+                break
+            node = child
+        else:
+            node[names[-1]] = None
+    return tree
+
+
+def _buffer_to_bytes(data, offset=0):
+    """Get the contents of `data`, from `offset` on, as bytes.
+
+    `data` can be any object supporting the buffer protocol. The C
+    extension decodes such objects in place, here they are copied.
+    """
+    if isinstance(data, text_type):
+        raise TypeError("BSON data must support the buffer protocol "
+                        "(e.g. bytes, bytearray or memoryview)")
+    if not isinstance(data, binary_type):
+        if PY3:
+            data = bytes(memoryview(data))
+        elif hasattr(data, "tobytes"):
+            # memoryview doesn't support the old buffer protocol.
+            data = data.tobytes()
+        else:
+            data = buffer(data)[:]
+    if offset < 0 or offset > len(data):
+        raise ValueError("offset out of range")
+    if offset:
+        return data[offset:]
+    return data
+
+
+def _binary_views(data, binary_view):
+    """A memoryview of `data` to decode binary values as slices of, if
+    `binary_view` is true.
+    """
+    if not binary_view:
+        return None
+    try:
+        return memoryview(data)
+    except NameError:
+        raise NotImplementedError("binary_view requires Python 2.7 "
+                                  "or later")
+
+
+def _bson_to_dict(data, as_class, tz_aware, uuid_subtype, offset=0,
+                  type_registry=None, compile_re=True, binary_view=False,
+                  typed_arrays=False):
+    data = _buffer_to_bytes(data, offset)
+    if len(data) < 5:
+        raise InvalidBSON("not enough data for a BSON document")
+    obj_size = _UNPACK_INT(data)[0]
     length = len(data)
     if length < obj_size:
         raise InvalidBSON("objsize too large")
     if obj_size != length or data[obj_size - 1:obj_size] != ZERO:
         raise InvalidBSON("bad eoo")
-    elements = data[4:obj_size - 1]
-    return (_elements_to_dict(elements, as_class,
-                              tz_aware, uuid_subtype), data[obj_size:])
+    if _raw_document_class(as_class):
+        return (as_class(data[:obj_size], tz_aware, uuid_subtype, compile_re),
+                data[obj_size:])
+    return (_elements_to_dict(data, 4, obj_size - 1, as_class, tz_aware,
+                              uuid_subtype, None, _decoders(type_registry),
+                              compile_re, _binary_views(data, binary_view),
+                              typed_arrays),
+            data[obj_size:])
 if _use_c:
     _bson_to_dict = _cbson._bson_to_dict
 
 
-def _element_to_bson(key, value, check_keys, uuid_subtype):
+def _find_encoder(type_registry, value):
+    """Get the encoder in `type_registry` for the type of `value` or the
+    nearest of its base classes, or ``None``.
+    """
+    if type_registry is None or not type_registry._encoders:
+        return None
+    encoders = type_registry._encoders
+    for python_type in getattr(type(value), "__mro__", ()):
+        if python_type in encoders:
+            return encoders[python_type]
+    return None
+
+
+def _encode_float(name, value, check_keys, uuid_subtype, type_registry):
+    return BSONNUM + name + _PACK_FLOAT(value)
+
+
+def _encode_text(name, value, check_keys, uuid_subtype, type_registry):
+    value = value.encode("utf-8")
+    return BSONSTR + name + _PACK_INT(len(value) + 1) + value + ZERO
+
+
+def _encode_bytes(name, value, check_keys, uuid_subtype, type_registry):
+    if PY3:
+        # Python3 special case. Store 'bytes' as BSON binary subtype 0.
+        return BSONBIN + name + _PACK_INT(len(value)) + ZERO + value
+    cstring = _make_c_string(value)
+    return BSONSTR + name + _PACK_INT(len(cstring)) + cstring
+
+
+def _encode_dict(name, value, check_keys, uuid_subtype, type_registry):
+    return BSONOBJ + name + _dict_to_bson(value, check_keys, uuid_subtype,
+                                          False, type_registry)
+
+
+def _encode_raw_document(name, value, check_keys, uuid_subtype,
+                         type_registry):
+    return BSONOBJ + name + value.raw
+
+
+# The element names of the first array indexes, encoded ahead of time.
+_INDEX_NAMES = [b(str(i)) + ZERO for i in range(1000)]
+
+
+def _encode_list(name, value, check_keys, uuid_subtype, type_registry):
+    elements = []
+    for i, item in enumerate(value):
+        if i < 1000:
+            index = _INDEX_NAMES[i]
+        else:
+            index = b(str(i)) + ZERO
+        elements.append(_name_value_to_bson(index, item, check_keys,
+                                            uuid_subtype, type_registry))
+    encoded = EMPTY.join(elements)
+    return BSONARR + name + _PACK_INT(len(encoded) + 5) + encoded + ZERO
+
+
+def _encode_array(name, value, check_keys, uuid_subtype, type_registry):
+    """Encode an :class:`array.array` or NumPy array like the list of its
+    elements. The C extension reads numeric elements straight from the
+    array's buffer instead.
+    """
+    items = value.tolist()
+    if not PY3:
+        # tolist() returns longs for unsigned typecodes, and longs are
+        # always encoded as int64. Like the C extension, encode the
+        # elements that fit as int32.
+        for i, item in enumerate(items):
+            if isinstance(item, long) and MIN_INT32 <= item <= MAX_INT32:
+                items[i] = int(item)
+    return _encode_list(name, items, check_keys, uuid_subtype,
+                        type_registry)
+
+
+def _encode_objectid(name, value, check_keys, uuid_subtype, type_registry):
+    return BSONOID + name + value.binary
+
+
+def _encode_bool(name, value, check_keys, uuid_subtype, type_registry):
+    if value:
+        return BSONBOO + name + ONE
+    return BSONBOO + name + ZERO
+
+
+def _encode_int(name, value, check_keys, uuid_subtype, type_registry):
+    if MIN_INT32 <= value <= MAX_INT32:
+        return BSONINT + name + _PACK_INT(value)
+    # TODO this is an ugly way to check for this...
+    if value > MAX_INT64 or value < MIN_INT64:
+        raise OverflowError("BSON can only handle up to 8-byte ints")
+    return BSONLON + name + _PACK_LONG(value)
+
+
+def _encode_long(name, value, check_keys, uuid_subtype, type_registry):
+    if value > MAX_INT64 or value < MIN_INT64:
+        raise OverflowError("BSON can only handle up to 8-byte ints")
+    return BSONLON + name + _PACK_LONG(value)
+
+
+def _encode_datetime(name, value, check_keys, uuid_subtype, type_registry):
+    if value.utcoffset() is not None:
+        value = value - value.utcoffset()
+    millis = int(calendar.timegm(value.timetuple()) * 1000 +
+                 value.microsecond / 1000)
+    return BSONDAT + name + _PACK_LONG(millis)
+
+
+def _encode_none(name, value, check_keys, uuid_subtype, type_registry):
+    return BSONNUL + name
+
+
+# Encoders for the most common types, looked up by exact type so that
+# values of these types skip the chain of isinstance checks in
+# _name_value_to_bson. Subclasses still go through the chain.
+_ENCODERS = {
+    float: _encode_float,
+    text_type: _encode_text,
+    binary_type: _encode_bytes,
+    dict: _encode_dict,
+    list: _encode_list,
+    tuple: _encode_list,
+    array.array: _encode_array,
+    ObjectId: _encode_objectid,
+    RawBSONDocument: _encode_raw_document,
+    bool: _encode_bool,
+    int: _encode_int,
+    datetime.datetime: _encode_datetime,
+    type(None): _encode_none,
+}
+if not PY3:
+    # 2to3 will convert long to int here, which must keep _encode_int.
+    _ENCODERS[long] = _encode_long
+
+
+def _element_to_bson(key, value, check_keys, uuid_subtype,
+                     type_registry=None):
     if not isinstance(key, basestring):
         raise InvalidDocument("documents must have only string keys, "
                               "key was %r" % key)
@@ -352,8 +923,20 @@ def _element_to_bson(key, value, check_keys, uuid_subtype):
             raise InvalidDocument("key %r must not contain '.'" % key)
 
     name = _make_c_string(key, True)
+    return _name_value_to_bson(name, value, check_keys, uuid_subtype,
+                               type_registry)
+
+
+def _name_value_to_bson(name, value, check_keys, uuid_subtype,
+                        type_registry=None):
+    """Encode `value` as an element named by the C string `name`.
+    """
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        return encoder(name, value, check_keys, uuid_subtype, type_registry)
+
     if isinstance(value, float):
-        return BSONNUM + name + struct.pack("<d", value)
+        return BSONNUM + name + _PACK_FLOAT(value)
 
     if _use_uuid:
         if isinstance(value, uuid.UUID):
@@ -377,35 +960,32 @@ def _element_to_bson(key, value, check_keys, uuid_subtype):
     if isinstance(value, Binary):
         subtype = value.subtype
         if subtype == 2:
-            value = struct.pack("<i", len(value)) + value
+            value = _PACK_INT(len(value)) + value
         return (BSONBIN + name +
-                struct.pack("<i", len(value)) + b(chr(subtype)) + value)
+                _PACK_INT(len(value)) + b(chr(subtype)) + value)
     if isinstance(value, Code):
         cstring = _make_c_string(value)
         if not value.scope:
-            length = struct.pack("<i", len(cstring))
+            length = _PACK_INT(len(cstring))
             return BSONCOD + name + length + cstring
-        scope = _dict_to_bson(value.scope, False, uuid_subtype, False)
-        full_length = struct.pack("<i", 8 + len(cstring) + len(scope))
-        length = struct.pack("<i", len(cstring))
+        scope = _dict_to_bson(value.scope, False, uuid_subtype, False,
+                              type_registry)
+        full_length = _PACK_INT(8 + len(cstring) + len(scope))
+        length = _PACK_INT(len(cstring))
         return BSONCWS + name + full_length + length + cstring + scope
     if isinstance(value, binary_type):
-        if PY3:
-            # Python3 special case. Store 'bytes' as BSON binary subtype 0.
-            return (BSONBIN + name +
-                    struct.pack("<i", len(value)) + ZERO + value)
-        cstring = _make_c_string(value)
-        length = struct.pack("<i", len(cstring))
-        return BSONSTR + name + length + cstring
+        return _encode_bytes(name, value, check_keys, uuid_subtype,
+                             type_registry)
     if isinstance(value, unicode):
         cstring = _make_c_string(value)
-        length = struct.pack("<i", len(cstring))
+        length = _PACK_INT(len(cstring))
         return BSONSTR + name + length + cstring
-    if isinstance(value, dict):
-        return BSONOBJ + name + _dict_to_bson(value, check_keys, uuid_subtype, False)
+    if isinstance(value, (dict, Record)):
+        return _encode_dict(name, value, check_keys, uuid_subtype,
+                            type_registry)
     if isinstance(value, (list, tuple)):
-        as_dict = SON(zip([str(i) for i in range(len(value))], value))
-        return BSONARR + name + _dict_to_bson(as_dict, check_keys, uuid_subtype, False)
+        return _encode_list(name, value, check_keys, uuid_subtype,
+                            type_registry)
     if isinstance(value, ObjectId):
         return BSONOID + name + value.binary
     if value is True:
@@ -413,31 +993,23 @@ def _element_to_bson(key, value, check_keys, uuid_subtype):
     if value is False:
         return BSONBOO + name + ZERO
     if isinstance(value, int):
-        # TODO this is an ugly way to check for this...
-        if value > MAX_INT64 or value < MIN_INT64:
-            raise OverflowError("BSON can only handle up to 8-byte ints")
-        if value > MAX_INT32 or value < MIN_INT32:
-            return BSONLON + name + struct.pack("<q", value)
-        return BSONINT + name + struct.pack("<i", value)
+        return _encode_int(name, value, check_keys, uuid_subtype,
+                           type_registry)
     # 2to3 will convert long to int here since there is no long in python3.
     # That's OK. The previous if block will match instead.
     if isinstance(value, long):
-        if value > MAX_INT64 or value < MIN_INT64:
-            raise OverflowError("BSON can only handle up to 8-byte ints")
-        return BSONLON + name + struct.pack("<q", value)
+        return _encode_long(name, value, check_keys, uuid_subtype,
+                            type_registry)
     if isinstance(value, datetime.datetime):
-        if value.utcoffset() is not None:
-            value = value - value.utcoffset()
-        millis = int(calendar.timegm(value.timetuple()) * 1000 +
-                     value.microsecond / 1000)
-        return BSONDAT + name + struct.pack("<q", millis)
+        return _encode_datetime(name, value, check_keys, uuid_subtype,
+                                type_registry)
     if isinstance(value, Timestamp):
-        time = struct.pack("<I", value.time)
-        inc = struct.pack("<I", value.inc)
+        time = _PACK_UINT(value.time)
+        inc = _PACK_UINT(value.inc)
         return BSONTIM + name + inc + time
     if value is None:
         return BSONNUL + name
-    if isinstance(value, RE_TYPE):
+    if isinstance(value, (RE_TYPE, Regex)):
         pattern = value.pattern
         flags = ""
         if value.flags & re.IGNORECASE:
@@ -455,41 +1027,147 @@ def _element_to_bson(key, value, check_keys, uuid_subtype):
         return BSONRGX + name + _make_c_string(pattern, True) + \
             _make_c_string(flags)
     if isinstance(value, DBRef):
-        return _element_to_bson(key, value.as_doc(), False, uuid_subtype)
+        return _name_value_to_bson(name, value.as_doc(), False, uuid_subtype,
+                                   type_registry)
     if isinstance(value, MinKey):
         return BSONMIN + name
     if isinstance(value, MaxKey):
         return BSONMAX + name
+    if isinstance(value, RawBSONDocument):
+        return _encode_raw_document(name, value, check_keys, uuid_subtype,
+                                    type_registry)
+    if isinstance(value, array.array):
+        return _encode_array(name, value, check_keys, uuid_subtype,
+                             type_registry)
+    # NumPy isn't a dependency: if it hasn't been imported there can't
+    # be any NumPy arrays.
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return _encode_array(name, value, check_keys, uuid_subtype,
+                             type_registry)
+
+    encoder = _find_encoder(type_registry, value)
+    if encoder is not None:
+        encoded = encoder(value)
+        if type(encoded) is type(value):
+            raise InvalidDocument("encoder for type %s must not return an "
+                                  "instance of the same type" %
+                                  (type(value).__name__,))
+        return _name_value_to_bson(name, encoded, check_keys, uuid_subtype,
+                                   type_registry)
 
     raise InvalidDocument("cannot convert value of type %s to bson" %
                           type(value))
 
 
-def _dict_to_bson(dict, check_keys, uuid_subtype, top_level=True):
+def _raw_bytes(document):
+    """Get the BSON bytes of `document` if it's already encoded (a
+    :class:`BSON` or :class:`~bson.raw_bson.RawBSONDocument` instance),
+    or ``None`` if it isn't.
+    """
+    if isinstance(document, RawBSONDocument):
+        return document.raw
+    if isinstance(document, BSON):
+        if (len(document) < 5 or document[-1:] != ZERO or
+            _UNPACK_INT(document, 0)[0] != len(document)):
+            raise InvalidDocument("encoded document has an invalid size")
+        return document
+    return None
+
+
+def _dict_to_bson(dict, check_keys, uuid_subtype, top_level=True,
+                  type_registry=None):
+    if top_level:
+        _check_registry(type_registry)
+        # Documents that are already encoded are copied verbatim.
+        raw = _raw_bytes(dict)
+        if raw is not None:
+            return raw
     try:
         elements = []
         if top_level and "_id" in dict:
-            elements.append(_element_to_bson("_id", dict["_id"], False, uuid_subtype))
+            elements.append(_element_to_bson("_id", dict["_id"], False,
+                                             uuid_subtype, type_registry))
         for (key, value) in dict.iteritems():
             if not top_level or key != "_id":
-                elements.append(_element_to_bson(key, value, check_keys, uuid_subtype))
+                elements.append(_element_to_bson(key, value, check_keys,
+                                                 uuid_subtype, type_registry))
     except AttributeError:
         raise TypeError("encoder expected a mapping type but got: %r" % dict)
 
     encoded = EMPTY.join(elements)
-    length = len(encoded) + 5
-    return struct.pack("<i", length) + encoded + ZERO
+    return _PACK_INT(len(encoded) + 5) + encoded + ZERO
 if _use_c:
     _dict_to_bson = _cbson._dict_to_bson
 
 
+def _encode_into(documents, buf, offset, check_keys, uuid_subtype,
+                 type_registry=None):
+    data = EMPTY.join([_dict_to_bson(document, check_keys, uuid_subtype,
+                                     True, type_registry)
+                       for document in documents])
+    end = offset + len(data)
+    if offset < 0 or offset > len(buf):
+        raise ValueError("offset out of range")
+    if end > len(buf) and not isinstance(buf, bytearray):
+        raise ValueError("offset out of range or buffer too small")
+    buf[offset:end] = data
+    return end
+if _use_c:
+    _encode_into = _cbson._encode_into
+
+
+def _decode_all(data, as_class, tz_aware, uuid_subtype, fields, offset=0,
+                type_registry=None, compile_re=True, binary_view=False,
+                typed_arrays=False):
+    data = _buffer_to_bytes(data, offset)
+    decoders = _decoders(type_registry)
+    views = _binary_views(data, binary_view)
+    docs = []
+    position = 0
+    end = len(data) - 1
+    while position < end:
+        obj_size = _UNPACK_INT(data, position)[0]
+        if len(data) - position < obj_size:
+            raise InvalidBSON("objsize too large")
+        if data[position + obj_size - 1:position + obj_size] != ZERO:
+            raise InvalidBSON("bad eoo")
+        if _raw_document_class(as_class):
+            docs.append(as_class(data[position:position + obj_size],
+                                 tz_aware, uuid_subtype, compile_re))
+            position += obj_size
+            continue
+        docs.append(_elements_to_dict(data, position + 4,
+                                      position + obj_size - 1, as_class,
+                                      tz_aware, uuid_subtype, fields,
+                                      decoders, compile_re, views,
+                                      typed_arrays))
+        position += obj_size
+    return docs
+if _use_c:
+    _decode_all = _cbson.decode_all
+
 
-def decode_all(data, as_class=dict,
-               tz_aware=True, uuid_subtype=OLD_UUID_SUBTYPE):
+def decode_all(data, as_class=dict, tz_aware=True,
+               uuid_subtype=OLD_UUID_SUBTYPE, fields=None, offset=0,
+               type_registry=None, compile_re=True, binary_view=False,
+               typed_arrays=False):
     """Decode BSON data to multiple documents.
 
-    `data` must be a string of concatenated, valid, BSON-encoded
-    documents.
+    `data` must contain concatenated, valid, BSON-encoded documents,
+    starting at `offset`. It can be a string or any other object
+    supporting the buffer protocol, like :class:`bytearray`,
+    :class:`memoryview` or :class:`mmap.mmap`. The C extension decodes
+    such objects in place, without copying them first. It also checks
+    the structure of all of the documents before decoding any of them,
+    releasing the GIL while checking large data.
+
+    If `fields` is given only the elements on those key paths are
+    decoded, e.g. ``fields=["name", "address.city"]`` decodes the
+    ``"name"`` field and the ``"city"`` field of the ``"address"``
+    sub-document. Any other element is skipped over without being
+    decoded. A path that goes through an array applies to each
+    document in that array.
 
     :Parameters:
       - `data`: BSON data
@@ -497,25 +1175,175 @@ def decode_all(data, as_class=dict,
         documents
       - `tz_aware` (optional): if ``True``, return timezone-aware
         :class:`~datetime.datetime` instances
-
+      - `fields` (optional): an iterable of key paths to decode. Ignored
+        if `as_class` is :class:`~bson.raw_bson.RawBSONDocument`
+      - `offset` (optional): position in `data` of the first document
+      - `type_registry` (optional): a
+        :class:`~bson.type_registry.TypeRegistry` whose decoders are
+        applied to the decoded values
+      - `compile_re` (optional): if ``False``, decode regular
+        expressions as :class:`~bson.regex.Regex` instances instead of
+        compiling them
+      - `binary_view` (optional): if ``True``, decode binary values of
+        subtype 0 as :class:`memoryview` slices of `data` instead of
+        copying them (see :meth:`BSON.decode`)
+      - `typed_arrays` (optional): if ``True``, decode arrays of numbers
+        as :class:`array.array` instances (see :meth:`BSON.decode`)
+
+    .. versionchanged:: 2.4
+       Added the `fields`, `offset`, `type_registry`, `compile_re`,
+       `binary_view` and `typed_arrays` parameters.
+       `data` can be any object supporting the buffer protocol.
     .. versionadded:: 1.9
     """
-    docs = []
+    if fields is not None:
+        fields = _fields_tree(fields)
+    return _decode_all(data, as_class, tz_aware, uuid_subtype,
+                       fields, offset, type_registry, compile_re, binary_view,
+                       typed_arrays)
+
+
+def decode_iter(data, as_class=dict, tz_aware=True,
+                uuid_subtype=OLD_UUID_SUBTYPE, fields=None, raw=False,
+                type_registry=None, compile_re=True):
+    """Decode BSON data to multiple documents, as a generator.
+
+    Works like :func:`decode_all`, but yields one document at a time.
+    Each document is framed by its length prefix and only decoded once
+    it is reached. `data` can be any object supporting the buffer
+    protocol and slicing, like :class:`mmap.mmap`, so only one document
+    at a time needs to be copied into memory.
+
+    :Parameters:
+      - `data`: BSON data
+      - `as_class` (optional): the class to use for the resulting
+        documents
+      - `tz_aware` (optional): if ``True``, return timezone-aware
+        :class:`~datetime.datetime` instances
+      - `fields` (optional): an iterable of key paths to decode (see
+        :func:`decode_all`)
+      - `raw` (optional): if ``True``, yield the BSON bytes of each
+        document instead of decoding it
+      - `type_registry` (optional): a
+        :class:`~bson.type_registry.TypeRegistry` whose decoders are
+        applied to the decoded values
+      - `compile_re` (optional): if ``False``, decode regular
+        expressions as :class:`~bson.regex.Regex` instances instead of
+        compiling them
+
+    .. versionadded:: 2.4
+    """
+    if fields is not None:
+        fields = _fields_tree(fields)
     position = 0
-    end = len(data) - 1
+    end = len(data)
     while position < end:
+        if end - position < 5:
+            raise InvalidBSON("not enough data for a BSON document")
         obj_size = struct.unpack("<i", data[position:position + 4])[0]
-        if len(data) - position < obj_size:
+        if obj_size < 5 or end - position < obj_size:
             raise InvalidBSON("objsize too large")
-        if data[position + obj_size - 1:position + obj_size] != ZERO:
-            raise InvalidBSON("bad eoo")
-        elements = data[position + 4:position + obj_size - 1]
+        document = data[position:position + obj_size]
         position += obj_size
-        docs.append(_elements_to_dict(elements, as_class,
-                                      tz_aware, uuid_subtype))
-    return docs
+        yield _decode_document(document, as_class, tz_aware, uuid_subtype,
+                               fields, raw, type_registry, compile_re)
+
+
+def decode_file_iter(file_obj, as_class=dict, tz_aware=True,
+                     uuid_subtype=OLD_UUID_SUBTYPE, fields=None, raw=False,
+                     type_registry=None, compile_re=True):
+    """Decode BSON data from a file to multiple documents, as a generator.
+
+    Reads one document at a time, like the output of mongodump, so
+    memory use is bounded by the size of the largest document rather
+    than the size of the file.
+
+    `file_obj` can be a file object opened in binary mode, from which
+    each document is read after its 4 byte length prefix, or the path
+    of a file, which is memory mapped and decoded with
+    :func:`decode_iter`.
+
+    :Parameters:
+      - `file_obj`: a file object or the path of a file containing
+        BSON data
+      - `as_class` (optional): the class to use for the resulting
+        documents
+      - `tz_aware` (optional): if ``True``, return timezone-aware
+        :class:`~datetime.datetime` instances
+      - `fields` (optional): an iterable of key paths to decode (see
+        :func:`decode_all`)
+      - `raw` (optional): if ``True``, yield the BSON bytes of each
+        document instead of decoding it
+      - `type_registry` (optional): a
+        :class:`~bson.type_registry.TypeRegistry` whose decoders are
+        applied to the decoded values
+      - `compile_re` (optional): if ``False``, decode regular
+        expressions as :class:`~bson.regex.Regex` instances instead of
+        compiling them
+
+    .. versionadded:: 2.4
+    """
+    if isinstance(file_obj, string_types):
+        bson_file = open(file_obj, "rb")
+        try:
+            size = os.fstat(bson_file.fileno()).st_size
+            # Empty files can't be mapped. The mapping stays valid once
+            # the file is closed.
+            if size:
+                data = mmap.mmap(bson_file.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+        finally:
+            bson_file.close()
+        if size:
+            try:
+                for document in decode_iter(data, as_class, tz_aware,
+                                            uuid_subtype, fields, raw,
+                                            type_registry, compile_re):
+                    yield document
+            finally:
+                data.close()
+        return
+
+    if fields is not None:
+        fields = _fields_tree(fields)
+    while True:
+        size_data = file_obj.read(4)
+        if not size_data:
+            break
+        if len(size_data) != 4:
+            raise InvalidBSON("cut off in middle of objsize")
+        obj_size = struct.unpack("<i", size_data)[0]
+        if obj_size < 5:
+            raise InvalidBSON("objsize too small")
+        elements = file_obj.read(obj_size - 4)
+        if len(elements) != obj_size - 4:
+            raise InvalidBSON("objsize too large")
+        yield _decode_document(size_data + elements, as_class, tz_aware,
+                               uuid_subtype, fields, raw, type_registry,
+                               compile_re)
+
+
+def _decode_document(document, as_class, tz_aware,
+                     uuid_subtype, fields, raw, type_registry, compile_re):
+    """Decode a single framed document for :func:`decode_iter` and
+    :func:`decode_file_iter`.
+    """
+    if raw:
+        if document[-1:] != ZERO:
+            raise InvalidBSON("bad eoo")
+        return document
+    return _decode_all(document, as_class, tz_aware, uuid_subtype,
+                       fields, 0, type_registry, compile_re)[0]
+
+
+def _validate(data):
+    try:
+        (_, remainder) = _bson_to_dict(data, dict, True, OLD_UUID_SUBTYPE)
+        return remainder == EMPTY
+    except:
+        return False
 if _use_c:
-    decode_all = _cbson.decode_all
+    _validate = _cbson._validate
 
 
 def is_valid(bson):
@@ -525,18 +1353,19 @@ def is_valid(bson):
     :class:`str` (:class:`bytes` in python 3). Returns ``True``
     if `bson` is valid :class:`BSON`, ``False`` otherwise.
 
+    The C extension checks the structure of `bson` without decoding it,
+    and releases the GIL while checking large documents.
+
     :Parameters:
       - `bson`: the data to be validated
+
+    .. versionchanged:: 2.4
+       Doesn't decode `bson` when the C extension is available.
     """
     if not isinstance(bson, binary_type):
         raise TypeError("BSON data must be an instance "
                         "of a subclass of %s" % (binary_type.__name__,))
-
-    try:
-        (_, remainder) = _bson_to_dict(bson, dict, True, OLD_UUID_SUBTYPE)
-        return remainder == EMPTY
-    except:
-        return False
+    return _validate(bson)
 
 
 class BSON(binary_type):
@@ -544,10 +1373,14 @@ class BSON(binary_type):
     """
 
     @classmethod
-    def encode(cls, document, check_keys=False, uuid_subtype=OLD_UUID_SUBTYPE):
+    def encode(cls, document, check_keys=False,
+               uuid_subtype=OLD_UUID_SUBTYPE, type_registry=None):
         """Encode a document to a new :class:`BSON` instance.
 
         A document can be any mapping type (like :class:`dict`).
+        Documents that are already encoded, :class:`BSON` and
+        :class:`~bson.raw_bson.RawBSONDocument` instances, are copied
+        as they are; their keys are never checked.
 
         Raises :class:`TypeError` if `document` is not a mapping type,
         or contains keys that are not instances of
@@ -560,13 +1393,59 @@ class BSON(binary_type):
           - `check_keys` (optional): check if keys start with '$' or
             contain '.', raising :class:`~bson.errors.InvalidDocument` in
             either case
-
+          - `type_registry` (optional): a
+            :class:`~bson.type_registry.TypeRegistry` whose encoders are
+            used for values BSON can't otherwise encode
+
+        .. versionchanged:: 2.4
+           Added the `type_registry` parameter, and accept
+           :class:`BSON` and :class:`~bson.raw_bson.RawBSONDocument`
+           documents.
         .. versionadded:: 1.9
         """
-        return cls(_dict_to_bson(document, check_keys, uuid_subtype))
+        return cls(_dict_to_bson(document, check_keys, uuid_subtype,
+                                 True, type_registry))
 
-    def decode(self, as_class=dict,
-               tz_aware=False, uuid_subtype=OLD_UUID_SUBTYPE):
+    @classmethod
+    def encode_into(cls, documents, buf, offset=0, check_keys=False,
+                    uuid_subtype=OLD_UUID_SUBTYPE, type_registry=None):
+        """Encode documents into an existing writable buffer.
+
+        Each document in `documents` is encoded, one after the other,
+        into `buf` starting at `offset`. Returns the offset just past the
+        last document, where encoding the next documents can continue.
+
+        `buf` can be a :class:`bytearray`, which is extended if it is
+        too short, or any other writable object supporting the buffer
+        protocol, like :class:`memoryview` or :class:`mmap.mmap`.
+        Reusing one buffer saves allocating a new :class:`BSON` instance
+        per document, which :meth:`encode` has to do.
+
+        Raises :class:`ValueError` if `offset` is out of range or `buf`
+        is too small and cannot be extended. Raises the same errors as
+        :meth:`encode` if a document cannot be encoded, in which case
+        `buf` is not changed.
+
+        :Parameters:
+          - `documents`: an iterable of mapping types representing
+            documents
+          - `buf`: the writable buffer to encode into
+          - `offset` (optional): position in `buf` of the first document
+          - `check_keys` (optional): check if keys start with '$' or
+            contain '.', raising :class:`~bson.errors.InvalidDocument` in
+            either case
+          - `type_registry` (optional): a
+            :class:`~bson.type_registry.TypeRegistry` whose encoders are
+            used for values BSON can't otherwise encode
+
+        .. versionadded:: 2.4
+        """
+        return _encode_into(documents, buf, offset, check_keys,
+                            uuid_subtype, type_registry)
+
+    def decode(self, as_class=dict, tz_aware=False,
+               uuid_subtype=OLD_UUID_SUBTYPE, type_registry=None,
+               compile_re=True, binary_view=False, typed_arrays=False):
         """Decode this BSON data.
 
         The default type to use for the resultant document is
@@ -586,10 +1465,35 @@ class BSON(binary_type):
             document
           - `tz_aware` (optional): if ``True``, return timezone-aware
             :class:`~datetime.datetime` instances
-
+          - `type_registry` (optional): a
+            :class:`~bson.type_registry.TypeRegistry` whose decoders are
+            applied to the decoded values
+          - `compile_re` (optional): if ``False``, decode regular
+            expressions as :class:`~bson.regex.Regex` instances instead
+            of compiling them
+          - `binary_view` (optional): if ``True``, decode binary values
+            of subtype 0 as :class:`memoryview` slices of this data
+            instead of copying them to :class:`~bson.binary.Binary`
+            (:class:`bytes` in python 3) instances. The views keep the
+            whole data alive, and are only read-only if it is.
+            Requires Python 2.7 or later
+          - `typed_arrays` (optional): if ``True``, decode arrays whose
+            elements are all doubles as ``array.array("d")`` instances,
+            and arrays whose elements are all integers as
+            ``array.array("i")`` instances, or arrays with 8 byte items
+            if some of the integers are 64-bit. Other arrays, and empty
+            ones, are still decoded as lists. The decoders of
+            `type_registry` aren't applied to the elements of typed
+            arrays
+
+        .. versionchanged:: 2.4
+           Added the `type_registry`, `compile_re`, `binary_view` and
+           `typed_arrays` parameters.
         .. versionadded:: 1.9
         """
-        (document, _) = _bson_to_dict(self, as_class, tz_aware, uuid_subtype)
+        (document, _) = _bson_to_dict(self, as_class, tz_aware,
+                                      uuid_subtype, 0, type_registry,
+                                      compile_re, binary_view, typed_arrays)
         return document
 
 
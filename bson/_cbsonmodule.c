@@ -23,6 +23,14 @@
 #include "Python.h"
 #include "datetime.h"
 
+#include <time.h>
+#ifdef _WIN32
+#include <process.h>
+#define getpid _getpid
+#else
+#include <unistd.h>
+#endif
+
 #include "buffer.h"
 #include "time64.h"
 #include "encoding_helpers.h"
@@ -48,6 +56,13 @@ struct module_state {
     PyObject* MinKey;
     PyObject* MaxKey;
     PyObject* UTC;
+    PyObject* RawBSONDocument;
+    PyObject* Regex;
+    PyObject* CompileRegex;
+    PyObject* BSON;
+    PyObject* Array;
+    PyObject* Record;
+    PyObject* RecordMissing;
     PyTypeObject* REType;
 };
 
@@ -69,51 +84,35 @@ static struct module_state _state;
 /* Maximum number of regex flags */
 #define FLAGS_SIZE 7
 
-#if defined(WIN32) || defined(_MSC_VER)
-/* This macro is basically an implementation of asprintf for win32
- * We get the length of the int as string and malloc a buffer for it,
- * returning -1 if that malloc fails. We then actually print to the
- * buffer to get the string value as an int. Like asprintf, the result
- * must be explicitly free'd when done being used.
- */
 #if defined(_MSC_VER) && (_MSC_VER >= 1400)
-#define INT2STRING(buffer, i)                                           \
-    *(buffer) = malloc(_scprintf("%d", (i)) + 1),                       \
-        (!(buffer) ?                                                    \
-         -1 :                                                           \
-         _snprintf_s(*(buffer),                                         \
-                     _scprintf("%d", (i)) + 1,                          \
-                     _scprintf("%d", (i)) + 1,                          \
-                     "%d",                                              \
-                     (i)))
 #define STRCAT(dest, n, src) strcat_s((dest), (n), (src))
 #else
-#define INT2STRING(buffer, i)                                           \
-    *(buffer) = malloc(_scprintf("%d", (i)) + 1),                       \
-        (!(buffer) ?                                                    \
-         -1 :                                                           \
-         _snprintf(*(buffer),                                           \
-                     _scprintf("%d", (i)) + 1,                          \
-                     "%d",                                              \
-                     (i)))
-#define STRCAT(dest, n, src) strcat((dest), (src))
-#endif
-#else
-#define INT2STRING(buffer, i) asprintf((buffer), "%d", (i))
 #define STRCAT(dest, n, src) strcat((dest), (src))
 #endif
 
 #define JAVA_LEGACY   5
 #define CSHARP_LEGACY 6
 
+/* The element names of the first array indexes, encoded ahead of time
+ * by _init_index_keys. */
+#define INDEX_KEY_COUNT 1000
+static char index_keys[INDEX_KEY_COUNT][4];
+
 
 static PyObject* elements_to_dict(PyObject* self, const char* string, int max,
                                   PyObject* as_class, unsigned char tz_aware,
-                                  unsigned char uuid_subtype);
+                                  unsigned char uuid_subtype, PyObject* fields,
+                                  PyObject* decoders, unsigned char compile_re,
+                                  PyObject* views, unsigned char typed_arrays);
 
 static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_byte,
                                     PyObject* value, unsigned char check_keys,
-                                    unsigned char uuid_subtype, unsigned char first_attempt);
+                                    unsigned char uuid_subtype, unsigned char first_attempt,
+                                    PyObject* encoders);
+
+static int write_typed_array(PyObject* self, buffer_t buffer, int type_byte,
+                             PyObject* value, unsigned char check_keys,
+                             unsigned char uuid_subtype, PyObject* encoders);
 
 /* Date stuff */
 static PyObject* datetime_from_millis(long long millis) {
@@ -156,6 +155,39 @@ int buffer_write_bytes(buffer_t buffer, const char* data, int size) {
     return 1;
 }
 
+static void _release_gap(void* owner) {
+    Py_DECREF((PyObject*)owner);
+}
+
+/* Write the contents of the bytes (str) object `bytes` to `buffer`. If
+ * there are at least the buffer's gap threshold of them, they're left
+ * as a gap that references `bytes` instead of being copied.
+ *
+ * returns 0 on failure */
+static int write_bytes_object(buffer_t buffer, PyObject* bytes) {
+    int threshold = buffer_get_gap_threshold(buffer);
+#if PY_MAJOR_VERSION >= 3
+    const char* data = PyBytes_AsString(bytes);
+    Py_ssize_t size = PyBytes_Size(bytes);
+#else
+    const char* data = PyString_AsString(bytes);
+    Py_ssize_t size = PyString_Size(bytes);
+#endif
+    if (!data) {
+        return 0;
+    }
+    if (threshold && size >= threshold) {
+        Py_INCREF(bytes);
+        if (buffer_write_gap(buffer, bytes, (int)size, _release_gap)) {
+            Py_DECREF(bytes);
+            PyErr_NoMemory();
+            return 0;
+        }
+        return 1;
+    }
+    return buffer_write_bytes(buffer, data, (int)size);
+}
+
 #if PY_MAJOR_VERSION >= 3
 static int write_unicode(buffer_t buffer, PyObject* py_string) {
     Py_ssize_t string_length;
@@ -174,12 +206,12 @@ static int write_unicode(buffer_t buffer, PyObject* py_string) {
         Py_DECREF(encoded);
         return 0;
     }
-    if (!buffer_write_bytes(buffer, string, string_length)) {
+    if (!write_bytes_object(buffer, encoded)) {
         Py_DECREF(encoded);
         return 0;
     }
     Py_DECREF(encoded);
-    return 1;
+    return buffer_write_bytes(buffer, "\x00", 1);
 }
 #endif
 
@@ -208,10 +240,10 @@ static int write_string(buffer_t buffer, PyObject* py_string) {
     if (!buffer_write_bytes(buffer, (const char*)&string_length, 4)) {
         return 0;
     }
-    if (!buffer_write_bytes(buffer, string, string_length)) {
+    if (!write_bytes_object(buffer, py_string)) {
         return 0;
     }
-    return 1;
+    return buffer_write_bytes(buffer, "\x00", 1);
 }
 
 /* Get an error class from the bson.errors module.
@@ -231,6 +263,33 @@ static PyObject* _error(char* name) {
 /* Reload a cached Python object.
  *
  * Returns non-zero on failure. */
+/* Get the dict of codecs called `name` ("_encoders" or "_decoders") from
+ * `type_registry`, a bson.type_registry.TypeRegistry or None.
+ *
+ * Sets `codecs` to a borrowed reference, owned by `type_registry`, or to
+ * NULL if there are no such codecs. Returns 0 on failure. */
+static int _get_codecs(PyObject* type_registry, char* name,
+                       PyObject** codecs) {
+    PyObject* dict;
+    *codecs = NULL;
+    if (type_registry == Py_None) {
+        return 1;
+    }
+    dict = PyObject_GetAttrString(type_registry, name);
+    if (!dict || !PyDict_Check(dict)) {
+        Py_XDECREF(dict);
+        PyErr_SetString(PyExc_TypeError, "type_registry must be an "
+                        "instance of bson.type_registry.TypeRegistry");
+        return 0;
+    }
+    /* The registry never replaces its dicts, it only updates them. */
+    if (PyDict_Size(dict)) {
+        *codecs = dict;
+    }
+    Py_DECREF(dict);
+    return 1;
+}
+
 static int _reload_object(PyObject** object, char* module_name, char* object_name) {
     PyObject* module;
 
@@ -259,7 +318,13 @@ static int _reload_python_objects(PyObject* module) {
         _reload_object(&state->MinKey, "bson.min_key", "MinKey") ||
         _reload_object(&state->MaxKey, "bson.max_key", "MaxKey") ||
         _reload_object(&state->UTC, "bson.tz_util", "utc") ||
-        _reload_object(&state->RECompile, "re", "compile")) {
+        _reload_object(&state->RawBSONDocument, "bson.raw_bson", "RawBSONDocument") ||
+        _reload_object(&state->Regex, "bson.regex", "Regex") ||
+        _reload_object(&state->CompileRegex, "bson.regex", "_compile") ||
+        _reload_object(&state->RECompile, "re", "compile") ||
+        _reload_object(&state->Array, "array", "array") ||
+        _reload_object(&state->Record, "bson.record", "Record") ||
+        _reload_object(&state->RecordMissing, "bson.record", "_MISSING")) {
         return 1;
     }
     /* If we couldn't import uuid then we must be on 2.4. Just ignore. */
@@ -277,15 +342,53 @@ static int _reload_python_objects(PyObject* module) {
     return 0;
 }
 
+static void _init_index_keys(void) {
+    int i;
+    for (i = 0; i < INDEX_KEY_COUNT; i++) {
+        PyOS_snprintf(index_keys[i], sizeof(index_keys[i]), "%d", i);
+    }
+}
+
+/* Write the element name of array index `index`.
+ *
+ * returns 0 on failure */
+static int write_index_key(buffer_t buffer, int index) {
+    char name[12];
+    char* digits = name + sizeof(name) - 1;
+    if (index < INDEX_KEY_COUNT) {
+        return buffer_write_bytes(buffer, index_keys[index],
+                                  index < 10 ? 2 : index < 100 ? 3 : 4);
+    }
+    /* Faster than formatting with snprintf. */
+    *digits = 0;
+    do {
+        *--digits = (char)('0' + index % 10);
+        index /= 10;
+    } while (index);
+    return buffer_write_bytes(buffer, digits,
+                              (int)(name + sizeof(name) - digits));
+}
+
+/* Is `value` an instance of a bson.record.Record class? */
+static int _is_record(PyObject* self, PyObject* value) {
+    struct module_state *state = GETSTATE(self);
+
+    return (PyTuple_Check(value) && !PyTuple_CheckExact(value) &&
+            PyType_IsSubtype(Py_TYPE(value),
+                             (PyTypeObject*)state->Record));
+}
+
 static int write_element_to_buffer(PyObject* self, buffer_t buffer, int type_byte,
                                    PyObject* value, unsigned char check_keys,
                                    unsigned char uuid_subtype,
-                                   unsigned char first_attempt) {
+                                   unsigned char first_attempt,
+                                   PyObject* encoders) {
     int result;
     if(Py_EnterRecursiveCall(" while encoding an object to BSON "))
         return 0;
     result = _write_element_to_buffer(self, buffer, type_byte, value,
-                                      check_keys, uuid_subtype, first_attempt);
+                                      check_keys, uuid_subtype, first_attempt,
+                                      encoders);
     Py_LeaveRecursiveCall();
     return result;
 }
@@ -303,15 +406,98 @@ static int _fix_java(const char* in, char* out) {
     return 0;
 }
 
+/* Find the encoder for the type of `value`, or for the nearest of its base
+ * classes, in the dict `encoders`.
+ *
+ * Returns a borrowed reference, or NULL if there is no encoder. */
+static PyObject* _find_encoder(PyObject* encoders, PyObject* value) {
+    PyObject* mro = value->ob_type->tp_mro;
+    PyObject* encoder = PyDict_GetItem(encoders, (PyObject*)value->ob_type);
+    Py_ssize_t i;
+
+    if (encoder || !mro) {
+        return encoder;
+    }
+    for (i = 1; i < PyTuple_GET_SIZE(mro); i++) {
+        encoder = PyDict_GetItem(encoders, PyTuple_GET_ITEM(mro, i));
+        if (encoder) {
+            return encoder;
+        }
+    }
+    return NULL;
+}
+
 /* TODO our platform better be little-endian w/ 4-byte ints! */
 /* Write a single value to the buffer (also write it's type_byte, for which
  * space has already been reserved.
  *
  * returns 0 on failure */
+/* Write `document` verbatim if it is already encoded: a bson.BSON
+ * instance or a bson.raw_bson.RawBSONDocument.
+ *
+ * Returns 1 if it was written, 0 if `document` isn't encoded and -1 on
+ * failure. */
+static int write_raw_document(PyObject* self, buffer_t buffer,
+                              PyObject* document) {
+    struct module_state *state = GETSTATE(self);
+    PyObject* raw;
+    const char* data;
+    Py_ssize_t size;
+    int length;
+    int result;
+
+    /* bson.BSON is defined after this module is imported, so it's
+     * looked up on first use. */
+    if (!state->BSON && _reload_object(&state->BSON, "bson", "BSON")) {
+        return -1;
+    }
+    if (PyObject_IsInstance(document, state->RawBSONDocument)) {
+        raw = PyObject_GetAttrString(document, "raw");
+        if (!raw) {
+            return -1;
+        }
+    } else if (PyObject_IsInstance(document, state->BSON)) {
+        Py_INCREF(document);
+        raw = document;
+    } else {
+        return 0;
+    }
+#if PY_MAJOR_VERSION >= 3
+    data = PyBytes_AsString(raw);
+    size = PyBytes_Size(raw);
+#else
+    data = PyString_AsString(raw);
+    size = PyString_Size(raw);
+#endif
+    if (!data) {
+        Py_DECREF(raw);
+        return -1;
+    }
+    if (size < 5 || size > INT_MAX) {
+        length = -1;
+    } else {
+        memcpy(&length, data, 4);
+    }
+    if (length != size || data[size - 1]) {
+        PyObject* InvalidDocument = _error("InvalidDocument");
+        PyErr_SetString(InvalidDocument,
+                        "encoded document has an invalid size");
+        Py_DECREF(InvalidDocument);
+        Py_DECREF(raw);
+        return -1;
+    }
+    result = write_bytes_object(buffer, raw) ? 1 : -1;
+    Py_DECREF(raw);
+    return result;
+}
+
 static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_byte,
                                     PyObject* value, unsigned char check_keys,
-                                    unsigned char uuid_subtype, unsigned char first_attempt) {
+                                    unsigned char uuid_subtype, unsigned char first_attempt,
+                                    PyObject* encoders) {
     struct module_state *state = GETSTATE(self);
+    PyObject* encoder;
+    int written;
 
     if (PyBool_Check(value)) {
 #if PY_MAJOR_VERSION >= 3
@@ -364,9 +550,10 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
     } else if (value == Py_None) {
         *(buffer_get_buffer(buffer) + type_byte) = 0x0A;
         return 1;
-    } else if (PyDict_Check(value)) {
+    } else if (PyDict_Check(value) || _is_record(self, value)) {
         *(buffer_get_buffer(buffer) + type_byte) = 0x03;
-        return write_dict(self, buffer, value, check_keys, uuid_subtype, 0);
+        return write_dict(self, buffer, value, check_keys, uuid_subtype, 0,
+                          encoders);
     } else if (PyList_Check(value) || PyTuple_Check(value)) {
         int start_position,
             length_location,
@@ -388,26 +575,20 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
         items = PySequence_Size(value);
         for(i = 0; i < items; i++) {
             int list_type_byte = buffer_save_space(buffer, 1);
-            char* name;
             PyObject* item_value;
 
             if (list_type_byte == -1) {
                 PyErr_NoMemory();
                 return 0;
             }
-            if (INT2STRING(&name, i) < 0 || !name) {
-                PyErr_NoMemory();
-                return 0;
-            }
-            if (!buffer_write_bytes(buffer, name, strlen(name) + 1)) {
-                free(name);
+            if (!write_index_key(buffer, i)) {
                 return 0;
             }
-            free(name);
 
             item_value = PySequence_GetItem(value, i);
             if (!write_element_to_buffer(self, buffer, list_type_byte,
-                                         item_value, check_keys, uuid_subtype, 1)) {
+                                         item_value, check_keys, uuid_subtype, 1,
+                                         encoders)) {
                 Py_DECREF(item_value);
                 return 0;
             }
@@ -418,7 +599,8 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
         if (!buffer_write_bytes(buffer, &zero, 1)) {
             return 0;
         }
-        length = buffer_get_position(buffer) - start_position;
+        length = buffer_get_position(buffer) - start_position +
+            buffer_get_gap_size(buffer, start_position);
         memcpy(buffer_get_buffer(buffer) + length_location, &length, 4);
         return 1;
     } else if (PyObject_IsInstance(value, state->Binary)) {
@@ -458,18 +640,8 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
                     return 0;
                 }
             }
-            {
-#if PY_MAJOR_VERSION >= 3
-                const char* string = PyBytes_AsString(value);
-#else
-                const char* string = PyString_AsString(value);
-#endif
-                if (!string) {
-                    return 0;
-                }
-                if (!buffer_write_bytes(buffer, string, length)) {
-                    return 0;
-                }
+            if (!write_bytes_object(buffer, value)) {
+                return 0;
             }
         }
         return 1;
@@ -567,13 +739,14 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
             return 0;
         }
 
-        if (!write_dict(self, buffer, scope, 0, uuid_subtype, 0)) {
+        if (!write_dict(self, buffer, scope, 0, uuid_subtype, 0, encoders)) {
             Py_DECREF(scope);
             return 0;
         }
         Py_DECREF(scope);
 
-        length = buffer_get_position(buffer) - start_position;
+        length = buffer_get_position(buffer) - start_position +
+            buffer_get_gap_size(buffer, start_position);
         memcpy(buffer_get_buffer(buffer) + length_location, &length, 4);
         return 1;
 #if PY_MAJOR_VERSION >= 3
@@ -588,10 +761,7 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
         if (!buffer_write_bytes(buffer, &subtype, 1)) {
             return 0;
         }
-        if (!buffer_write_bytes(buffer, PyBytes_AsString(value), length)) {
-            return 0;
-        }
-        return 1;
+        return write_bytes_object(buffer, value);
 #else
     /* PyString_Check only works in Python 2.x. */
     } else if (PyString_Check(value)) {
@@ -668,7 +838,7 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
         if (!as_doc) {
             return 0;
         }
-        if (!write_dict(self, buffer, as_doc, 0, uuid_subtype, 0)) {
+        if (!write_dict(self, buffer, as_doc, 0, uuid_subtype, 0, encoders)) {
             Py_DECREF(as_doc);
             return 0;
         }
@@ -710,7 +880,8 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
         *(buffer_get_buffer(buffer) + type_byte) = 0x11;
         return 1;
     }
-    else if (PyObject_TypeCheck(value, state->REType)) {
+    else if (PyObject_TypeCheck(value, state->REType) ||
+             PyObject_IsInstance(value, state->Regex) == 1) {
         PyObject* py_flags = PyObject_GetAttrString(value, "flags");
         PyObject* py_pattern;
         PyObject* encoded_pattern;
@@ -814,6 +985,36 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
     } else if (PyObject_IsInstance(value, state->MaxKey)) {
         *(buffer_get_buffer(buffer) + type_byte) = 0x7F;
         return 1;
+    } else if (PyObject_IsInstance(value, state->RawBSONDocument)) {
+        /* An embedded document that is already encoded. */
+        *(buffer_get_buffer(buffer) + type_byte) = 0x03;
+        return write_raw_document(self, buffer, value) == 1;
+    } else if ((written = write_typed_array(self, buffer, type_byte, value,
+                                            check_keys, uuid_subtype,
+                                            encoders))) {
+        /* An array.array or NumPy array. */
+        return written == 1;
+    } else if (encoders && (encoder = _find_encoder(encoders, value))) {
+        /* An application type, encoded as the value its encoder returns. */
+        PyObject* encoded = PyObject_CallFunctionObjArgs(encoder, value, NULL);
+        int result;
+        if (!encoded) {
+            return 0;
+        }
+        if (encoded->ob_type == value->ob_type) {
+            PyObject* InvalidDocument = _error("InvalidDocument");
+            PyErr_Format(InvalidDocument, "encoder for type %s must not "
+                         "return an instance of the same type",
+                         value->ob_type->tp_name);
+            Py_DECREF(InvalidDocument);
+            Py_DECREF(encoded);
+            return 0;
+        }
+        result = write_element_to_buffer(self, buffer, type_byte, encoded,
+                                         check_keys, uuid_subtype, 1,
+                                         encoders);
+        Py_DECREF(encoded);
+        return result;
     } else if (first_attempt) {
         /* Try reloading the modules and having one more go at it. */
         if (WARN(PyExc_RuntimeWarning, "couldn't encode - reloading python "
@@ -826,7 +1027,8 @@ static int _write_element_to_buffer(PyObject* self, buffer_t buffer, int type_by
         if (_reload_python_objects(self)) {
             return 0;
         }
-        return write_element_to_buffer(self, buffer, type_byte, value, check_keys, uuid_subtype, 0);
+        return write_element_to_buffer(self, buffer, type_byte, value, check_keys, uuid_subtype, 0,
+                                       encoders);
     }
     {
         PyObject* repr = PyObject_Repr(value);
@@ -887,7 +1089,8 @@ static int check_key_name(const char* name,
  * Returns 0 on failure */
 int write_pair(PyObject* self, buffer_t buffer, const char* name, Py_ssize_t name_length,
                PyObject* value, unsigned char check_keys,
-               unsigned char uuid_subtype, unsigned char allow_id) {
+               unsigned char uuid_subtype, unsigned char allow_id,
+               PyObject* encoders) {
     int type_byte;
 
     /* Don't write any _id elements unless we're explicitly told to -
@@ -909,7 +1112,7 @@ int write_pair(PyObject* self, buffer_t buffer, const char* name, Py_ssize_t nam
         return 0;
     }
     if (!write_element_to_buffer(self, buffer, type_byte, value,
-                                 check_keys, uuid_subtype, 1)) {
+                                 check_keys, uuid_subtype, 1, encoders)) {
         return 0;
     }
     return 1;
@@ -918,7 +1121,8 @@ int write_pair(PyObject* self, buffer_t buffer, const char* name, Py_ssize_t nam
 int decode_and_write_pair(PyObject* self, buffer_t buffer,
                           PyObject* key, PyObject* value,
                           unsigned char check_keys,
-                          unsigned char uuid_subtype, unsigned char top_level) {
+                          unsigned char uuid_subtype, unsigned char top_level,
+                          PyObject* encoders) {
     PyObject* encoded;
     if (PyUnicode_Check(key)) {
         result_t status;
@@ -986,11 +1190,11 @@ int decode_and_write_pair(PyObject* self, buffer_t buffer,
 #if PY_MAJOR_VERSION >= 3
     if (!write_pair(self, buffer, PyBytes_AsString(encoded),
                     PyBytes_Size(encoded), value,
-                    check_keys, uuid_subtype, !top_level)) {
+                    check_keys, uuid_subtype, !top_level, encoders)) {
 #else
     if (!write_pair(self, buffer, PyString_AsString(encoded),
                     PyString_Size(encoded), value,
-                    check_keys, uuid_subtype, !top_level)) {
+                    check_keys, uuid_subtype, !top_level, encoders)) {
 #endif
         Py_DECREF(encoded);
         return 0;
@@ -1000,17 +1204,140 @@ int decode_and_write_pair(PyObject* self, buffer_t buffer,
     return 1;
 }
 
+/* Is the field name `key` "_id"? */
+static int _is_id(PyObject* key) {
+#if PY_MAJOR_VERSION >= 3
+    return (PyUnicode_Check(key) &&
+            PyUnicode_CompareWithASCIIString(key, "_id") == 0);
+#else
+    if (PyString_Check(key)) {
+        return (PyString_GET_SIZE(key) == 3 &&
+                memcmp(PyString_AS_STRING(key), "_id", 3) == 0);
+    }
+    return (PyUnicode_Check(key) && PyUnicode_GET_SIZE(key) == 3 &&
+            PyUnicode_AS_UNICODE(key)[0] == '_' &&
+            PyUnicode_AS_UNICODE(key)[1] == 'i' &&
+            PyUnicode_AS_UNICODE(key)[2] == 'd');
+#endif
+}
+
+/* Write the bson.record.Record `record`: the fields it has, by position,
+ * then its overflow fields.
+ *
+ * returns 0 on failure */
+static int write_record(PyObject* self, buffer_t buffer, PyObject* record,
+                        unsigned char check_keys, unsigned char uuid_subtype,
+                        unsigned char top_level, PyObject* encoders) {
+    struct module_state *state = GETSTATE(self);
+    PyObject* fields;
+    PyObject* overflow = NULL;
+    PyObject* key;
+    PyObject* value;
+    Py_ssize_t count;
+    Py_ssize_t i;
+    char zero = 0;
+    int length;
+    int length_location;
+
+    fields = PyObject_GetAttrString(record, "_fields");
+    if (!fields) {
+        return 0;
+    }
+    if (!PyTuple_Check(fields)) {
+        PyErr_SetString(PyExc_TypeError, "record _fields must be a tuple");
+        Py_DECREF(fields);
+        return 0;
+    }
+    count = PyTuple_GET_SIZE(fields);
+    if (PyTuple_GET_SIZE(record) > count &&
+        PyDict_Check(PyTuple_GET_ITEM(record, count))) {
+        overflow = PyTuple_GET_ITEM(record, count);
+    }
+
+    length_location = buffer_save_space(buffer, 4);
+    if (length_location == -1) {
+        PyErr_NoMemory();
+        Py_DECREF(fields);
+        return 0;
+    }
+
+    /* Write _id first if this is a top level doc. */
+    if (top_level) {
+        PyObject* _id = NULL;
+        for (i = 0; i < count; i++) {
+            key = PyTuple_GET_ITEM(fields, i);
+            if (_is_id(key)) {
+                if (PyTuple_GET_ITEM(record, i) != state->RecordMissing) {
+                    _id = PyTuple_GET_ITEM(record, i);
+                }
+                break;
+            }
+        }
+        if (!_id && overflow) {
+            _id = PyDict_GetItemString(overflow, "_id");
+        }
+        if (_id && !write_pair(self, buffer, "_id", 3, _id, 0,
+                               uuid_subtype, 1, encoders)) {
+            Py_DECREF(fields);
+            return 0;
+        }
+    }
+
+    for (i = 0; i < count; i++) {
+        value = PyTuple_GET_ITEM(record, i);
+        if (value == state->RecordMissing) {
+            continue;
+        }
+        if (!decode_and_write_pair(self, buffer, PyTuple_GET_ITEM(fields, i),
+                                   value, check_keys, uuid_subtype,
+                                   top_level, encoders)) {
+            Py_DECREF(fields);
+            return 0;
+        }
+    }
+    Py_DECREF(fields);
+    if (overflow) {
+        i = 0;
+        while (PyDict_Next(overflow, &i, &key, &value)) {
+            if (!decode_and_write_pair(self, buffer, key, value, check_keys,
+                                       uuid_subtype, top_level, encoders)) {
+                return 0;
+            }
+        }
+    }
+
+    /* write null byte and fill in length */
+    if (!buffer_write_bytes(buffer, &zero, 1)) {
+        return 0;
+    }
+    length = buffer_get_position(buffer) - length_location +
+        buffer_get_gap_size(buffer, length_location);
+    memcpy(buffer_get_buffer(buffer) + length_location, &length, 4);
+    return 1;
+}
+
 /* returns 0 on failure */
 int write_dict(PyObject* self, buffer_t buffer, PyObject* dict,
-               unsigned char check_keys, unsigned char uuid_subtype, unsigned char top_level) {
+               unsigned char check_keys, unsigned char uuid_subtype, unsigned char top_level,
+               PyObject* encoders) {
     PyObject* key;
     PyObject* iter;
     char zero = 0;
     int length;
     int length_location;
 
+    if (_is_record(self, dict)) {
+        return write_record(self, buffer, dict, check_keys, uuid_subtype,
+                            top_level, encoders);
+    }
     if (!PyDict_Check(dict)) {
-        PyObject* repr = PyObject_Repr(dict);
+        PyObject* repr;
+        /* Documents that are already encoded are copied verbatim. */
+        int written = write_raw_document(self, buffer, dict);
+        if (written) {
+            return written == 1;
+        }
+        repr = PyObject_Repr(dict);
 #if PY_MAJOR_VERSION >= 3
         PyObject* errmsg = PyUnicode_FromString("encoder expected a mapping type but got: ");
         PyObject* error = PyUnicode_Concat(errmsg, repr);
@@ -1038,7 +1365,8 @@ int write_dict(PyObject* self, buffer_t buffer, PyObject* dict,
         if (_id) {
             /* Don't bother checking keys, but do make sure we're allowed to
              * write _id */
-            if (!write_pair(self, buffer, "_id", 3, _id, 0, uuid_subtype, 1)) {
+            if (!write_pair(self, buffer, "_id", 3, _id, 0, uuid_subtype, 1,
+                            encoders)) {
                 return 0;
             }
         }
@@ -1057,7 +1385,8 @@ int write_dict(PyObject* self, buffer_t buffer, PyObject* dict,
             return 0;
         }
         if (!decode_and_write_pair(self, buffer, key, value,
-                                   check_keys, uuid_subtype, top_level)) {
+                                   check_keys, uuid_subtype, top_level,
+                                   encoders)) {
             Py_DECREF(key);
             Py_DECREF(iter);
             return 0;
@@ -1070,7 +1399,8 @@ int write_dict(PyObject* self, buffer_t buffer, PyObject* dict,
     if (!buffer_write_bytes(buffer, &zero, 1)) {
         return 0;
     }
-    length = buffer_get_position(buffer) - length_location;
+    length = buffer_get_position(buffer) - length_location +
+        buffer_get_gap_size(buffer, length_location);
     memcpy(buffer_get_buffer(buffer) + length_location, &length, 4);
     return 1;
 }
@@ -1081,20 +1411,26 @@ static PyObject* _cbson_dict_to_bson(PyObject* self, PyObject* args) {
     unsigned char check_keys;
     unsigned char uuid_subtype;
     unsigned char top_level = 1;
+    PyObject* type_registry = Py_None;
+    PyObject* encoders;
     buffer_t buffer;
 
-    if (!PyArg_ParseTuple(args, "Obb|b", &dict,
-                          &check_keys, &uuid_subtype, &top_level)) {
+    if (!PyArg_ParseTuple(args, "Obb|bO", &dict, &check_keys,
+                          &uuid_subtype, &top_level, &type_registry)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_encoders", &encoders)) {
         return NULL;
     }
 
-    buffer = buffer_new();
+    buffer = buffer_get_scratch();
     if (!buffer) {
         PyErr_NoMemory();
         return NULL;
     }
 
-    if (!write_dict(self, buffer, dict, check_keys, uuid_subtype, top_level)) {
+    if (!write_dict(self, buffer, dict, check_keys, uuid_subtype,
+                    top_level, encoders)) {
         buffer_free(buffer);
         return NULL;
     }
@@ -1107,78 +1443,527 @@ static PyObject* _cbson_dict_to_bson(PyObject* self, PyObject* args) {
     result = Py_BuildValue("s#", buffer_get_buffer(buffer),
                            buffer_get_position(buffer));
 #endif
-    buffer_free(buffer);
+    buffer_release(buffer);
     return result;
 }
 
-static PyObject* get_value(PyObject* self, const char* buffer, int* position,
-                           int type, int max, PyObject* as_class,
-                           unsigned char tz_aware, unsigned char uuid_subtype) {
-    struct module_state *state = GETSTATE(self);
-
-    PyObject* value;
-    PyObject* error;
-    switch (type) {
-    case 1:
-        {
-            double d;
-            if (max < 8) {
-                goto invalid;
-            }
-            memcpy(&d, buffer + *position, 8);
-            value = PyFloat_FromDouble(d);
-            if (!value) {
-                return NULL;
-            }
-            *position += 8;
-            break;
+/* Copy `size` bytes from `data` into the writable buffer `target`,
+ * starting at `offset`. A bytearray is extended if it is too short.
+ *
+ * Returns 0 on failure, with an exception set. */
+static int _copy_into(PyObject* target, int offset,
+                      const char* data, int size) {
+    Py_ssize_t dest_size;
+#if PY_VERSION_HEX >= 0x02060000
+    Py_buffer view;
+
+    if (PyByteArray_Check(target)) {
+        dest_size = PyByteArray_GET_SIZE(target);
+        if (offset < 0 || offset > dest_size) {
+            PyErr_SetString(PyExc_ValueError, "offset out of range");
+            return 0;
         }
-    case 2:
-    case 14:
-        {
-            int value_length = ((int*)(buffer + *position))[0] - 1;
-            if (max < value_length) {
-                goto invalid;
-            }
-            *position += 4;
-            value = PyUnicode_DecodeUTF8(buffer + *position, value_length, "strict");
-            if (!value) {
-                return NULL;
-            }
-            *position += value_length + 1;
-            break;
+        if (offset + size > dest_size &&
+            PyByteArray_Resize(target, offset + size) == -1) {
+            return 0;
         }
-    case 3:
-        {
-            int size;
-            memcpy(&size, buffer + *position, 4);
-            if (max < size) {
-                goto invalid;
-            }
-            value = elements_to_dict(self, buffer + *position + 4,
-                                     size - 5, as_class, tz_aware, uuid_subtype);
-            if (!value) {
-                return NULL;
+        memcpy(PyByteArray_AS_STRING(target) + offset, data, size);
+        return 1;
+    }
+    if (PyObject_CheckBuffer(target)) {
+        if (PyObject_GetBuffer(target, &view, PyBUF_WRITABLE) == -1) {
+            if (PyErr_ExceptionMatches(PyExc_BufferError)) {
+                PyErr_SetString(PyExc_TypeError,
+                                "buffer must be a writable object "
+                                "supporting the buffer protocol");
             }
+            return 0;
+        }
+        if (offset < 0 || offset + size > view.len) {
+            PyBuffer_Release(&view);
+            PyErr_SetString(PyExc_ValueError,
+                            "offset out of range or buffer too small");
+            return 0;
+        }
+        memcpy((char*)view.buf + offset, data, size);
+        PyBuffer_Release(&view);
+        return 1;
+    }
+#endif
+#if PY_MAJOR_VERSION >= 3
+    PyErr_SetString(PyExc_TypeError,
+                    "buffer must be a writable object supporting "
+                    "the buffer protocol");
+    return 0;
+#else
+    {
+        char* dest;
+        if (PyObject_AsWriteBuffer(target, (void**)&dest, &dest_size) == -1) {
+            return 0;
+        }
+        if (offset < 0 || offset + size > dest_size) {
+            PyErr_SetString(PyExc_ValueError,
+                            "offset out of range or buffer too small");
+            return 0;
+        }
+        memcpy(dest + offset, data, size);
+        return 1;
+    }
+#endif
+}
 
-            /* Decoding for DBRefs */
-            if (strcmp(buffer + *position + 5, "$ref") == 0) { /* DBRef */
-                PyObject* dbref;
-                PyObject* collection = PyDict_GetItemString(value, "$ref");
-                PyObject* id = PyDict_GetItemString(value, "$id");
-                PyObject* database = PyDict_GetItemString(value, "$db");
+static PyObject* _cbson_encode_into(PyObject* self, PyObject* args) {
+    PyObject* documents;
+    PyObject* target;
+    PyObject* iterator;
+    PyObject* document;
+    int offset;
+    int size;
+    unsigned char check_keys;
+    unsigned char uuid_subtype;
+    PyObject* type_registry = Py_None;
+    PyObject* encoders;
+    buffer_t buffer;
 
-                Py_INCREF(collection);
-                PyDict_DelItemString(value, "$ref");
-                Py_INCREF(id);
-                PyDict_DelItemString(value, "$id");
+    if (!PyArg_ParseTuple(args, "OOibb|O", &documents, &target, &offset,
+                          &check_keys, &uuid_subtype, &type_registry)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_encoders", &encoders)) {
+        return NULL;
+    }
 
-                if (database == NULL) {
-                    database = Py_None;
-                    Py_INCREF(database);
-                } else {
-                    Py_INCREF(database);
-                    PyDict_DelItemString(value, "$db");
+    iterator = PyObject_GetIter(documents);
+    if (!iterator) {
+        return NULL;
+    }
+    buffer = buffer_get_scratch();
+    if (!buffer) {
+        Py_DECREF(iterator);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    while ((document = PyIter_Next(iterator)) != NULL) {
+        if (!write_dict(self, buffer, document, check_keys, uuid_subtype, 1,
+                        encoders)) {
+            Py_DECREF(document);
+            Py_DECREF(iterator);
+            buffer_free(buffer);
+            return NULL;
+        }
+        Py_DECREF(document);
+    }
+    Py_DECREF(iterator);
+    if (PyErr_Occurred()) {
+        buffer_free(buffer);
+        return NULL;
+    }
+
+    size = buffer_get_position(buffer);
+    if (!_copy_into(target, offset, buffer_get_buffer(buffer), size)) {
+        buffer_release(buffer);
+        return NULL;
+    }
+    buffer_release(buffer);
+    return Py_BuildValue("i", offset + size);
+}
+
+/* Is `as_class` bson.raw_bson.RawBSONDocument or a subclass of it? */
+static int _raw_document_class(PyObject* self, PyObject* as_class) {
+    struct module_state *state = GETSTATE(self);
+
+    return (PyType_Check(as_class) &&
+            PyType_IsSubtype((PyTypeObject*)as_class,
+                             (PyTypeObject*)state->RawBSONDocument));
+}
+
+/* Wrap the `size` bytes of a BSON document at `string` in an instance
+ * of `as_class` (a RawBSONDocument type) without decoding them.
+ *
+ * Returns a new ref */
+static PyObject* _raw_document(const char* string, int size,
+                               PyObject* as_class, unsigned char tz_aware,
+                               unsigned char uuid_subtype,
+                               unsigned char compile_re) {
+#if PY_MAJOR_VERSION >= 3
+    return PyObject_CallFunction(as_class, "y#bbb", string, size,
+                                 tz_aware, uuid_subtype, compile_re);
+#else
+    return PyObject_CallFunction(as_class, "s#bbb", string, size,
+                                 tz_aware, uuid_subtype, compile_re);
+#endif
+}
+
+/* Get the size of the value of type `type` at `position` in `buffer`
+ * without decoding it.
+ *
+ * Returns -1 if the value is invalid or longer than `max`. */
+static int _value_size(const char* buffer, int position, int type, int max) {
+    int size;
+    switch (type) {
+    case 6:
+    case 10:
+    case -1:
+    case 127:
+        size = 0;
+        break;
+    case 8:
+        size = 1;
+        break;
+    case 16:
+        size = 4;
+        break;
+    case 1:
+    case 9:
+    case 17:
+    case 18:
+        size = 8;
+        break;
+    case 7:
+        size = 12;
+        break;
+    case 2:
+    case 13:
+    case 14:
+    case 3:
+    case 4:
+    case 15:
+    case 5:
+    case 12:
+        if (max < 4) {
+            return -1;
+        }
+        memcpy(&size, buffer + position, 4);
+        if (size < 0) {
+            return -1;
+        }
+        if (type == 5) {
+            size += 5; /* length and subtype */
+        } else if (type == 12) {
+            size += 16; /* length and ObjectId */
+        } else if (type != 3 && type != 4 && type != 15) {
+            size += 4; /* length */
+        }
+        break;
+    case 11:
+        {
+            const char* end = memchr(buffer + position, 0, max);
+            if (!end) {
+                return -1;
+            }
+            end = memchr(end + 1, 0, max - (end + 1 - (buffer + position)));
+            if (!end) {
+                return -1;
+            }
+            size = end + 1 - (buffer + position);
+            break;
+        }
+    default:
+        return -1;
+    }
+    if (size > max) {
+        return -1;
+    }
+    return size;
+}
+
+/* Find the key `name` in a tree of fields to decode (see
+ * bson._fields_tree). On success, sets `subfields` to a borrowed
+ * reference to the subtree for that key (Py_None for the entire value).
+ *
+ * Returns 1 if `name` should be decoded, 0 otherwise. */
+static int _find_field(PyObject* fields, const char* name, int name_length,
+                       PyObject** subfields) {
+    Py_ssize_t pos = 0;
+    PyObject* key;
+    PyObject* value;
+
+    while (PyDict_Next(fields, &pos, &key, &value)) {
+#if PY_MAJOR_VERSION >= 3
+        if (PyBytes_GET_SIZE(key) == name_length &&
+            memcmp(PyBytes_AS_STRING(key), name, name_length) == 0) {
+#else
+        if (PyString_GET_SIZE(key) == name_length &&
+            memcmp(PyString_AS_STRING(key), name, name_length) == 0) {
+#endif
+            *subfields = value;
+            return 1;
+        }
+    }
+    return 0;
+}
+
+/* Apply the decoder in the dict `decoders` for the type of `value`, if
+ * there is one. Steals the reference to `value`.
+ *
+ * Returns a new reference. */
+static PyObject* _decode_custom(PyObject* decoders, PyObject* value) {
+    PyObject* decoder = PyDict_GetItem(decoders, (PyObject*)value->ob_type);
+    PyObject* result;
+
+    if (!decoder) {
+        return value;
+    }
+    result = PyObject_CallFunctionObjArgs(decoder, value, NULL);
+    Py_DECREF(value);
+    return result;
+}
+
+/* Get a read-only memoryview of `obj`, which contains the data being
+ * decoded, if `binary_view` is true. Binary values are then decoded as
+ * slices of it (see _binary_view). The view is read-only even if `obj`
+ * is writable, like a bytearray a reply was received into.
+ *
+ * Returns 0 on failure. Otherwise `*views` is a new reference, or NULL
+ * if `binary_view` is false. */
+static int _get_binary_views(PyObject* obj, unsigned char binary_view,
+                             PyObject** views) {
+    *views = NULL;
+    if (!binary_view) {
+        return 1;
+    }
+#if PY_VERSION_HEX >= 0x02070000
+    *views = PyMemoryView_FromObject(obj);
+    if (!*views) {
+        return 0;
+    }
+    PyMemoryView_GET_BUFFER(*views)->readonly = 1;
+    return 1;
+#else
+    PyErr_SetString(PyExc_NotImplementedError,
+                    "binary_view requires Python 2.7 or later");
+    return 0;
+#endif
+}
+
+/* A slice of the memoryview `views` covering the `length` bytes at
+ * `data`, which must point into its buffer.
+ *
+ * Returns a new ref */
+static PyObject* _binary_view(PyObject* views, const char* data, int length) {
+#if PY_VERSION_HEX >= 0x02070000
+    Py_buffer* buffer = PyMemoryView_GET_BUFFER(views);
+    Py_ssize_t start = data - (const char*)buffer->buf;
+    PyObject* slice;
+    if (start < 0 || start + length > buffer->len) {
+        PyErr_SetString(PyExc_SystemError, "binary value outside of view");
+        return NULL;
+    }
+    /* Python 2.7 takes a slice's flags from the exporter, not from
+     * `views`. */
+    slice = PySequence_GetSlice(views, start, start + length);
+    if (slice) {
+        PyMemoryView_GET_BUFFER(slice)->readonly = 1;
+    }
+    return slice;
+#else
+    PyErr_SetString(PyExc_NotImplementedError,
+                    "binary_view requires Python 2.7 or later");
+    return NULL;
+#endif
+}
+
+/* Decode the BSON array at `buffer` as an array.array if its elements
+ * are all doubles ('d') or all integers ('i' if they're all int32, else
+ * 'l' or 'q', whichever is 8 bytes). `*result` is set to NULL if the
+ * array is empty or holds other types, and should be decoded as a list.
+ *
+ * Returns 0 on failure. */
+static int _typed_array(PyObject* self, const char* buffer, int size,
+                        PyObject** result) {
+    struct module_state *state = GETSTATE(self);
+    int position = 4;
+    int end = size - 1;
+    int kind = 0;
+    int count = 0;
+    int itemsize;
+    const char* typecode;
+    char* items;
+    PyObject* bytes;
+
+    *result = NULL;
+    if (sizeof(long) == 8) {
+        typecode = "l";
+#if PY_VERSION_HEX >= 0x03030000
+    } else if (sizeof(long long) == 8) {
+        typecode = "q";
+#endif
+    } else {
+        return 1;
+    }
+    /* Copy every element out as 8 bytes in one pass, narrowing to int32
+     * afterwards if that's all there was. The smallest int32 element
+     * (type, one character key, NUL, 4 bytes) takes 7 bytes. */
+    items = (char*)malloc(((size_t)size / 7 + 1) * 8);
+    if (!items) {
+        PyErr_NoMemory();
+        return 0;
+    }
+    while (position < end) {
+        int type = (unsigned char)buffer[position++];
+        char* item = items + (size_t)count * 8;
+        /* Anything else, even a value with no data like null, makes it
+         * a list. */
+        if (type != 0x10 && type != 0x01 && type != 0x12) {
+            goto generic;
+        }
+        while (position < end && buffer[position]) {
+            position++;
+        }
+        position++;
+        if (type == 0x10) {
+            int n;
+            long long integer;
+            if (kind == 0x01 || position + 4 > end) {
+                goto generic;
+            }
+            if (!kind) {
+                kind = 0x10;
+            }
+            memcpy(&n, buffer + position, 4);
+            integer = n;
+            memcpy(item, &integer, 8);
+            position += 4;
+        } else if (type == 0x01) {
+            if ((kind && kind != 0x01) || position + 8 > end) {
+                goto generic;
+            }
+            kind = 0x01;
+            memcpy(item, buffer + position, 8);
+            position += 8;
+        } else {
+            if (kind == 0x01 || position + 8 > end) {
+                goto generic;
+            }
+            kind = 0x12;
+            memcpy(item, buffer + position, 8);
+            position += 8;
+        }
+        count++;
+    }
+    if (!count || position != end) {
+        goto generic;
+    }
+
+    if (kind == 0x01) {
+        typecode = "d";
+        itemsize = sizeof(double);
+    } else if (kind == 0x10 && sizeof(int) == 4) {
+        int i;
+        typecode = "i";
+        itemsize = sizeof(int);
+        for (i = 0; i < count; i++) {
+            long long integer;
+            int n;
+            memcpy(&integer, items + (size_t)i * 8, 8);
+            n = (int)integer;
+            memcpy(items + (size_t)i * 4, &n, 4);
+        }
+    } else {
+        itemsize = 8;
+    }
+
+#if PY_MAJOR_VERSION >= 3
+    bytes = PyBytes_FromStringAndSize(items, (Py_ssize_t)count * itemsize);
+#else
+    bytes = PyString_FromStringAndSize(items, (Py_ssize_t)count * itemsize);
+#endif
+    free(items);
+    if (!bytes) {
+        return 0;
+    }
+    *result = PyObject_CallFunction(state->Array, "sO", typecode, bytes);
+    Py_DECREF(bytes);
+    return *result != NULL;
+
+generic:
+    free(items);
+    return 1;
+}
+
+static PyObject* get_value(PyObject* self, const char* buffer, int* position,
+                           int type, int max, PyObject* as_class,
+                           unsigned char tz_aware, unsigned char uuid_subtype,
+                           PyObject* fields, PyObject* decoders,
+                           unsigned char compile_re, PyObject* views,
+                           unsigned char typed_arrays) {
+    struct module_state *state = GETSTATE(self);
+
+    PyObject* value;
+    PyObject* error;
+    switch (type) {
+    case 1:
+        {
+            double d;
+            if (max < 8) {
+                goto invalid;
+            }
+            memcpy(&d, buffer + *position, 8);
+            value = PyFloat_FromDouble(d);
+            if (!value) {
+                return NULL;
+            }
+            *position += 8;
+            break;
+        }
+    case 2:
+    case 14:
+        {
+            int value_length = ((int*)(buffer + *position))[0] - 1;
+            if (max < value_length) {
+                goto invalid;
+            }
+            *position += 4;
+            value = PyUnicode_DecodeUTF8(buffer + *position, value_length, "strict");
+            if (!value) {
+                return NULL;
+            }
+            *position += value_length + 1;
+            break;
+        }
+    case 3:
+        {
+            int size;
+            memcpy(&size, buffer + *position, 4);
+            if (max < size) {
+                goto invalid;
+            }
+            if (_raw_document_class(self, as_class)) {
+                value = _raw_document(buffer + *position, size, as_class,
+                                      tz_aware, uuid_subtype, compile_re);
+                if (!value) {
+                    return NULL;
+                }
+                *position += size;
+                break;
+            }
+            value = elements_to_dict(self, buffer + *position + 4,
+                                     size - 5, as_class, tz_aware, uuid_subtype,
+                                     fields, decoders, compile_re, views,
+                                     typed_arrays);
+            if (!value) {
+                return NULL;
+            }
+
+            /* Decoding for DBRefs */
+            if (PyDict_Check(value) &&
+                strcmp(buffer + *position + 5, "$ref") == 0) { /* DBRef */
+                PyObject* dbref;
+                PyObject* collection = PyDict_GetItemString(value, "$ref");
+                PyObject* id = PyDict_GetItemString(value, "$id");
+                PyObject* database = PyDict_GetItemString(value, "$db");
+
+                Py_INCREF(collection);
+                PyDict_DelItemString(value, "$ref");
+                Py_INCREF(id);
+                PyDict_DelItemString(value, "$id");
+
+                if (database == NULL) {
+                    database = Py_None;
+                    Py_INCREF(database);
+                } else {
+                    Py_INCREF(database);
+                    PyDict_DelItemString(value, "$db");
                 }
 
                 dbref = PyObject_CallFunctionObjArgs(state->DBRef, collection, id, database, value, NULL);
@@ -1205,6 +1990,15 @@ static PyObject* get_value(PyObject* self, const char* buffer, int* position,
             if (max < size) {
                 goto invalid;
             }
+            if (typed_arrays && !fields) {
+                if (!_typed_array(self, buffer + *position, size, &value)) {
+                    return NULL;
+                }
+                if (value) {
+                    *position += size;
+                    break;
+                }
+            }
             end = *position + size - 1;
             *position += 4;
 
@@ -1218,8 +2012,21 @@ static PyObject* get_value(PyObject* self, const char* buffer, int* position,
                 int type = (int)buffer[(*position)++];
                 int key_size = strlen(buffer + *position);
                 *position += key_size + 1; /* just skip the key, they're in order. */
+                if (fields && type != 3 && type != 4) {
+                    /* Only embedded documents can contain the fields. */
+                    int value_size = _value_size(buffer, *position, type,
+                                                 end - *position);
+                    if (value_size == -1) {
+                        Py_DECREF(value);
+                        goto invalid;
+                    }
+                    *position += value_size;
+                    continue;
+                }
                 to_append = get_value(self, buffer, position, type,
-                                      max - key_size, as_class, tz_aware, uuid_subtype);
+                                      max - key_size, as_class, tz_aware, uuid_subtype,
+                                      fields, decoders, compile_re, views,
+                                      typed_arrays);
                 if (!to_append) {
                     return NULL;
                 }
@@ -1240,6 +2047,14 @@ static PyObject* get_value(PyObject* self, const char* buffer, int* position,
                 goto invalid;
             }
             subtype = (unsigned char)buffer[*position + 4];
+            if (views && subtype == 0) {
+                value = _binary_view(views, buffer + *position + 5, length);
+                if (!value) {
+                    return NULL;
+                }
+                *position += length + 5;
+                break;
+            }
 #if PY_MAJOR_VERSION >= 3
             /* Python3 special case. Decode BSON binary subtype 0 to bytes. */
             if (subtype == 0) {
@@ -1440,7 +2255,13 @@ static PyObject* get_value(PyObject* self, const char* buffer, int* position,
                 }
             }
             *position += flags_length + 1;
-            value = PyObject_CallFunction(state->RECompile, "Oi", pattern, flags);
+            if (compile_re) {
+                value = PyObject_CallFunction(state->CompileRegex, "Oi",
+                                              pattern, flags);
+            } else {
+                value = PyObject_CallFunction(state->Regex, "Oi",
+                                              pattern, flags);
+            }
             Py_DECREF(pattern);
             break;
         }
@@ -1511,7 +2332,8 @@ static PyObject* get_value(PyObject* self, const char* buffer, int* position,
 
             memcpy(&scope_size, buffer + *position, 4);
             scope = elements_to_dict(self, buffer + *position + 4, scope_size - 5,
-                                     (PyObject*)&PyDict_Type, tz_aware, uuid_subtype);
+                                     (PyObject*)&PyDict_Type, tz_aware, uuid_subtype,
+                                     NULL, NULL, 1, NULL, 0);
             if (!scope) {
                 Py_DECREF(code);
                 return NULL;
@@ -1588,6 +2410,9 @@ static PyObject* get_value(PyObject* self, const char* buffer, int* position,
             return NULL;
         }
     }
+    if (value && decoders) {
+        return _decode_custom(decoders, value);
+    }
     return value;
 
     invalid:
@@ -1598,211 +2423,3621 @@ static PyObject* get_value(PyObject* self, const char* buffer, int* position,
     return NULL;
 }
 
-static PyObject* elements_to_dict(PyObject* self, const char* string, int max,
-                                  PyObject* as_class, unsigned char tz_aware,
-                                  unsigned char uuid_subtype) {
-    int position = 0;
-    PyObject* dict = PyObject_CallObject(as_class, NULL);
-    if (!dict) {
-        return NULL;
-    }
-    while (position < max) {
-        PyObject* name;
-        PyObject* value;
-        int type = (int)string[position++];
-        int name_length = strlen(string + position);
-        if (position + name_length >= max) {
-            PyObject* InvalidBSON = _error("InvalidBSON");
-            PyErr_SetNone(InvalidBSON);
-            Py_DECREF(InvalidBSON);
-            return NULL;
-        }
-        name = PyUnicode_DecodeUTF8(string + position, name_length, "strict");
-        if (!name) {
-            return NULL;
-        }
-        position += name_length + 1;
-        value = get_value(self, string, &position, type,
-                          max - position, as_class, tz_aware, uuid_subtype);
-        if (!value) {
-            return NULL;
-        }
+/* A cache of the decoded names of elements.
+ *
+ * The documents in a batch usually repeat the same names, so rather than
+ * creating a new unicode object for each name of each document, the name
+ * objects are shared. The cache is a fixed size table indexed by a hash of
+ * the raw name, where each slot holds the last name that hashed to it. It
+ * is only used while holding the GIL. */
+#define NAME_CACHE_SIZE 256
+#define NAME_CACHE_MAX_LENGTH 32
+
+typedef struct {
+    int length;
+    char name[NAME_CACHE_MAX_LENGTH];
+    PyObject* value;
+} name_cache_entry_t;
 
-        PyObject_SetItem(dict, name, value);
-        Py_DECREF(name);
-        Py_DECREF(value);
-    }
-    return dict;
-}
+static name_cache_entry_t _name_cache[NAME_CACHE_SIZE];
 
-static PyObject* _cbson_bson_to_dict(PyObject* self, PyObject* args) {
-    unsigned int size;
-    Py_ssize_t total_size;
-    const char* string;
-    PyObject* bson;
-    PyObject* as_class;
-    unsigned char tz_aware;
-    unsigned char uuid_subtype;
-    PyObject* dict;
-    PyObject* remainder;
-    PyObject* result;
+/* Decode the UTF-8 element name `name`, sharing the object created with
+ * the previous elements of the same name.
+ *
+ * Returns a new reference, or NULL on failure. */
+static PyObject* _decode_name(const char* name, int length) {
+    name_cache_entry_t* entry;
+    PyObject* value;
+    unsigned int hash = 2166136261U;
+    int i;
 
-    if (!PyArg_ParseTuple(args, "OObb", &bson, &as_class, &tz_aware, &uuid_subtype)) {
-        return NULL;
+    if (length > NAME_CACHE_MAX_LENGTH) {
+        return PyUnicode_DecodeUTF8(name, length, "strict");
+    }
+    /* FNV-1a */
+    for (i = 0; i < length; i++) {
+        hash = (hash ^ (unsigned char)name[i]) * 16777619U;
+    }
+    entry = &_name_cache[hash % NAME_CACHE_SIZE];
+    if (entry->value && entry->length == length &&
+        !memcmp(entry->name, name, length)) {
+        Py_INCREF(entry->value);
+        return entry->value;
     }
 
-#if PY_MAJOR_VERSION >= 3
-    if (!PyBytes_Check(bson)) {
-        PyErr_SetString(PyExc_TypeError, "argument to _bson_to_dict must be a bytes object");
-#else
-    if (!PyString_Check(bson)) {
-        PyErr_SetString(PyExc_TypeError, "argument to _bson_to_dict must be a string");
-#endif
+    value = PyUnicode_DecodeUTF8(name, length, "strict");
+    if (!value) {
         return NULL;
     }
 #if PY_MAJOR_VERSION >= 3
-    total_size = PyBytes_Size(bson);
-#else
-    total_size = PyString_Size(bson);
+    PyUnicode_InternInPlace(&value);
 #endif
-    if (total_size < 5) {
-        PyObject* InvalidBSON = _error("InvalidBSON");
-        PyErr_SetString(InvalidBSON,
-                        "not enough data for a BSON document");
-        Py_DECREF(InvalidBSON);
-        return NULL;
-    }
+    Py_XDECREF(entry->value);
+    Py_INCREF(value);
+    entry->value = value;
+    entry->length = length;
+    memcpy(entry->name, name, length);
+    return value;
+}
 
-#if PY_MAJOR_VERSION >= 3
-    string = PyBytes_AsString(bson);
-#else
-    string = PyString_AsString(bson);
-#endif
-    if (!string) {
-        return NULL;
+/* Make an instance of the bson.record.Record class `record_class` with
+ * all of its fields missing, to be filled in by position.
+ *
+ * Sets `*index` to a new reference to the class's map of field names to
+ * positions, `*overflow` to whether it keeps other fields and
+ * `*document_class` to a new reference to the class for embedded
+ * documents.
+ *
+ * Returns a new ref, or NULL on failure */
+static PyObject* _new_record(PyObject* self, PyObject* record_class,
+                             PyObject** index, int* overflow,
+                             PyObject** document_class) {
+    struct module_state *state = GETSTATE(self);
+    PyObject* names = NULL;
+    PyObject* flag = NULL;
+    PyObject* record = NULL;
+    Py_ssize_t count;
+    Py_ssize_t i;
+
+    *index = NULL;
+    *document_class = NULL;
+    names = PyObject_GetAttrString(record_class, "_fields");
+    if (!names) {
+        goto fail;
+    }
+    *index = PyObject_GetAttrString(record_class, "_index");
+    if (!*index) {
+        goto fail;
+    }
+    if (!PyTuple_Check(names) || !PyDict_Check(*index)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "record _fields must be a tuple and _index a dict");
+        goto fail;
+    }
+    flag = PyObject_GetAttrString(record_class, "_overflow");
+    if (!flag || (*overflow = PyObject_IsTrue(flag)) == -1) {
+        goto fail;
+    }
+    *document_class = PyObject_GetAttrString(record_class,
+                                             "_document_class");
+    if (!*document_class) {
+        goto fail;
     }
-    memcpy(&size, string, 4);
 
-    if (total_size < size) {
-        PyObject* InvalidBSON = _error("InvalidBSON");
-        PyErr_SetString(InvalidBSON,
-                        "objsize too large");
-        Py_DECREF(InvalidBSON);
-        return NULL;
+    count = PyTuple_GET_SIZE(names);
+    record = ((PyTypeObject*)record_class)->tp_alloc(
+        (PyTypeObject*)record_class, count + *overflow);
+    if (!record) {
+        goto fail;
     }
+    for (i = 0; i < count; i++) {
+        Py_INCREF(state->RecordMissing);
+        PyTuple_SET_ITEM(record, i, state->RecordMissing);
+    }
+    if (*overflow) {
+        Py_INCREF(Py_None);
+        PyTuple_SET_ITEM(record, count, Py_None);
+    }
+    Py_DECREF(names);
+    Py_DECREF(flag);
+    return record;
+
+fail:
+    Py_XDECREF(names);
+    Py_XDECREF(flag);
+    Py_CLEAR(*index);
+    Py_CLEAR(*document_class);
+    return NULL;
+}
 
-    if (size != total_size || string[size - 1]) {
-        PyObject* InvalidBSON = _error("InvalidBSON");
-        PyErr_SetString(InvalidBSON,
-                        "bad eoo");
-        Py_DECREF(InvalidBSON);
-        return NULL;
+/* Set the field `name` of `record` (made by _new_record) to `value`,
+ * by position if it's one of the record's fields, else in its overflow
+ * dict.
+ *
+ * Returns 0 on failure */
+static int _set_record_field(PyObject* record, PyObject* index,
+                             PyObject* name, PyObject* value) {
+    PyObject* position = PyDict_GetItem(index, name);
+    Py_ssize_t size = PyTuple_GET_SIZE(record);
+    PyObject* overflow;
+
+    if (position) {
+        Py_ssize_t i = PyNumber_AsSsize_t(position, PyExc_IndexError);
+        if (i < 0 || i >= size) {
+            if (!PyErr_Occurred()) {
+                PyErr_SetString(PyExc_IndexError,
+                                "record field position out of range");
+            }
+            return 0;
+        }
+        Py_DECREF(PyTuple_GET_ITEM(record, i));
+        Py_INCREF(value);
+        PyTuple_SET_ITEM(record, i, value);
+        return 1;
     }
+    overflow = PyTuple_GET_ITEM(record, size - 1);
+    if (overflow == Py_None) {
+        overflow = PyDict_New();
+        if (!overflow) {
+            return 0;
+        }
+        Py_DECREF(Py_None);
+        PyTuple_SET_ITEM(record, size - 1, overflow);
+    }
+    return PyDict_SetItem(overflow, name, value) == 0;
+}
 
-    dict = elements_to_dict(self, string + 4, size - 5, as_class, tz_aware, uuid_subtype);
+/* Decode the elements in `string` to an instance of `as_class`.
+ *
+ * If `as_class` is a bson.record.Record class its fields are set by
+ * position. Other fields go to its overflow dict, or are skipped without
+ * being decoded if it doesn't keep them. Embedded documents are decoded
+ * to the record class's _document_class. */
+static PyObject* elements_to_dict(PyObject* self, const char* string, int max,
+                                  PyObject* as_class, unsigned char tz_aware,
+                                  unsigned char uuid_subtype, PyObject* fields,
+                                  PyObject* decoders, unsigned char compile_re,
+                                  PyObject* views, unsigned char typed_arrays) {
+    struct module_state *state = GETSTATE(self);
+    int position = 0;
+    PyObject* dict;
+    PyObject* index = NULL;
+    PyObject* document_class = NULL;
+    int overflow = 1;
+
+    if (PyType_Check(as_class) &&
+        PyType_IsSubtype((PyTypeObject*)as_class,
+                         (PyTypeObject*)state->Record)) {
+        dict = _new_record(self, as_class, &index, &overflow,
+                           &document_class);
+        as_class = document_class;
+    } else {
+        dict = PyObject_CallObject(as_class, NULL);
+    }
     if (!dict) {
         return NULL;
     }
-#if PY_MAJOR_VERSION >= 3
-    remainder = PyBytes_FromStringAndSize(string + size, total_size - size);
-#else
-    remainder = PyString_FromStringAndSize(string + size, total_size - size);
-#endif
-    if (!remainder) {
-        Py_DECREF(dict);
-        return NULL;
+    while (position < max) {
+        PyObject* name;
+        PyObject* value;
+        PyObject* subfields = NULL;
+        int type = (int)string[position++];
+        int name_length = strlen(string + position);
+        if (position + name_length >= max) {
+            goto invalid;
+        }
+        if (fields) {
+            /* Skip elements that aren't wanted without decoding them. */
+            if (!_find_field(fields, string + position, name_length,
+                             &subfields) ||
+                (subfields != Py_None && type != 3 && type != 4)) {
+                goto skip;
+            }
+            if (subfields == Py_None) {
+                subfields = NULL;
+            }
+        }
+        name = _decode_name(string + position, name_length);
+        if (!name) {
+            goto fail;
+        }
+        if (index && !overflow && !PyDict_GetItem(index, name)) {
+            /* Not a field of the record, which doesn't keep others. */
+            Py_DECREF(name);
+            goto skip;
+        }
+        position += name_length + 1;
+        value = get_value(self, string, &position, type,
+                          max - position, as_class, tz_aware, uuid_subtype,
+                          subfields, decoders, compile_re, views,
+                          typed_arrays);
+        if (!value) {
+            Py_DECREF(name);
+            goto fail;
+        }
+
+        if (index) {
+            if (!_set_record_field(dict, index, name, value)) {
+                Py_DECREF(name);
+                Py_DECREF(value);
+                goto fail;
+            }
+        } else {
+            PyObject_SetItem(dict, name, value);
+        }
+        Py_DECREF(name);
+        Py_DECREF(value);
+        continue;
+
+    skip:
+        {
+            int value_size;
+            position += name_length + 1;
+            value_size = _value_size(string, position, type,
+                                     max - position);
+            if (value_size == -1) {
+                goto invalid;
+            }
+            position += value_size;
+        }
     }
-    result = Py_BuildValue("OO", dict, remainder);
+    Py_XDECREF(index);
+    Py_XDECREF(document_class);
+    return dict;
+
+invalid:
+    {
+        PyObject* InvalidBSON = _error("InvalidBSON");
+        PyErr_SetNone(InvalidBSON);
+        Py_DECREF(InvalidBSON);
+    }
+fail:
+    Py_XDECREF(index);
+    Py_XDECREF(document_class);
     Py_DECREF(dict);
-    Py_DECREF(remainder);
-    return result;
+    return NULL;
 }
 
-static PyObject* _cbson_decode_all(PyObject* self, PyObject* args) {
-    unsigned int size;
-    Py_ssize_t total_size;
+/* A read-only view of the contents of an object supporting the buffer
+ * protocol: bytes (str), bytearray, memoryview, mmap, buffer...
+ *
+ * Decoding straight from the view saves copying the data to a new bytes
+ * object first (e.g. slicing the header off of a reply from the server). */
+typedef struct {
     const char* string;
-    PyObject* bson;
-    PyObject* dict;
-    PyObject* result;
-    PyObject* as_class = (PyObject*)&PyDict_Type;
-    unsigned char tz_aware = 1;
-    unsigned char uuid_subtype = 3;
+    Py_ssize_t size;
+#if PY_VERSION_HEX >= 0x02060000
+    Py_buffer view;
+#endif
+} bson_view_t;
 
-    if (!PyArg_ParseTuple(args, "O|Obb", &bson, &as_class, &tz_aware, &uuid_subtype)) {
-        return NULL;
+static void _release_view(bson_view_t* view) {
+#if PY_VERSION_HEX >= 0x02060000
+    if (view->view.obj) {
+        PyBuffer_Release(&view->view);
     }
-
-#if PY_MAJOR_VERSION >= 3
-    if (!PyBytes_Check(bson)) {
-        PyErr_SetString(PyExc_TypeError, "argument to decode_all must be a bytes object");
-#else
-    if (!PyString_Check(bson)) {
-        PyErr_SetString(PyExc_TypeError, "argument to decode_all must be a string");
 #endif
-        return NULL;
+}
+
+/* Fill `view` with the contents of `obj`, starting at `offset`.
+ *
+ * Returns 0 on failure, with an exception set. On success,
+ * _release_view must be called once the view is no longer used. */
+static int _get_view(PyObject* obj, int offset,
+                     bson_view_t* view, const char* function) {
+    /* Text supports the buffer protocol in Python 2, but doesn't
+     * contain BSON. */
+    if (PyUnicode_Check(obj)) {
+        goto type_error;
     }
+#if PY_VERSION_HEX >= 0x02060000
+    view->view.obj = NULL;
+    if (PyObject_CheckBuffer(obj)) {
+        if (PyObject_GetBuffer(obj, &view->view, PyBUF_SIMPLE) == -1) {
+            return 0;
+        }
+        view->string = (const char*)view->view.buf;
+        view->size = view->view.len;
+    } else
+#endif
+    {
 #if PY_MAJOR_VERSION >= 3
-    total_size = PyBytes_Size(bson);
-    string = PyBytes_AsString(bson);
+        goto type_error;
 #else
-    total_size = PyString_Size(bson);
-    string = PyString_AsString(bson);
+        const void* string;
+        if (!PyObject_CheckReadBuffer(obj)) {
+            goto type_error;
+        }
+        if (PyObject_AsReadBuffer(obj, &string, &view->size) == -1) {
+            return 0;
+        }
+        view->string = (const char*)string;
 #endif
-    if (!string) {
-        return NULL;
     }
+    if (offset < 0 || offset > view->size) {
+        _release_view(view);
+        PyErr_SetString(PyExc_ValueError, "offset out of range");
+        return 0;
+    }
+    view->string += offset;
+    view->size -= offset;
+    return 1;
 
-    result = PyList_New(0);
-
-    while (total_size > 0) {
-        if (total_size < 5) {
-            PyObject* InvalidBSON = _error("InvalidBSON");
-            PyErr_SetString(InvalidBSON,
-                            "not enough data for a BSON document");
-            Py_DECREF(InvalidBSON);
-            return NULL;
-        }
+type_error:
+    PyErr_Format(PyExc_TypeError, "argument to %s must support the "
+                 "buffer protocol (e.g. bytes, bytearray or memoryview)",
+                 function);
+    return 0;
+}
 
-        memcpy(&size, string, 4);
+/* Get the attribute `name` of `obj`, a single character string (like an
+ * array typecode), in `*c`. `*c` is set to 0 if the attribute isn't a
+ * single character.
+ *
+ * Returns 0 on failure. */
+static int _get_char_attribute(PyObject* obj, const char* name, char* c) {
+    PyObject* attribute = PyObject_GetAttrString(obj, name);
+    PyObject* bytes;
 
-        if (total_size < size) {
-            PyObject* InvalidBSON = _error("InvalidBSON");
-            PyErr_SetString(InvalidBSON,
-                            "objsize too large");
-            Py_DECREF(InvalidBSON);
-            return NULL;
+    *c = 0;
+    if (!attribute) {
+        return 0;
+    }
+    if (PyUnicode_Check(attribute)) {
+        bytes = PyUnicode_AsASCIIString(attribute);
+        Py_DECREF(attribute);
+        if (!bytes) {
+            PyErr_Clear();
+            return 1;
         }
+    } else {
+        bytes = attribute;
+    }
+#if PY_MAJOR_VERSION >= 3
+    if (PyBytes_Check(bytes) && PyBytes_Size(bytes) == 1) {
+        *c = PyBytes_AsString(bytes)[0];
+    }
+#else
+    if (PyString_Check(bytes) && PyString_Size(bytes) == 1) {
+        *c = PyString_AsString(bytes)[0];
+    }
+#endif
+    Py_DECREF(bytes);
+    return 1;
+}
 
-        if (string[size - 1]) {
-            PyObject* InvalidBSON = _error("InvalidBSON");
-            PyErr_SetString(InvalidBSON,
-                            "bad eoo");
-            Py_DECREF(InvalidBSON);
-            return NULL;
-        }
+/* Get the typecode of the NumPy array `value` in `*typecode`, or 0 if
+ * its elements can't be read straight from its buffer: it has more than
+ * one dimension, isn't contiguous or isn't in native byte order.
+ *
+ * Returns 0 on failure. */
+static int _ndarray_typecode(PyObject* value, char* typecode) {
+    PyObject* attribute;
+    PyObject* flags;
+    PyObject* dtype;
+    Py_ssize_t ndim;
+    int contiguous;
+    char byteorder;
+
+    *typecode = 0;
+    attribute = PyObject_GetAttrString(value, "ndim");
+    if (!attribute) {
+        return 0;
+    }
+    ndim = PyNumber_AsSsize_t(attribute, NULL);
+    Py_DECREF(attribute);
+    if (ndim == -1 && PyErr_Occurred()) {
+        return 0;
+    }
+    flags = PyObject_GetAttrString(value, "flags");
+    if (!flags) {
+        return 0;
+    }
+    attribute = PyObject_GetAttrString(flags, "c_contiguous");
+    Py_DECREF(flags);
+    if (!attribute) {
+        return 0;
+    }
+    contiguous = PyObject_IsTrue(attribute);
+    Py_DECREF(attribute);
+    if (contiguous == -1) {
+        return 0;
+    }
+    if (ndim != 1 || !contiguous) {
+        return 1;
+    }
+    dtype = PyObject_GetAttrString(value, "dtype");
+    if (!dtype) {
+        return 0;
+    }
+    if (!_get_char_attribute(dtype, "byteorder", &byteorder) ||
+        !_get_char_attribute(dtype, "char", typecode)) {
+        Py_DECREF(dtype);
+        return 0;
+    }
+    Py_DECREF(dtype);
+    if (byteorder != '=' && byteorder != '|') {
+        *typecode = 0;
+    }
+    return 1;
+}
 
-        dict = elements_to_dict(self, string + 4, size - 5,
-                                as_class, tz_aware, uuid_subtype);
-        if (!dict) {
-            return NULL;
-        }
-        PyList_Append(result, dict);
-        Py_DECREF(dict);
-        string += size;
-        total_size -= size;
+/* The size of the elements of arrays with typecode `typecode`, or 0 if
+ * write_typed_array doesn't read them itself. */
+static int _typecode_size(char typecode) {
+    switch (typecode) {
+    case 'b':
+    case 'B':
+        return 1;
+    case 'h':
+    case 'H':
+        return sizeof(short);
+    case 'i':
+    case 'I':
+        return sizeof(int);
+    case 'l':
+    case 'L':
+        return sizeof(long);
+    case 'q':
+    case 'Q':
+        return sizeof(long long);
+    case 'f':
+        return sizeof(float);
+    case 'd':
+        return sizeof(double);
+    default:
+        return 0;
     }
+}
+
+/* Write the elements of the buffer of a typed array, with `typecode`,
+ * as the elements of a BSON array. Integers are written as int32 if
+ * they fit and int64 otherwise, floating point numbers as doubles, just
+ * like the elements of a list.
+ *
+ * returns 0 on failure */
+static int _write_array_elements(buffer_t buffer, const char* items,
+                                 int count, char typecode) {
+    int itemsize = _typecode_size(typecode);
+    int i;
+
+    for (i = 0; i < count; i++) {
+        const char* item = items + (Py_ssize_t)i * itemsize;
+        long long integer;
+        unsigned long long unsigned_integer = 0;
+        char type;
 
+        switch (typecode) {
+        case 'f':
+        case 'd':
+            {
+                double d;
+                if (typecode == 'f') {
+                    float f;
+                    memcpy(&f, item, sizeof(float));
+                    d = f;
+                } else {
+                    memcpy(&d, item, sizeof(double));
+                }
+                type = 0x01;
+                if (!buffer_write_bytes(buffer, &type, 1) ||
+                    !write_index_key(buffer, i) ||
+                    !buffer_write_bytes(buffer, (const char*)&d, 8)) {
+                    return 0;
+                }
+                continue;
+            }
+        case 'b':
+            integer = *(const signed char*)item;
+            break;
+        case 'B':
+            integer = *(const unsigned char*)item;
+            break;
+        case 'h':
+            {
+                short h;
+                memcpy(&h, item, sizeof(short));
+                integer = h;
+                break;
+            }
+        case 'H':
+            {
+                unsigned short h;
+                memcpy(&h, item, sizeof(unsigned short));
+                integer = h;
+                break;
+            }
+        case 'i':
+            {
+                int n;
+                memcpy(&n, item, sizeof(int));
+                integer = n;
+                break;
+            }
+        case 'I':
+            {
+                unsigned int n;
+                memcpy(&n, item, sizeof(unsigned int));
+                integer = n;
+                break;
+            }
+        case 'l':
+            {
+                long n;
+                memcpy(&n, item, sizeof(long));
+                integer = n;
+                break;
+            }
+        case 'L':
+            {
+                unsigned long n;
+                memcpy(&n, item, sizeof(unsigned long));
+                unsigned_integer = n;
+                integer = (long long)n;
+                break;
+            }
+        case 'q':
+            memcpy(&integer, item, sizeof(long long));
+            break;
+        default: /* 'Q' */
+            memcpy(&unsigned_integer, item, sizeof(unsigned long long));
+            integer = (long long)unsigned_integer;
+            break;
+        }
+        if (unsigned_integer > (unsigned long long)LLONG_MAX) {
+            PyErr_SetString(PyExc_OverflowError,
+                            "MongoDB can only handle up to 8-byte ints");
+            return 0;
+        }
+        if (integer >= INT_MIN && integer <= INT_MAX) {
+            int int_value = (int)integer;
+            type = 0x10;
+            if (!buffer_write_bytes(buffer, &type, 1) ||
+                !write_index_key(buffer, i) ||
+                !buffer_write_bytes(buffer, (const char*)&int_value, 4)) {
+                return 0;
+            }
+        } else {
+            type = 0x12;
+            if (!buffer_write_bytes(buffer, &type, 1) ||
+                !write_index_key(buffer, i) ||
+                !buffer_write_bytes(buffer, (const char*)&integer, 8)) {
+                return 0;
+            }
+        }
+    }
+    return 1;
+}
+
+/* Write `value` as a BSON array if it's an array.array or, if NumPy has
+ * been imported, a NumPy array. Numeric elements are read straight from
+ * the array's buffer. Other arrays are written as their tolist().
+ *
+ * Returns 1 if it was written, 0 if `value` isn't such an array and -1
+ * on failure. */
+static int write_typed_array(PyObject* self, buffer_t buffer, int type_byte,
+                             PyObject* value, unsigned char check_keys,
+                             unsigned char uuid_subtype, PyObject* encoders) {
+    struct module_state *state = GETSTATE(self);
+    PyObject* numpy;
+    char typecode;
+    int is_array;
+    bson_view_t view;
+    int length_location;
+    int length;
+    int status;
+    char zero = 0;
+
+    is_array = PyObject_IsInstance(value, state->Array);
+    if (is_array == -1) {
+        return -1;
+    }
+    if (is_array) {
+        if (!_get_char_attribute(value, "typecode", &typecode)) {
+            return -1;
+        }
+    } else {
+        /* NumPy isn't a dependency: if it hasn't been imported there
+         * can't be any NumPy arrays. */
+        PyObject* ndarray;
+        numpy = PyDict_GetItemString(PyImport_GetModuleDict(), "numpy");
+        if (!numpy || numpy == Py_None) {
+            return 0;
+        }
+        ndarray = PyObject_GetAttrString(numpy, "ndarray");
+        if (!ndarray) {
+            PyErr_Clear();
+            return 0;
+        }
+        is_array = PyObject_IsInstance(value, ndarray);
+        Py_DECREF(ndarray);
+        if (is_array != 1) {
+            return is_array;
+        }
+        if (!_ndarray_typecode(value, &typecode)) {
+            return -1;
+        }
+    }
+
+    if (!_typecode_size(typecode)) {
+        PyObject* list = PyObject_CallMethod(value, "tolist", NULL);
+        if (!list) {
+            return -1;
+        }
+        status = write_element_to_buffer(self, buffer, type_byte, list,
+                                         check_keys, uuid_subtype, 1,
+                                         encoders);
+        Py_DECREF(list);
+        return status ? 1 : -1;
+    }
+
+    if (!_get_view(value, 0, &view, "encode")) {
+        return -1;
+    }
+    *(buffer_get_buffer(buffer) + type_byte) = 0x04;
+    length_location = buffer_save_space(buffer, 4);
+    if (length_location == -1) {
+        _release_view(&view);
+        PyErr_NoMemory();
+        return -1;
+    }
+    status = _write_array_elements(buffer, view.string,
+                                   (int)(view.size / _typecode_size(typecode)),
+                                   typecode);
+    _release_view(&view);
+    if (!status || !buffer_write_bytes(buffer, &zero, 1)) {
+        return -1;
+    }
+    length = buffer_get_position(buffer) - length_location;
+    memcpy(buffer_get_buffer(buffer) + length_location, &length, 4);
+    return 1;
+}
+
+static PyObject* _cbson_bson_to_dict(PyObject* self, PyObject* args) {
+    unsigned int size;
+    Py_ssize_t total_size;
+    const char* string;
+    PyObject* bson;
+    PyObject* as_class;
+    unsigned char tz_aware;
+    unsigned char uuid_subtype;
+    int offset = 0;
+    PyObject* type_registry = Py_None;
+    unsigned char compile_re = 1;
+    unsigned char binary_view = 0;
+    unsigned char typed_arrays = 0;
+    PyObject* decoders;
+    PyObject* views;
+    bson_view_t view;
+    PyObject* dict;
+    PyObject* remainder;
+    PyObject* result = NULL;
+
+    if (!PyArg_ParseTuple(args, "OObb|iObbb", &bson, &as_class, &tz_aware,
+                          &uuid_subtype, &offset, &type_registry,
+                          &compile_re, &binary_view, &typed_arrays)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_decoders", &decoders)) {
+        return NULL;
+    }
+    if (!_get_view(bson, offset, &view, "_bson_to_dict")) {
+        return NULL;
+    }
+    if (!_get_binary_views(bson, binary_view, &views)) {
+        _release_view(&view);
+        return NULL;
+    }
+    string = view.string;
+    total_size = view.size;
+
+    if (total_size < 5) {
+        PyObject* InvalidBSON = _error("InvalidBSON");
+        PyErr_SetString(InvalidBSON,
+                        "not enough data for a BSON document");
+        Py_DECREF(InvalidBSON);
+        goto done;
+    }
+
+    memcpy(&size, string, 4);
+
+    if (total_size < size) {
+        PyObject* InvalidBSON = _error("InvalidBSON");
+        PyErr_SetString(InvalidBSON,
+                        "objsize too large");
+        Py_DECREF(InvalidBSON);
+        goto done;
+    }
+
+    if (size != total_size || string[size - 1]) {
+        PyObject* InvalidBSON = _error("InvalidBSON");
+        PyErr_SetString(InvalidBSON,
+                        "bad eoo");
+        Py_DECREF(InvalidBSON);
+        goto done;
+    }
+
+    if (_raw_document_class(self, as_class)) {
+        dict = _raw_document(string, size, as_class, tz_aware, uuid_subtype,
+                             compile_re);
+    } else {
+        dict = elements_to_dict(self, string + 4, size - 5,
+                                as_class, tz_aware, uuid_subtype, NULL,
+                                decoders, compile_re, views,
+                                typed_arrays);
+    }
+    if (!dict) {
+        goto done;
+    }
+#if PY_MAJOR_VERSION >= 3
+    remainder = PyBytes_FromStringAndSize(string + size, total_size - size);
+#else
+    remainder = PyString_FromStringAndSize(string + size, total_size - size);
+#endif
+    if (!remainder) {
+        Py_DECREF(dict);
+        goto done;
+    }
+    result = Py_BuildValue("OO", dict, remainder);
+    Py_DECREF(dict);
+    Py_DECREF(remainder);
+done:
+    Py_XDECREF(views);
+    _release_view(&view);
+    return result;
+}
+
+static PyObject* _cbson_element_to_dict(PyObject* self, PyObject* args) {
+    int position;
+    int name_length;
+    int type;
+    Py_ssize_t total_size;
+    const char* string;
+    PyObject* bson;
+    PyObject* as_class;
+    unsigned char tz_aware;
+    unsigned char uuid_subtype;
+    PyObject* type_registry = Py_None;
+    unsigned char compile_re = 1;
+    PyObject* decoders;
+    PyObject* name;
+    PyObject* value;
+    PyObject* result;
+
+    if (!PyArg_ParseTuple(args, "OiObb|Ob", &bson, &position, &as_class,
+                          &tz_aware, &uuid_subtype, &type_registry,
+                          &compile_re)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_decoders", &decoders)) {
+        return NULL;
+    }
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyBytes_Check(bson)) {
+        PyErr_SetString(PyExc_TypeError, "argument to _element_to_dict must be a bytes object");
+#else
+    if (!PyString_Check(bson)) {
+        PyErr_SetString(PyExc_TypeError, "argument to _element_to_dict must be a string");
+#endif
+        return NULL;
+    }
+#if PY_MAJOR_VERSION >= 3
+    total_size = PyBytes_Size(bson);
+    string = PyBytes_AsString(bson);
+#else
+    total_size = PyString_Size(bson);
+    string = PyString_AsString(bson);
+#endif
+    if (!string) {
+        return NULL;
+    }
+
+    /* The document's trailing null byte bounds the element. */
+    if (position < 0 || position >= total_size - 1) {
+        PyObject* InvalidBSON = _error("InvalidBSON");
+        PyErr_SetString(InvalidBSON, "element position out of range");
+        Py_DECREF(InvalidBSON);
+        return NULL;
+    }
+    type = (int)string[position++];
+    name_length = strlen(string + position);
+    if (position + name_length >= total_size - 1) {
+        PyObject* InvalidBSON = _error("InvalidBSON");
+        PyErr_SetNone(InvalidBSON);
+        Py_DECREF(InvalidBSON);
+        return NULL;
+    }
+    name = _decode_name(string + position, name_length);
+    if (!name) {
+        return NULL;
+    }
+    position += name_length + 1;
+    value = get_value(self, string, &position, type,
+                      total_size - 1 - position, as_class,
+                      tz_aware, uuid_subtype, NULL, decoders, compile_re,
+                      NULL, 0);
+    if (!value) {
+        Py_DECREF(name);
+        return NULL;
+    }
+
+    result = Py_BuildValue("OOi", name, value, position);
+    Py_DECREF(name);
+    Py_DECREF(value);
+    return result;
+}
+
+/* Structural validation of BSON data.
+ *
+ * These functions don't touch any Python objects, so they are called
+ * with the GIL released: other threads keep running while a large reply
+ * is validated, and the documents are only built once it is known to be
+ * valid. Each returns -1 and sets `error` to a message for InvalidBSON
+ * if the data is invalid. */
+
+/* Data at least this large is validated with the GIL released. Below
+ * that, releasing and reacquiring the GIL costs more than it saves. */
+#define GIL_RELEASE_SIZE 4096
+
+/* Whether the GIL can be released while reading `view`, of `obj`.
+ *
+ * The data has to stay where it is: bytes are immutable, and while an
+ * object is exported through the new buffer protocol it can't be freed
+ * or resized, nor an mmap closed. Old-style buffers, like an mmap in
+ * Python 2, aren't pinned. If `immutable` is true the contents must not
+ * change either (bytes, or read-only exports), because the caller uses
+ * them afterwards without checking them again. */
+static int _can_release_gil(PyObject* obj, bson_view_t* view,
+                            int immutable) {
+#if PY_MAJOR_VERSION >= 3
+    if (PyBytes_CheckExact(obj)) {
+        return 1;
+    }
+#else
+    if (PyString_CheckExact(obj)) {
+        return 1;
+    }
+#endif
+#if PY_VERSION_HEX >= 0x02060000
+    if (view->view.obj) {
+        return !immutable || view->view.readonly;
+    }
+#endif
+    return 0;
+}
+
+static int _validate_document(const char* string, Py_ssize_t max,
+                              int check_utf8, const char** error);
+
+/* Validate the C string at `string`.
+ *
+ * Returns its size, including the trailing null byte. */
+static int _validate_cstring(const char* string, int max,
+                             int check_utf8, const char** error) {
+    const char* end = memchr(string, 0, max);
+    if (!end) {
+        *error = "invalid C string";
+        return -1;
+    }
+    if (check_utf8 && check_string((const unsigned char*)string,
+                                   (int)(end - string), 1, 0) != VALID) {
+        *error = "invalid UTF-8 in C string";
+        return -1;
+    }
+    return (int)(end - string) + 1;
+}
+
+/* Validate the length-prefixed string at `string`.
+ *
+ * Returns its size, including the length. */
+static int _validate_string(const char* string, int max,
+                            int check_utf8, const char** error) {
+    int length;
+    if (max < 5) {
+        *error = "invalid string length";
+        return -1;
+    }
+    memcpy(&length, string, 4);
+    if (length < 1 || length > max - 4 || string[4 + length - 1]) {
+        *error = "invalid string length";
+        return -1;
+    }
+    if (check_utf8 && check_string((const unsigned char*)string + 4,
+                                   length - 1, 1, 0) != VALID) {
+        *error = "invalid UTF-8 in string";
+        return -1;
+    }
+    return length + 4;
+}
+
+/* Validate the value of type `type` at `string`.
+ *
+ * Returns its size. */
+static int _validate_value(const char* string, int type, int max,
+                           int check_utf8, const char** error) {
+    int size;
+    switch (type) {
+    case 6:
+    case 10:
+    case -1:
+    case 127:
+        size = 0;
+        break;
+    case 8:
+        size = 1;
+        break;
+    case 16:
+        size = 4;
+        break;
+    case 1:
+    case 9:
+    case 17:
+    case 18:
+        size = 8;
+        break;
+    case 7:
+        size = 12;
+        break;
+    case 2:
+    case 13:
+    case 14:
+        return _validate_string(string, max, check_utf8, error);
+    case 3:
+    case 4:
+        return _validate_document(string, max, check_utf8, error);
+    case 5:
+        {
+            int length;
+            if (max < 5) {
+                *error = "invalid binary length";
+                return -1;
+            }
+            memcpy(&length, string, 4);
+            if (length < 0 || length > max - 5) {
+                *error = "invalid binary length";
+                return -1;
+            }
+            if (string[4] == 2) {
+                int length2;
+                if (length < 4) {
+                    *error = "invalid binary length";
+                    return -1;
+                }
+                memcpy(&length2, string + 5, 4);
+                if (length2 != length - 4) {
+                    *error = "invalid binary (st 2) - lengths don't match!";
+                    return -1;
+                }
+            }
+            return length + 5;
+        }
+    case 11:
+        {
+            int pattern_size = _validate_cstring(string, max,
+                                                 check_utf8, error);
+            int flags_size;
+            if (pattern_size == -1) {
+                return -1;
+            }
+            flags_size = _validate_cstring(string + pattern_size,
+                                           max - pattern_size,
+                                           check_utf8, error);
+            if (flags_size == -1) {
+                return -1;
+            }
+            return pattern_size + flags_size;
+        }
+    case 12:
+        {
+            int collection_size = _validate_string(string, max,
+                                                   check_utf8, error);
+            if (collection_size == -1) {
+                return -1;
+            }
+            size = collection_size + 12;
+            break;
+        }
+    case 15:
+        {
+            int total_size,
+                code_size,
+                scope_size;
+            if (max < 4) {
+                *error = "invalid code with scope length";
+                return -1;
+            }
+            memcpy(&total_size, string, 4);
+            if (total_size < 14 || total_size > max) {
+                *error = "invalid code with scope length";
+                return -1;
+            }
+            code_size = _validate_string(string + 4, total_size - 4,
+                                         check_utf8, error);
+            if (code_size == -1) {
+                return -1;
+            }
+            scope_size = _validate_document(string + 4 + code_size,
+                                            total_size - 4 - code_size,
+                                            check_utf8, error);
+            if (scope_size == -1) {
+                return -1;
+            }
+            if (4 + code_size + scope_size != total_size) {
+                *error = "invalid code with scope length";
+                return -1;
+            }
+            return total_size;
+        }
+    default:
+        *error = "invalid element type";
+        return -1;
+    }
+    if (size > max) {
+        *error = "bad element size";
+        return -1;
+    }
+    return size;
+}
+
+/* Validate the document at `string`, which is at most `max` bytes long.
+ * The UTF-8 of strings is only validated if `check_utf8` is true.
+ *
+ * Returns the size of the document. */
+static int _validate_document(const char* string, Py_ssize_t max,
+                              int check_utf8, const char** error) {
+    int size;
+    int position = 4;
+    if (max < 5) {
+        *error = "not enough data for a BSON document";
+        return -1;
+    }
+    memcpy(&size, string, 4);
+    if (size < 5 || size > max) {
+        *error = "objsize too large";
+        return -1;
+    }
+    if (string[size - 1]) {
+        *error = "bad eoo";
+        return -1;
+    }
+    while (position < size - 1) {
+        int type = (int)string[position++];
+        int name_size = _validate_cstring(string + position,
+                                          size - 1 - position,
+                                          check_utf8, error);
+        int value_size;
+        if (name_size == -1) {
+            return -1;
+        }
+        position += name_size;
+        value_size = _validate_value(string + position, type,
+                                     size - 1 - position,
+                                     check_utf8, error);
+        if (value_size == -1) {
+            return -1;
+        }
+        position += value_size;
+    }
+    return size;
+}
+
+/* Validate the concatenated documents in `string` and write the offset
+ * of each of them to `offsets`, as a Py_ssize_t.
+ *
+ * Returns the number of documents, or -1 with `error` set to a message
+ * for InvalidBSON, or to NULL if `offsets` couldn't grow (it has then
+ * been freed). */
+static int _frame_documents(const char* string, Py_ssize_t total_size,
+                            int check_utf8, buffer_t offsets,
+                            const char** error) {
+    Py_ssize_t position = 0;
+    int count = 0;
+    while (position < total_size) {
+        int size = _validate_document(string + position,
+                                      total_size - position,
+                                      check_utf8, error);
+        if (size == -1) {
+            return -1;
+        }
+        if (buffer_write(offsets, (const char*)&position,
+                         sizeof(Py_ssize_t))) {
+            *error = NULL;
+            return -1;
+        }
+        position += size;
+        count++;
+    }
+    return count;
+}
+
+/* Raise InvalidBSON with `message`, or MemoryError if it is NULL. */
+static void _raise_invalid(const char* message) {
+    PyObject* InvalidBSON;
+    if (!message) {
+        PyErr_NoMemory();
+        return;
+    }
+    InvalidBSON = _error("InvalidBSON");
+    if (InvalidBSON) {
+        PyErr_SetString(InvalidBSON, message);
+        Py_DECREF(InvalidBSON);
+    }
+}
+
+static PyObject* _cbson_validate(PyObject* self, PyObject* args) {
+    PyObject* bson;
+    bson_view_t view;
+    const char* error = NULL;
+    int size;
+
+    if (!PyArg_ParseTuple(args, "O", &bson)) {
+        return NULL;
+    }
+    if (!_get_view(bson, 0, &view, "_validate")) {
+        return NULL;
+    }
+    if (view.size >= GIL_RELEASE_SIZE && _can_release_gil(bson, &view, 0)) {
+        Py_BEGIN_ALLOW_THREADS
+        size = _validate_document(view.string, view.size, 1, &error);
+        Py_END_ALLOW_THREADS
+    } else {
+        size = _validate_document(view.string, view.size, 1, &error);
+    }
+    _release_view(&view);
+    if (size == -1 || size != view.size) {
+        Py_RETURN_FALSE;
+    }
+    Py_RETURN_TRUE;
+}
+
+static PyObject* _cbson_decode_all(PyObject* self, PyObject* args) {
+    unsigned int size;
+    Py_ssize_t total_size;
+    const char* string;
+    PyObject* bson;
+    PyObject* dict;
+    PyObject* result = NULL;
+    PyObject* as_class = (PyObject*)&PyDict_Type;
+    unsigned char tz_aware = 1;
+    unsigned char uuid_subtype = 3;
+    PyObject* fields = Py_None;
+    int offset = 0;
+    PyObject* type_registry = Py_None;
+    unsigned char compile_re = 1;
+    unsigned char binary_view = 0;
+    unsigned char typed_arrays = 0;
+    PyObject* decoders;
+    PyObject* views = NULL;
+    bson_view_t view;
+    int raw;
+    buffer_t offsets;
+    const Py_ssize_t* offset_table;
+    const char* error = NULL;
+    int count;
+    int i;
+
+    if (!PyArg_ParseTuple(args, "O|ObbOiObbb", &bson, &as_class, &tz_aware,
+                          &uuid_subtype, &fields, &offset, &type_registry,
+                          &compile_re, &binary_view, &typed_arrays)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_decoders", &decoders)) {
+        return NULL;
+    }
+    raw = _raw_document_class(self, as_class);
+    if (fields == Py_None) {
+        fields = NULL;
+    } else if (!PyDict_Check(fields)) {
+        PyErr_SetString(PyExc_TypeError, "fields must be a dict or None");
+        return NULL;
+    }
+
+    if (!_get_view(bson, offset, &view, "decode_all")) {
+        return NULL;
+    }
+    if (!raw && !_get_binary_views(bson, binary_view, &views)) {
+        _release_view(&view);
+        return NULL;
+    }
+    string = view.string;
+    total_size = view.size;
+
+    /* Frame and validate all of the documents before building any of
+     * them. UTF-8 is left to the decoder, which raises the same errors
+     * for it as before. */
+    offsets = buffer_new();
+    if (!offsets) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    if (total_size >= GIL_RELEASE_SIZE && _can_release_gil(bson, &view, 0)) {
+        Py_BEGIN_ALLOW_THREADS
+        count = _frame_documents(string, total_size, 0, offsets, &error);
+        Py_END_ALLOW_THREADS
+    } else {
+        count = _frame_documents(string, total_size, 0, offsets, &error);
+    }
+    if (count == -1) {
+        /* _frame_documents frees `offsets` if it fails to grow it. */
+        if (error) {
+            buffer_free(offsets);
+        }
+        _raise_invalid(error);
+        goto done;
+    }
+
+    result = PyList_New(count);
+    if (!result) {
+        buffer_free(offsets);
+        goto done;
+    }
+    offset_table = (const Py_ssize_t*)buffer_get_buffer(offsets);
+    for (i = 0; i < count; i++) {
+        const char* document = string + offset_table[i];
+        memcpy(&size, document, 4);
+        /* A mutable buffer could have changed since it was framed. */
+        if (size < 5 || size > total_size - offset_table[i]) {
+            Py_DECREF(result);
+            result = NULL;
+            _raise_invalid("objsize too large");
+            break;
+        }
+        if (raw) {
+            dict = _raw_document(document, size, as_class,
+                                 tz_aware, uuid_subtype, compile_re);
+        } else {
+            dict = elements_to_dict(self, document + 4, size - 5,
+                                    as_class, tz_aware, uuid_subtype, fields,
+                                    decoders, compile_re, views,
+                                    typed_arrays);
+        }
+        if (!dict) {
+            Py_DECREF(result);
+            result = NULL;
+            break;
+        }
+        PyList_SET_ITEM(result, i, dict);
+    }
+    buffer_free(offsets);
+
+done:
+    Py_XDECREF(views);
+    _release_view(&view);
+    return result;
+}
+
+/* Column types, see bson/columns.py. */
+#define COLUMN_INT32 1
+#define COLUMN_INT64 2
+#define COLUMN_DOUBLE 3
+#define COLUMN_DATETIME 4
+#define COLUMN_OBJECTID 5
+
+static const char* _column_type_names[] = {
+    NULL, "INT32", "INT64", "DOUBLE", "DATETIME", "OBJECTID"
+};
+
+static const int _column_sizes[] = {0, 4, 8, 8, 8, 12};
+
+/* The value of a column for documents that don't have the field, or
+ * where it is null: zeros, or a little-endian NaN for DOUBLE columns. */
+static const char _column_zeros[12] = {0};
+static const char _column_nan[8] = {0, 0, 0, 0, 0, 0, (char)0xF8, 0x7F};
+
+/* Find the value on the key path `parts` (a tuple of bytes), starting
+ * with the key at index `depth`, in the document whose elements are
+ * string[0:max].
+ *
+ * Returns 1 and sets `type` and `position` to the type and position of
+ * the value if there is one, returns 0 if there is no such value, or -1
+ * if the document is invalid. */
+static int _find_column_value(const char* string, int max, PyObject* parts,
+                              Py_ssize_t depth, int* type, int* position) {
+    PyObject* py_part = PyTuple_GET_ITEM(parts, depth);
+    const char* part;
+    Py_ssize_t part_length;
+    int pos = 0;
+
+#if PY_MAJOR_VERSION >= 3
+    part = PyBytes_AS_STRING(py_part);
+    part_length = PyBytes_GET_SIZE(py_part);
+#else
+    part = PyString_AS_STRING(py_part);
+    part_length = PyString_GET_SIZE(py_part);
+#endif
+    while (pos < max) {
+        int element_type = (int)string[pos++];
+        const char* name = string + pos;
+        const char* name_end = memchr(name, 0, max - pos);
+        int name_length;
+        int size;
+        if (!name_end) {
+            return -1;
+        }
+        name_length = name_end - name;
+        pos += name_length + 1;
+        size = _value_size(string, pos, element_type, max - pos);
+        if (size < 0) {
+            return -1;
+        }
+        if (name_length == part_length && !memcmp(name, part, name_length)) {
+            if (depth == PyTuple_GET_SIZE(parts) - 1) {
+                *type = (unsigned char)element_type;
+                *position = pos;
+                return 1;
+            }
+            if (element_type == 3 || element_type == 4) {
+                int found;
+                if (size < 5) {
+                    return -1;
+                }
+                found = _find_column_value(string + pos + 4, size - 5, parts,
+                                           depth + 1, type, position);
+                if (found == 1) {
+                    *position += pos + 4;
+                }
+                return found;
+            }
+            return 0;
+        }
+        pos += size;
+    }
+    return 0;
+}
+
+/* Write the value of type `type` at `value` to a column of type
+ * `column_type`, converting it if needed.
+ *
+ * Returns 0 on failure, with an exception set, in which case `buffer`
+ * may have been freed (see buffer.h). */
+static int _write_column_value(buffer_t buffer, const char* value,
+                               int type, int column_type, PyObject* path) {
+    int int_value;
+    long long long_value;
+    double double_value;
+
+    if (type == 10) {
+        type = 0;  /* null, like a missing value */
+    }
+    if (!type) {
+        if (column_type == COLUMN_DOUBLE) {
+            return !buffer_write(buffer, _column_nan, 8);
+        }
+        return !buffer_write(buffer, _column_zeros,
+                             _column_sizes[column_type]);
+    }
+    switch (column_type) {
+    case COLUMN_INT32:
+        if (type == 16) {
+            return !buffer_write(buffer, value, 4);
+        }
+        break;
+    case COLUMN_INT64:
+        if (type == 18) {
+            return !buffer_write(buffer, value, 8);
+        }
+        if (type == 16) {
+            memcpy(&int_value, value, 4);
+            long_value = int_value;
+            return !buffer_write(buffer, (const char*)&long_value, 8);
+        }
+        break;
+    case COLUMN_DOUBLE:
+        if (type == 1) {
+            return !buffer_write(buffer, value, 8);
+        }
+        if (type == 16) {
+            memcpy(&int_value, value, 4);
+            double_value = (double)int_value;
+            return !buffer_write(buffer, (const char*)&double_value, 8);
+        }
+        if (type == 18) {
+            memcpy(&long_value, value, 8);
+            double_value = (double)long_value;
+            return !buffer_write(buffer, (const char*)&double_value, 8);
+        }
+        break;
+    case COLUMN_DATETIME:
+        if (type == 9) {
+            return !buffer_write(buffer, value, 8);
+        }
+        break;
+    case COLUMN_OBJECTID:
+        if (type == 7) {
+            return !buffer_write(buffer, value, 12);
+        }
+        break;
+    }
+    {
+        PyObject* InvalidBSON = _error("InvalidBSON");
+        PyErr_Format(InvalidBSON, "cannot decode BSON type %d in field %s as %s",
+#if PY_MAJOR_VERSION >= 3
+                     type, PyBytes_AS_STRING(path),
+#else
+                     type, PyString_AS_STRING(path),
+#endif
+                     _column_type_names[column_type]);
+        Py_DECREF(InvalidBSON);
+    }
+    return 0;
+}
+
+static PyObject* _cbson_decode_columns(PyObject* self, PyObject* args) {
+    unsigned int size;
+    Py_ssize_t total_size;
+    const char* string;
+    PyObject* bson;
+    PyObject* columns;
+    PyObject* result = NULL;
+    int offset = 0;
+    Py_ssize_t count;
+    Py_ssize_t i;
+    int* column_types = NULL;
+    buffer_t* buffers = NULL;
+    bson_view_t view;
+
+    if (!PyArg_ParseTuple(args, "OO|i", &bson, &columns, &offset)) {
+        return NULL;
+    }
+    if (!PyList_Check(columns)) {
+        PyErr_SetString(PyExc_TypeError, "columns must be a list");
+        return NULL;
+    }
+    count = PyList_GET_SIZE(columns);
+    column_types = (int*)PyMem_Malloc((count + 1) * sizeof(int));
+    buffers = (buffer_t*)PyMem_Malloc((count + 1) * sizeof(buffer_t));
+    if (!column_types || !buffers) {
+        PyMem_Free(column_types);
+        PyMem_Free(buffers);
+        return PyErr_NoMemory();
+    }
+    for (i = 0; i < count; i++) {
+        buffers[i] = NULL;
+    }
+    for (i = 0; i < count; i++) {
+        PyObject* column = PyList_GET_ITEM(columns, i);
+        PyObject* parts;
+        long column_type;
+        if (!PyTuple_Check(column) || PyTuple_GET_SIZE(column) != 4 ||
+            !PyTuple_Check(PyTuple_GET_ITEM(column, 2))) {
+            PyErr_SetString(PyExc_TypeError, "invalid column");
+            goto done_columns;
+        }
+        parts = PyTuple_GET_ITEM(column, 2);
+#if PY_MAJOR_VERSION >= 3
+        column_type = PyLong_AsLong(PyTuple_GET_ITEM(column, 3));
+#else
+        column_type = PyInt_AsLong(PyTuple_GET_ITEM(column, 3));
+#endif
+        if (column_type < COLUMN_INT32 || column_type > COLUMN_OBJECTID ||
+            !PyTuple_GET_SIZE(parts)) {
+            PyErr_SetString(PyExc_TypeError, "invalid column");
+            goto done_columns;
+        }
+        column_types[i] = (int)column_type;
+        buffers[i] = buffer_new();
+        if (!buffers[i]) {
+            PyErr_NoMemory();
+            goto done_columns;
+        }
+    }
+
+    if (!_get_view(bson, offset, &view, "decode_columns")) {
+        goto done_columns;
+    }
+    string = view.string;
+    total_size = view.size;
+
+    while (total_size > 0) {
+        if (total_size < 5) {
+            PyObject* InvalidBSON = _error("InvalidBSON");
+            PyErr_SetString(InvalidBSON,
+                            "not enough data for a BSON document");
+            Py_DECREF(InvalidBSON);
+            goto done;
+        }
+
+        memcpy(&size, string, 4);
+
+        if (size < 5 || total_size < size) {
+            PyObject* InvalidBSON = _error("InvalidBSON");
+            PyErr_SetString(InvalidBSON,
+                            "objsize too large");
+            Py_DECREF(InvalidBSON);
+            goto done;
+        }
+
+        if (string[size - 1]) {
+            PyObject* InvalidBSON = _error("InvalidBSON");
+            PyErr_SetString(InvalidBSON,
+                            "bad eoo");
+            Py_DECREF(InvalidBSON);
+            goto done;
+        }
+
+        for (i = 0; i < count; i++) {
+            PyObject* column = PyList_GET_ITEM(columns, i);
+            int type = 0;
+            int position = 0;
+            int found = _find_column_value(string + 4, size - 5,
+                                           PyTuple_GET_ITEM(column, 2), 0,
+                                           &type, &position);
+            if (found == -1) {
+                PyObject* InvalidBSON = _error("InvalidBSON");
+                PyErr_SetString(InvalidBSON, "invalid document");
+                Py_DECREF(InvalidBSON);
+                goto done;
+            }
+            if (!_write_column_value(buffers[i], string + 4 + position,
+                                     found ? type : 0, column_types[i],
+                                     PyTuple_GET_ITEM(column, 1))) {
+                if (!PyErr_Occurred()) {
+                    /* The buffer was freed by a failed write. */
+                    buffers[i] = NULL;
+                    PyErr_NoMemory();
+                }
+                goto done;
+            }
+        }
+        string += size;
+        total_size -= size;
+    }
+
+    result = PyList_New(count);
+    if (!result) {
+        goto done;
+    }
+    for (i = 0; i < count; i++) {
+#if PY_MAJOR_VERSION >= 3
+        PyObject* data = PyBytes_FromStringAndSize(
+#else
+        PyObject* data = PyString_FromStringAndSize(
+#endif
+            buffer_get_buffer(buffers[i]), buffer_get_position(buffers[i]));
+        if (!data) {
+            Py_DECREF(result);
+            result = NULL;
+            goto done;
+        }
+        PyList_SET_ITEM(result, i, data);
+    }
+
+done:
+    _release_view(&view);
+done_columns:
+    for (i = 0; i < count; i++) {
+        if (buffers[i]) {
+            buffer_free(buffers[i]);
+        }
+    }
+    PyMem_Free(column_types);
+    PyMem_Free(buffers);
+    return result;
+}
+
+/* The counter of the last three bytes of generated ObjectIds, seeded
+ * from ObjectId._inc on first use. It is only used while holding the
+ * GIL, so unlike the pure Python implementation it needs no lock. */
+static long _oid_inc = -1;
+
+static PyObject* _cbson_generate_oids(PyObject* self, PyObject* args) {
+    const char* machine;
+    int machine_length;
+    int count;
+    int i;
+    long inc;
+    unsigned long seconds;
+    unsigned int pid;
+    char* data;
+    PyObject* result;
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTuple(args, "y#i", &machine, &machine_length, &count)) {
+#else
+    if (!PyArg_ParseTuple(args, "s#i", &machine, &machine_length, &count)) {
+#endif
+        return NULL;
+    }
+    if (machine_length != 3) {
+        PyErr_SetString(PyExc_ValueError, "machine bytes must be 3 bytes");
+        return NULL;
+    }
+    if (count < 0 || count > INT_MAX / 12) {
+        PyErr_SetString(PyExc_ValueError, "count out of range");
+        return NULL;
+    }
+    if (_oid_inc < 0) {
+        PyObject* py_inc = PyObject_GetAttrString(GETSTATE(self)->ObjectId,
+                                                  "_inc");
+        if (!py_inc) {
+            return NULL;
+        }
+#if PY_MAJOR_VERSION >= 3
+        inc = PyLong_AsLong(py_inc);
+#else
+        inc = PyInt_AsLong(py_inc);
+#endif
+        Py_DECREF(py_inc);
+        if (inc == -1 && PyErr_Occurred()) {
+            return NULL;
+        }
+        _oid_inc = inc % 0xFFFFFF;
+    }
+
+#if PY_MAJOR_VERSION >= 3
+    result = PyBytes_FromStringAndSize(NULL, 12 * count);
+#else
+    result = PyString_FromStringAndSize(NULL, 12 * count);
+#endif
+    if (!result) {
+        return NULL;
+    }
+#if PY_MAJOR_VERSION >= 3
+    data = PyBytes_AS_STRING(result);
+#else
+    data = PyString_AS_STRING(result);
+#endif
+
+    /* Reserve the whole range of the counter at once. */
+    inc = _oid_inc;
+    _oid_inc = (inc + count) % 0xFFFFFF;
+
+    seconds = (unsigned long)time(NULL);
+    pid = (unsigned int)getpid() % 0xFFFF;
+    for (i = 0; i < count; i++) {
+        char* oid = data + 12 * i;
+        long value = (inc + i) % 0xFFFFFF;
+        oid[0] = (char)(seconds >> 24);
+        oid[1] = (char)(seconds >> 16);
+        oid[2] = (char)(seconds >> 8);
+        oid[3] = (char)seconds;
+        memcpy(oid + 4, machine, 3);
+        oid[7] = (char)(pid >> 8);
+        oid[8] = (char)pid;
+        oid[9] = (char)(value >> 16);
+        oid[10] = (char)(value >> 8);
+        oid[11] = (char)value;
+    }
+    return result;
+}
+
+static PyObject* _cbson_oid_to_hex(PyObject* self, PyObject* args) {
+    static const char digits[] = "0123456789abcdef";
+    const unsigned char* binary;
+    int length;
+    int i;
+    char hex[24];
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTuple(args, "y#", &binary, &length)) {
+#else
+    if (!PyArg_ParseTuple(args, "s#", &binary, &length)) {
+#endif
+        return NULL;
+    }
+    if (length != 12) {
+        PyErr_SetString(PyExc_ValueError, "ObjectIds must be 12 bytes");
+        return NULL;
+    }
+    for (i = 0; i < 12; i++) {
+        hex[2 * i] = digits[binary[i] >> 4];
+        hex[2 * i + 1] = digits[binary[i] & 0xF];
+    }
+#if PY_MAJOR_VERSION >= 3
+    return PyUnicode_FromStringAndSize(hex, 24);
+#else
+    return PyString_FromStringAndSize(hex, 24);
+#endif
+}
+
+static int _hex_digit(char digit) {
+    if (digit >= '0' && digit <= '9') {
+        return digit - '0';
+    }
+    if (digit >= 'a' && digit <= 'f') {
+        return digit - 'a' + 10;
+    }
+    if (digit >= 'A' && digit <= 'F') {
+        return digit - 'A' + 10;
+    }
+    return -1;
+}
+
+static PyObject* _cbson_oid_from_hex(PyObject* self, PyObject* args) {
+    PyObject* value;
+    PyObject* ascii = NULL;
+    const char* hex;
+    char binary[12];
+    int i;
+
+    if (!PyArg_ParseTuple(args, "O", &value)) {
+        return NULL;
+    }
+    if (PyUnicode_Check(value)) {
+        ascii = PyUnicode_AsASCIIString(value);
+        if (!ascii) {
+            PyErr_Clear();
+            PyErr_SetString(PyExc_ValueError, "non-hexadecimal digit found");
+            return NULL;
+        }
+        value = ascii;
+#if PY_MAJOR_VERSION >= 3
+    } else {
+        PyErr_SetString(PyExc_TypeError, "hex ObjectIds must be str");
+        return NULL;
+    }
+    hex = PyBytes_AS_STRING(value);
+    if (PyBytes_GET_SIZE(value) != 24) {
+#else
+    } else if (!PyString_Check(value)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "hex ObjectIds must be str or unicode");
+        return NULL;
+    }
+    hex = PyString_AS_STRING(value);
+    if (PyString_GET_SIZE(value) != 24) {
+#endif
+        Py_XDECREF(ascii);
+        PyErr_SetString(PyExc_ValueError, "hex ObjectIds must be 24 digits");
+        return NULL;
+    }
+    for (i = 0; i < 12; i++) {
+        int high = _hex_digit(hex[2 * i]);
+        int low = _hex_digit(hex[2 * i + 1]);
+        if (high < 0 || low < 0) {
+            Py_XDECREF(ascii);
+            PyErr_SetString(PyExc_ValueError, "non-hexadecimal digit found");
+            return NULL;
+        }
+        binary[i] = (char)((high << 4) | low);
+    }
+    Py_XDECREF(ascii);
+#if PY_MAJOR_VERSION >= 3
+    return PyBytes_FromStringAndSize(binary, 12);
+#else
+    return PyString_FromStringAndSize(binary, 12);
+#endif
+}
+
+/* Extended JSON, see bson/json_util.py.
+ *
+ * _bson_to_json writes the JSON text that json_util.dumps produces for
+ * decoded documents straight from their BSON, and _json_to_bson parses
+ * JSON text straight to BSON, converting the objects that
+ * json_util.object_hook would convert. Neither creates Python objects
+ * for the values. */
+
+/* Write the string literal `literal` to `buffer`. */
+#define JSON_WRITE(buffer, literal)                                     \
+    buffer_write_bytes((buffer), (literal), sizeof(literal) - 1)
+
+static const char _json_hex_digits[] = "0123456789abcdef";
+static const char _json_base64_digits[] =
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+
+/* The earliest and latest datetimes Python can represent, in
+ * milliseconds since the epoch. */
+#define JSON_MIN_MILLIS -62135596800000LL
+#define JSON_MAX_MILLIS 253402300799999LL
+
+typedef struct {
+    buffer_t buffer;
+    unsigned char uuid_subtype;
+    unsigned char has_uuid;
+} json_writer_t;
+
+static int _json_write_document(json_writer_t* writer, const char* string,
+                                int is_array);
+
+static int _json_write_int64(buffer_t buffer, long long value) {
+    char digits[21];
+    int i = sizeof(digits);
+    unsigned long long magnitude = (unsigned long long)value;
+    if (value < 0) {
+        magnitude = 0 - magnitude;
+    }
+    do {
+        digits[--i] = (char)('0' + magnitude % 10);
+        magnitude /= 10;
+    } while (magnitude);
+    if (value < 0) {
+        digits[--i] = '-';
+    }
+    return buffer_write_bytes(buffer, digits + i, sizeof(digits) - i);
+}
+
+/* Write `value` the way json.dumps writes a float. */
+static int _json_write_double(buffer_t buffer, double value) {
+    char* repr;
+    int result;
+    if (Py_IS_NAN(value)) {
+        return JSON_WRITE(buffer, "NaN");
+    }
+    if (Py_IS_INFINITY(value)) {
+        if (value > 0) {
+            return JSON_WRITE(buffer, "Infinity");
+        }
+        return JSON_WRITE(buffer, "-Infinity");
+    }
+#if PY_VERSION_HEX >= 0x02070000
+    repr = PyOS_double_to_string(value, 'r', 0, Py_DTSF_ADD_DOT_0, NULL);
+    if (!repr) {
+        return 0;
+    }
+    result = buffer_write_bytes(buffer, repr, (int)strlen(repr));
+    PyMem_Free(repr);
+#else
+    {
+        PyObject* py_value = PyFloat_FromDouble(value);
+        PyObject* py_repr;
+        if (!py_value) {
+            return 0;
+        }
+        py_repr = PyObject_Repr(py_value);
+        Py_DECREF(py_value);
+        if (!py_repr) {
+            return 0;
+        }
+        repr = PyString_AsString(py_repr);
+        result = buffer_write_bytes(buffer, repr, (int)strlen(repr));
+        Py_DECREF(py_repr);
+    }
+#endif
+    return result;
+}
+
+static int _json_write_escape(buffer_t buffer, unsigned int code) {
+    char escape[6] = {'\\', 'u', 0, 0, 0, 0};
+    escape[2] = _json_hex_digits[(code >> 12) & 0xF];
+    escape[3] = _json_hex_digits[(code >> 8) & 0xF];
+    escape[4] = _json_hex_digits[(code >> 4) & 0xF];
+    escape[5] = _json_hex_digits[code & 0xF];
+    return buffer_write_bytes(buffer, escape, 6);
+}
+
+/* Write the `length` bytes of UTF-8 at `string` as a JSON string, with
+ * the escapes json.dumps uses, so that the text is ASCII. */
+static int _json_write_string(buffer_t buffer, const char* string,
+                              int length) {
+    const unsigned char* data = (const unsigned char*)string;
+    int position = 0;
+
+    if (!JSON_WRITE(buffer, "\"")) {
+        return 0;
+    }
+    while (position < length) {
+        int start = position;
+        unsigned int code;
+        int sequence_length;
+        int i;
+
+        /* Copy runs of printable ASCII at once. */
+        while (position < length && data[position] >= 0x20 &&
+               data[position] < 0x7F && data[position] != '"' &&
+               data[position] != '\\') {
+            position++;
+        }
+        if (position > start &&
+            !buffer_write_bytes(buffer, string + start, position - start)) {
+            return 0;
+        }
+        if (position == length) {
+            break;
+        }
+
+        code = data[position];
+        if (code < 0x80) {
+            sequence_length = 1;
+        } else if ((code & 0xE0) == 0xC0) {
+            sequence_length = 2;
+            code &= 0x1F;
+        } else if ((code & 0xF0) == 0xE0) {
+            sequence_length = 3;
+            code &= 0x0F;
+        } else if ((code & 0xF8) == 0xF0) {
+            sequence_length = 4;
+            code &= 0x07;
+        } else {
+            goto invalid;
+        }
+        if (position + sequence_length > length) {
+            goto invalid;
+        }
+        for (i = 1; i < sequence_length; i++) {
+            if ((data[position + i] & 0xC0) != 0x80) {
+                goto invalid;
+            }
+            code = (code << 6) | (data[position + i] & 0x3F);
+        }
+        if ((sequence_length == 2 && code < 0x80) ||
+            (sequence_length == 3 && code < 0x800) ||
+            (sequence_length == 4 && (code < 0x10000 || code > 0x10FFFF))) {
+            goto invalid;
+        }
+#if PY_MAJOR_VERSION >= 3
+        if (code >= 0xD800 && code <= 0xDFFF) {
+            goto invalid;
+        }
+#endif
+        position += sequence_length;
+
+        switch (code) {
+        case '"':
+            if (!JSON_WRITE(buffer, "\\\"")) {
+                return 0;
+            }
+            break;
+        case '\\':
+            if (!JSON_WRITE(buffer, "\\\\")) {
+                return 0;
+            }
+            break;
+        case '\n':
+            if (!JSON_WRITE(buffer, "\\n")) {
+                return 0;
+            }
+            break;
+        case '\r':
+            if (!JSON_WRITE(buffer, "\\r")) {
+                return 0;
+            }
+            break;
+        case '\t':
+            if (!JSON_WRITE(buffer, "\\t")) {
+                return 0;
+            }
+            break;
+        case '\b':
+            if (!JSON_WRITE(buffer, "\\b")) {
+                return 0;
+            }
+            break;
+        case '\f':
+            if (!JSON_WRITE(buffer, "\\f")) {
+                return 0;
+            }
+            break;
+        default:
+            if (code >= 0x10000) {
+                code -= 0x10000;
+                if (!_json_write_escape(buffer, 0xD800 | (code >> 10)) ||
+                    !_json_write_escape(buffer, 0xDC00 | (code & 0x3FF))) {
+                    return 0;
+                }
+            } else if (!_json_write_escape(buffer, code)) {
+                return 0;
+            }
+        }
+    }
+    return JSON_WRITE(buffer, "\"");
+
+invalid:
+    /* Raise the same error as decoding the string would. */
+    {
+        PyObject* decoded = PyUnicode_DecodeUTF8(string, length, "strict");
+        if (decoded) {
+            Py_DECREF(decoded);
+            _raise_invalid("invalid UTF-8 in string");
+        }
+    }
+    return 0;
+}
+
+static int _json_write_base64(buffer_t buffer, const unsigned char* data,
+                              int length) {
+    int position = buffer_save_space(buffer, 4 * ((length + 2) / 3));
+    char* out;
+    int i;
+    if (position == -1) {
+        PyErr_NoMemory();
+        return 0;
+    }
+    out = buffer_get_buffer(buffer) + position;
+    for (i = 0; i + 2 < length; i += 3) {
+        *out++ = _json_base64_digits[data[i] >> 2];
+        *out++ = _json_base64_digits[((data[i] & 0x03) << 4) | (data[i + 1] >> 4)];
+        *out++ = _json_base64_digits[((data[i + 1] & 0x0F) << 2) | (data[i + 2] >> 6)];
+        *out++ = _json_base64_digits[data[i + 2] & 0x3F];
+    }
+    if (i < length) {
+        *out++ = _json_base64_digits[data[i] >> 2];
+        if (i + 1 < length) {
+            *out++ = _json_base64_digits[((data[i] & 0x03) << 4) | (data[i + 1] >> 4)];
+            *out++ = _json_base64_digits[(data[i + 1] & 0x0F) << 2];
+        } else {
+            *out++ = _json_base64_digits[(data[i] & 0x03) << 4];
+            *out++ = '=';
+        }
+        *out++ = '=';
+    }
+    return 1;
+}
+
+/* Write `length` bytes at `data` as lowercase hex. */
+static int _json_write_hex(buffer_t buffer, const unsigned char* data,
+                           int length) {
+    int position = buffer_save_space(buffer, 2 * length);
+    char* out;
+    int i;
+    if (position == -1) {
+        PyErr_NoMemory();
+        return 0;
+    }
+    out = buffer_get_buffer(buffer) + position;
+    for (i = 0; i < length; i++) {
+        *out++ = _json_hex_digits[data[i] >> 4];
+        *out++ = _json_hex_digits[data[i] & 0xF];
+    }
+    return 1;
+}
+
+static int _json_write_oid(buffer_t buffer, const char* oid) {
+    return (JSON_WRITE(buffer, "{\"$oid\": \"") &&
+            _json_write_hex(buffer, (const unsigned char*)oid, 12) &&
+            JSON_WRITE(buffer, "\"}"));
+}
+
+/* Write the UUID in the 16 bytes at `data`, stored in the byte order
+ * for `uuid_subtype`. */
+static int _json_write_uuid(buffer_t buffer, const char* data,
+                            unsigned char uuid_subtype) {
+    char bytes[16];
+    if (uuid_subtype == JAVA_LEGACY) {
+        _fix_java(data, bytes);
+    } else if (uuid_subtype == CSHARP_LEGACY) {
+        /* bytes_le reverses the first three fields. */
+        int i;
+        for (i = 0; i < 4; i++) {
+            bytes[i] = data[3 - i];
+        }
+        bytes[4] = data[5];
+        bytes[5] = data[4];
+        bytes[6] = data[7];
+        bytes[7] = data[6];
+        memcpy(bytes + 8, data + 8, 8);
+    } else {
+        memcpy(bytes, data, 16);
+    }
+    return (JSON_WRITE(buffer, "{\"$uuid\": \"") &&
+            _json_write_hex(buffer, (const unsigned char*)bytes, 16) &&
+            JSON_WRITE(buffer, "\"}"));
+}
+
+/* Write the BSON value of type `type` at `value` as extended JSON. */
+static int _json_write_value(json_writer_t* writer, const char* value,
+                             int type) {
+    buffer_t buffer = writer->buffer;
+    switch (type) {
+    case 1:
+        {
+            double d;
+            memcpy(&d, value, 8);
+            return _json_write_double(buffer, d);
+        }
+    case 2:
+    case 14:
+        {
+            int length;
+            memcpy(&length, value, 4);
+            return _json_write_string(buffer, value + 4, length - 1);
+        }
+    case 3:
+        return _json_write_document(writer, value, 0);
+    case 4:
+        return _json_write_document(writer, value, 1);
+    case 5:
+        {
+            int length;
+            int subtype = (unsigned char)value[4];
+            const char* data = value + 5;
+            memcpy(&length, value, 4);
+            if (subtype == 2) {
+                data += 4;
+                length -= 4;
+            }
+            if ((subtype == 3 || subtype == 4) &&
+                writer->has_uuid && length == 16) {
+                return _json_write_uuid(buffer, data, writer->uuid_subtype);
+            }
+            return (JSON_WRITE(buffer, "{\"$binary\": \"") &&
+                    _json_write_base64(buffer, (const unsigned char*)data,
+                                       length) &&
+                    JSON_WRITE(buffer, "\", \"$type\": ") &&
+                    _json_write_int64(buffer, subtype) &&
+                    JSON_WRITE(buffer, "}"));
+        }
+    case 6:
+    case 10:
+        return JSON_WRITE(buffer, "null");
+    case 7:
+        return _json_write_oid(buffer, value);
+    case 8:
+        if (value[0]) {
+            return JSON_WRITE(buffer, "true");
+        }
+        return JSON_WRITE(buffer, "false");
+    case 9:
+        {
+            long long millis;
+            memcpy(&millis, value, 8);
+            return (JSON_WRITE(buffer, "{\"$date\": ") &&
+                    _json_write_int64(buffer, millis) &&
+                    JSON_WRITE(buffer, "}"));
+        }
+    case 11:
+        {
+            int pattern_length = (int)strlen(value);
+            const char* flags = value + pattern_length + 1;
+            if (!JSON_WRITE(buffer, "{\"$regex\": ") ||
+                !_json_write_string(buffer, value, pattern_length) ||
+                !JSON_WRITE(buffer, ", \"$options\": \"")) {
+                return 0;
+            }
+            /* json_util only keeps re.IGNORECASE and re.MULTILINE. */
+            if (strchr(flags, 'i') && !JSON_WRITE(buffer, "i")) {
+                return 0;
+            }
+            if (strchr(flags, 'm') && !JSON_WRITE(buffer, "m")) {
+                return 0;
+            }
+            return JSON_WRITE(buffer, "\"}");
+        }
+    case 12:
+        {
+            int length;
+            memcpy(&length, value, 4);
+            return (JSON_WRITE(buffer, "{\"$ref\": ") &&
+                    _json_write_string(buffer, value + 4, length - 1) &&
+                    JSON_WRITE(buffer, ", \"$id\": ") &&
+                    _json_write_oid(buffer, value + 4 + length) &&
+                    JSON_WRITE(buffer, "}"));
+        }
+    case 13:
+        {
+            int length;
+            memcpy(&length, value, 4);
+            return (JSON_WRITE(buffer, "{\"$code\": ") &&
+                    _json_write_string(buffer, value + 4, length - 1) &&
+                    JSON_WRITE(buffer, ", \"$scope\": {}}"));
+        }
+    case 15:
+        {
+            int length;
+            memcpy(&length, value + 4, 4);
+            return (JSON_WRITE(buffer, "{\"$code\": ") &&
+                    _json_write_string(buffer, value + 8, length - 1) &&
+                    JSON_WRITE(buffer, ", \"$scope\": ") &&
+                    _json_write_document(writer, value + 8 + length, 0) &&
+                    JSON_WRITE(buffer, "}"));
+        }
+    case 16:
+        {
+            int i;
+            memcpy(&i, value, 4);
+            return _json_write_int64(buffer, i);
+        }
+    case 17:
+        {
+            unsigned int time, inc;
+            memcpy(&inc, value, 4);
+            memcpy(&time, value + 4, 4);
+            return (JSON_WRITE(buffer, "{\"t\": ") &&
+                    _json_write_int64(buffer, time) &&
+                    JSON_WRITE(buffer, ", \"i\": ") &&
+                    _json_write_int64(buffer, inc) &&
+                    JSON_WRITE(buffer, "}"));
+        }
+    case 18:
+        {
+            long long ll;
+            memcpy(&ll, value, 8);
+            return _json_write_int64(buffer, ll);
+        }
+    case -1:
+        return JSON_WRITE(buffer, "{\"$minKey\": 1}");
+    case 127:
+        return JSON_WRITE(buffer, "{\"$maxKey\": 1}");
+    }
+    _raise_invalid("invalid element type");
+    return 0;
+}
+
+/* Write the validated document or array at `string` as extended JSON. */
+static int _json_write_document(json_writer_t* writer, const char* string,
+                                int is_array) {
+    buffer_t buffer = writer->buffer;
+    int size;
+    int position = 4;
+    int first = 1;
+
+    if (Py_EnterRecursiveCall(" while converting BSON to JSON")) {
+        return 0;
+    }
+    memcpy(&size, string, 4);
+    if (!(is_array ? JSON_WRITE(buffer, "[") : JSON_WRITE(buffer, "{"))) {
+        goto fail;
+    }
+    while (position < size - 1) {
+        int type = (int)string[position++];
+        int name_length = (int)strlen(string + position);
+        if (!first && !JSON_WRITE(buffer, ", ")) {
+            goto fail;
+        }
+        first = 0;
+        if (!is_array &&
+            (!_json_write_string(buffer, string + position, name_length) ||
+             !JSON_WRITE(buffer, ": "))) {
+            goto fail;
+        }
+        position += name_length + 1;
+        if (!_json_write_value(writer, string + position, type)) {
+            goto fail;
+        }
+        position += _value_size(string, position, type,
+                                size - 1 - position);
+    }
+    if (!(is_array ? JSON_WRITE(buffer, "]") : JSON_WRITE(buffer, "}"))) {
+        goto fail;
+    }
+    Py_LeaveRecursiveCall();
+    return 1;
+
+fail:
+    Py_LeaveRecursiveCall();
+    return 0;
+}
+
+static PyObject* _cbson_bson_to_json(PyObject* self, PyObject* args) {
+    PyObject* bson;
+    unsigned char uuid_subtype = 3;
+    const char* separator = NULL;
+    int separator_length = 0;
+    int offset = 0;
+    bson_view_t view;
+    buffer_t offsets;
+    const Py_ssize_t* offset_table;
+    json_writer_t writer;
+    const char* error = NULL;
+    int count;
+    int i;
+    PyObject* result = NULL;
+
+    if (!PyArg_ParseTuple(args, "O|bz#i", &bson, &uuid_subtype,
+                          &separator, &separator_length, &offset)) {
+        return NULL;
+    }
+    if (!_get_view(bson, offset, &view, "_bson_to_json")) {
+        return NULL;
+    }
+
+    offsets = buffer_new();
+    if (!offsets) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    if (view.size >= GIL_RELEASE_SIZE && _can_release_gil(bson, &view, 1)) {
+        Py_BEGIN_ALLOW_THREADS
+        count = _frame_documents(view.string, view.size, 0, offsets, &error);
+        Py_END_ALLOW_THREADS
+    } else {
+        count = _frame_documents(view.string, view.size, 0, offsets, &error);
+    }
+    if (count == -1) {
+        if (error) {
+            buffer_free(offsets);
+        }
+        _raise_invalid(error);
+        goto done;
+    }
+    /* Without a separator `bson` must be a single document. */
+    if (!separator && count != 1) {
+        buffer_free(offsets);
+        _raise_invalid(count ? "data contains more than one document" :
+                       "not enough data for a BSON document");
+        goto done;
+    }
+
+    writer.buffer = buffer_get_scratch();
+    if (!writer.buffer) {
+        buffer_free(offsets);
+        PyErr_NoMemory();
+        goto done;
+    }
+    writer.uuid_subtype = uuid_subtype;
+    writer.has_uuid = GETSTATE(self)->UUID != NULL;
+    offset_table = (const Py_ssize_t*)buffer_get_buffer(offsets);
+    for (i = 0; i < count; i++) {
+        if (i && !buffer_write_bytes(writer.buffer, separator,
+                                     separator_length)) {
+            break;
+        }
+        if (!_json_write_document(&writer, view.string + offset_table[i], 0)) {
+            break;
+        }
+    }
+    buffer_free(offsets);
+    if (i < count) {
+        buffer_free(writer.buffer);
+        goto done;
+    }
+#if PY_MAJOR_VERSION >= 3
+    result = PyUnicode_DecodeUTF8(buffer_get_buffer(writer.buffer),
+                                  buffer_get_position(writer.buffer),
+                                  "strict");
+#else
+    result = PyString_FromStringAndSize(buffer_get_buffer(writer.buffer),
+                                        buffer_get_position(writer.buffer));
+#endif
+    buffer_release(writer.buffer);
+
+done:
+    _release_view(&view);
+    return result;
+}
+
+typedef struct {
+    const char* string;
+    Py_ssize_t length;
+    Py_ssize_t position;
+    buffer_t buffer;
+    /* For values that json_util.object_hook converts. */
+    buffer_t scratch;
+    unsigned char uuid_subtype;
+    unsigned char has_uuid;
+} json_parser_t;
+
+static int _json_parse_value(json_parser_t* parser, int type_byte);
+
+/* Raise ValueError for a syntax error at the current position, with a
+ * message like the json module's. */
+static void _json_syntax_error(json_parser_t* parser, const char* message) {
+    Py_ssize_t line = 1;
+    Py_ssize_t column = 1;
+    Py_ssize_t i;
+    for (i = 0; i < parser->position && i < parser->length; i++) {
+        if (parser->string[i] == '\n') {
+            line++;
+            column = 1;
+        } else {
+            column++;
+        }
+    }
+    PyErr_Format(PyExc_ValueError, "%s: line %zd column %zd (char %zd)",
+                 message, line, column, parser->position);
+}
+
+static void _json_raise(char* name, const char* message) {
+    PyObject* error = _error(name);
+    if (error) {
+        PyErr_SetString(error, message);
+        Py_DECREF(error);
+    }
+}
+
+static void _json_skip_whitespace(json_parser_t* parser) {
+    while (parser->position < parser->length) {
+        char c = parser->string[parser->position];
+        if (c != ' ' && c != '\t' && c != '\n' && c != '\r') {
+            return;
+        }
+        parser->position++;
+    }
+}
+
+/* Is the text at the current position `literal`? Skips it if it is. */
+static int _json_match(json_parser_t* parser, const char* literal) {
+    Py_ssize_t length = (Py_ssize_t)strlen(literal);
+    if (parser->length - parser->position < length ||
+        memcmp(parser->string + parser->position, literal, length)) {
+        return 0;
+    }
+    parser->position += length;
+    return 1;
+}
+
+static int _json_hex_value(json_parser_t* parser, Py_ssize_t position) {
+    int value = 0;
+    int i;
+    if (parser->length - position < 4) {
+        return -1;
+    }
+    for (i = 0; i < 4; i++) {
+        int digit = _hex_digit(parser->string[position + i]);
+        if (digit < 0) {
+            return -1;
+        }
+        value = (value << 4) | digit;
+    }
+    return value;
+}
+
+static int _json_write_utf8(buffer_t buffer, unsigned int code) {
+    char bytes[4];
+    int length;
+    if (code < 0x80) {
+        bytes[0] = (char)code;
+        length = 1;
+    } else if (code < 0x800) {
+        bytes[0] = (char)(0xC0 | (code >> 6));
+        bytes[1] = (char)(0x80 | (code & 0x3F));
+        length = 2;
+    } else if (code < 0x10000) {
+        bytes[0] = (char)(0xE0 | (code >> 12));
+        bytes[1] = (char)(0x80 | ((code >> 6) & 0x3F));
+        bytes[2] = (char)(0x80 | (code & 0x3F));
+        length = 3;
+    } else {
+        bytes[0] = (char)(0xF0 | (code >> 18));
+        bytes[1] = (char)(0x80 | ((code >> 12) & 0x3F));
+        bytes[2] = (char)(0x80 | ((code >> 6) & 0x3F));
+        bytes[3] = (char)(0x80 | (code & 0x3F));
+        length = 4;
+    }
+    return buffer_write_bytes(buffer, bytes, length);
+}
+
+/* Parse the JSON string at the current position and write it as UTF-8,
+ * followed by a null byte. A `name` must not contain null bytes.
+ *
+ * Returns the length written, without the null byte, or -1. */
+static int _json_parse_string(json_parser_t* parser, int name) {
+    const char* string = parser->string;
+    Py_ssize_t start = parser->position;
+    Py_ssize_t position = start + 1;
+    int written = buffer_get_position(parser->buffer);
+
+    for (;;) {
+        Py_ssize_t run = position;
+        unsigned char c = 0;
+        while (position < parser->length) {
+            c = (unsigned char)string[position];
+            if (c == '"' || c == '\\' || c < 0x20) {
+                break;
+            }
+            /* The text is valid UTF-8, but that allows surrogates. */
+            if (c == 0xED && position + 1 < parser->length &&
+                (unsigned char)string[position + 1] >= 0xA0) {
+                _json_raise("InvalidStringData",
+                            "strings in documents must be valid UTF-8");
+                return -1;
+            }
+            position++;
+        }
+        if (position > run &&
+            !buffer_write_bytes(parser->buffer, string + run,
+                                (int)(position - run))) {
+            return -1;
+        }
+        if (position >= parser->length) {
+            parser->position = start;
+            _json_syntax_error(parser, "Unterminated string starting at");
+            return -1;
+        }
+        if (c == '"') {
+            position++;
+            break;
+        }
+        if (c < 0x20) {
+            parser->position = position;
+            _json_syntax_error(parser, "Invalid control character at");
+            return -1;
+        }
+
+        /* An escape. */
+        position++;
+        if (position >= parser->length) {
+            parser->position = start;
+            _json_syntax_error(parser, "Unterminated string starting at");
+            return -1;
+        }
+        c = (unsigned char)string[position++];
+        if (c == 'u') {
+            int code = _json_hex_value(parser, position);
+            if (code == -1) {
+                parser->position = position - 1;
+                _json_syntax_error(parser, "Invalid \\uXXXX escape");
+                return -1;
+            }
+            position += 4;
+            if (code >= 0xD800 && code <= 0xDBFF &&
+                parser->length - position >= 6 &&
+                string[position] == '\\' && string[position + 1] == 'u') {
+                int low = _json_hex_value(parser, position + 2);
+                if (low >= 0xDC00 && low <= 0xDFFF) {
+                    code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00);
+                    position += 6;
+                }
+            }
+            if (code >= 0xD800 && code <= 0xDFFF) {
+                _json_raise("InvalidStringData",
+                            "strings in documents must be valid UTF-8");
+                return -1;
+            }
+            if (code == 0 && name) {
+                _json_raise("InvalidDocument",
+                            "Key names must not contain the NULL byte");
+                return -1;
+            }
+            if (!_json_write_utf8(parser->buffer, code)) {
+                return -1;
+            }
+            continue;
+        }
+        switch (c) {
+        case '"':
+        case '\\':
+        case '/':
+            break;
+        case 'b':
+            c = '\b';
+            break;
+        case 'f':
+            c = '\f';
+            break;
+        case 'n':
+            c = '\n';
+            break;
+        case 'r':
+            c = '\r';
+            break;
+        case 't':
+            c = '\t';
+            break;
+        default:
+            parser->position = position - 2;
+            _json_syntax_error(parser, "Invalid \\escape");
+            return -1;
+        }
+        if (!buffer_write_bytes(parser->buffer, (const char*)&c, 1)) {
+            return -1;
+        }
+    }
+    if (!buffer_write_bytes(parser->buffer, "\0", 1)) {
+        return -1;
+    }
+    parser->position = position;
+    return buffer_get_position(parser->buffer) - written - 1;
+}
+
+/* Parse the JSON number at the current position. Integers are written
+ * as int32 if they fit, or else as int64.
+ *
+ * Returns the BSON type written, or 0 on failure. */
+static int _json_parse_number(json_parser_t* parser) {
+    const char* string = parser->string;
+    Py_ssize_t start = parser->position;
+    Py_ssize_t position = start;
+    int negative = 0;
+    int is_float = 0;
+
+    if (string[position] == '-') {
+        negative = 1;
+        position++;
+    }
+    if (position < parser->length && string[position] == '0') {
+        position++;
+    } else if (position < parser->length &&
+               string[position] >= '1' && string[position] <= '9') {
+        while (position < parser->length &&
+               string[position] >= '0' && string[position] <= '9') {
+            position++;
+        }
+    } else {
+        _json_syntax_error(parser, "No JSON object could be decoded");
+        return 0;
+    }
+    if (parser->length - position >= 2 && string[position] == '.' &&
+        string[position + 1] >= '0' && string[position + 1] <= '9') {
+        is_float = 1;
+        position += 2;
+        while (position < parser->length &&
+               string[position] >= '0' && string[position] <= '9') {
+            position++;
+        }
+    }
+    if (position < parser->length &&
+        (string[position] == 'e' || string[position] == 'E')) {
+        Py_ssize_t exponent = position + 1;
+        if (exponent < parser->length &&
+            (string[exponent] == '+' || string[exponent] == '-')) {
+            exponent++;
+        }
+        if (exponent < parser->length &&
+            string[exponent] >= '0' && string[exponent] <= '9') {
+            is_float = 1;
+            position = exponent;
+            while (position < parser->length &&
+                   string[position] >= '0' && string[position] <= '9') {
+                position++;
+            }
+        }
+    }
+    parser->position = position;
+
+    if (is_float) {
+        /* Copy the number so that it is null terminated. */
+        char digits[64];
+        char* copy = digits;
+        Py_ssize_t length = position - start;
+        double d;
+        if (length >= (Py_ssize_t)sizeof(digits)) {
+            copy = (char*)PyMem_Malloc(length + 1);
+            if (!copy) {
+                PyErr_NoMemory();
+                return 0;
+            }
+        }
+        memcpy(copy, string + start, length);
+        copy[length] = 0;
+#if PY_VERSION_HEX >= 0x02070000
+        d = PyOS_string_to_double(copy, NULL, NULL);
+#else
+        d = PyOS_ascii_strtod(copy, NULL);
+#endif
+        if (copy != digits) {
+            PyMem_Free(copy);
+        }
+        if (d == -1.0 && PyErr_Occurred()) {
+            return 0;
+        }
+        if (!buffer_write_bytes(parser->buffer, (const char*)&d, 8)) {
+            return 0;
+        }
+        return 1;
+    } else {
+        unsigned long long magnitude = 0;
+        unsigned long long limit = negative ? 9223372036854775808ULL :
+            9223372036854775807ULL;
+        long long value;
+        Py_ssize_t i;
+        for (i = start + negative; i < position; i++) {
+            int digit = string[i] - '0';
+            if (magnitude > (limit - digit) / 10) {
+                PyErr_SetString(PyExc_OverflowError,
+                                "MongoDB can only handle up to 8-byte ints");
+                return 0;
+            }
+            magnitude = magnitude * 10 + digit;
+        }
+        value = negative ? (long long)(0 - magnitude) : (long long)magnitude;
+        if (value >= INT_MIN && value <= INT_MAX) {
+            int int_value = (int)value;
+            if (!buffer_write_bytes(parser->buffer,
+                                    (const char*)&int_value, 4)) {
+                return 0;
+            }
+            return 16;
+        }
+        if (!buffer_write_bytes(parser->buffer, (const char*)&value, 8)) {
+            return 0;
+        }
+        return 18;
+    }
+}
+
+/* Find the last element called `name` in the document at `document`.
+ *
+ * Returns a pointer to its value and sets `type`, or returns NULL. */
+static const char* _json_find(const char* document, const char* name,
+                              int* type) {
+    const char* found = NULL;
+    int size;
+    int position = 4;
+    memcpy(&size, document, 4);
+    while (position < size - 1) {
+        int element_type = (int)document[position++];
+        int match = strcmp(document + position, name) == 0;
+        position += (int)strlen(document + position) + 1;
+        if (match) {
+            *type = element_type;
+            found = document + position;
+        }
+        position += _value_size(document, position, element_type,
+                                size - 1 - position);
+    }
+    return found;
+}
+
+/* The names json_util.object_hook checks for, in the order it does. */
+enum {
+    JSON_OID,
+    JSON_REF,
+    JSON_DATE,
+    JSON_REGEX,
+    JSON_MIN_KEY,
+    JSON_MAX_KEY,
+    JSON_BINARY,
+    JSON_CODE,
+    JSON_UUID,
+    JSON_SPECIAL_COUNT
+};
+
+static const char* _json_special_names[JSON_SPECIAL_COUNT] = {
+    "$oid", "$ref", "$date", "$regex", "$minKey", "$maxKey",
+    "$binary", "$code", "$uuid"
+};
+
+/* Returns which value the document at `document` is the extended JSON
+ * for, or -1 if it is just a document. */
+static int _json_special(json_parser_t* parser, const char* document) {
+    int i;
+    int type;
+    for (i = 0; i < JSON_SPECIAL_COUNT; i++) {
+        if (i == JSON_UUID && !parser->has_uuid) {
+            break;
+        }
+        if (_json_find(document, _json_special_names[i], &type)) {
+            return i;
+        }
+    }
+    return -1;
+}
+
+/* Find `name` in `document`, raising KeyError if it isn't there. */
+static const char* _json_require(const char* document, const char* name,
+                                 int* type) {
+    const char* value = _json_find(document, name, type);
+    if (!value) {
+        PyErr_SetString(PyExc_KeyError, name);
+    }
+    return value;
+}
+
+/* Write the `size` bytes at `data` to the parser's scratch buffer. */
+static int _json_scratch(json_parser_t* parser, const char* data, int size) {
+    return buffer_write_bytes(parser->scratch, data, size);
+}
+
+/* Write an element named `name` with the value of type `type` at
+ * `value`, from the document at `document`, to the scratch buffer. */
+static int _json_scratch_element(json_parser_t* parser, const char* document,
+                                 const char* name, int type,
+                                 const char* value) {
+    char type_byte = (char)type;
+    int size;
+    memcpy(&size, document, 4);
+    return (_json_scratch(parser, &type_byte, 1) &&
+            _json_scratch(parser, name, (int)strlen(name) + 1) &&
+            _json_scratch(parser, value,
+                          _value_size(value, 0, type,
+                                      size - (int)(value - document))));
+}
+
+static int _json_fill_length(buffer_t buffer, int length_location) {
+    int length = buffer_get_position(buffer) - length_location;
+    memcpy(buffer_get_buffer(buffer) + length_location, &length, 4);
+    return 1;
+}
+
+
+/* Decode the base64 string at `data` the way binascii.a2b_base64 does,
+ * writing the bytes to the scratch buffer. */
+static int _json_base64_decode(json_parser_t* parser, const char* data,
+                               int length) {
+    unsigned int bits = 0;
+    int quad_position = 0;
+    int i;
+    for (i = 0; i < length; i++) {
+        const char* digit;
+        if (data[i] == '=') {
+            int padding = 0;
+            char bytes[2];
+            /* Padding is only allowed after two or three digits. */
+            if (quad_position < 2) {
+                continue;
+            }
+            for (; i < length; i++) {
+                padding += data[i] == '=';
+            }
+            if (quad_position + padding < 4) {
+                break;
+            }
+            if (quad_position == 2) {
+                bytes[0] = (char)(bits >> 4);
+            } else {
+                bytes[0] = (char)(bits >> 10);
+                bytes[1] = (char)(bits >> 2);
+            }
+            return _json_scratch(parser, bytes, quad_position - 1);
+        }
+        digit = data[i] ? strchr(_json_base64_digits, data[i]) : NULL;
+        if (!digit) {
+            continue;
+        }
+        bits = (bits << 6) | (unsigned int)(digit - _json_base64_digits);
+        if (++quad_position == 4) {
+            char bytes[3];
+            bytes[0] = (char)(bits >> 16);
+            bytes[1] = (char)(bits >> 8);
+            bytes[2] = (char)bits;
+            if (!_json_scratch(parser, bytes, 3)) {
+                return 0;
+            }
+            quad_position = 0;
+            bits = 0;
+        }
+    }
+    if (quad_position) {
+        PyErr_SetString(PyExc_ValueError, "Incorrect padding");
+        return 0;
+    }
+    return 1;
+}
+
+/* Write the value in the `$date` element of type `type` at `value`, as
+ * milliseconds since the epoch, to the scratch buffer. */
+static int _json_convert_date(json_parser_t* parser, const char* value,
+                              int type) {
+    long long millis;
+    double d;
+    switch (type) {
+    case 16:
+        {
+            int i;
+            memcpy(&i, value, 4);
+            millis = i;
+            goto write;
+        }
+    case 18:
+        memcpy(&millis, value, 8);
+        goto write;
+    case 8:
+        millis = value[0] ? 1 : 0;
+        goto write;
+    case 1:
+        memcpy(&d, value, 8);
+        break;
+    case 2:
+        {
+            /* Like float() of the string. */
+            int length;
+            PyObject* string;
+            PyObject* number;
+            memcpy(&length, value, 4);
+            string = PyUnicode_DecodeUTF8(value + 4, length - 1, "strict");
+            if (!string) {
+                return 0;
+            }
+            number = PyObject_CallFunctionObjArgs((PyObject*)&PyFloat_Type,
+                                                  string, NULL);
+            Py_DECREF(string);
+            if (!number) {
+                return 0;
+            }
+            d = PyFloat_AsDouble(number);
+            Py_DECREF(number);
+            break;
+        }
+    default:
+        PyErr_SetString(PyExc_TypeError, "$date must be a number");
+        return 0;
+    }
+    if (Py_IS_NAN(d) || d < (double)JSON_MIN_MILLIS - 1 ||
+        d > (double)JSON_MAX_MILLIS + 1) {
+        PyErr_SetString(PyExc_OverflowError, "date value out of range");
+        return 0;
+    }
+    /* Rounded to microseconds, then truncated to milliseconds, as
+     * datetime.timedelta and BSON.encode would. */
+    millis = (long long)floor(floor(d * 1000.0 + 0.5) / 1000.0);
+
+write:
+    if (millis < JSON_MIN_MILLIS || millis > JSON_MAX_MILLIS) {
+        PyErr_SetString(PyExc_OverflowError, "date value out of range");
+        return 0;
+    }
+    return _json_scratch(parser, (const char*)&millis, 8);
+}
+
+/* Write the UUID in the string at `value` to the scratch buffer. */
+static int _json_convert_uuid(json_parser_t* parser, const char* value,
+                              int type) {
+    const char* hex;
+    int length;
+    int digits = 0;
+    int i;
+    char bytes[16];
+    char stored[21];
+    int subtype = parser->uuid_subtype;
+
+    if (type != 2) {
+        PyErr_SetString(PyExc_TypeError, "$uuid must be a string");
+        return 0;
+    }
+    memcpy(&length, value, 4);
+    length--;
+    hex = value + 4;
+    /* uuid.UUID ignores these. */
+    if (length >= 4 && memcmp(hex, "urn:", 4) == 0) {
+        hex += 4;
+        length -= 4;
+    }
+    if (length >= 5 && memcmp(hex, "uuid:", 5) == 0) {
+        hex += 5;
+        length -= 5;
+    }
+    while (length && *hex == '{') {
+        hex++;
+        length--;
+    }
+    while (length && hex[length - 1] == '}') {
+        length--;
+    }
+    for (i = 0; i < length; i++) {
+        int digit;
+        if (hex[i] == '-') {
+            continue;
+        }
+        digit = _hex_digit(hex[i]);
+        if (digit < 0 || digits == 32) {
+            digits = -1;
+            break;
+        }
+        if (digits % 2) {
+            bytes[digits / 2] |= (char)digit;
+        } else {
+            bytes[digits / 2] = (char)(digit << 4);
+        }
+        digits++;
+    }
+    if (digits != 32) {
+        PyErr_SetString(PyExc_ValueError,
+                        "badly formed hexadecimal UUID string");
+        return 0;
+    }
+
+    /* Stored the way BSON.encode stores uuid.UUID instances. */
+    length = 16;
+    memcpy(stored, &length, 4);
+    if (subtype == JAVA_LEGACY) {
+        stored[4] = 3;
+        _fix_java(bytes, stored + 5);
+    } else if (subtype == CSHARP_LEGACY) {
+        stored[4] = 3;
+        for (i = 0; i < 4; i++) {
+            stored[5 + i] = bytes[3 - i];
+        }
+        stored[9] = bytes[5];
+        stored[10] = bytes[4];
+        stored[11] = bytes[7];
+        stored[12] = bytes[6];
+        memcpy(stored + 13, bytes + 8, 8);
+    } else {
+        stored[4] = (char)subtype;
+        memcpy(stored + 5, bytes, 16);
+    }
+    return _json_scratch(parser, stored, 21);
+}
+
+/* Convert the extended JSON document written at `value_start`, which
+ * json_util.object_hook would convert to the value `special`.
+ *
+ * Returns the BSON type of the converted value, or 0 on failure. */
+static int _json_convert(json_parser_t* parser, int special,
+                         int value_start) {
+    /* The converted value is built in the scratch buffer, and only
+     * replaces the document once it is complete. */
+    const char* document = buffer_get_buffer(parser->buffer) + value_start;
+    const char* value;
+    const char* other;
+    int type;
+    int other_type;
+    int result_type;
+    int length;
+
+    buffer_truncate(parser->scratch, 0);
+    value = _json_find(document, _json_special_names[special], &type);
+
+    switch (special) {
+    case JSON_OID:
+        {
+            char oid[12];
+            int i;
+            memcpy(&length, value, 4);
+            if (type != 2 || length != 25) {
+                _json_raise("InvalidId", "$oid must be a 24 character "
+                            "hex string");
+                return 0;
+            }
+            for (i = 0; i < 12; i++) {
+                int high = _hex_digit(value[4 + 2 * i]);
+                int low = _hex_digit(value[5 + 2 * i]);
+                if (high < 0 || low < 0) {
+                    _json_raise("InvalidId", "$oid must be a 24 character "
+                                "hex string");
+                    return 0;
+                }
+                oid[i] = (char)((high << 4) | low);
+            }
+            if (!_json_scratch(parser, oid, 12)) {
+                return 0;
+            }
+            result_type = 7;
+            break;
+        }
+    case JSON_REF:
+        {
+            /* Like DBRef.as_doc, without any other fields. */
+            if (type != 2) {
+                PyErr_SetString(PyExc_TypeError, "$ref must be a string");
+                return 0;
+            }
+            other = _json_require(document, "$id", &other_type);
+            if (!other) {
+                return 0;
+            }
+            if (!_json_scratch(parser, "\0\0\0\0", 4) ||
+                !_json_scratch_element(parser, document, "$ref",
+                                       type, value) ||
+                !_json_scratch_element(parser, document, "$id",
+                                       other_type, other)) {
+                return 0;
+            }
+            other = _json_find(document, "$db", &other_type);
+            if (other && other_type != 10) {
+                if (other_type != 2) {
+                    PyErr_SetString(PyExc_TypeError,
+                                    "$db must be a string");
+                    return 0;
+                }
+                if (!_json_scratch_element(parser, document, "$db",
+                                           other_type, other)) {
+                    return 0;
+                }
+            }
+            if (!_json_scratch(parser, "\0", 1)) {
+                return 0;
+            }
+            _json_fill_length(parser->scratch, 0);
+            result_type = 3;
+            break;
+        }
+    case JSON_DATE:
+        if (!_json_convert_date(parser, value, type)) {
+            return 0;
+        }
+        result_type = 9;
+        break;
+    case JSON_REGEX:
+        {
+            const char* options;
+            int options_length;
+            if (type != 2) {
+                PyErr_SetString(PyExc_TypeError, "$regex must be a string");
+                return 0;
+            }
+            other = _json_require(document, "$options", &other_type);
+            if (!other) {
+                return 0;
+            }
+            if (other_type != 2) {
+                PyErr_SetString(PyExc_TypeError,
+                                "$options must be a string");
+                return 0;
+            }
+            memcpy(&length, value, 4);
+            if (memchr(value + 4, 0, length - 1)) {
+                _json_raise("InvalidDocument", "BSON keys / regex patterns "
+                            "must not contain a NULL character");
+                return 0;
+            }
+            memcpy(&options_length, other, 4);
+            options = other + 4;
+            /* json_util only keeps re.IGNORECASE and re.MULTILINE. */
+            if (!_json_scratch(parser, value + 4, length) ||
+                (memchr(options, 'i', options_length - 1) &&
+                 !_json_scratch(parser, "i", 1)) ||
+                (memchr(options, 'm', options_length - 1) &&
+                 !_json_scratch(parser, "m", 1)) ||
+                !_json_scratch(parser, "\0", 1)) {
+                return 0;
+            }
+            result_type = 11;
+            break;
+        }
+    case JSON_MIN_KEY:
+        result_type = 255;
+        break;
+    case JSON_MAX_KEY:
+        result_type = 127;
+        break;
+    case JSON_BINARY:
+        {
+            long long subtype;
+            int data_length;
+            if (type != 2) {
+                PyErr_SetString(PyExc_TypeError, "$binary must be a string");
+                return 0;
+            }
+            other = _json_require(document, "$type", &other_type);
+            if (!other) {
+                return 0;
+            }
+            if (other_type == 16) {
+                int i;
+                memcpy(&i, other, 4);
+                subtype = i;
+            } else if (other_type == 18) {
+                memcpy(&subtype, other, 8);
+            } else {
+                PyErr_SetString(PyExc_TypeError,
+                                "subtype must be an instance of int");
+                return 0;
+            }
+            if (subtype < 0 || subtype > 255) {
+                PyErr_SetString(PyExc_ValueError,
+                                "subtype must be contained in [0, 256)");
+                return 0;
+            }
+            /* Room for the lengths and subtype, filled in below. */
+            if (!_json_scratch(parser, "\0\0\0\0\0\0\0\0\0",
+                               subtype == 2 ? 9 : 5)) {
+                return 0;
+            }
+            memcpy(&length, value, 4);
+            if (!_json_base64_decode(parser, value + 4, length - 1)) {
+                return 0;
+            }
+            data_length = buffer_get_position(parser->scratch) -
+                (subtype == 2 ? 9 : 5);
+            if (subtype == 2) {
+                /* The old binary subtype repeats the length. */
+                int outer_length = data_length + 4;
+                memcpy(buffer_get_buffer(parser->scratch), &outer_length, 4);
+                memcpy(buffer_get_buffer(parser->scratch) + 5,
+                       &data_length, 4);
+            } else {
+                memcpy(buffer_get_buffer(parser->scratch), &data_length, 4);
+            }
+            buffer_get_buffer(parser->scratch)[4] = (char)subtype;
+            result_type = 5;
+            break;
+        }
+    case JSON_CODE:
+        {
+            int scope_size = 5;
+            if (type != 2) {
+                PyErr_SetString(PyExc_TypeError,
+                                "code must be an instance of basestring");
+                return 0;
+            }
+            other = _json_find(document, "$scope", &other_type);
+            if (other && other_type != 10) {
+                if (other_type != 3) {
+                    PyErr_SetString(PyExc_TypeError,
+                                    "scope must be an instance of dict");
+                    return 0;
+                }
+                memcpy(&scope_size, other, 4);
+            }
+            memcpy(&length, value, 4);
+            /* Like Code, which is encoded with its scope only if the
+             * scope isn't empty. */
+            if (scope_size == 5) {
+                if (!_json_scratch(parser, value, length + 4)) {
+                    return 0;
+                }
+                result_type = 13;
+                break;
+            }
+            if (!_json_scratch(parser, "\0\0\0\0", 4) ||
+                !_json_scratch(parser, value, length + 4) ||
+                !_json_scratch(parser, other, scope_size)) {
+                return 0;
+            }
+            _json_fill_length(parser->scratch, 0);
+            result_type = 15;
+            break;
+        }
+    case JSON_UUID:
+        if (!_json_convert_uuid(parser, value, type)) {
+            return 0;
+        }
+        result_type = 5;
+        break;
+    default:
+        return 3;
+    }
+
+    buffer_truncate(parser->buffer, value_start);
+    if (!buffer_write_bytes(parser->buffer,
+                            buffer_get_buffer(parser->scratch),
+                            buffer_get_position(parser->scratch))) {
+        return 0;
+    }
+    return result_type;
+}
+
+/* Parse the JSON object at the current position to a document. The
+ * "_id" of a `top_level` document is moved to the front, like
+ * BSON.encode does.
+ *
+ * Returns 1 if it has a name starting with '$', 0 if not, or -1. */
+static int _json_parse_object(json_parser_t* parser, int top_level) {
+    int length_location = buffer_save_space(parser->buffer, 4);
+    int id_start = -1;
+    int id_end = -1;
+    int dollar = 0;
+
+    if (length_location == -1) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    parser->position++;
+    _json_skip_whitespace(parser);
+    if (parser->position < parser->length &&
+        parser->string[parser->position] == '}') {
+        parser->position++;
+    } else {
+        for (;;) {
+            int type_byte;
+            const char* name;
+            int name_length;
+            if (parser->position >= parser->length ||
+                parser->string[parser->position] != '"') {
+                _json_syntax_error(parser, "Expecting property name");
+                return -1;
+            }
+            type_byte = buffer_save_space(parser->buffer, 1);
+            if (type_byte == -1) {
+                PyErr_NoMemory();
+                return -1;
+            }
+            name_length = _json_parse_string(parser, 1);
+            if (name_length == -1) {
+                return -1;
+            }
+            name = buffer_get_buffer(parser->buffer) + type_byte + 1;
+            if (name[0] == '$') {
+                dollar = 1;
+            }
+            if (top_level && name_length == 3 && !memcmp(name, "_id", 3)) {
+                id_start = type_byte;
+            }
+            _json_skip_whitespace(parser);
+            if (parser->position >= parser->length ||
+                parser->string[parser->position] != ':') {
+                _json_syntax_error(parser, "Expecting : delimiter");
+                return -1;
+            }
+            parser->position++;
+            _json_skip_whitespace(parser);
+            if (!_json_parse_value(parser, type_byte)) {
+                return -1;
+            }
+            if (id_start == type_byte) {
+                id_end = buffer_get_position(parser->buffer);
+            }
+            _json_skip_whitespace(parser);
+            if (parser->position < parser->length &&
+                parser->string[parser->position] == ',') {
+                parser->position++;
+                _json_skip_whitespace(parser);
+                continue;
+            }
+            if (parser->position < parser->length &&
+                parser->string[parser->position] == '}') {
+                parser->position++;
+                break;
+            }
+            _json_syntax_error(parser, "Expecting , delimiter");
+            return -1;
+        }
+    }
+    if (!buffer_write_bytes(parser->buffer, "\0", 1)) {
+        return -1;
+    }
+    _json_fill_length(parser->buffer, length_location);
+
+    if (id_start > length_location + 4) {
+        /* Rotate the _id element to the front of the document. */
+        char* document = buffer_get_buffer(parser->buffer);
+        int before = id_start - (length_location + 4);
+        buffer_truncate(parser->scratch, 0);
+        if (!_json_scratch(parser, document + id_start, id_end - id_start)) {
+            return -1;
+        }
+        memmove(document + length_location + 4 + (id_end - id_start),
+                document + length_location + 4, before);
+        memcpy(document + length_location + 4,
+               buffer_get_buffer(parser->scratch), id_end - id_start);
+    }
+    return dollar;
+}
+
+static int _json_parse_array(json_parser_t* parser) {
+    int length_location = buffer_save_space(parser->buffer, 4);
+    int index = 0;
+
+    if (length_location == -1) {
+        PyErr_NoMemory();
+        return 0;
+    }
+    parser->position++;
+    _json_skip_whitespace(parser);
+    if (parser->position < parser->length &&
+        parser->string[parser->position] == ']') {
+        parser->position++;
+    } else {
+        for (;;) {
+            char name[16];
+            int type_byte = buffer_save_space(parser->buffer, 1);
+            if (type_byte == -1) {
+                PyErr_NoMemory();
+                return 0;
+            }
+            PyOS_snprintf(name, sizeof(name), "%d", index++);
+            if (!buffer_write_bytes(parser->buffer, name,
+                                    (int)strlen(name) + 1)) {
+                return 0;
+            }
+            if (!_json_parse_value(parser, type_byte)) {
+                return 0;
+            }
+            _json_skip_whitespace(parser);
+            if (parser->position < parser->length &&
+                parser->string[parser->position] == ',') {
+                parser->position++;
+                _json_skip_whitespace(parser);
+                continue;
+            }
+            if (parser->position < parser->length &&
+                parser->string[parser->position] == ']') {
+                parser->position++;
+                break;
+            }
+            _json_syntax_error(parser, "Expecting , delimiter");
+            return 0;
+        }
+    }
+    if (!buffer_write_bytes(parser->buffer, "\0", 1)) {
+        return 0;
+    }
+    return _json_fill_length(parser->buffer, length_location);
+}
+
+static int _json_write_constant(json_parser_t* parser, double value) {
+    return buffer_write_bytes(parser->buffer, (const char*)&value, 8);
+}
+
+/* Parse the JSON value at the current position, and set the byte at
+ * `type_byte` to its BSON type. */
+static int _json_parse_value(json_parser_t* parser, int type_byte) {
+    int type;
+    int value_start = buffer_get_position(parser->buffer);
+    if (parser->position >= parser->length) {
+        _json_syntax_error(parser, "No JSON object could be decoded");
+        return 0;
+    }
+    switch (parser->string[parser->position]) {
+    case '{':
+        {
+            int dollar;
+            if (Py_EnterRecursiveCall(" while converting JSON to BSON")) {
+                return 0;
+            }
+            dollar = _json_parse_object(parser, 0);
+            Py_LeaveRecursiveCall();
+            if (dollar == -1) {
+                return 0;
+            }
+            type = 3;
+            if (dollar) {
+                int special = _json_special(
+                    parser, buffer_get_buffer(parser->buffer) + value_start);
+                if (special != -1) {
+                    type = _json_convert(parser, special, value_start);
+                    if (!type) {
+                        return 0;
+                    }
+                }
+            }
+            break;
+        }
+    case '[':
+        {
+            int result;
+            if (Py_EnterRecursiveCall(" while converting JSON to BSON")) {
+                return 0;
+            }
+            result = _json_parse_array(parser);
+            Py_LeaveRecursiveCall();
+            if (!result) {
+                return 0;
+            }
+            type = 4;
+            break;
+        }
+    case '"':
+        {
+            int length;
+            int length_location = buffer_save_space(parser->buffer, 4);
+            if (length_location == -1) {
+                PyErr_NoMemory();
+                return 0;
+            }
+            length = _json_parse_string(parser, 0);
+            if (length == -1) {
+                return 0;
+            }
+            length++;
+            memcpy(buffer_get_buffer(parser->buffer) + length_location,
+                   &length, 4);
+            type = 2;
+            break;
+        }
+    default:
+        if (_json_match(parser, "true")) {
+            if (!buffer_write_bytes(parser->buffer, "\1", 1)) {
+                return 0;
+            }
+            type = 8;
+        } else if (_json_match(parser, "false")) {
+            if (!buffer_write_bytes(parser->buffer, "\0", 1)) {
+                return 0;
+            }
+            type = 8;
+        } else if (_json_match(parser, "null")) {
+            type = 10;
+        } else if (_json_match(parser, "NaN")) {
+            if (!_json_write_constant(parser, Py_NAN)) {
+                return 0;
+            }
+            type = 1;
+        } else if (_json_match(parser, "Infinity")) {
+            if (!_json_write_constant(parser, Py_HUGE_VAL)) {
+                return 0;
+            }
+            type = 1;
+        } else if (_json_match(parser, "-Infinity")) {
+            if (!_json_write_constant(parser, -Py_HUGE_VAL)) {
+                return 0;
+            }
+            type = 1;
+        } else {
+            type = _json_parse_number(parser);
+            if (!type) {
+                return 0;
+            }
+        }
+    }
+    buffer_get_buffer(parser->buffer)[type_byte] = (char)type;
+    return 1;
+}
+
+static PyObject* _cbson_json_to_bson(PyObject* self, PyObject* args) {
+    PyObject* text;
+    PyObject* encoded = NULL;
+    unsigned char uuid_subtype = 3;
+    bson_view_t view;
+    json_parser_t parser;
+    PyObject* result = NULL;
+    int dollar;
+
+    if (!PyArg_ParseTuple(args, "O|b", &text, &uuid_subtype)) {
+        return NULL;
+    }
+    if (PyUnicode_Check(text)) {
+        encoded = PyUnicode_AsUTF8String(text);
+        if (!encoded) {
+            /* Python 3 doesn't encode surrogates. */
+            if (PyErr_ExceptionMatches(PyExc_UnicodeEncodeError)) {
+                PyErr_Clear();
+                _json_raise("InvalidStringData",
+                            "strings in documents must be valid UTF-8");
+            }
+            return NULL;
+        }
+        text = encoded;
+    }
+    if (!_get_view(text, 0, &view, "_json_to_bson")) {
+        Py_XDECREF(encoded);
+        return NULL;
+    }
+    if (!encoded && check_string((const unsigned char*)view.string,
+                                 (int)view.size, 1, 0) != VALID) {
+        /* Raise the same error as decoding the text would. */
+        PyObject* decoded = PyUnicode_DecodeUTF8(view.string, view.size,
+                                                 "strict");
+        if (decoded) {
+            Py_DECREF(decoded);
+            PyErr_SetString(PyExc_ValueError, "invalid UTF-8 in JSON text");
+        }
+        goto done;
+    }
+
+    parser.string = view.string;
+    parser.length = view.size;
+    parser.position = 0;
+    parser.uuid_subtype = uuid_subtype;
+    parser.has_uuid = GETSTATE(self)->UUID != NULL;
+    parser.buffer = buffer_get_scratch();
+    if (!parser.buffer) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    parser.scratch = buffer_new();
+    if (!parser.scratch) {
+        buffer_free(parser.buffer);
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    _json_skip_whitespace(&parser);
+    if (parser.position >= parser.length) {
+        _json_syntax_error(&parser, "No JSON object could be decoded");
+        goto fail;
+    }
+    if (parser.string[parser.position] != '{') {
+        if (strchr("[\"-0123456789tfnNI", parser.string[parser.position])) {
+            _json_raise("InvalidDocument", "JSON text must be an object");
+        } else {
+            _json_syntax_error(&parser, "No JSON object could be decoded");
+        }
+        goto fail;
+    }
+    dollar = _json_parse_object(&parser, 1);
+    if (dollar == -1) {
+        goto fail;
+    }
+    if (dollar && _json_special(&parser,
+                                buffer_get_buffer(parser.buffer)) != -1) {
+        _json_raise("InvalidDocument", "JSON text must be an object, not "
+                    "the extended JSON for a value");
+        goto fail;
+    }
+    _json_skip_whitespace(&parser);
+    if (parser.position != parser.length) {
+        _json_syntax_error(&parser, "Extra data");
+        goto fail;
+    }
+
+#if PY_MAJOR_VERSION >= 3
+    result = Py_BuildValue("y#", buffer_get_buffer(parser.buffer),
+                           buffer_get_position(parser.buffer));
+#else
+    result = Py_BuildValue("s#", buffer_get_buffer(parser.buffer),
+                           buffer_get_position(parser.buffer));
+#endif
+    buffer_release(parser.buffer);
+    buffer_free(parser.scratch);
+    goto done;
+
+fail:
+    buffer_free(parser.buffer);
+    buffer_free(parser.scratch);
+done:
+    _release_view(&view);
+    Py_XDECREF(encoded);
     return result;
 }
 
 static PyMethodDef _CBSONMethods[] = {
     {"_dict_to_bson", _cbson_dict_to_bson, METH_VARARGS,
      "convert a dictionary to a string containing its BSON representation."},
+    {"_encode_into", _cbson_encode_into, METH_VARARGS,
+     "encode a sequence of documents into a writable buffer."},
     {"_bson_to_dict", _cbson_bson_to_dict, METH_VARARGS,
      "convert a BSON string to a SON object."},
     {"decode_all", _cbson_decode_all, METH_VARARGS,
      "convert binary data to a sequence of documents."},
+    {"_validate", _cbson_validate, METH_VARARGS,
+     "check that binary data is exactly one structurally valid document."},
+    {"_element_to_dict", _cbson_element_to_dict, METH_VARARGS,
+     "decode the single BSON element at a position in a BSON string."},
+    {"_decode_columns", _cbson_decode_columns, METH_VARARGS,
+     "decode binary data to the packed values of columns of fields."},
+    {"_generate_oids", _cbson_generate_oids, METH_VARARGS,
+     "generate the binary values of new ObjectIds."},
+    {"_oid_to_hex", _cbson_oid_to_hex, METH_VARARGS,
+     "convert the binary value of an ObjectId to hex."},
+    {"_oid_from_hex", _cbson_oid_from_hex, METH_VARARGS,
+     "convert a hex ObjectId to its binary value."},
+    {"_bson_to_json", _cbson_bson_to_json, METH_VARARGS,
+     "convert binary data to the extended JSON text of its documents."},
+    {"_json_to_bson", _cbson_json_to_bson, METH_VARARGS,
+     "convert extended JSON text of a document to BSON."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -1819,6 +6054,13 @@ static int _cbson_traverse(PyObject *m, visitproc visit, void *arg) {
     Py_VISIT(GETSTATE(m)->MinKey);
     Py_VISIT(GETSTATE(m)->MaxKey);
     Py_VISIT(GETSTATE(m)->UTC);
+    Py_VISIT(GETSTATE(m)->RawBSONDocument);
+    Py_VISIT(GETSTATE(m)->Regex);
+    Py_VISIT(GETSTATE(m)->CompileRegex);
+    Py_VISIT(GETSTATE(m)->BSON);
+    Py_VISIT(GETSTATE(m)->Array);
+    Py_VISIT(GETSTATE(m)->Record);
+    Py_VISIT(GETSTATE(m)->RecordMissing);
     Py_VISIT(GETSTATE(m)->REType);
     return 0;
 }
@@ -1834,6 +6076,13 @@ static int _cbson_clear(PyObject *m) {
     Py_CLEAR(GETSTATE(m)->MinKey);
     Py_CLEAR(GETSTATE(m)->MaxKey);
     Py_CLEAR(GETSTATE(m)->UTC);
+    Py_CLEAR(GETSTATE(m)->RawBSONDocument);
+    Py_CLEAR(GETSTATE(m)->Regex);
+    Py_CLEAR(GETSTATE(m)->CompileRegex);
+    Py_CLEAR(GETSTATE(m)->BSON);
+    Py_CLEAR(GETSTATE(m)->Array);
+    Py_CLEAR(GETSTATE(m)->Record);
+    Py_CLEAR(GETSTATE(m)->RecordMissing);
     Py_CLEAR(GETSTATE(m)->REType);
     return 0;
 }
@@ -1882,6 +6131,7 @@ init_cbson(void)
         Py_DECREF(m);
         INITERROR;
     }
+    _init_index_keys();
 
     /* Export C API */
     _cbson_API[_cbson_buffer_write_bytes_INDEX] = (void *) buffer_write_bytes;
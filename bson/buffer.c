@@ -20,13 +20,38 @@
 #include "buffer.h"
 
 #define INITIAL_BUFFER_SIZE 256
+/* Larger buffers are freed rather than kept by buffer_release. */
+#define MAX_SCRATCH_BUFFER_SIZE (4 * 1024 * 1024)
+
+/* A gap left by buffer_write_gap. */
+struct gap {
+    int position;
+    int size;
+    void* owner;
+    buffer_gap_release release;
+};
 
 struct buffer {
     char* buffer;
     int size;
     int position;
+    int gap_threshold;
+    struct gap* gaps;
+    int gap_count;
+    int gap_capacity;
+    int gap_total;
 };
 
+/* Release the gaps of `buffer` at or after `position`. */
+static void buffer_release_gaps(buffer_t buffer, buffer_position position) {
+    while (buffer->gap_count &&
+           buffer->gaps[buffer->gap_count - 1].position >= position) {
+        struct gap* gap = &buffer->gaps[--buffer->gap_count];
+        buffer->gap_total -= gap->size;
+        gap->release(gap->owner);
+    }
+}
+
 /* Allocate and return a new buffer.
  * Return NULL on allocation failure. */
 buffer_t buffer_new(void) {
@@ -38,6 +63,11 @@ buffer_t buffer_new(void) {
 
     buffer->size = INITIAL_BUFFER_SIZE;
     buffer->position = 0;
+    buffer->gap_threshold = 0;
+    buffer->gaps = NULL;
+    buffer->gap_count = 0;
+    buffer->gap_capacity = 0;
+    buffer->gap_total = 0;
     buffer->buffer = (char*)malloc(sizeof(char) * INITIAL_BUFFER_SIZE);
     if (buffer->buffer == NULL) {
         free(buffer);
@@ -53,11 +83,47 @@ int buffer_free(buffer_t buffer) {
     if (buffer == NULL) {
         return 1;
     }
+    buffer_release_gaps(buffer, 0);
+    free(buffer->gaps);
     free(buffer->buffer);
     free(buffer);
     return 0;
 }
 
+/* A buffer kept by buffer_release. Whoever calls buffer_get_scratch takes
+ * ownership of it, so a buffer is never shared between two callers, even if
+ * the GIL is released while it is being written to. */
+static buffer_t scratch_buffer = NULL;
+
+/* Return an empty buffer, reusing the memory of a buffer passed to
+ * buffer_release if there is one, or allocating a new buffer.
+ * Return NULL on allocation failure. */
+buffer_t buffer_get_scratch(void) {
+    buffer_t buffer = scratch_buffer;
+    if (buffer == NULL) {
+        return buffer_new();
+    }
+    scratch_buffer = NULL;
+    buffer->position = 0;
+    return buffer;
+}
+
+/* Keep `buffer` for reuse by the next call to buffer_get_scratch, or free it
+ * if a buffer is already kept or `buffer` has grown too large to keep.
+ * Return non-zero on failure. */
+int buffer_release(buffer_t buffer) {
+    if (buffer == NULL) {
+        return 1;
+    }
+    if (scratch_buffer != NULL || buffer->size > MAX_SCRATCH_BUFFER_SIZE) {
+        return buffer_free(buffer);
+    }
+    buffer_release_gaps(buffer, 0);
+    buffer->gap_threshold = 0;
+    scratch_buffer = buffer;
+    return 0;
+}
+
 /* Grow `buffer` to at least `min_length`.
  * Return non-zero on allocation failure. */
 static int buffer_grow(buffer_t buffer, int min_length) {
@@ -78,8 +144,8 @@ static int buffer_grow(buffer_t buffer, int min_length) {
     }
     buffer->buffer = (char*)realloc(buffer->buffer, sizeof(char) * size);
     if (buffer->buffer == NULL) {
-        free(old_buffer);
-        free(buffer);
+        buffer->buffer = old_buffer;
+        buffer_free(buffer);
         return 1;
     }
     buffer->size = size;
@@ -132,6 +198,78 @@ int buffer_write_at_position(buffer_t buffer, buffer_position position,
     return 0;
 }
 
+/* Discard everything written to `buffer` after `position`. */
+void buffer_truncate(buffer_t buffer, buffer_position position) {
+    if (position >= 0 && position < buffer->position) {
+        buffer->position = position;
+    }
+}
+
+/* Leave a gap of `size` bytes at the current position in `buffer`, for
+ * the contents of `owner`. They aren't copied to `buffer`, but sent as a
+ * separate segment (see buffer_get_gap). `release` is called with `owner`
+ * once the gap is discarded.
+ * Return non-zero on allocation failure. */
+int buffer_write_gap(buffer_t buffer, void* owner, int size,
+                     buffer_gap_release release) {
+    struct gap* gap;
+    if (buffer->gap_count == buffer->gap_capacity) {
+        int capacity = buffer->gap_capacity ? buffer->gap_capacity * 2 : 4;
+        struct gap* gaps = (struct gap*)realloc(buffer->gaps,
+                                                sizeof(struct gap) * capacity);
+        if (gaps == NULL) {
+            buffer_free(buffer);
+            return 1;
+        }
+        buffer->gaps = gaps;
+        buffer->gap_capacity = capacity;
+    }
+    gap = &buffer->gaps[buffer->gap_count++];
+    gap->position = buffer->position;
+    gap->size = size;
+    gap->owner = owner;
+    gap->release = release;
+    buffer->gap_total += size;
+    return 0;
+}
+
+/* Set the size from which values are written as gaps rather than copied
+ * to `buffer`. 0, the default, disables gaps. */
+void buffer_set_gap_threshold(buffer_t buffer, int threshold) {
+    buffer->gap_threshold = threshold;
+}
+
+int buffer_get_gap_threshold(buffer_t buffer) {
+    return buffer->gap_threshold;
+}
+
+/* Return the total size of the gaps in `buffer` after `position`. */
+int buffer_get_gap_size(buffer_t buffer, buffer_position position) {
+    int size = 0;
+    int i;
+    for (i = buffer->gap_count - 1;
+         i >= 0 && buffer->gaps[i].position > position; i--) {
+        size += buffer->gaps[i].size;
+    }
+    return size;
+}
+
+int buffer_get_gap_total(buffer_t buffer) {
+    return buffer->gap_total;
+}
+
+int buffer_get_gap_count(buffer_t buffer) {
+    return buffer->gap_count;
+}
+
+/* Get the position and owner of gap number `index` of `buffer`. The
+ * gaps are in order of position. */
+void buffer_get_gap(buffer_t buffer, int index,
+                    buffer_position* position, void** owner) {
+    *position = buffer->gaps[index].position;
+    *owner = buffer->gaps[index].owner;
+}
+
 
 int buffer_get_position(buffer_t buffer) {
     return buffer->position;
@@ -33,6 +33,16 @@ buffer_t buffer_new(void);
  * Return non-zero on failure. */
 int buffer_free(buffer_t buffer);
 
+/* Return an empty buffer, reusing the memory of a buffer passed to
+ * buffer_release if there is one, or allocating a new buffer.
+ * Return NULL on allocation failure. */
+buffer_t buffer_get_scratch(void);
+
+/* Keep `buffer` for reuse by the next call to buffer_get_scratch, or free it
+ * if a buffer is already kept or `buffer` has grown too large to keep.
+ * Return non-zero on failure. */
+int buffer_release(buffer_t buffer);
+
 /* Save `size` bytes from the current position in `buffer` (and grow if needed).
  * Return offset for writing, or -1 on allocation failure. */
 buffer_position buffer_save_space(buffer_t buffer, int size);
@@ -46,6 +56,36 @@ int buffer_write(buffer_t buffer, const char* data, int size);
  * Return non-zero if buffer isn't large enough for write. */
 int buffer_write_at_position(buffer_t buffer, buffer_position position, const char* data, int size);
 
+/* Discard everything written to `buffer` after `position`. */
+void buffer_truncate(buffer_t buffer, buffer_position position);
+
+/* Called with the owner of a gap once the gap is discarded. */
+typedef void (*buffer_gap_release)(void* owner);
+
+/* Leave a gap of `size` bytes at the current position in `buffer`, for
+ * the contents of `owner`. They aren't copied to `buffer`, but sent as a
+ * separate segment (see buffer_get_gap). `release` is called with `owner`
+ * once the gap is discarded.
+ * Return non-zero on allocation failure. */
+int buffer_write_gap(buffer_t buffer, void* owner, int size,
+                     buffer_gap_release release);
+
+/* Set the size from which values are written as gaps rather than copied
+ * to `buffer`. 0, the default, disables gaps. */
+void buffer_set_gap_threshold(buffer_t buffer, int threshold);
+int buffer_get_gap_threshold(buffer_t buffer);
+
+/* Return the total size of the gaps in `buffer` after `position`, e.g.
+ * after a length that must include them, and of all its gaps. */
+int buffer_get_gap_size(buffer_t buffer, buffer_position position);
+int buffer_get_gap_total(buffer_t buffer);
+
+/* Get the number of gaps in `buffer`, and the position and owner of gap
+ * number `index`. The gaps are in order of position. */
+int buffer_get_gap_count(buffer_t buffer);
+void buffer_get_gap(buffer_t buffer, int index,
+                    buffer_position* position, void** owner);
+
 /* Getters for the internals of a buffer_t.
  * Should try to avoid using these as much as possible
  * since they break the abstraction. */
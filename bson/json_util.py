@@ -32,7 +32,7 @@ Example usage (serialization)::
    ...        {'bar': {'hello': 'world'}},
    ...        {'code': Code("function x() { return 1; }")},
    ...        {'bin': Binary("\x00\x01\x02\x03\x04")}])
-   '[{"foo": [1, 2]}, {"bar": {"hello": "world"}}, {"code": {"$scope": {}, "$code": "function x() { return 1; }"}}, {"bin": {"$type": 0, "$binary": "AAECAwQ=\\n"}}]'
+   '[{"foo": [1, 2]}, {"bar": {"hello": "world"}}, {"code": {"$code": "function x() { return 1; }", "$scope": {}}}, {"bin": {"$binary": "AAECAwQ=\\n", "$type": 0}}]'
 
 Example usage (deserialization)::
 
@@ -42,11 +42,21 @@ Example usage (deserialization)::
    >>> loads('[{"foo": [1, 2]}, {"bar": {"hello": "world"}}, {"code": {"$scope": {}, "$code": "function x() { return 1; }"}}, {"bin": {"$type": 0, "$binary": "AAECAwQ=\\n"}}]')
    [{u'foo': [1, 2]}, {u'bar': {u'hello': u'world'}}, {u'code': Code('function x() { return 1; }', {})}, {u'bin': Binary('\x00\x01\x02\x03\x04', 0)}]
 
+To skip the Python objects entirely, :func:`bson_to_json` converts BSON
+straight to the same JSON text, :func:`json_to_bson` converts JSON text
+straight to BSON, and :func:`dump_cursor` writes all the results of a
+:class:`~pymongo.cursor.Cursor` as JSON. With the C extension these don't
+create any Python objects for the values, and are much faster.
+
 Alternatively, you can manually pass the `default` to :func:`json.dumps`.
 It won't handle :class:`~bson.binary.Binary` and :class:`~bson.code.Code`
 instances (as they are extended strings you can't provide custom defaults),
 but it will be faster as there is less recursion.
 
+.. versionchanged:: 2.4
+   Added :func:`bson_to_json`, :func:`json_to_bson` and
+   :func:`dump_cursor`.
+
 .. versionchanged:: 2.3
    Added dumps and loads helpers to automatically handle conversion to and
    from json and supports :class:`~bson.binary.Binary` and
@@ -72,6 +82,7 @@ import base64
 import calendar
 import datetime
 import re
+import sys
 
 json_lib = True
 try:
@@ -84,19 +95,43 @@ except ImportError:
 
 import bson
 from bson import EPOCH_AWARE
-from bson.binary import Binary
+from bson.binary import Binary, OLD_UUID_SUBTYPE
 from bson.code import Code
 from bson.dbref import DBRef
+from bson.errors import InvalidDocument, InvalidStringData
 from bson.max_key import MaxKey
 from bson.min_key import MinKey
 from bson.objectid import ObjectId
+from bson.son import SON
 from bson.timestamp import Timestamp
 
-from bson.py3compat import PY3, binary_type, string_types
+from bson.py3compat import PY3, binary_type, string_types, text_type
 
 # TODO share this with bson.py?
 _RE_TYPE = type(re.compile("foo"))
 
+# The names object_hook checks for, which make an object the extended
+# JSON for a value.
+_SPECIAL_NAMES = ("$oid", "$ref", "$date", "$regex", "$minKey", "$maxKey",
+                  "$binary", "$code")
+
+# A surrogate that isn't part of a pair can't be encoded as UTF-8. Wide
+# builds join the escapes of a pair into one character.
+if sys.maxunicode > 0xFFFF:
+    _LONE_SURROGATE = re.compile(u"[\ud800-\udfff]")
+else:
+    _LONE_SURROGATE = re.compile(u"[\ud800-\udbff](?![\udc00-\udfff])|"
+                                 u"(?<![\ud800-\udbff])[\udc00-\udfff]")
+
+# object_pairs_hook keeps the order of the names in JSON objects.
+_use_pairs_hook = False
+if json_lib:
+    try:
+        json.loads("{}", object_pairs_hook=SON)
+        _use_pairs_hook = True
+    except TypeError:
+        pass
+
 
 def dumps(obj, *args, **kwargs):
     """Helper function that wraps :class:`json.dumps`.
@@ -120,16 +155,203 @@ def loads(s, *args, **kwargs):
     return json.loads(s, *args, **kwargs)
 
 
+def bson_to_json(data, uuid_subtype=OLD_UUID_SUBTYPE):
+    """Convert a BSON document to extended JSON text.
+
+    The text is what :func:`dumps` returns for the decoded document,
+    except that the names are in the order of the BSON document. With
+    the C extension the document is never decoded, which is much faster.
+    Type registries are not applied.
+
+    :Parameters:
+      - `data`: a single BSON document, as a string or any other object
+        supporting the buffer protocol
+      - `uuid_subtype` (optional): the subtype binary UUIDs were
+        encoded with
+
+    .. versionadded:: 2.4
+    """
+    return _bson_to_json(data, uuid_subtype, None)
+
+
+def json_to_bson(s, uuid_subtype=OLD_UUID_SUBTYPE):
+    """Convert the extended JSON text of a document to BSON.
+
+    The document is the one :func:`loads` returns for `s`, encoded with
+    the names in the order of the JSON text. With the C extension no
+    Python objects are created for it, which is much faster. A name
+    repeated in an object is kept as it is, rather than replaced by its
+    last value. The result can be passed to
+    :meth:`~pymongo.collection.Collection.insert` as it is.
+
+    Raises :class:`~bson.errors.InvalidDocument` if `s` isn't the text
+    of a document, and :class:`~bson.errors.InvalidStringData` if a
+    string has a surrogate that isn't part of a pair.
+
+    :Parameters:
+      - `s`: the JSON text, as a string (UTF-8 if it is bytes)
+      - `uuid_subtype` (optional): the subtype to encode UUIDs with
+
+    .. versionadded:: 2.4
+    """
+    return bson.BSON(_json_to_bson(s, uuid_subtype))
+
+
+def dump_cursor(cursor, fp, json_lines=False):
+    """Write all the results of `cursor` to `fp` as extended JSON.
+
+    Each batch of results is converted straight from the server's reply
+    with :func:`bson_to_json`, without building any documents. The
+    results are written as a JSON array, or as JSON Lines (one document
+    per line) if `json_lines` is ``True``. The cursor is exhausted
+    afterwards. SON manipulators are not applied.
+
+    :Parameters:
+      - `cursor`: a :class:`~pymongo.cursor.Cursor` that hasn't been
+        used yet
+      - `fp`: a file-like object with a ``write`` method
+      - `json_lines` (optional): write JSON Lines instead of an array
+
+    .. versionadded:: 2.4
+    """
+    if json_lines:
+        separator = "\n"
+    else:
+        separator = ", "
+        fp.write("[")
+    uuid_subtype = cursor.collection.uuid_subtype
+    first = True
+    for batch in cursor.raw_batches():
+        if not first:
+            fp.write(separator)
+        first = False
+        fp.write(_bson_to_json(batch, uuid_subtype, separator))
+    if json_lines:
+        if not first:
+            fp.write("\n")
+    else:
+        fp.write("]")
+
+
+def load_json_lines(lines, uuid_subtype=OLD_UUID_SUBTYPE):
+    """Convert JSON Lines text, one extended JSON document per line, to
+    BSON.
+
+    A generator yielding a :class:`~bson.BSON` instance for each
+    document, converted with :func:`json_to_bson`. Blank lines are
+    skipped. The documents can be passed to
+    :meth:`~pymongo.collection.Collection.insert` as they are, or see
+    :meth:`~pymongo.collection.Collection.insert_json_lines`.
+
+    :Parameters:
+      - `lines`: an iterable of lines, e.g. a file opened in binary
+        mode
+      - `uuid_subtype` (optional): the subtype to encode UUIDs with
+
+    .. versionadded:: 2.4
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        yield bson.BSON(_json_to_bson(line, uuid_subtype))
+
+
+def _bson_to_json(data, uuid_subtype, separator):
+    """Convert the concatenated BSON documents in `data` to extended
+    JSON, joined by `separator`. If `separator` is ``None`` `data` must
+    be a single document.
+    """
+    if not json_lib:
+        raise Exception("No json library available")
+    documents = bson.decode_all(data, SON, True, uuid_subtype)
+    if separator is None:
+        if len(documents) != 1:
+            raise bson.InvalidBSON("data must be a single document")
+        separator = ""
+    return separator.join([dumps(document) for document in documents])
+
+
+def _json_to_bson(s, uuid_subtype):
+    """Convert the extended JSON text of a document to BSON bytes.
+    """
+    if not json_lib:
+        raise Exception("No json library available")
+    # The objects are converted after checking the top level one, so the
+    # errors are the same as the C extension's.
+    if _use_pairs_hook:
+        document = json.loads(s, object_pairs_hook=_checked_pairs_hook)
+    else:
+        document = json.loads(s, object_hook=_checked_object_hook)
+    if not isinstance(document, dict):
+        raise InvalidDocument("JSON text must be an object")
+    special = _SPECIAL_NAMES
+    if bson.has_uuid():
+        special += ("$uuid",)
+    for name in special:
+        if name in document:
+            raise InvalidDocument("JSON text must be an object, not the "
+                                  "extended JSON for a value")
+    return bson.BSON.encode(_convert_objects(document),
+                            uuid_subtype=uuid_subtype)
+
+
+def _check_strings(values):
+    """Raise :class:`~bson.errors.InvalidStringData` if a string in
+    `values`, or in a list in `values`, has an unpaired surrogate.
+    """
+    for value in values:
+        if isinstance(value, list):
+            _check_strings(value)
+        elif isinstance(value, text_type) and _LONE_SURROGATE.search(value):
+            raise InvalidStringData("strings in documents must be valid "
+                                    "UTF-8")
+
+
+def _checked_pairs_hook(pairs):
+    for pair in pairs:
+        _check_strings(pair)
+    return SON(pairs)
+
+
+def _checked_object_hook(dct):
+    _check_strings(dct.keys())
+    _check_strings(dct.values())
+    return dct
+
+
+def _convert_objects(value):
+    """Apply :func:`object_hook` to the objects in `value`, innermost
+    first, like :func:`json.loads` does.
+    """
+    if isinstance(value, dict):
+        for key in value:
+            value[key] = _convert_objects(value[key])
+        return object_hook(value)
+    if isinstance(value, list):
+        return [_convert_objects(item) for item in value]
+    return value
+
+# Kept to check the C extension's output against.
+_py_bson_to_json = _bson_to_json
+_py_json_to_bson = _json_to_bson
+if bson._use_c:
+    _bson_to_json = bson._cbson._bson_to_json
+    _json_to_bson = bson._cbson._json_to_bson
+
+
 def _json_convert(obj):
     """Recursive helper method that converts BSON types so they can be
     converted into json.
     """
+    if isinstance(obj, SON):
+        return SON(((k, _json_convert(v)) for k, v in obj.iteritems()))
     if hasattr(obj, 'iteritems') or hasattr(obj, 'items'):  # PY3 support
         return dict(((k, _json_convert(v)) for k, v in obj.iteritems()))
     elif hasattr(obj, '__iter__') and not isinstance(obj, string_types):
         return list((_json_convert(v) for v in obj))
     try:
-        return default(obj)
+        # The id of a DBRef and the scope of a Code need converting too.
+        return _json_convert(default(obj))
     except TypeError:
         return obj
 
@@ -180,22 +402,21 @@ def default(obj):
             flags += "i"
         if obj.flags & re.MULTILINE:
             flags += "m"
-        return {"$regex": obj.pattern,
-                "$options": flags}
+        return SON([("$regex", obj.pattern), ("$options", flags)])
     if isinstance(obj, MinKey):
         return {"$minKey": 1}
     if isinstance(obj, MaxKey):
         return {"$maxKey": 1}
     if isinstance(obj, Timestamp):
-        return {"t": obj.time, "i": obj.inc}
+        return SON([("t", obj.time), ("i", obj.inc)])
     if isinstance(obj, Code):
-        return {'$code': "%s" % obj, '$scope': obj.scope}
+        return SON([('$code', "%s" % obj), ('$scope', obj.scope)])
     if isinstance(obj, Binary):
-        return {'$binary': base64.b64encode(obj).decode(),
-                '$type': obj.subtype}
+        return SON([('$binary', base64.b64encode(obj).decode()),
+                    ('$type', obj.subtype)])
     if PY3 and isinstance(obj, binary_type):
-        return {'$binary': base64.b64encode(obj).decode(),
-                '$type': 0}
+        return SON([('$binary', base64.b64encode(obj).decode()),
+                    ('$type', 0)])
     if bson.has_uuid() and isinstance(obj, bson.uuid.UUID):
         return {"$uuid": obj.hex}
     raise TypeError("%r is not JSON serializable" % obj)
@@ -0,0 +1,183 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tools for representing raw BSON documents.
+"""
+
+import struct
+
+import bson
+from bson.binary import OLD_UUID_SUBTYPE
+from bson.errors import InvalidBSON
+from bson.py3compat import b, binary_type
+
+ZERO = b("\x00")
+
+
+class RawBSONDocument(object):
+    """Representation for a MongoDB document that provides access to the
+    raw BSON bytes that compose it.
+
+    Only when a field is accessed is its value decoded. Fields that are
+    never read are never decoded, so documents that are large but only
+    partially used are much cheaper to work with than a :class:`dict`.
+    Embedded documents are returned as :class:`RawBSONDocument` instances
+    as well, so they are also decoded lazily.
+
+    :class:`RawBSONDocument` is read-only. It can be used as the
+    `as_class` parameter to :func:`~bson.decode_all`,
+    :meth:`~bson.BSON.decode` and
+    :meth:`~pymongo.collection.Collection.find`, or as the
+    `document_class` of a :class:`~pymongo.connection.Connection`.
+
+    Raises :class:`~bson.errors.InvalidBSON` if `bson_bytes` is not
+    exactly one BSON document.
+
+    :Parameters:
+      - `bson_bytes`: the BSON bytes that compose this document
+      - `tz_aware` (optional): if ``True``, return timezone-aware
+        :class:`~datetime.datetime` instances
+      - `uuid_subtype` (optional): the BSON binary subtype used for
+        decoding UUIDs
+      - `compile_re` (optional): if ``False``, decode regular
+        expressions as :class:`~bson.regex.Regex` instances instead of
+        compiling them
+
+    .. versionadded:: 2.4
+    """
+
+    def __init__(self, bson_bytes, tz_aware=False,
+                 uuid_subtype=OLD_UUID_SUBTYPE, compile_re=True):
+        if not isinstance(bson_bytes, binary_type):
+            raise TypeError("bson_bytes must be an instance "
+                            "of %s" % (binary_type.__name__,))
+        if len(bson_bytes) < 5:
+            raise InvalidBSON("not enough data for a BSON document")
+        obj_size = struct.unpack("<i", bson_bytes[:4])[0]
+        if obj_size != len(bson_bytes) or bson_bytes[-1:] != ZERO:
+            raise InvalidBSON("bad eoo")
+        self.__raw = bson_bytes
+        self.__tz_aware = tz_aware
+        self.__uuid_subtype = uuid_subtype
+        self.__compile_re = compile_re
+        # Maps each key to the position of its element, built on first use.
+        self.__positions = None
+        self.__keys = None
+        # Values that have already been decoded.
+        self.__decoded = {}
+
+    @property
+    def raw(self):
+        """The raw BSON bytes composing this document.
+        """
+        return self.__raw
+
+    def __index(self):
+        """Scan the element names once, skipping over the values.
+        """
+        if self.__positions is None:
+            positions = {}
+            keys = []
+            data = self.__raw
+            position = 4
+            end = len(data) - 1
+            while position < end:
+                element_position = position
+                element_type = data[position:position + 1]
+                name, position = bson._get_c_string(data, position + 1)
+                position = bson._element_end(data, position, element_type)
+                # A repeated key keeps its first place and its last
+                # value, like decoding to a SON does.
+                if name not in positions:
+                    keys.append(name)
+                positions[name] = element_position
+            self.__positions = positions
+            self.__keys = keys
+        return self.__positions
+
+    def __getitem__(self, key):
+        try:
+            return self.__decoded[key]
+        except KeyError:
+            pass
+        position = self.__index()[key]
+        _, value, _ = bson._element_to_dict(self.__raw, position,
+                                            self.__class__, self.__tz_aware,
+                                            self.__uuid_subtype, None,
+                                            self.__compile_re)
+        self.__decoded[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.__index()
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self.__index())
+
+    def __iter__(self):
+        self.__index()
+        return iter(self.__keys)
+
+    def keys(self):
+        self.__index()
+        return list(self.__keys)
+
+    def iterkeys(self):
+        return self.__iter__()
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        """Decode this document to a :class:`dict`.
+
+        Embedded documents are decoded to :class:`dict` as well.
+        """
+        (document, _) = bson._bson_to_dict(self.__raw, dict,
+                                           self.__tz_aware,
+                                           self.__uuid_subtype, 0, None,
+                                           self.__compile_re)
+        return document
+
+    def __eq__(self, other):
+        if isinstance(other, RawBSONDocument):
+            return self.__raw == other.raw
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "RawBSONDocument(%r)" % (self.__raw,)
@@ -0,0 +1,237 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tools for representing documents with a known set of fields as
+compact records.
+
+A record stores its values in a tuple, by position, instead of in a
+hash table like a :class:`dict`, so holding many decoded documents
+costs much less memory::
+
+  >>> from bson.record import record_class
+  >>> User = record_class("User", ["_id", "name", "email"])
+  >>> user = User({"_id": 1, "name": "Mike"})
+  >>> user["name"]
+  'Mike'
+  >>> user.name
+  'Mike'
+  >>> "email" in user
+  False
+
+Pass a record class as the `as_class` parameter to
+:func:`~bson.decode_all`, :meth:`~bson.BSON.decode` and
+:meth:`~pymongo.collection.Collection.find`, or as the
+`document_class` of a :class:`~pymongo.connection.Connection`, to decode
+documents straight to records.
+"""
+
+import re
+import sys
+
+from bson.py3compat import string_types
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class _Missing(object):
+    """The value of fields that a record doesn't have.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<missing>"
+
+_MISSING = _Missing()
+
+
+class Record(tuple):
+    """Base class for the classes made by :func:`record_class`.
+
+    A record is a read-only mapping. Iterating over it, and its
+    :meth:`keys`, give the fields it has in the order they were declared,
+    followed by its overflow fields.
+    """
+    __slots__ = ()
+
+    _fields = ()
+    _index = {}
+    _overflow = True
+    _document_class = dict
+
+    def __new__(cls, *args, **kwargs):
+        document = dict(*args, **kwargs)
+        index = cls._index
+        values = [_MISSING] * len(cls._fields)
+        overflow = None
+        for (key, value) in document.items():
+            position = index.get(key)
+            if position is not None:
+                values[position] = value
+            elif cls._overflow:
+                if overflow is None:
+                    overflow = {}
+                overflow[key] = value
+        if cls._overflow:
+            values.append(overflow)
+        return tuple.__new__(cls, values)
+
+    def __reduce__(self):
+        return (self.__class__, (self.to_dict(),))
+
+    def _get_overflow(self):
+        if self._overflow:
+            return tuple.__getitem__(self, len(self._fields))
+        return None
+
+    def __getitem__(self, key):
+        position = self._index.get(key)
+        if position is not None:
+            value = tuple.__getitem__(self, position)
+            if value is not _MISSING:
+                return value
+            raise KeyError(key)
+        overflow = self._get_overflow()
+        if overflow is None:
+            raise KeyError(key)
+        return overflow[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def __len__(self):
+        count = 0
+        for key in self:
+            count += 1
+        return count
+
+    def __iter__(self):
+        for position in range(len(self._fields)):
+            if tuple.__getitem__(self, position) is not _MISSING:
+                yield self._fields[position]
+        overflow = self._get_overflow()
+        if overflow:
+            for key in overflow:
+                yield key
+
+    def keys(self):
+        return list(self)
+
+    def iterkeys(self):
+        return self.__iter__()
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        """Copy this record's fields to a :class:`dict`.
+
+        Embedded documents are not copied.
+        """
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_dict())
+
+
+def _field_property(position, name):
+    def get(self):
+        value = tuple.__getitem__(self, position)
+        if value is _MISSING:
+            raise AttributeError(name)
+        return value
+    return property(get)
+
+
+def record_class(typename, field_names, overflow=True, document_class=dict):
+    """Make a :class:`Record` class with the fields `field_names`.
+
+    Records hold the values of `field_names` by position. If `overflow`
+    is ``True``, other fields are kept in a :class:`dict` that is only
+    created for records that have any. If it's ``False``, other fields
+    are dropped, so decoding to the record class is also a projection.
+
+    Fields can be read like :class:`dict` items, or as attributes when
+    their names are identifiers that aren't already attributes of
+    :class:`Record`, ``_id`` included. Records are read-only.
+
+    Embedded documents are decoded to `document_class`, which can be
+    another record class.
+
+    :Parameters:
+      - `typename`: the name of the class
+      - `field_names`: the names of the fields
+      - `overflow` (optional): keep fields that aren't in `field_names`
+      - `document_class` (optional): class to use for embedded documents
+
+    .. versionadded:: 2.4
+    """
+    field_names = tuple(field_names)
+    for name in field_names:
+        if not isinstance(name, string_types):
+            raise TypeError("field names must be instances of %s" %
+                            (string_types[0].__name__,))
+    if len(set(field_names)) != len(field_names):
+        raise ValueError("field names must be unique")
+
+    namespace = {"__slots__": (),
+                 "_fields": field_names,
+                 "_index": dict([(name, position) for (position, name)
+                                 in enumerate(field_names)]),
+                 "_overflow": bool(overflow),
+                 "_document_class": document_class}
+    for (position, name) in enumerate(field_names):
+        if _IDENTIFIER.match(name) and not hasattr(Record, name):
+            namespace[name] = _field_property(position, name)
+    cls = type(typename, (Record,), namespace)
+
+    # Let records be pickled, like collections.namedtuple.
+    try:
+        cls.__module__ = sys._getframe(1).f_globals.get("__name__",
+                                                        "__main__")
+    except (AttributeError, ValueError):
+        pass
+    return cls
@@ -0,0 +1,145 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tools for representing MongoDB regular expressions.
+"""
+
+import re
+
+# Maps BSON regex flags to their :mod:`re` flags.
+_FLAGS = {
+    "i": re.IGNORECASE,
+    "l": re.LOCALE,
+    "m": re.MULTILINE,
+    "s": re.DOTALL,
+    "u": re.UNICODE,
+    "x": re.VERBOSE,
+}
+
+# The number of compiled regular expressions kept by _compile.
+_CACHE_SIZE = 256
+
+# Maps (pattern, flags) to a [compiled regex, last use] list.
+_cache = {}
+_uses = 0
+
+
+def _compile(pattern, flags):
+    """Compile `pattern` with `flags`, reusing the compiled regular
+    expression for the same pattern and flags if it was compiled before.
+
+    Both the C extension and the pure Python decoder compile the regexes
+    they decode here. The least recently used regexes are dropped once
+    the cache is full.
+    """
+    global _uses
+    _uses += 1
+    key = (pattern, flags)
+    entry = _cache.get(key)
+    if entry is not None:
+        entry[1] = _uses
+        return entry[0]
+    compiled = re.compile(pattern, flags)
+    if len(_cache) >= _CACHE_SIZE:
+        # Drop the least recently used quarter at once, rather than
+        # looking for the oldest entry on each miss.
+        entries = [(last_use, old_key)
+                   for (old_key, (_, last_use)) in list(_cache.items())]
+        entries.sort()
+        for _, old_key in entries[:_CACHE_SIZE // 4]:
+            _cache.pop(old_key, None)
+    _cache[key] = [compiled, _uses]
+    return compiled
+
+
+def str_flags_to_int(str_flags):
+    """Convert BSON regex flags, like ``"im"``, to :mod:`re` flags.
+
+    Unknown flags are ignored.
+    """
+    flags = 0
+    for flag in str_flags:
+        flags |= _FLAGS.get(flag, 0)
+    return flags
+
+
+class Regex(object):
+    """A BSON regular expression, which isn't compiled.
+
+    Decoding regular expressions as :class:`Regex` rather than compiling
+    them (see the `compile_re` option of :func:`~bson.decode_all`) saves
+    the cost of compiling patterns that are only stored, or passed back
+    to the server. :class:`Regex` instances can be encoded like compiled
+    regular expressions.
+
+    :Parameters:
+      - `pattern`: the pattern, an instance of :class:`basestring`
+      - `flags` (optional): an integer of :mod:`re` flags, or a string
+        of BSON regex flags, like ``"im"``
+
+    .. versionadded:: 2.4
+    """
+
+    def __init__(self, pattern, flags=0):
+        if not isinstance(pattern, basestring):
+            raise TypeError("pattern must be an instance "
+                            "of %s" % (basestring.__name__,))
+        if isinstance(flags, basestring):
+            flags = str_flags_to_int(flags)
+        elif not isinstance(flags, (int, long)):
+            raise TypeError("flags must be an instance of %s or int" %
+                            (basestring.__name__,))
+        self.__pattern = pattern
+        self.__flags = flags
+
+    @classmethod
+    def from_native(cls, regex):
+        """Make a :class:`Regex` from a compiled regular expression.
+        """
+        return cls(regex.pattern, regex.flags)
+
+    @property
+    def pattern(self):
+        """The pattern of this regular expression.
+        """
+        return self.__pattern
+
+    @property
+    def flags(self):
+        """The :mod:`re` flags of this regular expression.
+        """
+        return self.__flags
+
+    def try_compile(self):
+        """Compile this regular expression.
+
+        Raises :class:`re.error` if the pattern isn't valid for
+        :mod:`re`, which is possible for patterns written for the server.
+        """
+        return _compile(self.__pattern, self.__flags)
+
+    def __eq__(self, other):
+        if isinstance(other, Regex):
+            return (self.__pattern == other.pattern and
+                    self.__flags == other.flags)
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__pattern, self.__flags))
+
+    def __repr__(self):
+        return "Regex(%r, %r)" % (self.__pattern, self.__flags)
@@ -0,0 +1,107 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tools for encoding and decoding application types.
+"""
+
+
+class TypeRegistry(object):
+    """A registry of encoders and decoders for application types, like
+    :class:`decimal.Decimal` or enumerations.
+
+    An encoder converts an instance of a type that BSON can't encode
+    into a value that it can, e.g. a :class:`decimal.Decimal` into a
+    :class:`unicode` string. Encoders are only looked up for types
+    that aren't otherwise supported, so documents without application
+    types are encoded at full speed. An encoder registered for a class
+    is also used for its subclasses.
+
+    A decoder converts a decoded value into an application type. It is
+    looked up by the exact type of each decoded value, e.g.
+    :class:`~bson.binary.Binary`, and is called with every value of
+    that type. Decoders for the type of embedded documents (`as_class`)
+    are called with each embedded document, but not with the top-level
+    documents. Registering no decoders adds no overhead to decoding.
+
+    For example, to store :class:`decimal.Decimal` values as binary
+    data with a user-defined subtype::
+
+      def decode_decimal(value):
+          if value.subtype == 128:
+              return decimal.Decimal(str(value))
+          return value
+
+      registry = TypeRegistry(
+          {decimal.Decimal: lambda value: Binary(str(value), 128)},
+          {Binary: decode_decimal})
+
+    Use a registry with :meth:`~bson.BSON.encode`,
+    :meth:`~bson.BSON.decode`, :func:`~bson.decode_all`, or as the
+    :attr:`~pymongo.collection.Collection.type_registry` of a
+    :class:`~pymongo.collection.Collection`. Decoders are not applied
+    to :class:`~bson.raw_bson.RawBSONDocument` instances.
+
+    :Parameters:
+      - `encoders` (optional): a mapping of types to encoders
+      - `decoders` (optional): a mapping of types to decoders
+
+    .. versionadded:: 2.4
+    """
+
+    def __init__(self, encoders=None, decoders=None):
+        # Looked up by the C extension, so these dicts are only ever
+        # updated, never replaced.
+        self._encoders = {}
+        self._decoders = {}
+        for python_type, encoder in (encoders or {}).items():
+            self.register_encoder(python_type, encoder)
+        for python_type, decoder in (decoders or {}).items():
+            self.register_decoder(python_type, decoder)
+
+    def register_encoder(self, python_type, encoder):
+        """Register `encoder` for instances of `python_type`.
+
+        `encoder` is called with each instance of `python_type` (or one
+        of its subclasses) that BSON can't otherwise encode, and must
+        return a value that can be encoded.
+
+        :Parameters:
+          - `python_type`: a new-style class
+          - `encoder`: a callable taking one argument
+        """
+        self._encoders[_check_type(python_type)] = _check_callable(encoder)
+
+    def register_decoder(self, python_type, decoder):
+        """Register `decoder` for decoded values of type `python_type`.
+
+        :Parameters:
+          - `python_type`: a new-style class
+          - `decoder`: a callable taking one argument
+        """
+        self._decoders[_check_type(python_type)] = _check_callable(decoder)
+
+    def __repr__(self):
+        return "TypeRegistry(%r, %r)" % (self._encoders, self._decoders)
+
+
+def _check_type(python_type):
+    if not isinstance(python_type, type):
+        raise TypeError("python_type must be a new-style class")
+    return python_type
+
+
+def _check_callable(codec):
+    if not hasattr(codec, "__call__"):
+        raise TypeError("encoders and decoders must be callable")
+    return codec
@@ -22,6 +22,8 @@
 
 #include "Python.h"
 
+#include <time.h>
+
 #include "_cbsonmodule.h"
 #include "buffer.h"
 
@@ -57,6 +59,50 @@ static PyObject* _error(char* name) {
     return error;
 }
 
+/* Get the dict of codecs called `name` ("_encoders" or "_decoders") from
+ * `type_registry`, a bson.type_registry.TypeRegistry or None.
+ *
+ * Sets `codecs` to a borrowed reference, owned by `type_registry`, or to
+ * NULL if there are no such codecs. Returns 0 on failure. */
+static int _get_codecs(PyObject* type_registry, char* name,
+                       PyObject** codecs) {
+    PyObject* dict;
+    *codecs = NULL;
+    if (type_registry == Py_None) {
+        return 1;
+    }
+    dict = PyObject_GetAttrString(type_registry, name);
+    if (!dict || !PyDict_Check(dict)) {
+        Py_XDECREF(dict);
+        PyErr_SetString(PyExc_TypeError, "type_registry must be an "
+                        "instance of bson.type_registry.TypeRegistry");
+        return 0;
+    }
+    /* The registry never replaces its dicts, it only updates them. */
+    if (PyDict_Size(dict)) {
+        *codecs = dict;
+    }
+    Py_DECREF(dict);
+    return 1;
+}
+
+/* The request id of the next message. Messages are only built with the
+ * GIL held, so it needs no other locking. */
+static int next_request_id = 0;
+
+/* Get a new request id. Request ids count up from a random start,
+ * wrapping around to 0 after INT_MAX, so that they don't repeat until
+ * over two billion messages later. */
+static int _request_id(void) {
+    int request_id = next_request_id;
+    next_request_id = (request_id == INT_MAX) ? 0 : request_id + 1;
+    return request_id;
+}
+
+static PyObject* _cbson_request_id(PyObject* self, PyObject* args) {
+    return Py_BuildValue("i", _request_id());
+}
+
 /* add a lastError message on the end of the buffer.
  * returns 0 on failure */
 static int add_last_error(PyObject* self, buffer_t buffer,
@@ -105,7 +151,7 @@ static int add_last_error(PyObject* self, buffer_t buffer,
 
     /* getlasterror: 1 */
     one = PyLong_FromLong(1);
-    if (!write_pair(state->_cbson, buffer, "getlasterror", 12, one, 0, 4, 1)) {
+    if (!write_pair(state->_cbson, buffer, "getlasterror", 12, one, 0, 4, 1, NULL)) {
         Py_DECREF(one);
         return 0;
     }
@@ -113,7 +159,7 @@ static int add_last_error(PyObject* self, buffer_t buffer,
 
     /* getlasterror options */
     while (PyDict_Next(args, &pos, &key, &value)) {
-        if (!decode_and_write_pair(state->_cbson, buffer, key, value, 0, 4, 0)) {
+        if (!decode_and_write_pair(state->_cbson, buffer, key, value, 0, 4, 0, NULL)) {
             return 0;
         }
     }
@@ -130,46 +176,93 @@ static int add_last_error(PyObject* self, buffer_t buffer,
     return 1;
 }
 
+/* Split `buffer` into a list of segments: strings of the bytes between
+ * its gaps, and the objects left as gaps (see write_bytes_object).
+ *
+ * Returns a new ref */
+static PyObject* _segments(buffer_t buffer) {
+    PyObject* segments = PyList_New(0);
+    int count = buffer_get_gap_count(buffer);
+    int start = 0;
+    int i;
+
+    if (!segments) {
+        return NULL;
+    }
+    for (i = 0; i <= count; i++) {
+        int end = buffer_get_position(buffer);
+        void* owner = NULL;
+        if (i < count) {
+            buffer_get_gap(buffer, i, &end, &owner);
+        }
+        if (end > start) {
+            PyObject* bytes = Py_BuildValue(BYTES_FORMAT_STRING,
+                                            buffer_get_buffer(buffer) + start,
+                                            end - start);
+            if (!bytes || PyList_Append(segments, bytes) == -1) {
+                Py_XDECREF(bytes);
+                Py_DECREF(segments);
+                return NULL;
+            }
+            Py_DECREF(bytes);
+        }
+        if (owner && PyList_Append(segments, (PyObject*)owner) == -1) {
+            Py_DECREF(segments);
+            return NULL;
+        }
+        start = end;
+    }
+    return segments;
+}
+
 static PyObject* _cbson_insert_message(PyObject* self, PyObject* args) {
-    /* NOTE just using a random number as the request_id */
     struct module_state *state = GETSTATE(self);
 
-    int request_id = rand();
+    int request_id = _request_id();
     char* collection_name = NULL;
     int collection_name_length;
     PyObject* docs;
     PyObject* doc;
     PyObject* iterator;
-    int before, cur_size, max_size = 0;
+    int before, before_gaps, cur_size, max_size = 0;
     int options = 0;
     unsigned char check_keys;
     unsigned char safe;
     unsigned char continue_on_error;
     unsigned char uuid_subtype;
     PyObject* last_error_args;
+    PyObject* type_registry = Py_None;
+    int segment_threshold = 0;
+    PyObject* encoders;
     buffer_t buffer;
     int length_location, message_length;
     PyObject* result;
 
-    if (!PyArg_ParseTuple(args, "et#ObbObb",
+    if (!PyArg_ParseTuple(args, "et#ObbObb|Oi",
                           "utf-8",
                           &collection_name,
                           &collection_name_length,
                           &docs, &check_keys, &safe,
                           &last_error_args,
-                          &continue_on_error, &uuid_subtype)) {
+                          &continue_on_error, &uuid_subtype,
+                          &type_registry, &segment_threshold)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_encoders", &encoders)) {
+        PyMem_Free(collection_name);
         return NULL;
     }
     if (continue_on_error) {
         options += 1;
     }
 
-    buffer = buffer_new();
+    buffer = buffer_get_scratch();
     if (!buffer) {
         PyErr_NoMemory();
         PyMem_Free(collection_name);
         return NULL;
     }
+    buffer_set_gap_threshold(buffer, segment_threshold);
 
     // save space for message length
     length_location = buffer_save_space(buffer, 4);
@@ -203,7 +296,9 @@ static PyObject* _cbson_insert_message(PyObject* self, PyObject* args) {
     }
     while ((doc = PyIter_Next(iterator)) != NULL) {
         before = buffer_get_position(buffer);
-        if (!write_dict(state->_cbson, buffer, doc, check_keys, uuid_subtype, 1)) {
+        before_gaps = buffer_get_gap_total(buffer);
+        if (!write_dict(state->_cbson, buffer, doc, check_keys, uuid_subtype, 1,
+                        encoders)) {
             Py_DECREF(doc);
             Py_DECREF(iterator);
             buffer_free(buffer);
@@ -211,7 +306,8 @@ static PyObject* _cbson_insert_message(PyObject* self, PyObject* args) {
             return NULL;
         }
         Py_DECREF(doc);
-        cur_size = buffer_get_position(buffer) - before;
+        cur_size = buffer_get_position(buffer) - before +
+            buffer_get_gap_total(buffer) - before_gaps;
         max_size = (cur_size > max_size) ? cur_size : max_size;
     }
     Py_DECREF(iterator);
@@ -225,7 +321,8 @@ static PyObject* _cbson_insert_message(PyObject* self, PyObject* args) {
         return NULL;
     }
 
-    message_length = buffer_get_position(buffer) - length_location;
+    message_length = buffer_get_position(buffer) - length_location +
+        buffer_get_gap_total(buffer);
     memcpy(buffer_get_buffer(buffer) + length_location, &message_length, 4);
 
     if (safe) {
@@ -239,20 +336,28 @@ static PyObject* _cbson_insert_message(PyObject* self, PyObject* args) {
 
     PyMem_Free(collection_name);
 
-    /* objectify buffer */
-    result = Py_BuildValue("i" BYTES_FORMAT_STRING "i", request_id,
-                           buffer_get_buffer(buffer),
-                           buffer_get_position(buffer),
-                           max_size);
-    buffer_free(buffer);
+    if (segment_threshold) {
+        PyObject* segments = _segments(buffer);
+        if (!segments) {
+            buffer_free(buffer);
+            return NULL;
+        }
+        result = Py_BuildValue("iNi", request_id, segments, max_size);
+    } else {
+        /* objectify buffer */
+        result = Py_BuildValue("i" BYTES_FORMAT_STRING "i", request_id,
+                               buffer_get_buffer(buffer),
+                               buffer_get_position(buffer),
+                               max_size);
+    }
+    buffer_release(buffer);
     return result;
 }
 
 static PyObject* _cbson_update_message(PyObject* self, PyObject* args) {
-    /* NOTE just using a random number as the request_id */
     struct module_state *state = GETSTATE(self);
 
-    int request_id = rand();
+    int request_id = _request_id();
     char* collection_name = NULL;
     int collection_name_length;
     int before, cur_size, max_size = 0;
@@ -264,17 +369,24 @@ static PyObject* _cbson_update_message(PyObject* self, PyObject* args) {
     unsigned char check_keys;
     unsigned char uuid_subtype;
     PyObject* last_error_args;
+    PyObject* type_registry = Py_None;
+    PyObject* encoders;
     int options;
     buffer_t buffer;
     int length_location, message_length;
     PyObject* result;
 
-    if (!PyArg_ParseTuple(args, "et#bbOObObb",
+    if (!PyArg_ParseTuple(args, "et#bbOObObb|O",
                           "utf-8",
                           &collection_name,
                           &collection_name_length,
                           &upsert, &multi, &spec, &doc, &safe,
-                          &last_error_args, &check_keys, &uuid_subtype)) {
+                          &last_error_args, &check_keys, &uuid_subtype,
+                          &type_registry)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_encoders", &encoders)) {
+        PyMem_Free(collection_name);
         return NULL;
     }
 
@@ -285,7 +397,7 @@ static PyObject* _cbson_update_message(PyObject* self, PyObject* args) {
     if (multi) {
         options += 2;
     }
-    buffer = buffer_new();
+    buffer = buffer_get_scratch();
     if (!buffer) {
         PyErr_NoMemory();
         PyMem_Free(collection_name);
@@ -315,7 +427,7 @@ static PyObject* _cbson_update_message(PyObject* self, PyObject* args) {
     }
 
     before = buffer_get_position(buffer);
-    if (!write_dict(state->_cbson, buffer, spec, 0, uuid_subtype, 1)) {
+    if (!write_dict(state->_cbson, buffer, spec, 0, uuid_subtype, 1, encoders)) {
         buffer_free(buffer);
         PyMem_Free(collection_name);
         return NULL;
@@ -323,7 +435,8 @@ static PyObject* _cbson_update_message(PyObject* self, PyObject* args) {
     max_size = buffer_get_position(buffer) - before;
 
     before = buffer_get_position(buffer);
-    if (!write_dict(state->_cbson, buffer, doc, check_keys, uuid_subtype, 1)) {
+    if (!write_dict(state->_cbson, buffer, doc, check_keys, uuid_subtype, 1,
+                        encoders)) {
         buffer_free(buffer);
         PyMem_Free(collection_name);
         return NULL;
@@ -350,15 +463,14 @@ static PyObject* _cbson_update_message(PyObject* self, PyObject* args) {
                            buffer_get_buffer(buffer),
                            buffer_get_position(buffer),
                            max_size);
-    buffer_free(buffer);
+    buffer_release(buffer);
     return result;
 }
 
 static PyObject* _cbson_query_message(PyObject* self, PyObject* args) {
-    /* NOTE just using a random number as the request_id */
     struct module_state *state = GETSTATE(self);
 
-    int request_id = rand();
+    int request_id = _request_id();
     unsigned int options;
     char* collection_name = NULL;
     int collection_name_length;
@@ -368,20 +480,27 @@ static PyObject* _cbson_query_message(PyObject* self, PyObject* args) {
     PyObject* query;
     PyObject* field_selector = Py_None;
     unsigned char uuid_subtype = 3;
+    PyObject* type_registry = Py_None;
+    PyObject* encoders;
     buffer_t buffer;
     int length_location, message_length;
     PyObject* result;
 
-    if (!PyArg_ParseTuple(args, "Iet#iiO|Ob",
+    if (!PyArg_ParseTuple(args, "Iet#iiO|ObO",
                           &options,
                           "utf-8",
                           &collection_name,
                           &collection_name_length,
                           &num_to_skip, &num_to_return,
-                          &query, &field_selector, &uuid_subtype)) {
+                          &query, &field_selector, &uuid_subtype,
+                          &type_registry)) {
         return NULL;
     }
-    buffer = buffer_new();
+    if (!_get_codecs(type_registry, "_encoders", &encoders)) {
+        PyMem_Free(collection_name);
+        return NULL;
+    }
+    buffer = buffer_get_scratch();
     if (!buffer) {
         PyErr_NoMemory();
         PyMem_Free(collection_name);
@@ -408,7 +527,7 @@ static PyObject* _cbson_query_message(PyObject* self, PyObject* args) {
     }
 
     begin = buffer_get_position(buffer);
-    if (!write_dict(state->_cbson, buffer, query, 0, uuid_subtype, 1)) {
+    if (!write_dict(state->_cbson, buffer, query, 0, uuid_subtype, 1, encoders)) {
         buffer_free(buffer);
         PyMem_Free(collection_name);
         return NULL;
@@ -417,7 +536,8 @@ static PyObject* _cbson_query_message(PyObject* self, PyObject* args) {
 
     if (field_selector != Py_None) {
         begin = buffer_get_position(buffer);
-        if (!write_dict(state->_cbson, buffer, field_selector, 0, uuid_subtype, 1)) {
+        if (!write_dict(state->_cbson, buffer, field_selector, 0, uuid_subtype, 1,
+                        encoders)) {
             buffer_free(buffer);
             PyMem_Free(collection_name);
             return NULL;
@@ -436,13 +556,12 @@ static PyObject* _cbson_query_message(PyObject* self, PyObject* args) {
                            buffer_get_buffer(buffer),
                            buffer_get_position(buffer),
                            max_size);
-    buffer_free(buffer);
+    buffer_release(buffer);
     return result;
 }
 
 static PyObject* _cbson_get_more_message(PyObject* self, PyObject* args) {
-    /* NOTE just using a random number as the request_id */
-    int request_id = rand();
+    int request_id = _request_id();
     char* collection_name = NULL;
     int collection_name_length;
     int num_to_return;
@@ -459,7 +578,7 @@ static PyObject* _cbson_get_more_message(PyObject* self, PyObject* args) {
                           &cursor_id)) {
         return NULL;
     }
-    buffer = buffer_new();
+    buffer = buffer_get_scratch();
     if (!buffer) {
         PyErr_NoMemory();
         PyMem_Free(collection_name);
@@ -497,7 +616,174 @@ static PyObject* _cbson_get_more_message(PyObject* self, PyObject* args) {
     result = Py_BuildValue("i" BYTES_FORMAT_STRING, request_id,
                            buffer_get_buffer(buffer),
                            buffer_get_position(buffer));
-    buffer_free(buffer);
+    buffer_release(buffer);
+    return result;
+}
+
+static PyObject* _cbson_delete_message(PyObject* self, PyObject* args) {
+    struct module_state *state = GETSTATE(self);
+
+    int request_id = _request_id();
+    char* collection_name = NULL;
+    int collection_name_length;
+    int before, max_size;
+    PyObject* spec;
+    unsigned char safe;
+    unsigned char uuid_subtype;
+    PyObject* last_error_args;
+    PyObject* type_registry = Py_None;
+    PyObject* encoders;
+    buffer_t buffer;
+    int length_location, message_length;
+    PyObject* result;
+
+    if (!PyArg_ParseTuple(args, "et#ObOb|O",
+                          "utf-8",
+                          &collection_name,
+                          &collection_name_length,
+                          &spec, &safe, &last_error_args, &uuid_subtype,
+                          &type_registry)) {
+        return NULL;
+    }
+    if (!_get_codecs(type_registry, "_encoders", &encoders)) {
+        PyMem_Free(collection_name);
+        return NULL;
+    }
+    buffer = buffer_get_scratch();
+    if (!buffer) {
+        PyErr_NoMemory();
+        PyMem_Free(collection_name);
+        return NULL;
+    }
+
+    // save space for message length
+    length_location = buffer_save_space(buffer, 4);
+    if (length_location == -1) {
+        PyMem_Free(collection_name);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    if (!buffer_write_bytes(buffer, (const char*)&request_id, 4) ||
+        !buffer_write_bytes(buffer,
+                            "\x00\x00\x00\x00"
+                            "\xd6\x07\x00\x00"
+                            "\x00\x00\x00\x00",
+                            12) ||
+        !buffer_write_bytes(buffer,
+                            collection_name,
+                            collection_name_length + 1) ||
+        !buffer_write_bytes(buffer, "\x00\x00\x00\x00", 4)) {
+        buffer_free(buffer);
+        PyMem_Free(collection_name);
+        return NULL;
+    }
+
+    before = buffer_get_position(buffer);
+    if (!write_dict(state->_cbson, buffer, spec, 0, uuid_subtype, 1,
+                    encoders)) {
+        buffer_free(buffer);
+        PyMem_Free(collection_name);
+        return NULL;
+    }
+    max_size = buffer_get_position(buffer) - before;
+
+    message_length = buffer_get_position(buffer) - length_location;
+    memcpy(buffer_get_buffer(buffer) + length_location, &message_length, 4);
+
+    if (safe) {
+        if (!add_last_error(self, buffer, request_id, collection_name,
+                            collection_name_length, last_error_args)) {
+            buffer_free(buffer);
+            PyMem_Free(collection_name);
+            return NULL;
+        }
+    }
+
+    PyMem_Free(collection_name);
+
+    /* objectify buffer */
+    result = Py_BuildValue("i" BYTES_FORMAT_STRING "i", request_id,
+                           buffer_get_buffer(buffer),
+                           buffer_get_position(buffer),
+                           max_size);
+    buffer_release(buffer);
+    return result;
+}
+
+static PyObject* _cbson_kill_cursors_message(PyObject* self, PyObject* args) {
+    int request_id = _request_id();
+    PyObject* cursor_ids;
+    PyObject* sequence;
+    Py_ssize_t count;
+    Py_ssize_t i;
+    int num_cursor_ids;
+    buffer_t buffer;
+    int length_location, message_length;
+    PyObject* result;
+
+    if (!PyArg_ParseTuple(args, "O", &cursor_ids)) {
+        return NULL;
+    }
+    sequence = PySequence_Fast(cursor_ids, "cursor_ids must be a sequence");
+    if (!sequence) {
+        return NULL;
+    }
+    count = PySequence_Fast_GET_SIZE(sequence);
+    if (count > INT_MAX / 8) {
+        PyErr_SetString(PyExc_OverflowError, "too many cursor ids");
+        Py_DECREF(sequence);
+        return NULL;
+    }
+    num_cursor_ids = (int)count;
+
+    buffer = buffer_get_scratch();
+    if (!buffer) {
+        PyErr_NoMemory();
+        Py_DECREF(sequence);
+        return NULL;
+    }
+
+    // save space for message length
+    length_location = buffer_save_space(buffer, 4);
+    if (length_location == -1) {
+        PyErr_NoMemory();
+        Py_DECREF(sequence);
+        return NULL;
+    }
+    if (!buffer_write_bytes(buffer, (const char*)&request_id, 4) ||
+        !buffer_write_bytes(buffer,
+                            "\x00\x00\x00\x00"
+                            "\xd7\x07\x00\x00"
+                            "\x00\x00\x00\x00", 12) ||
+        !buffer_write_bytes(buffer, (const char*)&num_cursor_ids, 4)) {
+        buffer_free(buffer);
+        Py_DECREF(sequence);
+        return NULL;
+    }
+    for (i = 0; i < count; i++) {
+        long long cursor_id = PyLong_AsLongLong(
+            PySequence_Fast_GET_ITEM(sequence, i));
+        if (cursor_id == -1 && PyErr_Occurred()) {
+            buffer_free(buffer);
+            Py_DECREF(sequence);
+            return NULL;
+        }
+        if (!buffer_write_bytes(buffer, (const char*)&cursor_id, 8)) {
+            buffer_free(buffer);
+            Py_DECREF(sequence);
+            return NULL;
+        }
+    }
+    Py_DECREF(sequence);
+
+    message_length = buffer_get_position(buffer) - length_location;
+    memcpy(buffer_get_buffer(buffer) + length_location, &message_length, 4);
+
+    /* objectify buffer */
+    result = Py_BuildValue("i" BYTES_FORMAT_STRING, request_id,
+                           buffer_get_buffer(buffer),
+                           buffer_get_position(buffer));
+    buffer_release(buffer);
     return result;
 }
 
@@ -510,6 +796,12 @@ static PyMethodDef _CMessageMethods[] = {
      "create a query message to be sent to MongoDB"},
     {"_get_more_message", _cbson_get_more_message, METH_VARARGS,
      "create a get more message to be sent to MongoDB"},
+    {"_delete_message", _cbson_delete_message, METH_VARARGS,
+     "create a delete message to be sent to MongoDB"},
+    {"_kill_cursors_message", _cbson_kill_cursors_message, METH_VARARGS,
+     "create a kill cursors message to be sent to MongoDB"},
+    {"_request_id", _cbson_request_id, METH_NOARGS,
+     "get the request id for a new message"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -560,6 +852,10 @@ init_cmessage(void)
 
     state = GETSTATE(m);
 
+    /* Start the request ids somewhere different in each process. */
+    next_request_id = (int)(((unsigned int)time(NULL) ^
+                             (unsigned int)rand()) & INT_MAX);
+
     /* Store a reference to the _cbson module since it's needed to call some
      * of its functions
      */
@@ -14,16 +14,75 @@
 
 """Collection level utilities for Mongo."""
 
+import struct
 import warnings
 
+from bson import BSON, json_util
 from bson.binary import ALL_UUID_SUBTYPES, OLD_UUID_SUBTYPE
 from bson.code import Code
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+from bson.py3compat import b
+from bson.raw_bson import RawBSONDocument
 from bson.son import SON
+from bson.type_registry import TypeRegistry
 from pymongo import (common,
                      helpers,
                      message)
 from pymongo.cursor import Cursor
-from pymongo.errors import ConfigurationError, InvalidName
+from pymongo.errors import (ConfigurationError,
+                            InvalidName,
+                            OperationFailure)
+
+
+# The types of documents that can be written.
+_DOCUMENT_TYPES = (dict, BSON, RawBSONDocument)
+
+_ID_NAME = b("_id\x00")
+
+# The largest document servers < 1.7.4 accept, which don't report it.
+_DEFAULT_MAX_BSON_SIZE = 4 * 1024 * 1024
+
+
+def _raw_document(doc):
+    """Wrap `doc` in a :class:`~bson.raw_bson.RawBSONDocument` if it's a
+    :class:`~bson.BSON` instance, so that its "_id" can be read.
+    """
+    if isinstance(doc, BSON):
+        return RawBSONDocument(doc)
+    return doc
+
+
+def _prepend_id(doc, oid):
+    """Copy the :class:`~bson.raw_bson.RawBSONDocument` `doc`, adding
+    `oid` as its "_id".
+    """
+    raw = doc.raw
+    return RawBSONDocument(struct.pack("<i", len(raw) + 17) +
+                           b("\x07_id\x00") + oid.binary + raw[4:])
+
+
+def _batch_documents(docs, max_size):
+    """Group the encoded documents `docs` into lists whose documents add
+    up to at most `max_size` bytes, adding an "_id" to the documents
+    that don't have one.
+
+    A document bigger than `max_size` is put in a list of its own.
+    """
+    batch = []
+    batch_size = 0
+    for doc in docs:
+        # Both encoders put a top level "_id" first.
+        if doc[5:9] != _ID_NAME:
+            doc = BSON(_prepend_id(RawBSONDocument(doc), ObjectId()).raw)
+        if batch and batch_size + len(doc) > max_size:
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(doc)
+        batch_size += len(doc)
+    if batch:
+        yield batch
 
 
 def _gen_index_name(keys):
@@ -63,6 +122,8 @@ class Collection(common.BaseObject):
         .. versionchanged:: 2.2
            Removed deprecated argument: options
 
+        .. versionadded:: 2.4
+           type_registry attribute
         .. versionadded:: 2.1
            uuid_subtype attribute
 
@@ -103,6 +164,7 @@ class Collection(common.BaseObject):
         self.__database = database
         self.__name = unicode(name)
         self.__uuid_subtype = OLD_UUID_SUBTYPE
+        self.__type_registry = None
         self.__full_name = u"%s.%s" % (self.__database.name, self.__name)
         if create or kwargs:
             self.__create(kwargs)
@@ -191,6 +253,26 @@ class Collection(common.BaseObject):
                             the Java and C# drivers. See the
                             :mod:`bson.binary` module for all options.""")
 
+    def __get_type_registry(self):
+        return self.__type_registry
+
+    def __set_type_registry(self, type_registry):
+        if (type_registry is not None and
+            not isinstance(type_registry, TypeRegistry)):
+            raise ConfigurationError("Not a valid setting for type_registry.")
+        self.__type_registry = type_registry
+
+    type_registry = property(__get_type_registry, __set_type_registry,
+                             doc="""The
+                             :class:`~bson.type_registry.TypeRegistry` used
+                             to encode the documents written to and decode
+                             the documents read from this collection, or
+                             ``None`` (the default) to use no application
+                             types.
+
+                             .. versionadded:: 2.4
+                             """)
+
     def save(self, to_save, manipulate=True,
              safe=None, check_keys=True, **kwargs):
         """Save a document in this collection.
@@ -204,8 +286,15 @@ class Collection(common.BaseObject):
         the ``"_id"`` will be added by the server but this method will
         return ``None``.
 
+        `to_save` can also be a document that is already encoded, a
+        :class:`~bson.BSON` or :class:`~bson.raw_bson.RawBSONDocument`
+        instance. It's saved without being decoded, as described for
+        :meth:`insert`.
+
         Raises :class:`TypeError` if `to_save` is not an instance of
-        :class:`dict`. If `safe` is ``True`` then the save will be
+        :class:`dict`, :class:`~bson.BSON` or
+        :class:`~bson.raw_bson.RawBSONDocument`. If `safe` is ``True``
+        then the save will be
         checked for errors, raising
         :class:`~pymongo.errors.OperationFailure` if one
         occurred. Safe inserts wait for a response from the database,
@@ -228,14 +317,18 @@ class Collection(common.BaseObject):
             ``safe=True``, and will be used as options for the
             `getLastError` command
 
+        .. versionchanged:: 2.4
+           Accept :class:`~bson.BSON` and
+           :class:`~bson.raw_bson.RawBSONDocument` documents.
         .. versionadded:: 1.8
            Support for passing `getLastError` options as keyword
            arguments.
 
         .. mongodoc:: insert
         """
-        if not isinstance(to_save, dict):
+        if not isinstance(to_save, _DOCUMENT_TYPES):
             raise TypeError("cannot save object of type %s" % type(to_save))
+        to_save = _raw_document(to_save)
 
         if "_id" not in to_save:
             return self.insert(to_save, manipulate, safe, check_keys, **kwargs)
@@ -258,6 +351,17 @@ class Collection(common.BaseObject):
         an ``"_id"`` one will be added by the server. The server
         does not return the ``"_id"`` it created so ``None`` is returned.
 
+        Documents that are already encoded, :class:`~bson.BSON` and
+        :class:`~bson.raw_bson.RawBSONDocument` instances, are sent as
+        they are, without being decoded and encoded again. Their keys are
+        not checked, and manipulators aren't applied to them, but an
+        ``"_id"`` is still added if `manipulate` is ``True`` and they
+        don't have one.
+
+        All of the documents are sent in one message. To insert more
+        documents than fit in a message, or to read them lazily from an
+        iterator, use :meth:`insert_iter`.
+
         If `safe` is ``True`` then the insert will be checked for
         errors, raising :class:`~pymongo.errors.OperationFailure` if
         one occurred. Safe inserts wait for a response from the
@@ -289,6 +393,9 @@ class Collection(common.BaseObject):
 
         .. note:: `continue_on_error` requires server version **>= 1.9.1**
 
+        .. versionchanged:: 2.4
+           Accept :class:`~bson.BSON` and
+           :class:`~bson.raw_bson.RawBSONDocument` documents.
         .. versionadded:: 2.1
            Support for continue_on_error.
         .. versionadded:: 1.8
@@ -301,29 +408,225 @@ class Collection(common.BaseObject):
         """
         docs = doc_or_docs
         return_one = False
-        if isinstance(docs, dict):
+        if isinstance(docs, _DOCUMENT_TYPES):
             return_one = True
             docs = [docs]
+        docs = [_raw_document(doc) for doc in docs]
 
         if manipulate:
-            docs = [self.__database._fix_incoming(doc, self) for doc in docs]
+            # Add the missing "_id"s at once, before the ObjectIdInjector
+            # would add them one at a time.
+            missing = [i for (i, doc) in enumerate(docs) if "_id" not in doc]
+            if len(missing) > 1:
+                for i, oid in zip(missing, ObjectId.batch(len(missing))):
+                    if isinstance(docs[i], RawBSONDocument):
+                        docs[i] = _prepend_id(docs[i], oid)
+                    else:
+                        docs[i]["_id"] = oid
+            for i, doc in enumerate(docs):
+                if not isinstance(doc, RawBSONDocument):
+                    docs[i] = self.__database._fix_incoming(doc, self)
+                elif "_id" not in doc:
+                    docs[i] = _prepend_id(doc, ObjectId())
 
         safe, options = self._get_safe_and_lasterror_options(safe, **kwargs)
         self.__database.connection._send_message(
             message.insert(self.__full_name, docs,
                            check_keys, safe, options,
-                           continue_on_error, self.__uuid_subtype), safe)
+                           continue_on_error, self.__uuid_subtype,
+                           self.__type_registry, message.SEGMENT_THRESHOLD),
+            safe)
 
         ids = [doc.get("_id", None) for doc in docs]
         return return_one and ids[0] or ids
 
+    def insert_iter(self, docs, manipulate=True, safe=None, check_keys=True,
+                    continue_on_error=False, batch_size=1000, **kwargs):
+        """Insert the documents of the iterable `docs`, reading it lazily.
+
+        Unlike :meth:`insert`, which encodes all of its documents into a
+        single message, the documents are encoded one at a time and sent
+        in as many insert messages as needed: each message holds at most
+        `batch_size` documents and fits within
+        :attr:`~pymongo.connection.Connection.max_message_size`. Only one
+        message's documents are held at a time, so any number of
+        documents can be inserted from a generator in constant memory.
+
+        This is a generator. Nothing is inserted until it's iterated, and
+        each message is sent as it's needed. It yields an ``(ids, error)``
+        tuple for each message: the ``"_id"`` values of the message's
+        documents (``None`` for each one if `manipulate` is ``False``),
+        and the :class:`~pymongo.errors.OperationFailure` the message
+        raised if `safe` is ``True``, else ``None``. After a message
+        fails, no more messages are sent unless `continue_on_error` is
+        ``True``.
+
+        Raises :class:`~bson.errors.InvalidDocument` for a document larger
+        than :attr:`~pymongo.connection.Connection.max_bson_size`, before
+        it's sent. If the size isn't known yet, because a
+        :class:`~pymongo.replica_set_connection.ReplicaSetConnection`
+        hasn't found its primary, the first message is checked when it's
+        sent and the following documents are checked against the size
+        the primary reports.
+
+        :Parameters:
+          - `docs`: an iterable of documents to be inserted
+          - `manipulate` (optional): manipulate the documents before
+            inserting, adding an ``"_id"`` to each that doesn't have one?
+          - `safe` (optional): check that each message succeeded?
+          - `check_keys` (optional): check if keys start with '$' or
+            contain '.', raising :class:`~pymongo.errors.InvalidName`
+            in either case
+          - `continue_on_error` (optional): If ``True``, the database
+            will not stop processing a message's inserts if one fails
+            (e.g. due to duplicate IDs), and the following messages are
+            still sent
+          - `batch_size` (optional): the most documents to send in one
+            message
+          - `**kwargs` (optional): any additional arguments imply
+            ``safe=True``, and will be used as options for the
+            `getLastError` command
+
+        .. versionadded:: 2.4
+        """
+        if not isinstance(batch_size, (int, long)):
+            raise TypeError("batch_size must be an int")
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        safe, options = self._get_safe_and_lasterror_options(safe, **kwargs)
+        max_bson_size, max_size = self.__size_limits()
+
+        batch = []
+        ids = []
+        size = 0
+        for doc in docs:
+            doc = _raw_document(doc)
+            if manipulate:
+                if isinstance(doc, RawBSONDocument):
+                    if "_id" not in doc:
+                        doc = _prepend_id(doc, ObjectId())
+                else:
+                    doc = self.__database._fix_incoming(doc, self)
+            if isinstance(doc, RawBSONDocument):
+                # Sent as it is.
+                data = doc
+                length = len(doc.raw)
+            else:
+                data = BSON.encode(doc, check_keys, self.__uuid_subtype,
+                                   self.__type_registry)
+                length = len(data)
+            if batch and (len(batch) == batch_size or
+                          size + length > max_size):
+                error = self.__insert_batch(batch, safe, options,
+                                            continue_on_error)
+                yield (ids, error)
+                if error is not None and not continue_on_error:
+                    return
+                if not max_bson_size:
+                    max_bson_size, max_size = self.__size_limits()
+                batch = []
+                ids = []
+                size = 0
+            if max_bson_size and length > max_bson_size:
+                raise InvalidDocument("BSON document too large (%d bytes)"
+                                      " - the connected server supports"
+                                      " BSON document sizes up to %d"
+                                      " bytes." % (length, max_bson_size))
+            batch.append(data)
+            size += length
+            if manipulate:
+                ids.append(doc.get("_id", None))
+            else:
+                ids.append(None)
+        if batch:
+            yield (ids, self.__insert_batch(batch, safe, options,
+                                            continue_on_error))
+
+    def __size_limits(self):
+        """Return the largest document the server accepts and the most
+        document bytes that fit in one insert message.
+
+        A :class:`~pymongo.replica_set_connection.ReplicaSetConnection`
+        reports sizes of 0 until it has found a primary, so the document
+        size is returned as 0, meaning unknown, and the message size
+        falls back to the default for servers that don't report it.
+        """
+        connection = self.__database.connection
+        max_message_size = (connection.max_message_size or
+                            2 * _DEFAULT_MAX_BSON_SIZE)
+        # Leave room for the message header, flags and namespace.
+        return (connection.max_bson_size, max_message_size - 21 -
+                len(self.__full_name.encode("utf-8")))
+
+    def __insert_batch(self, batch, safe, options, continue_on_error):
+        """Send the encoded documents `batch` in one insert message,
+        returning the :class:`~pymongo.errors.OperationFailure` it raised
+        or ``None``.
+        """
+        try:
+            self.__database.connection._send_message(
+                message.insert(self.__full_name, batch, False, safe,
+                               options, continue_on_error,
+                               self.__uuid_subtype, None,
+                               message.SEGMENT_THRESHOLD), safe)
+        except OperationFailure, error:
+            return error
+        return None
+
+    def insert_json_lines(self, lines, safe=None,
+                          continue_on_error=False, **kwargs):
+        """Insert documents read from JSON Lines text, one extended JSON
+        document per line.
+
+        Each line is converted straight to BSON with
+        :func:`~bson.json_util.load_json_lines`, and the documents are
+        sent in as many insert messages as needed to keep each message's
+        documents within :attr:`~pymongo.connection.Connection.max_bson_size`
+        bytes. No Python objects are created for the documents. An
+        ``"_id"`` is added to the documents that don't have one, but
+        manipulators aren't applied and keys aren't checked. Returns the
+        number of documents inserted.
+
+        If `safe` is ``True`` each message is checked for errors, raising
+        :class:`~pymongo.errors.OperationFailure` if one occurred, and
+        the documents of the following messages aren't inserted.
+
+        :Parameters:
+          - `lines`: an iterable of lines, e.g. a file opened in binary
+            mode
+          - `safe` (optional): check that each insert succeeded?
+          - `continue_on_error` (optional): If ``True``, the database
+            will not stop processing a message's inserts if one fails
+            (e.g. due to duplicate IDs)
+          - `**kwargs` (optional): any additional arguments imply
+            ``safe=True``, and will be used as options for the
+            `getLastError` command
+
+        .. versionadded:: 2.4
+        """
+        safe, options = self._get_safe_and_lasterror_options(safe, **kwargs)
+        connection = self.__database.connection
+        # The size is 0 if a ReplicaSetConnection hasn't found a primary.
+        max_bson_size = self.__size_limits()[0] or _DEFAULT_MAX_BSON_SIZE
+        docs = json_util.load_json_lines(lines, self.__uuid_subtype)
+        count = 0
+        for batch in _batch_documents(docs, max_bson_size):
+            connection._send_message(
+                message.insert(self.__full_name, batch, False, safe,
+                               options, continue_on_error,
+                               self.__uuid_subtype, None,
+                               message.SEGMENT_THRESHOLD), safe)
+            count += len(batch)
+        return count
+
     def update(self, spec, document, upsert=False, manipulate=False,
                safe=None, multi=False, _check_keys=False, **kwargs):
         """Update a document(s) in this collection.
 
-        Raises :class:`TypeError` if either `spec` or `document` is
-        not an instance of ``dict`` or `upsert` is not an instance of
-        ``bool``. If `safe` is ``True`` then the update will be
+        Raises :class:`TypeError` if `spec` is not an instance of
+        ``dict``, `document` is not an instance of ``dict``,
+        :class:`~bson.BSON` or :class:`~bson.raw_bson.RawBSONDocument`,
+        or `upsert` is not an instance of ``bool``. If `safe` is ``True`` then the update will be
         checked for errors, raising
         :class:`~pymongo.errors.OperationFailure` if one
         occurred. Safe updates require a response from the database,
@@ -360,7 +663,9 @@ class Collection(common.BaseObject):
           - `document`: a ``dict`` or :class:`~bson.son.SON`
             instance specifying the document to be used for the update
             or (in the case of an upsert) insert - see docs on MongoDB
-            `update modifiers`_
+            `update modifiers`_. A document that is already encoded, a
+            :class:`~bson.BSON` or :class:`~bson.raw_bson.RawBSONDocument`
+            instance, is sent as it is and never manipulated
           - `upsert` (optional): perform an upsert if ``True``
           - `manipulate` (optional): manipulate the document before
             updating? If ``True`` all instances of
@@ -378,6 +683,9 @@ class Collection(common.BaseObject):
             ``safe=True``, and will be used as options for the
             `getLastError` command
 
+        .. versionchanged:: 2.4
+           Accept :class:`~bson.BSON` and
+           :class:`~bson.raw_bson.RawBSONDocument` documents.
         .. versionadded:: 1.8
            Support for passing `getLastError` options as keyword
            arguments.
@@ -392,12 +700,13 @@ class Collection(common.BaseObject):
         """
         if not isinstance(spec, dict):
             raise TypeError("spec must be an instance of dict")
-        if not isinstance(document, dict):
-            raise TypeError("document must be an instance of dict")
+        if not isinstance(document, _DOCUMENT_TYPES):
+            raise TypeError("document must be an instance of dict, "
+                            "BSON or RawBSONDocument")
         if not isinstance(upsert, bool):
             raise TypeError("upsert must be an instance of bool")
 
-        if manipulate:
+        if manipulate and isinstance(document, dict):
             document = self.__database._fix_incoming(document, self)
 
         safe, options = self._get_safe_and_lasterror_options(safe, **kwargs)
@@ -408,7 +717,8 @@ class Collection(common.BaseObject):
         return self.__database.connection._send_message(
             message.update(self.__full_name, upsert, multi,
                            spec, document, safe, options,
-                           _check_keys, self.__uuid_subtype), safe)
+                           _check_keys, self.__uuid_subtype,
+                           self.__type_registry), safe)
 
     def drop(self):
         """Alias for :meth:`~pymongo.database.Database.drop_collection`.
@@ -480,7 +790,8 @@ class Collection(common.BaseObject):
         safe, options = self._get_safe_and_lasterror_options(safe, **kwargs)
         return self.__database.connection._send_message(
             message.delete(self.__full_name, spec_or_id, safe,
-                           options, self.__uuid_subtype), safe)
+                           options, self.__uuid_subtype,
+                           self.__type_registry), safe)
 
     def find_one(self, spec_or_id=None, *args, **kwargs):
         """Get a single document from the database.
@@ -517,6 +828,42 @@ class Collection(common.BaseObject):
             return result
         return None
 
+    def find_one_many(self, specs, *args, **kwargs):
+        """Get a single document from the database for each of `specs`.
+
+        Like calling :meth:`find_one` with each spec in turn, but the
+        queries are pipelined: they're all written to one socket before
+        their responses are read, so they take about one round trip to
+        the server rather than one each. Returns a list of the document
+        found, or ``None``, for each spec.
+
+        :Parameters:
+          - `specs`: an iterable of queries, each a dictionary OR any
+            other type to be used as the value for a query for ``"_id"``
+
+          - `*args` (optional): any additional positional arguments
+            are the same as the arguments to :meth:`find`.
+
+          - `**kwargs` (optional): any additional keyword arguments
+            are the same as the arguments to :meth:`find`.
+
+        .. versionadded:: 2.4
+        """
+        cursors = []
+        for spec in specs:
+            if spec is not None and not isinstance(spec, dict):
+                spec = {"_id": spec}
+            cursors.append(self.find(spec, *args, **kwargs).limit(-1))
+        Cursor._refresh_all(cursors)
+
+        results = []
+        for cursor in cursors:
+            result = None
+            for result in cursor:
+                break
+            results.append(result)
+        return results
+
     def find(self, *args, **kwargs):
         """Query the database.
 
@@ -594,6 +941,28 @@ class Collection(common.BaseObject):
           - `secondary_acceptable_latency_ms` (optional): Any replica-set
             member whose ping time is within secondary_acceptable_latency_ms of
             the nearest member may accept reads. Default 15 milliseconds.
+          - `decode_fields` (optional): a list of field names, in dot
+            notation, to decode from each document returned by the
+            server. All other fields are skipped over without being
+            decoded. Unlike `fields` this is applied on the client side,
+            so it can be used to avoid decoding fields which must still be
+            sent by the server. See :func:`~bson.decode_all`.
+          - `compile_re` (optional): if ``False``, don't compile the
+            regular expressions in the returned documents, but return
+            them as :class:`~bson.regex.Regex` instances. Compiling
+            regular expressions is slow, and unneeded if they are only
+            stored, or sent back to the server.
+          - `binary_view` (optional): if ``True``, return binary values
+            of subtype 0 as read-only :class:`memoryview` slices of the
+            server's reply instead of copying them. Saves copying large
+            values like GridFS chunks, e.g. to write them straight to a
+            file. Each view keeps its whole reply alive. Requires Python
+            2.7 or later.
+          - `typed_arrays` (optional): if ``True``, return arrays whose
+            elements are all numbers of the same kind (integers or
+            doubles) as :class:`array.array` instances instead of lists
+            (see :meth:`bson.BSON.decode`). Cheaper to decode, and to
+            hold in memory, than lists of large numeric arrays.
 
         .. note:: The `manipulate` parameter may default to False in
            a future release.
@@ -601,6 +970,10 @@ class Collection(common.BaseObject):
         .. note:: The `max_scan` parameter requires server
            version **>= 1.5.1**
 
+        .. versionadded:: 2.4
+           The `decode_fields`, `compile_re`, `binary_view` and
+           `typed_arrays` parameters.
+
         .. versionadded:: 2.3
            The `tag_sets` and `secondary_acceptable_latency_ms` parameters.
 
@@ -160,6 +160,7 @@ VALIDATORS = {
     'secondary_acceptable_latency_ms': validate_positive_float,
     'auto_start_request': validate_boolean,
     'use_greenlets': validate_boolean,
+    'share_sockets': validate_boolean,
 }
 
 
@@ -37,11 +37,9 @@ access:
 import datetime
 import random
 import socket
-import struct
 import time
 import warnings
 
-from bson.py3compat import b
 from bson.son import SON
 from pymongo import (common,
                      database,
@@ -58,7 +56,6 @@ from pymongo.errors import (AutoReconnect,
                             InvalidURI,
                             OperationFailure)
 
-EMPTY = b("")
 
 def _partition_node(node):
     """Split a host:port string returned from mongod/s into
@@ -82,6 +79,7 @@ class Connection(common.BaseObject):
     PORT = 27017
 
     __max_bson_size = 4 * 1024 * 1024
+    __max_message_size = 2 * __max_bson_size
 
     def __init__(self, host=None, port=None, max_pool_size=10,
                  network_timeout=None, document_class=dict,
@@ -167,10 +165,22 @@ class Connection(common.BaseObject):
           - `use_greenlets` (optional): if ``True``, :meth:`start_request()`
             will ensure that the current greenlet uses the same socket for all
             operations until :meth:`end_request()`
+          - `share_sockets` (optional): if ``True``, threads use the
+            sockets in the connection pool at once, instead of each taking
+            one of its own, so at most `max_pool_size` sockets are opened.
+            Each thread's requests are sent whole and the responses are
+            handed to the threads waiting for them. The server handles the
+            requests on a socket one at a time, so a slow operation delays
+            the others sharing its socket. The `network_timeout` of single
+            operations is ignored, and :meth:`~pymongo.database.Database.error`
+            and the like can report the errors of other threads' unsafe
+            writes. Can't be used with `use_greenlets`.
           - `slave_okay` or `slaveOk` (deprecated): Use `read_preference`
             instead.
 
         .. seealso:: :meth:`end_request`
+        .. versionchanged:: 2.4
+           Added the `share_sockets` option.
         .. versionchanged:: 2.3
            Added support for failover between mongos seed list members.
         .. versionchanged:: 2.2
@@ -269,13 +279,19 @@ class Connection(common.BaseObject):
                                      "2.6 you must install the ssl package "
                                      "from PyPI.")
 
+        self.__share_sockets = options.get('share_sockets', False)
         if options.get('use_greenlets', False):
             if not pool.have_greenlet:
                 raise ConfigurationError(
                     "The greenlet module is not available. "
                     "Install the greenlet package from PyPI."
                 )
+            if self.__share_sockets:
+                raise ConfigurationError("share_sockets can't be used "
+                                         "with use_greenlets")
             self.pool_class = pool.GreenletPool
+        elif self.__share_sockets:
+            self.pool_class = pool.SharedPool
         else:
             self.pool_class = pool.Pool
 
@@ -507,14 +523,24 @@ class Connection(common.BaseObject):
         """
         return self.__max_bson_size
 
+    @property
+    def max_message_size(self):
+        """Return the maximum size message the connected server accepts
+        in bytes. Defaults to twice :attr:`max_bson_size` in servers that
+        don't report it (< 2.4).
+
+        .. versionadded:: 2.4
+        """
+        return self.__max_message_size
+
     def __simple_command(self, sock_info, dbname, spec):
         """Send a command to the server.
         """
         rqst_id, msg, _ = message.query(0, dbname + '.$cmd', 0, -1, spec)
         start = time.time()
         try:
-            sock_info.sock.sendall(msg)
-            response = self.__receive_message_on_socket(1, rqst_id, sock_info)
+            sock_info.sendall(msg)
+            response = sock_info.receive_message(1, rqst_id)
         except:
             sock_info.close()
             raise
@@ -560,6 +586,8 @@ class Connection(common.BaseObject):
 
         if "maxBsonObjectSize" in response:
             self.__max_bson_size = response["maxBsonObjectSize"]
+        self.__max_message_size = response.get("maxMessageSizeBytes",
+                                                2 * self.__max_bson_size)
 
         # Replica Set?
         if not self.__direct:
@@ -825,15 +853,14 @@ class Connection(common.BaseObject):
         sock_info = self.__socket()
         try:
             (request_id, data) = self.__check_bson_size(message)
-            sock_info.sock.sendall(data)
+            sock_info.sendall(data)
             # Safe mode. We pack the message together with a lastError
             # message and send both. We then get the response (to the
             # lastError) and raise OperationFailure if it is an error
             # response.
             rv = None
             if with_last_error:
-                response = self.__receive_message_on_socket(1, request_id,
-                                                            sock_info)
+                response = sock_info.receive_message(1, request_id)
                 rv = self.__check_response_to_last_error(response)
 
             self.__pool.maybe_return_socket(sock_info)
@@ -848,42 +875,24 @@ class Connection(common.BaseObject):
             sock_info.close()
             raise
 
-    def __receive_data_on_socket(self, length, sock_info):
-        """Lowest level receive operation.
-
-        Takes length to receive and repeatedly calls recv until able to
-        return a buffer of that length, raising ConnectionFailure on error.
-        """
-        chunks = []
-        while length:
-            chunk = sock_info.sock.recv(length)
-            if chunk == EMPTY:
-                raise ConnectionFailure("connection closed")
-            length -= len(chunk)
-            chunks.append(chunk)
-        return EMPTY.join(chunks)
-
-    def __receive_message_on_socket(self, operation, request_id, sock_info):
-        """Receive a message in response to `request_id` on `sock`.
-
-        Returns the response data with the header removed.
-        """
-        header = self.__receive_data_on_socket(16, sock_info)
-        length = struct.unpack("<i", header[:4])[0]
-        assert request_id == struct.unpack("<i", header[8:12])[0], \
-            "ids don't match %r %r" % (request_id,
-                                       struct.unpack("<i", header[8:12])[0])
-        assert operation == struct.unpack("<i", header[12:])[0]
-
-        return self.__receive_data_on_socket(length - 16, sock_info)
-
     def __send_and_receive(self, message, sock_info):
         """Send a message on the given socket and return the response data.
+
+        If `message` is a list of messages they're pipelined, and a list
+        of their response data is returned.
         """
+        if isinstance(message, list):
+            messages = [self.__check_bson_size(m) for m in message]
+            try:
+                return sock_info.pipeline(messages)
+            except:
+                sock_info.close()
+                raise
+
         (request_id, data) = self.__check_bson_size(message)
         try:
-            sock_info.sock.sendall(data)
-            return self.__receive_message_on_socket(1, request_id, sock_info)
+            sock_info.sendall(data)
+            return sock_info.receive_message(1, request_id)
         except:
             sock_info.close()
             raise
@@ -897,8 +906,13 @@ class Connection(common.BaseObject):
         Sends the given message and returns the response.
 
         :Parameters:
-          - `message`: (request_id, data) pair making up the message to send
+          - `message`: (request_id, data) pair making up the message to
+            send, or a list of them to pipeline on one socket, returning
+            a list of the responses
         """
+        if self.__share_sockets:
+            # Other threads use the socket too, keep its timeout.
+            kwargs.pop("network_timeout", None)
         sock_info = self.__socket()
 
         try:
@@ -15,6 +15,7 @@
 """Cursor class to iterate over Mongo query results."""
 from collections import deque
 
+import bson
 from bson.code import Code
 from bson.son import SON
 from pymongo import helpers, message, read_preferences
@@ -44,8 +45,11 @@ class Cursor(object):
                  max_scan=None, as_class=None, slave_okay=False,
                  await_data=False, partial=False, manipulate=True,
                  read_preference=ReadPreference.PRIMARY, tag_sets=[{}],
-                 secondary_acceptable_latency_ms=None,
-                 _must_use_master=False, _uuid_subtype=None, **kwargs):
+                 secondary_acceptable_latency_ms=None, decode_fields=None,
+                 compile_re=True, binary_view=False, typed_arrays=False,
+                 _must_use_master=False,
+                 _uuid_subtype=None,
+                 **kwargs):
         """Create a new cursor.
 
         Should not be called directly by application developers - see
@@ -76,6 +80,12 @@ class Cursor(object):
             raise TypeError("await_data must be an instance of bool")
         if not isinstance(partial, bool):
             raise TypeError("partial must be an instance of bool")
+        if not isinstance(compile_re, bool):
+            raise TypeError("compile_re must be an instance of bool")
+        if not isinstance(binary_view, bool):
+            raise TypeError("binary_view must be an instance of bool")
+        if not isinstance(typed_arrays, bool):
+            raise TypeError("typed_arrays must be an instance of bool")
 
         if fields is not None:
             if not fields:
@@ -83,6 +93,11 @@ class Cursor(object):
             if not isinstance(fields, dict):
                 fields = helpers._fields_list_to_dict(fields)
 
+        if decode_fields is not None:
+            # Raises TypeError for an invalid list of fields.
+            bson._fields_tree(decode_fields)
+            decode_fields = list(decode_fields)
+
         if as_class is None:
             as_class = collection.database.connection.document_class
 
@@ -111,6 +126,10 @@ class Cursor(object):
         self.__explain = False
         self.__hint = None
         self.__as_class = as_class
+        self.__decode_fields = decode_fields
+        self.__compile_re = compile_re
+        self.__binary_view = binary_view
+        self.__typed_arrays = typed_arrays
         self.__slave_okay = slave_okay
         self.__manipulate = manipulate
         self.__read_preference = read_preference
@@ -119,6 +138,9 @@ class Cursor(object):
         self.__tz_aware = collection.database.connection.tz_aware
         self.__must_use_master = _must_use_master
         self.__uuid_subtype = _uuid_subtype or collection.uuid_subtype
+        self.__type_registry = collection.type_registry
+        self.__columns = None
+        self.__raw = False
         self.__query_flags = 0
 
         self.__data = deque()
@@ -177,6 +199,10 @@ class Cursor(object):
         copy.__batch_size = self.__batch_size
         copy.__max_scan = self.__max_scan
         copy.__as_class = self.__as_class
+        copy.__decode_fields = self.__decode_fields
+        copy.__compile_re = self.__compile_re
+        copy.__binary_view = self.__binary_view
+        copy.__typed_arrays = self.__typed_arrays
         copy.__slave_okay = self.__slave_okay
         copy.__await_data = self.__await_data
         copy.__partial = self.__partial
@@ -187,6 +213,7 @@ class Cursor(object):
             self.__secondary_acceptable_latency_ms)
         copy.__must_use_master = self.__must_use_master
         copy.__uuid_subtype = self.__uuid_subtype
+        copy.__type_registry = self.__type_registry
         copy.__query_flags = self.__query_flags
         copy.__kwargs = self.__kwargs
         return copy
@@ -579,6 +606,60 @@ class Cursor(object):
                                 uuid_subtype = self.__uuid_subtype,
                                 **options)["values"]
 
+    def decode_columns(self, schema):
+        """Decode all the results of this cursor to columns of typed
+        arrays.
+
+        Each batch of results is decoded straight from the server's
+        reply to the columns in `schema`, without creating any
+        documents, which is much faster when results are only read to
+        collect numeric fields for analysis. See
+        :func:`bson.columns.decode_columns` for `schema` and the
+        columns returned. The cursor is exhausted afterwards.
+
+        Raises :class:`~pymongo.errors.InvalidOperation` if this
+        :class:`Cursor` has already been used. SON manipulators are not
+        applied.
+
+        :Parameters:
+          - `schema`: a mapping, or a list of pairs, of field paths to
+            column types from :mod:`bson.columns`
+
+        .. versionadded:: 2.4
+        """
+        self.__check_okay_to_chain()
+        columns = bson.columns._columns_schema(schema)
+        batches = []
+        self.__columns = columns
+        try:
+            while self._refresh():
+                batches.append(self.__data.popleft())
+        finally:
+            self.__columns = None
+        return bson.columns._make_columns(columns, batches)
+
+    def raw_batches(self):
+        """Iterate over the results of this cursor in raw batches.
+
+        Each batch is a string of the concatenated BSON documents of one
+        reply from the server, which isn't decoded. It can be decoded
+        with :func:`bson.decode_all`, or :func:`bson.json_util.dump_cursor`
+        can write it as JSON. The cursor is exhausted afterwards.
+
+        Raises :class:`~pymongo.errors.InvalidOperation` if this
+        :class:`Cursor` has already been used. SON manipulators are not
+        applied.
+
+        .. versionadded:: 2.4
+        """
+        self.__check_okay_to_chain()
+        self.__raw = True
+        try:
+            while self._refresh():
+                yield self.__data.popleft()
+        finally:
+            self.__raw = False
+
     def explain(self):
         """Returns an explain plan record for this cursor.
 
@@ -651,6 +732,12 @@ class Cursor(object):
     def __send_message(self, message):
         """Send a query or getmore message and handles the response.
         """
+        self.__handle_response(self.__send(message))
+
+    def __send(self, message):
+        """Send a message, or a list of messages to pipeline, and return
+        the response from the connection.
+        """
         db = self.__collection.database
         kwargs = {"_must_use_master": self.__must_use_master}
         kwargs["read_preference"] = self.__read_preference
@@ -662,8 +749,8 @@ class Cursor(object):
         kwargs.update(self.__kwargs)
 
         try:
-            response = db.connection._send_message_with_response(message,
-                                                                 **kwargs)
+            return db.connection._send_message_with_response(message,
+                                                             **kwargs)
         except AutoReconnect:
             # Don't try to send kill cursors on another socket
             # or to another server. It can cause a _pinValue
@@ -672,6 +759,9 @@ class Cursor(object):
             self.__killed = True
             raise
 
+    def __handle_response(self, response):
+        """Unpack the response to a query or getmore message.
+        """
         if isinstance(response, tuple):
             (connection_id, response) = response
         else:
@@ -683,12 +773,19 @@ class Cursor(object):
             response = helpers._unpack_response(response, self.__id,
                                                 self.__as_class,
                                                 self.__tz_aware,
-                                                self.__uuid_subtype)
+                                                self.__uuid_subtype,
+                                                self.__decode_fields,
+                                                self.__type_registry,
+                                                self.__columns,
+                                                self.__compile_re,
+                                                self.__raw,
+                                                self.__binary_view,
+                                                self.__typed_arrays)
         except AutoReconnect:
             # Don't send kill cursors to another server after a "not master"
             # error. It's completely pointless.
             self.__killed = True
-            db.connection.disconnect()
+            self.__collection.database.connection.disconnect()
             raise
         self.__id = response["cursor_id"]
 
@@ -704,6 +801,49 @@ class Cursor(object):
         if self.__limit and self.__id and self.__limit <= self.__retrieved:
             self.__die()
 
+    def __query_message(self):
+        """The message for this cursor's query.
+        """
+        ntoreturn = self.__batch_size
+        if self.__limit:
+            if self.__batch_size:
+                ntoreturn = min(self.__limit, self.__batch_size)
+            else:
+                ntoreturn = self.__limit
+        return message.query(self.__query_options(),
+                             self.__collection.full_name,
+                             self.__skip, ntoreturn,
+                             self.__query_spec(), self.__fields,
+                             self.__uuid_subtype, self.__type_registry)
+
+    @staticmethod
+    def _refresh_all(cursors):
+        """Send the queries of `cursors`, which must not have been
+        iterated yet, pipelined on one socket, and handle the responses
+        like :meth:`_refresh`.
+
+        The queries are sent like the first cursor's, so the cursors
+        should share a collection and read preferences.
+        """
+        cursors = list(cursors)
+        if not cursors:
+            return
+        try:
+            response = cursors[0].__send([cursor.__query_message()
+                                          for cursor in cursors])
+        except AutoReconnect:
+            for cursor in cursors:
+                cursor.__killed = True
+            raise
+
+        if isinstance(response, tuple):
+            (connection_id, response) = response
+            response = [(connection_id, data) for data in response]
+        for (cursor, data) in zip(cursors, response):
+            cursor.__handle_response(data)
+            if not cursor.__id:
+                cursor.__killed = True
+
     def _refresh(self):
         """Refreshes the cursor with more data from Mongo.
 
@@ -715,18 +855,7 @@ class Cursor(object):
             return len(self.__data)
 
         if self.__id is None:  # Query
-            ntoreturn = self.__batch_size
-            if self.__limit:
-                if self.__batch_size:
-                    ntoreturn = min(self.__limit, self.__batch_size)
-                else:
-                    ntoreturn = self.__limit
-            self.__send_message(
-                message.query(self.__query_options(),
-                              self.__collection.full_name,
-                              self.__skip, ntoreturn,
-                              self.__query_spec(), self.__fields,
-                              self.__uuid_subtype))
+            self.__send_message(self.__query_message())
             if not self.__id:
                 self.__killed = True
         elif self.__id:  # Get More
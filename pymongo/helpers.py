@@ -76,18 +76,38 @@ def _index_document(index_list):
 
 
 def _unpack_response(response, cursor_id=None,
-                     as_class=dict, tz_aware=False, uuid_subtype=OLD_UUID_SUBTYPE):
+                     as_class=dict, tz_aware=False, uuid_subtype=OLD_UUID_SUBTYPE,
+                     fields=None, type_registry=None, columns=None,
+                     compile_re=True, raw=False, binary_view=False,
+                     typed_arrays=False):
     """Unpack a response from the database.
 
     Check the response for errors and unpack, returning a dictionary
     containing the response data.
 
     :Parameters:
-      - `response`: byte string as returned from the database
+      - `response`: byte string as returned from the database, or any
+        other object supporting the buffer protocol
       - `cursor_id` (optional): cursor_id we sent to get this response -
         used for raising an informative exception when we get cursor id not
         valid at server response
       - `as_class` (optional): class to use for resulting documents
+      - `fields` (optional): list of field names, in dot notation, to
+        decode from each document (see :func:`bson.decode_all`)
+      - `type_registry` (optional): a
+        :class:`~bson.type_registry.TypeRegistry` to decode with
+      - `columns` (optional): columns to decode the documents to instead
+        (see :meth:`~pymongo.cursor.Cursor.decode_columns`), making
+        the data a list of a single batch of columns
+      - `compile_re` (optional): if ``False``, decode regular
+        expressions as :class:`~bson.regex.Regex` instances
+      - `raw` (optional): if ``True``, don't decode the documents,
+        making the data a list of a single string of the BSON of all of
+        them (or an empty list if there are none)
+      - `binary_view` (optional): if ``True``, decode binary values of
+        subtype 0 as :class:`memoryview` slices of `response`
+      - `typed_arrays` (optional): if ``True``, decode arrays of numbers
+        as :class:`array.array` instances
     """
     response_flag = struct.unpack("<i", response[:4])[0]
     if response_flag & 1:
@@ -97,7 +117,7 @@ def _unpack_response(response, cursor_id=None,
         raise OperationFailure("cursor id '%s' not valid at server" %
                                cursor_id)
     elif response_flag & 2:
-        error_object = bson.BSON(response[20:]).decode()
+        error_object = bson.BSON(bson._buffer_to_bytes(response, 20)).decode()
         if error_object["$err"].startswith("not master"):
             raise AutoReconnect("master has changed")
         raise OperationFailure("database error: %s" %
@@ -107,8 +127,20 @@ def _unpack_response(response, cursor_id=None,
     result["cursor_id"] = struct.unpack("<q", response[4:12])[0]
     result["starting_from"] = struct.unpack("<i", response[12:16])[0]
     result["number_returned"] = struct.unpack("<i", response[16:20])[0]
-    result["data"] = bson.decode_all(response[20:],
-                                     as_class, tz_aware, uuid_subtype)
+    # Decode the documents in place, rather than copying them with
+    # response[20:] first.
+    if columns is not None:
+        result["data"] = [bson.columns._decode_columns(response, columns, 20)]
+        return result
+    if raw:
+        if result["number_returned"]:
+            result["data"] = [bson._buffer_to_bytes(response, 20)]
+        else:
+            result["data"] = []
+        return result
+    result["data"] = bson.decode_all(response, as_class, tz_aware,
+                                     uuid_subtype, fields, 20, type_registry,
+                                     compile_re, binary_view, typed_arrays)
     assert len(result["data"]) == result["number_returned"]
     return result
 
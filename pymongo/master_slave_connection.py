@@ -107,6 +107,23 @@ class MasterSlaveConnection(BaseObject):
     def tz_aware(self):
         return self.__tz_aware
 
+    @property
+    def max_bson_size(self):
+        """Return the maximum size BSON object the master accepts in
+        bytes.
+
+        .. versionadded:: 2.4
+        """
+        return self.__master.max_bson_size
+
+    @property
+    def max_message_size(self):
+        """Return the maximum size message the master accepts in bytes.
+
+        .. versionadded:: 2.4
+        """
+        return self.__master.max_message_size
+
     def disconnect(self):
         """Disconnect from MongoDB.
 
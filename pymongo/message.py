@@ -22,6 +22,7 @@ MongoDB.
 .. versionadded:: 1.1.2
 """
 
+import itertools
 import random
 import struct
 
@@ -44,6 +45,25 @@ EMPTY  = b("")
 MAX_INT32 = 2147483647
 MIN_INT32 = -2147483648
 
+# Values at least this large are sent as separate segments by insert
+# rather than being copied into the message (see SocketInfo.sendall).
+SEGMENT_THRESHOLD = 64 * 1024
+
+
+__request_ids = itertools.count(random.randint(0, MAX_INT32))
+
+
+def _request_id():
+    """Get the request id for a new message.
+
+    Request ids count up, wrapping around to 0 after the largest int32.
+    The counter is shared with the C message builders when they're
+    available.
+    """
+    return __request_ids.next() & MAX_INT32
+if _use_c:
+    _request_id = _cmessage._request_id
+
 
 def __last_error(namespace, args):
     """Data to send to do a lastError.
@@ -59,7 +79,7 @@ def __pack_message(operation, data):
 
     Returns the resultant message string.
     """
-    request_id = random.randint(MIN_INT32, MAX_INT32)
+    request_id = _request_id()
     message = struct.pack("<i", 16 + len(data))
     message += struct.pack("<i", request_id)
     message += __ZERO  # responseTo
@@ -67,9 +87,34 @@ def __pack_message(operation, data):
     return (request_id, message + data)
 
 
-def insert(collection_name, docs, check_keys,
-           safe, last_error_args, continue_on_error, uuid_subtype):
+def __segments(pieces, threshold):
+    """Join the runs of `pieces` smaller than `threshold`, returning a
+    list of segments.
+    """
+    segments = []
+    run = []
+    for piece in pieces:
+        if len(piece) < threshold:
+            run.append(piece)
+            continue
+        if run:
+            segments.append(EMPTY.join(run))
+            run = []
+        segments.append(piece)
+    if run:
+        segments.append(EMPTY.join(run))
+    return segments
+
+
+def insert(collection_name, docs, check_keys, safe, last_error_args,
+           continue_on_error, uuid_subtype, type_registry=None,
+           segment_threshold=0):
     """Get an **insert** message.
+
+    If `segment_threshold` is non-zero the message is returned as a list
+    of segments, rather than one string, and values (or, without the C
+    extension, documents) at least that large are segments of their
+    own rather than being copied.
     """
     max_bson_size = 0
     options = 0
@@ -77,10 +122,22 @@ def insert(collection_name, docs, check_keys,
         options += 1
     data = struct.pack("<i", options)
     data += bson._make_c_string(collection_name)
-    encoded = [bson.BSON.encode(doc, check_keys, uuid_subtype) for doc in docs]
+    encoded = [bson.BSON.encode(doc, check_keys, uuid_subtype, type_registry)
+               for doc in docs]
     if not encoded:
         raise InvalidOperation("cannot do an empty bulk insert")
     max_bson_size = max(map(len, encoded))
+    if segment_threshold:
+        request_id = _request_id()
+        length = 16 + len(data) + sum(map(len, encoded))
+        header = struct.pack("<iiii", length, request_id, 0, 2002)
+        pieces = [header + data] + encoded
+        if safe:
+            (request_id, error_message, _) = __last_error(collection_name,
+                                                          last_error_args)
+            pieces.append(error_message)
+        return (request_id, __segments(pieces, segment_threshold),
+                max_bson_size)
     data += EMPTY.join(encoded)
     if safe:
         (_, insert_message) = __pack_message(2002, data)
@@ -94,8 +151,8 @@ if _use_c:
     insert = _cmessage._insert_message
 
 
-def update(collection_name, upsert, multi,
-           spec, doc, safe, last_error_args, check_keys, uuid_subtype):
+def update(collection_name, upsert, multi, spec, doc, safe,
+           last_error_args, check_keys, uuid_subtype, type_registry=None):
     """Get an **update** message.
     """
     options = 0
@@ -107,8 +164,8 @@ def update(collection_name, upsert, multi,
     data = __ZERO
     data += bson._make_c_string(collection_name)
     data += struct.pack("<i", options)
-    data += bson.BSON.encode(spec, False, uuid_subtype)
-    encoded = bson.BSON.encode(doc, check_keys, uuid_subtype)
+    data += bson.BSON.encode(spec, False, uuid_subtype, type_registry)
+    encoded = bson.BSON.encode(doc, check_keys, uuid_subtype, type_registry)
     data += encoded
     if safe:
         (_, update_message) = __pack_message(2001, data)
@@ -124,18 +181,19 @@ if _use_c:
 
 def query(options, collection_name, num_to_skip,
           num_to_return, query, field_selector=None,
-          uuid_subtype=OLD_UUID_SUBTYPE):
+          uuid_subtype=OLD_UUID_SUBTYPE, type_registry=None):
     """Get a **query** message.
     """
     data = struct.pack("<I", options)
     data += bson._make_c_string(collection_name)
     data += struct.pack("<i", num_to_skip)
     data += struct.pack("<i", num_to_return)
-    encoded = bson.BSON.encode(query, False, uuid_subtype)
+    encoded = bson.BSON.encode(query, False, uuid_subtype, type_registry)
     data += encoded
     max_bson_size = len(encoded)
     if field_selector is not None:
-        encoded = bson.BSON.encode(field_selector, False, uuid_subtype)
+        encoded = bson.BSON.encode(field_selector, False,
+                                   uuid_subtype, type_registry)
         data += encoded
         max_bson_size = max(len(encoded), max_bson_size)
     (request_id, query_message) = __pack_message(2004, data)
@@ -156,13 +214,14 @@ if _use_c:
     get_more = _cmessage._get_more_message
 
 
-def delete(collection_name, spec, safe, last_error_args, uuid_subtype):
+def delete(collection_name, spec, safe,
+           last_error_args, uuid_subtype, type_registry=None):
     """Get a **delete** message.
     """
     data = __ZERO
     data += bson._make_c_string(collection_name)
     data += __ZERO
-    encoded = bson.BSON.encode(spec, False, uuid_subtype)
+    encoded = bson.BSON.encode(spec, False, uuid_subtype, type_registry)
     data += encoded
     if safe:
         (_, remove_message) = __pack_message(2006, data)
@@ -172,13 +231,17 @@ def delete(collection_name, spec, safe, last_error_args, uuid_subtype):
     else:
         (request_id, remove_message) = __pack_message(2006, data)
         return (request_id, remove_message, len(encoded))
+if _use_c:
+    delete = _cmessage._delete_message
 
 
 def kill_cursors(cursor_ids):
     """Get a **killCursors** message.
     """
+    cursor_ids = list(cursor_ids)
     data = __ZERO
-    data += struct.pack("<i", len(cursor_ids))
-    for cursor_id in cursor_ids:
-        data += struct.pack("<q", cursor_id)
+    data += struct.pack("<i%dq" % len(cursor_ids), len(cursor_ids),
+                        *cursor_ids)
     return __pack_message(2007, data)
+if _use_c:
+    kill_cursors = _cmessage._kill_cursors_message
@@ -14,11 +14,13 @@
 
 import os
 import socket
+import struct
 import sys
 import time
 import threading
 import weakref
 
+from bson.py3compat import b
 from pymongo.errors import ConnectionFailure
 
 
@@ -39,9 +41,30 @@ except ImportError:
     have_greenlet = False
 
 
+EMPTY = b("")
+
 NO_REQUEST    = None
 NO_SOCKET_YET = -1
 
+# Segments passed to one sendmsg call, within the IOV_MAX of most systems.
+_IOV_MAX = 1024
+
+# Size of each socket's read-ahead buffer. A reply smaller than this,
+# header included, usually takes one recv_into call.
+_READ_AHEAD = 64 * 1024
+
+# Most bytes of messages pipelined before reading their responses. Kept
+# within the socket buffers, so that neither end blocks sending while
+# the other one does too.
+_PIPELINE_SIZE = 16 * 1024
+
+try:
+    memoryview
+    have_memoryview = True
+except NameError:
+    # Python < 2.7
+    have_memoryview = False
+
 
 if sys.platform.startswith('java'):
     from select import cpython_compatible_select as select
@@ -73,6 +96,144 @@ class SocketInfo(object):
         # created before the last reset.
         self.pool_id = pool_id
 
+        # Bytes received past the end of the last read are kept in
+        # __ahead[__ahead_start:__ahead_end] for the next one.
+        self.__ahead = None
+        self.__ahead_start = 0
+        self.__ahead_end = 0
+
+    def sendall(self, data):
+        """Send `data`, a string or a list of strings (segments).
+
+        Segments are sent with as few ``sendmsg`` calls as possible
+        where the socket supports it (Python 3.3+, not SSL), and one
+        at a time otherwise, so they're never joined into one string.
+        """
+        if not isinstance(data, list):
+            self.sock.sendall(data)
+            return
+
+        index = 0
+        if hasattr(self.sock, "sendmsg"):
+            segments = [memoryview(segment) for segment in data
+                        if len(segment)]
+            try:
+                while index < len(segments):
+                    sent = self.sock.sendmsg(segments[index:index + _IOV_MAX])
+                    while sent and sent >= len(segments[index]):
+                        sent -= len(segments[index])
+                        index += 1
+                    if sent:
+                        segments[index] = segments[index][sent:]
+                return
+            except NotImplementedError:
+                # SSL sockets don't implement sendmsg.
+                data = segments
+        for segment in data[index:]:
+            self.sock.sendall(segment)
+
+    def receive_message(self, operation, request_id):
+        """Receive a message in response to `request_id`.
+
+        Returns the response data with the header removed, raising
+        :class:`~pymongo.errors.ConnectionFailure` if the connection is
+        closed. Where the socket supports ``recv_into`` the data is a
+        new :class:`bytearray` received straight into, except for what
+        was read ahead with the header. It isn't reused, so documents
+        decoded with `binary_view` can keep referencing it.
+        """
+        (response_to, response_op, data) = self._receive_any()
+        assert request_id == response_to, \
+            "ids don't match %r %r" % (request_id, response_to)
+        assert operation == response_op
+        return data
+
+    def _receive_any(self):
+        """Receive the next message, whatever it responds to.
+
+        Returns its responseTo and opCode fields, and its data with the
+        header removed.
+        """
+        header = self.__receive(16)
+        length, _, response_to, response_op = struct.unpack("<iiii", header)
+        return (response_to, response_op, self.__receive(length - 16))
+
+    def pipeline(self, messages):
+        """Send `messages`, a list of (request_id, data) pairs, and
+        return the response data for each in order.
+
+        Messages are written back to back and then their responses are
+        read, about :data:`_PIPELINE_SIZE` bytes of messages at a time,
+        so there's a round trip per batch rather than per message. The
+        data of each message must be a string.
+        """
+        responses = []
+        start = 0
+        while start < len(messages):
+            end = start + 1
+            size = len(messages[start][1])
+            while (end < len(messages) and
+                   size + len(messages[end][1]) <= _PIPELINE_SIZE):
+                size += len(messages[end][1])
+                end += 1
+            batch = messages[start:end]
+            self.sendall(EMPTY.join([data for (_, data) in batch]))
+            for (request_id, _) in batch:
+                responses.append(self.receive_message(1, request_id))
+            start = end
+        return responses
+
+    def __receive(self, length):
+        """Receive exactly `length` bytes.
+        """
+        if have_memoryview and hasattr(self.sock, "recv_into"):
+            data = bytearray(length)
+            self.__receive_into(memoryview(data))
+            return data
+
+        chunks = []
+        while length:
+            chunk = self.sock.recv(length)
+            if not chunk:
+                raise ConnectionFailure("connection closed")
+            length -= len(chunk)
+            chunks.append(chunk)
+        return EMPTY.join(chunks)
+
+    def __receive_into(self, view):
+        """Fill the memoryview `view`, first with bytes read ahead.
+
+        Reads shorter than the read-ahead buffer go through it, taking
+        whatever follows them in the same call. Longer ones are received
+        directly into `view`.
+        """
+        length = len(view)
+        received = min(self.__ahead_end - self.__ahead_start, length)
+        if received:
+            start = self.__ahead_start
+            view[:received] = self.__ahead[start:start + received]
+            self.__ahead_start += received
+
+        while received < length:
+            wanted = length - received
+            if wanted < _READ_AHEAD:
+                if self.__ahead is None:
+                    self.__ahead = memoryview(bytearray(_READ_AHEAD))
+                count = self.__recv_into(self.__ahead)
+                chunk = min(count, wanted)
+                view[received:received + chunk] = self.__ahead[:chunk]
+                self.__ahead_start = chunk
+                self.__ahead_end = count
+            else:
+                chunk = self.__recv_into(view[received:])
+            received += chunk
+
+    def __recv_into(self, view):
+        count = self.sock.recv_into(view)
+        if not count:
+            raise ConnectionFailure("connection closed")
+        return count
+
     def close(self):
         self.closed = True
         # Avoid exceptions on interpreter shutdown.
@@ -97,6 +258,162 @@ class SocketInfo(object):
         )
 
 
+class _Waiter(object):
+    """A thread waiting for a response on a :class:`SharedSocketInfo`.
+    """
+    __slots__ = ("event", "data", "error", "lead")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.data = None
+        self.error = None
+        # Set when it's this thread's turn to read responses.
+        self.lead = False
+
+
+class SharedSocketInfo(SocketInfo):
+    """A :class:`SocketInfo` that many threads use at once.
+
+    Each message is sent whole, by one thread at a time. Threads waiting
+    for responses take turns to read them: the thread reading hands each
+    response to the thread waiting for it, by its responseTo field, until
+    it gets its own. Then the next waiting thread takes over.
+
+    If reading fails, the socket is closed and every waiting thread gets
+    a :class:`~pymongo.errors.ConnectionFailure`.
+    """
+    def __init__(self, sock, pool_id):
+        SocketInfo.__init__(self, sock, pool_id)
+        self.__send_lock = threading.Lock()
+
+        # Guards the attributes below.
+        self.__lock = threading.Lock()
+        # Whether a thread is reading responses.
+        self.__reading = False
+        # Map request id -> _Waiter for threads waiting for a response.
+        self.__waiters = {}
+        # Map request id -> response data read before the thread that
+        # sent the request started waiting for it.
+        self.__responses = {}
+        # Ids of requests whose threads stopped waiting for a response,
+        # which is dropped when it's read.
+        self.__abandoned = set()
+        self.__error = None
+
+    def sendall(self, data):
+        self.__send_lock.acquire()
+        try:
+            SocketInfo.sendall(self, data)
+        finally:
+            self.__send_lock.release()
+
+    def receive_message(self, operation, request_id):
+        waiter = None
+        self.__lock.acquire()
+        try:
+            if request_id in self.__responses:
+                return self.__responses.pop(request_id)
+            if self.__error is not None:
+                raise ConnectionFailure(self.__error)
+            if self.__reading:
+                waiter = _Waiter()
+                self.__waiters[request_id] = waiter
+            else:
+                self.__reading = True
+        finally:
+            self.__lock.release()
+
+        if waiter is not None:
+            try:
+                waiter.event.wait()
+            except:
+                self.__abandon(request_id, waiter)
+                raise
+            if waiter.error is not None:
+                raise ConnectionFailure(waiter.error)
+            if not waiter.lead:
+                return waiter.data
+
+        try:
+            return self.__read_responses(operation, request_id)
+        except:
+            self.__fail(sys.exc_info()[1])
+            raise
+
+    def __read_responses(self, operation, request_id):
+        """Read responses, handing them to the threads waiting for them,
+        until the response to `request_id`. Then let another waiting
+        thread read.
+        """
+        while True:
+            (response_to, response_op, data) = self._receive_any()
+            assert operation == response_op
+            if response_to == request_id:
+                break
+            self.__lock.acquire()
+            try:
+                waiter = self.__waiters.pop(response_to, None)
+                if response_to in self.__abandoned:
+                    self.__abandoned.discard(response_to)
+                elif waiter is None:
+                    self.__responses[response_to] = data
+                else:
+                    waiter.data = data
+                    waiter.event.set()
+            finally:
+                self.__lock.release()
+
+        self.__lock.acquire()
+        try:
+            self.__hand_over()
+        finally:
+            self.__lock.release()
+        return data
+
+    def __hand_over(self):
+        """Let a waiting thread read responses next. Call with the lock
+        held.
+        """
+        if self.__waiters:
+            (_, waiter) = self.__waiters.popitem()
+            waiter.lead = True
+            waiter.event.set()
+        else:
+            self.__reading = False
+
+    def __abandon(self, request_id, waiter):
+        """Stop `waiter` waiting, e.g. if it's interrupted, handing
+        over reading responses if it was its turn.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__waiters.get(request_id) is waiter:
+                del self.__waiters[request_id]
+                self.__abandoned.add(request_id)
+            elif waiter.lead:
+                self.__hand_over()
+        finally:
+            self.__lock.release()
+
+    def __fail(self, error):
+        """Close the socket after reading from it failed with `error`,
+        failing every waiting thread.
+        """
+        self.__lock.acquire()
+        try:
+            self.__error = str(error) or "connection closed"
+            self.__reading = False
+            for waiter in self.__waiters.values():
+                waiter.error = self.__error
+                waiter.event.set()
+            self.__waiters.clear()
+            self.__responses.clear()
+            self.__abandoned.clear()
+        finally:
+            self.__lock.release()
+        self.close()
+
+
 # Do *not* explicitly inherit from object or Jython won't call __del__
 # http://bugs.jython.org/issue1057
 class BasePool:
@@ -433,6 +750,89 @@ class Pool(BasePool):
         self._refs[tid] = weakref.ref(self._local.vigil, callback)
 
 
+class SharedPool(Pool):
+    """A connection pool whose sockets are used by many threads at once.
+
+    Up to `max_size` sockets are opened, each a
+    :class:`SharedSocketInfo`, and operations use them in turn. Calling
+    start_request() makes the thread use one socket until it calls
+    end_request(), but not on its own.
+    """
+    def __init__(self, *args, **kwargs):
+        Pool.__init__(self, *args, **kwargs)
+        self.__count = 0
+        # Number of sockets being opened, which count towards max_size.
+        self.__connecting = 0
+        # Notified when a socket has been opened, or failed to.
+        self.__connected = threading.Condition(self.lock)
+
+    def connect(self, pair):
+        sock_info = Pool.connect(self, pair)
+        return SharedSocketInfo(sock_info.sock, sock_info.pool_id)
+
+    def get_socket(self, pair=None):
+        if self.pid != os.getpid():
+            self.reset()
+
+        req_state = self._get_request_state()
+        if req_state in (NO_SOCKET_YET, NO_REQUEST):
+            sock_info = self.__get_shared_socket(pair)
+            if req_state == NO_SOCKET_YET:
+                self._set_request_state(sock_info)
+        else:
+            # Other threads' responses may be waiting to be read, so the
+            # socket isn't checked with select() like in BasePool._check.
+            sock_info = req_state
+            if sock_info.closed or sock_info.pool_id != self.pool_id:
+                sock_info = self.__get_shared_socket(pair)
+                self._set_request_state(sock_info)
+
+        sock_info.last_checkout = time.time()
+        return sock_info
+
+    def __get_shared_socket(self, pair):
+        """Get the next open socket, or a new one if fewer than
+        `max_size` are open or being opened.
+        """
+        self.lock.acquire()
+        try:
+            while True:
+                for sock_info in list(self.sockets):
+                    if sock_info.closed or sock_info.pool_id != self.pool_id:
+                        self.sockets.discard(sock_info)
+                if (len(self.sockets) + self.__connecting <
+                    max(self.max_size, 1)):
+                    # Reserve a place for the new socket.
+                    self.__connecting += 1
+                    break
+                if self.sockets:
+                    self.__count += 1
+                    sockets = list(self.sockets)
+                    return sockets[self.__count % len(sockets)]
+                # Every socket is still being opened.
+                self.__connected.wait()
+        finally:
+            self.lock.release()
+
+        sock_info = None
+        try:
+            sock_info = self.connect(pair)
+        finally:
+            self.lock.acquire()
+            try:
+                self.__connecting -= 1
+                if sock_info is not None:
+                    self.sockets.add(sock_info)
+                self.__connected.notifyAll()
+            finally:
+                self.lock.release()
+        return sock_info
+
+    def _return_socket(self, sock_info):
+        # Shared sockets stay in the pool until they're closed.
+        pass
+
+
 class GreenletPool(BasePool):
     """A simple connection pool.
 
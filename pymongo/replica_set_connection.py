@@ -33,7 +33,6 @@ attribute-style access:
 
 import datetime
 import socket
-import struct
 import sys
 import threading
 import time
@@ -41,7 +40,6 @@ import warnings
 import weakref
 import atexit
 
-from bson.py3compat import b
 from bson.son import SON
 from pymongo import (common,
                      database,
@@ -58,7 +56,6 @@ from pymongo.errors import (AutoReconnect,
                             InvalidDocument,
                             OperationFailure)
 
-EMPTY = b("")
 MAX_BSON_SIZE = 4 * 1024 * 1024
 MAX_RETRY = 3
 
@@ -198,6 +195,8 @@ class Member(object):
         self.is_primary = ismaster_response['ismaster']
         self.max_bson_size = ismaster_response.get(
             'maxBsonObjectSize', MAX_BSON_SIZE)
+        self.max_message_size = ismaster_response.get(
+            'maxMessageSizeBytes', 2 * self.max_bson_size)
         self.tags = ismaster_response.get('tags', {})
         self.record_ping_time(ping_time)
         self.up = True
@@ -342,6 +341,10 @@ class ReplicaSetConnection(common.BaseObject):
             the same socket for all operations until :meth:`end_request()`.
             `use_greenlets` with ReplicaSetConnection requires `Gevent
             <http://gevent.org/>`_ to be installed.
+          - `share_sockets` (optional): if ``True``, threads use the
+            sockets in each member's connection pool at once, instead of
+            each taking one of its own (see
+            :class:`~pymongo.connection.Connection`).
           - `slave_okay` or `slaveOk` (deprecated): Use `read_preference`
             instead.
           - `host`: For compatibility with connection.Connection. If both
@@ -355,6 +358,8 @@ class ReplicaSetConnection(common.BaseObject):
             connection.Connection.
 
 
+        .. versionchanged:: 2.4
+           Added the `share_sockets` option.
         .. versionchanged:: 2.3
            Added `tag_sets` and `secondary_acceptable_latency_ms` options.
         .. versionchanged:: 2.2
@@ -411,13 +416,19 @@ class ReplicaSetConnection(common.BaseObject):
             option, value = common.validate(option, value)
             self.__opts[option] = value
 
+        self.__share_sockets = self.__opts.get('share_sockets', False)
         if self.__opts.get('use_greenlets', False):
             if not have_gevent:
                 raise ConfigurationError(
                     "The gevent module is not available. "
                     "Install the gevent package from PyPI."
                 )
+            if self.__share_sockets:
+                raise ConfigurationError("share_sockets can't be used "
+                                         "with use_greenlets")
             self.pool_class = pool.GreenletPool
+        elif self.__share_sockets:
+            self.pool_class = pool.SharedPool
         else:
             self.pool_class = pool.Pool
 
@@ -646,6 +657,18 @@ class ReplicaSetConnection(common.BaseObject):
             return self.__members[self.__writer].max_bson_size
         return 0
 
+    @property
+    def max_message_size(self):
+        """Returns the maximum size message the connected primary accepts
+        in bytes. Defaults to twice :attr:`max_bson_size` in servers that
+        don't report it (< 2.4). Returns 0 if no primary is available.
+
+        .. versionadded:: 2.4
+        """
+        if self.__writer:
+            return self.__members[self.__writer].max_message_size
+        return 0
+
     @property
     def auto_start_request(self):
         return self.__auto_start_request
@@ -657,8 +680,8 @@ class ReplicaSetConnection(common.BaseObject):
         rqst_id, msg, _ = message.query(0, dbname + '.$cmd', 0, -1, spec)
         start = time.time()
         try:
-            sock_info.sock.sendall(msg)
-            response = self.__recv_msg(1, rqst_id, sock_info)
+            sock_info.sendall(msg)
+            response = sock_info.receive_message(1, rqst_id)
         except:
             sock_info.close()
             raise
@@ -946,35 +969,6 @@ class ReplicaSetConnection(common.BaseObject):
         else:
             raise OperationFailure(error["err"])
 
-    def __recv_data(self, length, sock_info):
-        """Lowest level receive operation.
-
-        Takes length to receive and repeatedly calls recv until able to
-        return a buffer of that length, raising ConnectionFailure on error.
-        """
-        chunks = []
-        while length:
-            chunk = sock_info.sock.recv(length)
-            if chunk == EMPTY:
-                raise ConnectionFailure("connection closed")
-            length -= len(chunk)
-            chunks.append(chunk)
-        return EMPTY.join(chunks)
-
-    def __recv_msg(self, operation, request_id, sock):
-        """Receive a message in response to `request_id` on `sock`.
-
-        Returns the response data with the header removed.
-        """
-        header = self.__recv_data(16, sock)
-        length = struct.unpack("<i", header[:4])[0]
-        resp_id = struct.unpack("<i", header[8:12])[0]
-        assert resp_id == request_id, "ids don't match %r %r" % (resp_id,
-                                                                 request_id)
-        assert operation == struct.unpack("<i", header[12:])[0]
-
-        return self.__recv_data(length - 16, sock)
-
     def __check_bson_size(self, msg, max_size):
         """Make sure the message doesn't include BSON documents larger
         than the connected server will accept.
@@ -1016,14 +1010,14 @@ class ReplicaSetConnection(common.BaseObject):
         try:
             sock_info = self.__socket(member)
             rqst_id, data = self.__check_bson_size(msg, member.max_bson_size)
-            sock_info.sock.sendall(data)
+            sock_info.sendall(data)
             # Safe mode. We pack the message together with a lastError
             # message and send both. We then get the response (to the
             # lastError) and raise OperationFailure if it is an error
             # response.
             rv = None
             if safe:
-                response = self.__recv_msg(1, rqst_id, sock_info)
+                response = sock_info.receive_message(1, rqst_id)
                 rv = self.__check_response_to_last_error(response)
             member.pool.maybe_return_socket(sock_info)
             return rv
@@ -1041,6 +1035,9 @@ class ReplicaSetConnection(common.BaseObject):
 
     def __send_and_receive(self, member, msg, **kwargs):
         """Send a message on the given socket and return the response data.
+
+        If `msg` is a list of messages they're pipelined, and a list of
+        their response data is returned.
         """
         sock_info = None
         try:
@@ -1049,9 +1046,15 @@ class ReplicaSetConnection(common.BaseObject):
             if "network_timeout" in kwargs:
                 sock_info.sock.settimeout(kwargs['network_timeout'])
 
-            rqst_id, data = self.__check_bson_size(msg, member.max_bson_size)
-            sock_info.sock.sendall(data)
-            response = self.__recv_msg(1, rqst_id, sock_info)
+            if isinstance(msg, list):
+                response = sock_info.pipeline(
+                    [self.__check_bson_size(m, member.max_bson_size)
+                     for m in msg])
+            else:
+                rqst_id, data = self.__check_bson_size(msg,
+                                                       member.max_bson_size)
+                sock_info.sendall(data)
+                response = sock_info.receive_message(1, rqst_id)
 
             if "network_timeout" in kwargs:
                 sock_info.sock.settimeout(self.__net_timeout)
@@ -1084,8 +1087,13 @@ class ReplicaSetConnection(common.BaseObject):
         Sends the given message and returns (host used, response).
 
         :Parameters:
-          - `msg`: (request_id, data) pair making up the message to send
+          - `msg`: (request_id, data) pair making up the message to send,
+            or a list of them to pipeline on one socket, returning a list
+            of the responses
         """
+        if self.__share_sockets:
+            # Other threads use the socket too, keep its timeout.
+            kwargs.pop("network_timeout", None)
 
         # If we've disconnected since last read, trigger refresh
         try:
@@ -17,9 +17,13 @@
 """Test the bson module."""
 
 import unittest
+import array
 import datetime
+import mmap
+import os
 import re
 import sys
+import tempfile
 try:
     import uuid
     should_test_uuid = True
@@ -32,15 +36,18 @@ from nose.plugins.skip import SkipTest
 import bson
 from bson import (BSON,
                   decode_all,
+                  decode_file_iter,
+                  decode_iter,
                   is_valid)
 from bson.binary import Binary, UUIDLegacy
 from bson.code import Code
 from bson.objectid import ObjectId
 from bson.dbref import DBRef
-from bson.py3compat import b
+from bson.py3compat import b, StringIO
 from bson.son import SON
 from bson.timestamp import Timestamp
-from bson.errors import (InvalidDocument,
+from bson.errors import (InvalidBSON,
+                         InvalidDocument,
                          InvalidStringData)
 from bson.max_key import MaxKey
 from bson.min_key import MinKey
@@ -76,6 +83,24 @@ class TestBSON(unittest.TestCase):
         self.assertFalse(is_valid(b("\x09\x00\x00\x00\x10a\x00\x05\x00")))
         self.assertFalse(is_valid(b("\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00")))
 
+    def test_nested_validation(self):
+        # An unknown element type in an embedded document.
+        self.assertFalse(is_valid(b("\x10\x00\x00\x00\x03a\x00\x08\x00\x00"
+                                    "\x00\x99b\x00\x00\x00")))
+        # Invalid UTF-8 in a string.
+        self.assertFalse(is_valid(b("\x0e\x00\x00\x00\x02a\x00\x02\x00\x00"
+                                    "\x00\xff\x00\x00")))
+        self.assertTrue(is_valid(b("\x0e\x00\x00\x00\x02a\x00\x02\x00\x00"
+                                   "\x00b\x00\x00")))
+
+    def test_large_data_validation(self):
+        doc = {"s": u"x" * 10000, "a": [{"b": i} for i in range(100)]}
+        data = BSON.encode(doc)
+        self.assertTrue(is_valid(data))
+        self.assertFalse(is_valid(data[:-1] + b("\x01")))
+        self.assertEqual([doc, doc], decode_all(data + data))
+        self.assertRaises(InvalidBSON, decode_all, data + data[:-1])
+
     def test_random_data_is_not_bson(self):
         qcheck.check_unittest(self, qcheck.isnt(is_valid),
                               qcheck.gen_string(qcheck.gen_range(0, 40)))
@@ -308,6 +333,18 @@ class TestBSON(unittest.TestCase):
         self.assertEqual({"tuple": [1, 2]},
                           BSON.encode({"tuple": (1, 2)}).decode())
 
+    def test_large_array(self):
+        doc = {"a": range(2000), "b": [[u"x"] * 1001]}
+        data = BSON.encode(doc)
+        self.assertEqual(doc, data.decode())
+        self.assertTrue(b("\x101999\x00") in data)
+
+    def test_bad_embedded_size(self):
+        # The size of the embedded document is one byte too large.
+        data = b("\x14\x00\x00\x00\x03a\x00\x0d\x00\x00\x00\x10b"
+                 "\x00\x01\x00\x00\x00\x00\x00")
+        self.assertRaises(InvalidBSON, BSON(data).decode)
+
     def test_uuid(self):
         if not should_test_uuid:
             raise SkipTest("No uuid module")
@@ -441,5 +478,266 @@ class TestBSON(unittest.TestCase):
         d = OrderedDict([("one", 1), ("two", 2), ("three", 3), ("four", 4)])
         self.assertEqual(d, BSON.encode(d).decode(as_class=OrderedDict))
 
+    def test_decode_all_fields(self):
+        doc = SON([("_id", 1),
+                   ("name", u"foo"),
+                   ("regex", re.compile("a*b")),
+                   ("code", Code("x", {"y": 1})),
+                   ("data", Binary(b("\x00\x01"), 128)),
+                   ("sub", SON([("x", 1), ("y", {"z": 2, "w": 3})])),
+                   ("list", [1, {"x": 1, "y": 2}, [{"x": 3}], u"str"]),
+                   (u"\u00e9", 4)])
+        data = BSON.encode(doc) + BSON.encode({"_id": 2, "sub": 5})
+
+        self.assertEqual([{"_id": 1}, {"_id": 2}],
+                         decode_all(data, fields=["_id"]))
+        self.assertEqual([{}, {}], decode_all(data, fields=[]))
+        self.assertEqual([{"sub": {"y": {"z": 2}}}, {}],
+                         decode_all(data, fields=["sub.y.z"]))
+        self.assertEqual([{"sub": doc["sub"]}, {"sub": 5}],
+                         decode_all(data, fields=["sub.x", "sub"]))
+        self.assertEqual([{"list": [{"x": 1}, [{"x": 3}]]}, {}],
+                         decode_all(data, fields=["list.x"]))
+        self.assertEqual([{u"\u00e9": 4, "code": doc["code"]}, {}],
+                         decode_all(data, fields=[u"\u00e9", "code"]))
+        result = decode_all(data, SON, fields=("name", "data", "sub.x"))
+        self.assertEqual(SON([("name", u"foo"),
+                              ("data", doc["data"]),
+                              ("sub", SON([("x", 1)]))]), result[0])
+
+        self.assertRaises(TypeError, decode_all, data, fields="_id")
+        self.assertRaises(TypeError, decode_all, data, fields=[1])
+
+    def test_decode_all_buffer(self):
+        docs = [{"x": 1}, {"y": [u"z", {"w": 2.5}]}]
+        data = b("").join([BSON.encode(doc) for doc in docs])
+
+        self.assertEqual(docs, decode_all(bytearray(data)))
+        self.assertEqual(docs[1:], decode_all(data, offset=12))
+        self.assertEqual(docs[1:], decode_all(bytearray(data), offset=12))
+        self.assertEqual([], decode_all(data, offset=len(data)))
+        if sys.version_info[:2] >= (2, 7):
+            self.assertEqual(docs, decode_all(memoryview(data)))
+            self.assertEqual(docs[1:],
+                             decode_all(memoryview(data)[12:]))
+        if not PY3:
+            self.assertEqual(docs[1:], decode_all(buffer(data, 12)))
+
+        self.assertRaises(TypeError, decode_all, data.decode("latin-1"))
+        self.assertRaises(TypeError, decode_all, 5)
+        self.assertRaises(ValueError, decode_all, data, offset=-1)
+        self.assertRaises(ValueError, decode_all, data, offset=len(data) + 1)
+        self.assertRaises(InvalidBSON, decode_all, data, offset=1)
+
+    def test_binary_view(self):
+        if sys.version_info[:2] < (2, 7):
+            raise SkipTest("memoryview requires Python 2.7 or later")
+        doc = {"a": Binary(b("\x00\x01\x02")),
+               "b": [{"c": Binary(b("xyz"))}],
+               "old": Binary(b("\x03"), 2),
+               "user": Binary(b("\x04"), 128)}
+        data = BSON.encode(doc)
+
+        for decoded in (BSON(data).decode(binary_view=True),
+                        decode_all(data, binary_view=True)[0],
+                        decode_all(bytearray(data), binary_view=True)[0],
+                        decode_all(b("x") * 4 + data, offset=4,
+                                   binary_view=True)[0]):
+            self.assertTrue(isinstance(decoded["a"], memoryview))
+            self.assertEqual(b("\x00\x01\x02"), decoded["a"].tobytes())
+            self.assertEqual(b("xyz"), decoded["b"][0]["c"].tobytes())
+            # Only subtype 0 is decoded to views.
+            self.assertEqual(doc["old"], decoded["old"])
+            self.assertEqual(doc["user"], decoded["user"])
+            # Even a view of a bytearray can't change the data.
+            self.assertTrue(decoded["a"].readonly)
+            self.assertTrue(decoded["b"][0]["c"].readonly)
+
+        buf = bytearray(data)
+        view = decode_all(buf, binary_view=True)[0]["a"]
+        self.assertRaises(TypeError, view.__setitem__, 0, b("Z"))
+        self.assertEqual(data, bytes(buf))
+
+        decoded = decode_all(data, fields=["b.c"], binary_view=True)[0]
+        self.assertEqual(b("xyz"), decoded["b"][0]["c"].tobytes())
+        self.assertFalse(isinstance(decode_all(data)[0]["a"], memoryview))
+
+    def test_typed_arrays(self):
+        doc = {"i": [1, -2, 3],
+               "l": [1, 2 ** 40],
+               "d": [0.5, 1.5],
+               "mixed": [1, 2.5],
+               "s": [u"a"],
+               "empty": [],
+               "nested": {"x": [[1, 2], [3.0]]}}
+        data = BSON.encode(doc)
+
+        for decoded in (BSON(data).decode(typed_arrays=True),
+                        decode_all(data, typed_arrays=True)[0]):
+            self.assertEqual(array.array("i", [1, -2, 3]), decoded["i"])
+            self.assertEqual(8, decoded["l"].itemsize)
+            self.assertEqual([1, 2 ** 40], decoded["l"].tolist())
+            self.assertEqual(array.array("d", [0.5, 1.5]), decoded["d"])
+            self.assertEqual([1, 2.5], decoded["mixed"])
+            self.assertEqual([u"a"], decoded["s"])
+            self.assertEqual([], decoded["empty"])
+            self.assertEqual(array.array("i", [1, 2]),
+                             decoded["nested"]["x"][0])
+            self.assertEqual(array.array("d", [3.0]),
+                             decoded["nested"]["x"][1])
+        self.assertEqual([1, -2, 3], BSON(data).decode()["i"])
+
+        # Values without data, like null, aren't dropped.
+        trailing = {"i": [1, None], "l": [2 ** 40, MinKey()],
+                    "d": [1.5, MaxKey()], "first": [None, 1]}
+        trailing_data = BSON.encode(trailing)
+        for result in (BSON(trailing_data).decode(typed_arrays=True),
+                       decode_all(trailing_data, typed_arrays=True)[0]):
+            self.assertEqual(trailing, result)
+            for value in result.values():
+                self.assertTrue(isinstance(value, list))
+
+        self.assertEqual(BSON.encode({"a": [1, -2, 3]}),
+                         BSON.encode({"a": array.array("i", [1, -2, 3])}))
+        self.assertEqual(BSON.encode({"a": [1, 2 ** 40]}),
+                         BSON.encode({"a": decoded["l"]}))
+        self.assertEqual(BSON.encode({"a": [0.5, 1.5]}),
+                         BSON.encode({"a": array.array("d", [0.5, 1.5])}))
+        self.assertEqual(BSON.encode({"a": [1, 2]}),
+                         BSON.encode({"a": array.array("B", [1, 2])}))
+        self.assertEqual({"a": [1, 2]},
+                         BSON.encode({"a": array.array("H", [1, 2])})
+                         .decode())
+
+    def test_shared_names(self):
+        name = u"a" * 32
+        data = BSON.encode({name: 1, u"b\xe9": {name: 2}}) * 2
+        docs = decode_all(data)
+        self.assertEqual([{name: 1, u"b\xe9": {name: 2}}] * 2, docs)
+        names = [key for key in docs[0] if key == name]
+        names += [key for key in docs[1][u"b\xe9"] if key == name]
+        if bson.has_c():
+            self.assertTrue(names[0] is names[1])
+        # The cached names are matched on their whole raw value.
+        self.assertEqual({u"a" * 31: 1},
+                         BSON.encode({u"a" * 31: 1}).decode())
+        self.assertEqual({u"a" * 33: 1},
+                         BSON.encode({u"a" * 33: 1}).decode())
+        self.assertRaises(UnicodeDecodeError, decode_all,
+                          b("\x0c\x00\x00\x00\x10\xff\x00")
+                          + b("\x01\x00\x00\x00\x00"))
+
+    def test_encode_into(self):
+        docs = [{"x": 1}, SON([("_id", 2), ("y", [u"z"])])]
+        data = b("").join([BSON.encode(doc) for doc in docs])
+
+        buf = bytearray()
+        end = BSON.encode_into(docs, buf)
+        self.assertEqual(len(data), end)
+        self.assertEqual(data, bytes(buf))
+        self.assertEqual(2 * len(data), BSON.encode_into(docs, buf, end))
+        self.assertEqual(data * 2, bytes(buf))
+        self.assertEqual(docs * 2, decode_all(buf))
+
+        # Overwrite in place.
+        buf = bytearray(b("\xff") * (len(data) + 3))
+        self.assertEqual(len(data) + 2, BSON.encode_into(docs, buf, 2))
+        self.assertEqual(b("\xff\xff") + data + b("\xff"), bytes(buf))
+        self.assertEqual(3, BSON.encode_into([], buf, 3))
+
+        if sys.version_info[:2] >= (2, 7):
+            buf = bytearray(len(data))
+            self.assertEqual(len(data),
+                             BSON.encode_into(docs, memoryview(buf)))
+            self.assertEqual(data, bytes(buf))
+            self.assertRaises(ValueError, BSON.encode_into,
+                              docs, memoryview(buf), 1)
+
+        buf = bytearray(b("abc"))
+        self.assertRaises(ValueError, BSON.encode_into, docs, buf, 4)
+        self.assertRaises(ValueError, BSON.encode_into, docs, buf, -1)
+        self.assertRaises(InvalidDocument, BSON.encode_into,
+                          [{"x": 1}, {"$bad": 1}], buf, 0, True)
+        self.assertEqual(b("abc"), bytes(buf))
+        self.assertRaises(TypeError, BSON.encode_into, [1], buf)
+        self.assertRaises(TypeError, BSON.encode_into, docs, data)
+
+    def test_decode_iter(self):
+        docs = [{"x": 1}, {"y": [u"z", {"w": 2.5}]}, {}]
+        encoded = [BSON.encode(doc) for doc in docs]
+        data = b("").join(encoded)
+
+        self.assertEqual(docs, list(decode_iter(data)))
+        self.assertEqual(docs, list(decode_iter(bytearray(data))))
+        self.assertEqual(encoded, list(decode_iter(data, raw=True)))
+        self.assertEqual([{"x": 1}, {}, {}],
+                         list(decode_iter(data, fields=["x"])))
+        self.assertEqual([SON], [type(doc) for doc in
+                                 decode_iter(encoded[0], SON)])
+        self.assertEqual([], list(decode_iter(b(""))))
+
+        documents = decode_iter(data + b("\x05\x00\x00\x00"))
+        self.assertEqual(docs, [documents.next() for _ in docs])
+        self.assertRaises(InvalidBSON, documents.next)
+        self.assertRaises(InvalidBSON, list, decode_iter(data[:-1]))
+        self.assertRaises(InvalidBSON, list,
+                          decode_iter(data[:-1] + b("\x01"), raw=True))
+
+    def test_decode_file_iter(self):
+        docs = [{"x": 1}, {"y": [u"z", {"w": 2.5}]}, {}]
+        encoded = [BSON.encode(doc) for doc in docs]
+        data = b("").join(encoded)
+
+        self.assertEqual(docs, list(decode_file_iter(StringIO(data))))
+        self.assertEqual(encoded,
+                         list(decode_file_iter(StringIO(data), raw=True)))
+        self.assertEqual([{"x": 1}, {}, {}],
+                         list(decode_file_iter(StringIO(data),
+                                               fields=["x"])))
+        self.assertEqual([], list(decode_file_iter(StringIO(b("")))))
+        for bad in (data[:-1], data + b("\x05\x00"),
+                    data + b("\x04\x00\x00\x00")):
+            self.assertRaises(InvalidBSON, list,
+                              decode_file_iter(StringIO(bad)))
+
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            self.assertEqual(docs, list(decode_file_iter(path)))
+            self.assertEqual(encoded, list(decode_file_iter(path, raw=True)))
+
+            # The mapping is closed even if iteration stops early.
+            mapped = []
+
+            class TrackedMmap(mmap.mmap):
+                def close(self):
+                    mapped.append(self)
+                    mmap.mmap.close(self)
+
+            class TrackedModule(object):
+                ACCESS_READ = mmap.ACCESS_READ
+                mmap = TrackedMmap
+
+            bson.mmap = TrackedModule
+            try:
+                for document in decode_file_iter(path):
+                    break
+                iterator = decode_file_iter(path)
+                iterator.next()
+                iterator.close()
+                bson_file = open(path, "ab")
+                bson_file.write(b("\x05\x00"))
+                bson_file.close()
+                self.assertRaises(InvalidBSON, list, decode_file_iter(path))
+            finally:
+                bson.mmap = mmap
+            self.assertEqual(3, len(mapped))
+
+            open(path, "wb").close()
+            self.assertEqual([], list(decode_file_iter(path)))
+        finally:
+            os.remove(path)
+
 if __name__ == "__main__":
     unittest.main()
@@ -16,8 +16,10 @@
 
 """Test the collection module."""
 
+import decimal
 import itertools
 import re
+import struct
 import sys
 import threading
 import time
@@ -28,13 +30,18 @@ from nose.plugins.skip import SkipTest
 
 sys.path[0:0] = [""]
 
+from bson import BSON
 from bson.binary import Binary, UUIDLegacy, OLD_UUID_SUBTYPE, UUID_SUBTYPE
 from bson.code import Code
 from bson.objectid import ObjectId
 from bson.py3compat import b
+from bson.raw_bson import RawBSONDocument
 from bson.son import SON
-from pymongo import ASCENDING, DESCENDING, GEO2D, GEOHAYSTACK
-from pymongo.collection import Collection
+from bson.type_registry import TypeRegistry
+from pymongo import ASCENDING, DESCENDING, GEO2D, GEOHAYSTACK, message
+from pymongo.collection import Collection, _batch_documents
+from pymongo.connection import Connection
+from pymongo.master_slave_connection import MasterSlaveConnection
 from pymongo.son_manipulator import SONManipulator
 from pymongo.errors import (ConfigurationError,
                             DuplicateKeyError,
@@ -710,6 +717,148 @@ class TestCollection(unittest.TestCase):
 
         self.assertRaises(InvalidOperation, db.test.insert, [])
 
+    def test_insert_encoded(self):
+        db = self.db
+        db.drop_collection("test")
+        doc = SON([("_id", 1), ("x", {"y": [1, 2]})])
+        raw = RawBSONDocument(BSON.encode(doc))
+        self.assertEqual(1, db.test.insert(raw, safe=True))
+        self.assertEqual(doc, db.test.find_one({"_id": 1}, as_class=SON))
+
+        # An "_id" is added to encoded documents that don't have one.
+        ids = db.test.insert([BSON.encode({"x": 2}),
+                              RawBSONDocument(BSON.encode({"x": 3})),
+                              {"x": 4}], safe=True)
+        self.assertEqual(3, len(ids))
+        for i, _id in enumerate(ids):
+            self.assertTrue(isinstance(_id, ObjectId))
+            self.assertEqual(i + 2, db.test.find_one({"_id": _id})["x"])
+        self.assertTrue(isinstance(db.test.insert(BSON.encode({"x": 5})),
+                                   ObjectId))
+
+        db.test.update({"_id": 1}, BSON.encode({"x": 6}), safe=True)
+        self.assertEqual({"_id": 1, "x": 6}, db.test.find_one({"_id": 1}))
+        db.test.save(RawBSONDocument(BSON.encode({"_id": 1, "x": 7})),
+                     safe=True)
+        self.assertEqual({"_id": 1, "x": 7}, db.test.find_one({"_id": 1}))
+        db.test.insert({"_id": 2, "raw": raw}, safe=True)
+        self.assertEqual(doc, db.test.find_one({"_id": 2},
+                                               as_class=SON)["raw"])
+
+    def test_insert_json_lines(self):
+        db = self.db
+        db.drop_collection("test")
+        oid = ObjectId()
+        lines = [b('{"_id": {"$oid": "%s"}, "x": 0}\n' % (oid,))]
+        lines.extend([b('{"x": %d, "s": "%s"}\n' % (i, "a" * 1000))
+                      for i in range(1, 100)])
+        self.assertEqual(100, db.test.insert_json_lines(lines, safe=True))
+        self.assertEqual(100, db.test.count())
+        self.assertEqual(0, db.test.find_one({"_id": oid})["x"])
+        for doc in db.test.find():
+            self.assertTrue(isinstance(doc["_id"], ObjectId))
+
+        docs = [BSON.encode({"_id": i, "s": "a" * 1000}) for i in range(10)]
+        docs.append(BSON.encode({"s": "a" * 5000}))
+        batches = list(_batch_documents(docs, 4000))
+        self.assertEqual([3, 3, 3, 1, 1], [len(batch) for batch in batches])
+        self.assertEqual(docs[:10], sum(batches[:4], []))
+        self.assertTrue("_id" in batches[4][0].decode())
+
+    def test_insert_iter(self):
+        db = self.db
+        db.drop_collection("test")
+
+        def docs(count):
+            for i in range(count):
+                yield {"x": i}
+
+        results = list(db.test.insert_iter(docs(25), safe=True,
+                                           batch_size=10))
+        self.assertEqual([10, 10, 5], [len(ids) for ids, _ in results])
+        self.assertEqual([None] * 3, [error for _, error in results])
+        self.assertEqual(25, db.test.count())
+        ids = sum([ids for ids, _ in results], [])
+        self.assertEqual(24, db.test.find_one({"_id": ids[-1]})["x"])
+
+        # The batch with a duplicate key reports it, and stops the rest.
+        dups = [{"_id": 1}, {"_id": 2}, {"_id": 1}, {"_id": 3}, {"_id": 4}]
+        db.drop_collection("test")
+        results = list(db.test.insert_iter(dups, safe=True, batch_size=2))
+        self.assertEqual(2, len(results))
+        self.assertEqual(None, results[0][1])
+        self.assertTrue(isinstance(results[1][1], DuplicateKeyError))
+        self.assertEqual(2, db.test.count())
+
+        db.drop_collection("test")
+        results = list(db.test.insert_iter(dups, safe=True, batch_size=2,
+                                           continue_on_error=True))
+        self.assertEqual(3, len(results))
+        self.assertEqual(4, db.test.count())
+
+        # Split by size as well as by count.
+        db.drop_collection("test")
+        big = "x" * (db.connection.max_bson_size // 2)
+        results = list(db.test.insert_iter([{"s": big}] * 5,
+                                           manipulate=False, safe=True))
+        self.assertTrue(len(results) > 1)
+        self.assertEqual([None] * 5, sum([ids for ids, _ in results], []))
+        self.assertEqual(5, db.test.count())
+
+        self.assertRaises(InvalidDocument, list,
+                          db.test.insert_iter([{"s": big * 3}]))
+        self.assertRaises(ValueError, list,
+                          db.test.insert_iter([{}], batch_size=0))
+
+    def test_insert_large_values(self):
+        db = self.db
+        db.drop_collection("test")
+        big = Binary(b("x") * (message.SEGMENT_THRESHOLD * 2))
+        docs = [{"_id": 1, "big": big, "s": "small"},
+                {"_id": 2, "s": "y" * message.SEGMENT_THRESHOLD}]
+
+        expected = message.insert("db.coll", docs, False, False, {}, False,
+                                  OLD_UUID_SUBTYPE)
+        segmented = message.insert("db.coll", docs, False, False, {}, False,
+                                   OLD_UUID_SUBTYPE, None,
+                                   message.SEGMENT_THRESHOLD)
+        self.assertTrue(isinstance(segmented[1], list))
+        self.assertTrue(len(segmented[1]) > 1)
+        # Skip the request ids.
+        self.assertEqual(expected[1][8:], b("").join(segmented[1])[8:])
+        self.assertEqual(expected[2], segmented[2])
+        if message._use_c:
+            self.assertTrue([s for s in segmented[1] if s is big])
+
+        db.test.insert(docs, safe=True)
+        self.assertEqual(big, db.test.find_one({"_id": 1})["big"])
+        self.assertEqual(docs[1]["s"], db.test.find_one({"_id": 2})["s"])
+
+    def test_message_request_ids(self):
+        ids = [message._request_id(),
+               message.query(0, "db.coll", 0, 0, {})[0],
+               message.get_more("db.coll", 0, 1)[0],
+               message.delete("db.coll", {}, False, {}, OLD_UUID_SUBTYPE)[0],
+               message.kill_cursors([1])[0],
+               message._request_id()]
+        self.assertEqual(list(range(ids[0], ids[0] + 6)), ids)
+
+    def test_delete_and_kill_cursors_messages(self):
+        request_id, data, max_size = message.delete(
+            "db.coll", {"x": 1}, False, {}, OLD_UUID_SUBTYPE)
+        spec = BSON.encode({"x": 1})
+        self.assertEqual(len(spec), max_size)
+        self.assertEqual(struct.pack("<iiii", 16 + 4 + 8 + 4 + len(spec),
+                                     request_id, 0, 2006) +
+                         b("\x00\x00\x00\x00db.coll\x00\x00\x00\x00\x00") +
+                         spec, data)
+
+        (request_id, data) = message.kill_cursors([1, 2 ** 40])
+        self.assertEqual(struct.pack("<iiiiiiqq", 40, request_id, 0, 2007,
+                                     0, 2, 1, 2 ** 40), data)
+        self.assertEqual(message.kill_cursors(iter([5]))[1][16:],
+                         message.kill_cursors((5,))[1][16:])
+
     def test_insert_multiple_with_duplicate(self):
         db = self.db
         db.drop_collection("test")
@@ -1340,6 +1489,26 @@ class TestCollection(unittest.TestCase):
         self.assertTrue(db.test.find_one(5))
         self.assertFalse(db.test.find_one(6))
 
+    def test_find_one_many(self):
+        db = self.db
+        db.drop_collection("test")
+
+        db.test.insert([{"_id": i, "x": i * 2} for i in range(5)], safe=True)
+
+        self.assertEqual([], db.test.find_one_many([]))
+        self.assertEqual([{"_id": 3, "x": 6}, None, {"_id": 0, "x": 0}],
+                         db.test.find_one_many([3, 7, {"x": 0}]))
+        self.assertEqual([{"x": 2}, {"x": 4}],
+                         db.test.find_one_many([1, 2],
+                                               fields={"_id": False}))
+        self.assertEqual([db.test.find_one()],
+                         db.test.find_one_many([None]))
+
+        # More queries than are pipelined at once.
+        ids = range(5) * 1000
+        self.assertEqual([{"_id": i, "x": i * 2} for i in ids],
+                         db.test.find_one_many(ids))
+
     def test_remove_non_objectid(self):
         db = self.db
         db.drop_collection("test")
@@ -1879,5 +2048,101 @@ class TestCollection(unittest.TestCase):
                          coll.group([], {"_id": uu},
                                     {"count": 0}, reduce))
 
+    def test_type_registry(self):
+        coll = self.db.test
+        coll.drop()
+
+        def change_registry(collection, type_registry):
+            collection.type_registry = type_registry
+
+        self.assertEqual(None, coll.type_registry)
+        self.assertRaises(ConfigurationError, change_registry, coll, {})
+
+        registry = TypeRegistry({decimal.Decimal: unicode},
+                                {unicode: lambda value: value.upper()})
+        coll.type_registry = registry
+        self.assertEqual(registry, coll.type_registry)
+
+        coll.insert({"_id": 1, "x": decimal.Decimal("1.5")}, safe=True)
+        self.assertEqual(u"1.5", coll.find_one({"x": decimal.Decimal("1.5")},
+                                               fields={"_id": False})["x"])
+        coll.update({"x": decimal.Decimal("1.5")},
+                    {"$set": {"y": decimal.Decimal("2")}}, safe=True)
+        self.assertEqual(u"2", coll.find_one()["y"])
+
+        coll.insert({"_id": 2, "s": u"abc"}, safe=True)
+        self.assertEqual(u"ABC", coll.find_one({"_id": 2})["s"])
+        self.assertEqual(u"ABC", coll.find({"_id": 2}).clone()[0]["s"])
+        coll.type_registry = None
+        self.assertEqual(u"abc", coll.find_one({"_id": 2})["s"])
+
+        coll.type_registry = registry
+        coll.remove({"x": decimal.Decimal("1.5")}, safe=True)
+        self.assertEqual(1, coll.count())
+
+class NoPrimaryConnection(Connection):
+    """Reports sizes of 0, like a ReplicaSetConnection without a primary,
+    until a message is sent.
+    """
+
+    def __init__(self):
+        Connection.__init__(self, _connect=False)
+        self.sent = []
+
+    def max_bson_size(self):
+        return self.sent and 16 * 1024 * 1024 or 0
+    max_bson_size = property(max_bson_size)
+
+    def max_message_size(self):
+        return self.sent and 48 * 1024 * 1024 or 0
+    max_message_size = property(max_message_size)
+
+    def _send_message(self, message, with_last_error=False):
+        self.sent.append(message)
+
+
+class TestInsertIterSizes(unittest.TestCase):
+
+    def test_insert_iter_without_primary(self):
+        connection = NoPrimaryConnection()
+        coll = connection.pymongo_test.test
+        big = "x" * (5 * 1024 * 1024)
+
+        # Documents aren't rejected while the sizes are unknown, and the
+        # message size falls back to the default.
+        results = list(coll.insert_iter([{"s": big}, {"s": big}],
+                                        manipulate=False))
+        self.assertEqual([[None], [None]], [ids for ids, _ in results])
+
+        # Once a message is sent the primary's size applies.
+        connection.sent = []
+        self.assertRaises(InvalidDocument, list,
+                          coll.insert_iter([{}, {"s": big * 4}]))
+        self.assertEqual(1, len(connection.sent))
+
+    def test_insert_json_lines_without_primary(self):
+        connection = NoPrimaryConnection()
+        coll = connection.pymongo_test.test
+        lines = [b('{"x": %d}\n' % (i,)) for i in range(10)]
+        self.assertEqual(10, coll.insert_json_lines(lines))
+        # One message, rather than one for each document.
+        self.assertEqual(1, len(connection.sent))
+
+    def test_insert_iter_master_slave(self):
+        master = NoPrimaryConnection()
+        master.sent = [None]
+        connection = MasterSlaveConnection(master,
+                                           [Connection(_connect=False)])
+        self.assertEqual(16 * 1024 * 1024, connection.max_bson_size)
+        self.assertEqual(48 * 1024 * 1024, connection.max_message_size)
+
+        coll = connection.pymongo_test.test
+        results = list(coll.insert_iter([{"x": 1}, {"x": 2}]))
+        self.assertEqual(1, len(results))
+        self.assertEqual(2, len(master.sent))
+        self.assertRaises(InvalidDocument, list,
+                          coll.insert_iter([{"s": "x" * (17 * 1024 * 1024)}]))
+
+
 if __name__ == "__main__":
     unittest.main()
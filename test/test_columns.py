@@ -0,0 +1,120 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the columns module."""
+
+import datetime
+import struct
+import unittest
+import sys
+sys.path[0:0] = [""]
+
+from nose.plugins.skip import SkipTest
+
+from bson import BSON, decode_columns
+from bson import columns
+from bson.columns import INT32, INT64, DOUBLE, DATETIME, OBJECTID
+from bson.errors import InvalidBSON
+from bson.objectid import ObjectId
+from bson.py3compat import b
+from bson.son import SON
+from pymongo import helpers
+
+
+class TestColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.oid = ObjectId()
+        self.documents = [
+            SON([("_id", self.oid), ("i", 1), ("l", 2 ** 40), ("f", 1.5),
+                 ("d", datetime.datetime(2012, 1, 1)),
+                 ("s", {"a": [{"b": 7}]})]),
+            {"i": None, "l": 3, "f": 2, "s": {"a": 5}},
+            {},
+        ]
+        self.data = b("").join([BSON.encode(doc)
+                                for doc in self.documents])
+        self.numpy = columns._numpy
+        columns._numpy = False
+
+    def tearDown(self):
+        columns._numpy = self.numpy
+
+    def test_decode_columns(self):
+        result = decode_columns(self.data, [("i", INT32), ("l", INT64),
+                                            ("f", DOUBLE), ("d", DATETIME),
+                                            ("_id", OBJECTID)])
+        self.assertEqual([1, 0, 0], list(result["i"]))
+        self.assertEqual([2 ** 40, 3, 0], list(result["l"]))
+        self.assertEqual([1.5, 2.0], list(result["f"])[:2])
+        self.assertTrue(result["f"][2] != result["f"][2])  # NaN
+        self.assertEqual([1325376000000, 0, 0], list(result["d"]))
+        oids = struct.pack("%dB" % len(result["_id"]), *result["_id"])
+        self.assertEqual(self.oid.binary + b("\x00") * 24, oids)
+
+    def test_conversions(self):
+        result = decode_columns(self.data, {"i": INT64, "l": DOUBLE})
+        self.assertEqual([1, 0, 0], list(result["i"]))
+        self.assertEqual([2.0 ** 40, 3.0], list(result["l"])[:2])
+
+    def test_paths(self):
+        result = decode_columns(self.data, {"s.a.0.b": INT32,
+                                            "i.x": INT32})
+        self.assertEqual([7, 0, 0], list(result["s.a.0.b"]))
+        self.assertEqual([0, 0, 0], list(result["i.x"]))
+        self.assertRaises(InvalidBSON, decode_columns,
+                          self.data, {"s.a": INT64})
+
+    def test_buffer_and_offset(self):
+        data = bytearray(b("head")) + bytearray(self.data)
+        result = decode_columns(data, {"i": INT32}, 4)
+        self.assertEqual([1, 0, 0], list(result["i"]))
+        self.assertEqual(0, len(decode_columns(b(""), {"i": INT32})["i"]))
+
+    def test_invalid(self):
+        self.assertRaises(InvalidBSON, decode_columns,
+                          self.data, {"f": INT32})
+        self.assertRaises(InvalidBSON, decode_columns,
+                          self.data[:-1], {"i": INT32})
+        self.assertRaises(InvalidBSON, decode_columns,
+                          self.data + b("\x05\x00\x00"), {"i": INT32})
+        self.assertRaises(ValueError, decode_columns, self.data, {})
+        self.assertRaises(ValueError, decode_columns, self.data, {"i": 0})
+        self.assertRaises(TypeError, decode_columns, self.data, {1: INT32})
+
+    def test_unpack_response(self):
+        reply = struct.pack("<iqii", 0, 0, 0, 3) + self.data
+        batches = helpers._unpack_response(reply,
+                                           columns=columns._columns_schema(
+                                               {"l": INT64}))["data"]
+        result = columns._make_columns(columns._columns_schema({"l": INT64}),
+                                       batches + batches)
+        self.assertEqual([2 ** 40, 3, 0] * 2, list(result["l"]))
+
+    def test_numpy(self):
+        columns._numpy = self.numpy
+        numpy = columns._get_numpy()
+        if not numpy:
+            raise SkipTest("No numpy module")
+        result = decode_columns(self.data, {"l": INT64, "f": DOUBLE,
+                                            "_id": OBJECTID})
+        self.assertEqual(numpy.dtype("<i8"), result["l"].dtype)
+        self.assertEqual([2 ** 40, 3, 0], result["l"].tolist())
+        self.assertEqual(1.5, result["f"][0])
+        self.assertEqual(self.oid.binary, result["_id"][0])
+        result["l"][0] = 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,20 +16,32 @@
 
 import datetime
 import os
+import socket
+import struct
 import sys
 import time
 import thread
+import threading
 import unittest
 
 sys.path[0:0] = [""]
 
 from nose.plugins.skip import SkipTest
 
+from bson import BSON
+from bson.binary import Binary
+from bson.py3compat import b
 from bson.son import SON
 from bson.tz_util import utc
 from pymongo.connection import Connection
 from pymongo.database import Database
-from pymongo.pool import NO_REQUEST, NO_SOCKET_YET, SocketInfo
+from pymongo import message
+from pymongo.helpers import _unpack_response
+from pymongo.pool import (NO_REQUEST,
+                          NO_SOCKET_YET,
+                          SharedPool,
+                          SharedSocketInfo,
+                          SocketInfo)
 from pymongo.errors import (AutoReconnect,
                             ConfigurationError,
                             ConnectionFailure,
@@ -655,6 +667,231 @@ with conn.start_request() as request:
         # OperationFailure doesn't affect the request socket
         self.assertEqual(old_sock_info, pool._get_request_state())
 
+    def test_receive_message(self):
+        if not hasattr(socket, "socketpair"):
+            raise SkipTest("needs socket.socketpair")
+
+        def reply(request_id, documents):
+            data = struct.pack("<iqii", 0, 0, 0, len(documents))
+            data += b("").join([BSON.encode(doc) for doc in documents])
+            return struct.pack("<iiii", len(data) + 16, 0,
+                               request_id, 1) + data
+
+        small = {"x": 1}
+        large = {"data": Binary(b("a") * (200 * 1024))}
+        split = reply(4, [large])
+
+        def send():
+            # Replies that arrive together, including one larger than
+            # the read-ahead buffer, then one split across many sends.
+            server.sendall(reply(1, [small]) + reply(2, [large, small]) +
+                           reply(3, []))
+            for i in range(0, len(split), 1000):
+                server.sendall(split[i:i + 1000])
+            server.sendall(reply(5, [small])[:20])
+            server.close()
+
+        server, client = socket.socketpair()
+        sender = threading.Thread(target=send)
+        sender.start()
+        try:
+            sock_info = SocketInfo(client, 0)
+            first = sock_info.receive_message(1, 1)
+            second = sock_info.receive_message(1, 2)
+            third = sock_info.receive_message(1, 3)
+            self.assertEqual([small], _unpack_response(first)["data"])
+            self.assertEqual([large, small],
+                             _unpack_response(second)["data"])
+            self.assertEqual([], _unpack_response(third)["data"])
+            # Replies are never received into the same buffer twice.
+            self.assertEqual([small], _unpack_response(first)["data"])
+            self.assertEqual([large], _unpack_response(
+                sock_info.receive_message(1, 4))["data"])
+            self.assertRaises(ConnectionFailure,
+                              sock_info.receive_message, 1, 5)
+        finally:
+            sender.join()
+            server.close()
+            client.close()
+
+    def test_pipeline(self):
+        if not hasattr(socket, "socketpair"):
+            raise SkipTest("needs socket.socketpair")
+
+        def serve():
+            # Reply to each query with its own request id, once it has
+            # been received in full.
+            received = b("")
+            while True:
+                chunk = server.recv(4096)
+                if not chunk:
+                    break
+                received += chunk
+                while len(received) >= 16:
+                    length, request_id = struct.unpack("<ii", received[:8])
+                    if len(received) < length:
+                        break
+                    data = struct.pack("<iqii", 0, 0, 0, 1)
+                    data += BSON.encode({"n": request_id})
+                    server.sendall(struct.pack("<iiii", len(data) + 16, 0,
+                                               request_id, 1) + data)
+                    received = received[length:]
+
+        server, client = socket.socketpair()
+        server_thread = threading.Thread(target=serve)
+        server_thread.start()
+        try:
+            sock_info = SocketInfo(client, 0)
+            # Enough queries to be sent in several batches.
+            messages = [message.query(0, "db.coll", 0, -1, {"x": i})[:2]
+                        for i in range(1000)]
+            responses = sock_info.pipeline(messages)
+            self.assertEqual([[{"n": request_id}]
+                              for (request_id, _) in messages],
+                             [_unpack_response(response)["data"]
+                              for response in responses])
+            self.assertEqual([], sock_info.pipeline([]))
+        finally:
+            client.close()
+            server_thread.join()
+            server.close()
+
+    def test_shared_socket(self):
+        if not hasattr(socket, "socketpair"):
+            raise SkipTest("needs socket.socketpair")
+
+        def reply(request_id):
+            data = struct.pack("<iqii", 0, 0, 0, 1)
+            data += BSON.encode({"n": request_id})
+            return struct.pack("<iiii", len(data) + 16, 0,
+                               request_id, 1) + data
+
+        def serve(count, respond=True):
+            # Reply to the first `count` queries in reverse order, once
+            # they have all been received.
+            received = b("")
+            request_ids = []
+            while len(request_ids) < count:
+                received += server.recv(4096)
+                while len(received) >= 16:
+                    length, request_id = struct.unpack("<ii", received[:8])
+                    if len(received) < length:
+                        break
+                    request_ids.append(request_id)
+                    received = received[length:]
+            request_ids.reverse()
+            if respond:
+                server.sendall(b("").join([reply(request_id)
+                                           for request_id in request_ids]))
+
+        results = []
+
+        def query(i):
+            request_id, data = message.query(0, "db.coll", 0, -1, {"x": i})[:2]
+            sock_info.sendall(data)
+            try:
+                response = sock_info.receive_message(1, request_id)
+                results.append(
+                    (request_id, _unpack_response(response)["data"][0]["n"]))
+            except ConnectionFailure:
+                results.append((request_id, None))
+
+        server, client = socket.socketpair()
+        sock_info = SharedSocketInfo(client, 0)
+        try:
+            server_thread = threading.Thread(target=serve, args=(20,))
+            server_thread.start()
+            threads = [threading.Thread(target=query, args=(i,))
+                       for i in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            server_thread.join()
+            self.assertEqual(20, len(results))
+            for (request_id, n) in results:
+                self.assertEqual(request_id, n)
+
+            # Every waiting thread fails if the connection is lost.
+            results = []
+            server_thread = threading.Thread(target=serve, args=(5, False))
+            server_thread.start()
+            threads = [threading.Thread(target=query, args=(i,))
+                       for i in range(5)]
+            for t in threads:
+                t.start()
+            server_thread.join()
+            server.close()
+            for t in threads:
+                t.join()
+            self.assertEqual(5, len(results))
+            for (request_id, n) in results:
+                self.assertEqual(None, n)
+            self.assertTrue(sock_info.closed)
+        finally:
+            server.close()
+            client.close()
+
+    def test_shared_pool(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(10)
+        try:
+            pool = SharedPool(listener.getsockname(), 2, None, None, False)
+            sockets = [pool.get_socket() for i in range(6)]
+            self.assertTrue(isinstance(sockets[0], SharedSocketInfo))
+            self.assertEqual(2, len(set(sockets)))
+            for sock_info in sockets:
+                pool.maybe_return_socket(sock_info)
+            self.assertEqual(2, len(pool.sockets))
+
+            # Requests use one of the shared sockets.
+            pool.start_request()
+            request_sock = pool.get_socket()
+            self.assertTrue(request_sock in sockets)
+            self.assertTrue(request_sock is pool.get_socket())
+            pool.end_request()
+            self.assertEqual(2, len(pool.sockets))
+
+            # Closed sockets are replaced.
+            sockets[0].close()
+            self.assertFalse(sockets[0] in
+                             [pool.get_socket() for i in range(4)])
+            self.assertEqual(2, len(pool.sockets))
+            pool.reset()
+
+            # Sockets being opened count towards the limit.
+            class SlowPool(SharedPool):
+                def connect(self, pair):
+                    time.sleep(0.1)
+                    return SharedPool.connect(self, pair)
+
+            pool = SlowPool(listener.getsockname(), 2, None, None, False)
+            sockets = []
+
+            def get_socket():
+                sockets.append(pool.get_socket())
+
+            threads = [threading.Thread(target=get_socket)
+                       for i in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(20, len(sockets))
+            self.assertEqual(2, len(set(sockets)))
+            self.assertEqual(2, len(pool.sockets))
+            pool.reset()
+        finally:
+            listener.close()
+
+        conn = Connection(self.host, self.port, _connect=False,
+                          share_sockets=True)
+        self.assertTrue(isinstance(conn._Connection__pool, SharedPool))
+        self.assertRaises(ConfigurationError, Connection, self.host,
+                          self.port, _connect=False, share_sockets=True,
+                          use_greenlets=True)
+
 
 if __name__ == "__main__":
     unittest.main()
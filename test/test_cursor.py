@@ -18,11 +18,16 @@ import random
 import warnings
 import sys
 import itertools
+import re
 sys.path[0:0] = [""]
 
 from nose.plugins.skip import SkipTest
 
+from bson.binary import Binary
 from bson.code import Code
+from bson.columns import DOUBLE, INT32, INT64
+from bson.py3compat import b
+from bson.regex import Regex
 from pymongo import (ASCENDING,
                      DESCENDING)
 from pymongo.cursor import Cursor
@@ -494,6 +499,66 @@ class TestCursor(unittest.TestCase):
         self.assertEqual(cursor._Cursor__query_flags,
                          cursor2._Cursor__query_flags)
 
+    def test_decode_fields(self):
+        self.db.test.remove()
+        self.db.test.save({"x": 1, "y": {"a": 1, "b": 2}, "z": [{"a": 3}]})
+
+        doc = self.db.test.find_one(decode_fields=["x", "y.a", "z.a"])
+        self.assertEqual({"x": 1, "y": {"a": 1}, "z": [{"a": 3}]}, doc)
+
+        cursor = self.db.test.find(decode_fields=["y.b"])
+        self.assertEqual({"y": {"b": 2}}, cursor.clone().next())
+        self.assertEqual({"y": {"b": 2}}, cursor.next())
+
+        self.assertRaises(TypeError, self.db.test.find, decode_fields="x")
+
+    def test_decode_columns(self):
+        self.db.test.remove()
+        self.db.test.insert([{"x": i, "y": {"z": i / 2.0}}
+                             for i in range(250)], safe=True)
+
+        cursor = self.db.test.find().sort("x").batch_size(100)
+        columns = cursor.decode_columns([("x", INT32), ("y.z", DOUBLE)])
+        self.assertEqual(list(range(250)), list(columns["x"]))
+        self.assertEqual([i / 2.0 for i in range(250)], list(columns["y.z"]))
+        self.assertFalse(cursor.alive)
+        self.assertRaises(InvalidOperation, cursor.decode_columns,
+                          {"x": INT32})
+
+        columns = self.db.test.find({"x": -1}).decode_columns({"x": INT64})
+        self.assertEqual(0, len(columns["x"]))
+        self.assertRaises(ValueError, self.db.test.find().decode_columns,
+                          {"x": "int32"})
+
+    def test_compile_re(self):
+        self.db.test.remove()
+        self.db.test.insert({"r": Regex(u"^a+", "i")}, safe=True)
+
+        self.assertEqual(Regex(u"^a+", "i"),
+                         self.db.test.find_one(compile_re=False)["r"])
+        cursor = self.db.test.find(compile_re=False)
+        self.assertEqual(Regex(u"^a+", "i"), cursor.clone().next()["r"])
+        self.assertEqual(re.compile(u"^a+", re.I),
+                         self.db.test.find_one()["r"])
+        self.assertRaises(TypeError, self.db.test.find, compile_re=1)
+
+    def test_binary_view(self):
+        if sys.version_info[:2] < (2, 7):
+            raise SkipTest("memoryview requires Python 2.7 or later")
+        self.db.test.remove()
+        self.db.test.insert({"data": Binary(b("x") * 1000)}, safe=True)
+
+        data = self.db.test.find_one(binary_view=True)["data"]
+        self.assertTrue(isinstance(data, memoryview))
+        self.assertTrue(data.readonly)
+        self.assertEqual(b("x") * 1000, data.tobytes())
+        cursor = self.db.test.find(binary_view=True)
+        self.assertTrue(isinstance(cursor.clone().next()["data"],
+                                   memoryview))
+        self.assertFalse(isinstance(self.db.test.find_one()["data"],
+                                    memoryview))
+        self.assertRaises(TypeError, self.db.test.find, binary_view=1)
+
     def test_add_remove_option(self):
         cursor = self.db.test.find()
         self.assertEqual(0, cursor._Cursor__query_options())
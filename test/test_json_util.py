@@ -24,14 +24,17 @@ from nose.plugins.skip import SkipTest
 sys.path[0:0] = [""]
 
 import bson
+from bson import BSON
 from bson.py3compat import b
 from bson import json_util
-from bson.binary import Binary, MD5_SUBTYPE
+from bson.binary import Binary, MD5_SUBTYPE, OLD_UUID_SUBTYPE
 from bson.code import Code
 from bson.dbref import DBRef
+from bson.errors import InvalidDocument, InvalidId, InvalidStringData
 from bson.max_key import MaxKey
 from bson.min_key import MinKey
 from bson.objectid import ObjectId
+from bson.son import SON
 from bson.timestamp import Timestamp
 from bson.tz_util import utc
 
@@ -39,6 +42,11 @@ from test.test_connection import get_connection
 
 PY3 = sys.version_info[0] == 3
 
+if PY3:
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
 
 class TestJsonUtil(unittest.TestCase):
 
@@ -136,5 +144,176 @@ class TestJsonUtil(unittest.TestCase):
         for doc in docs:
             self.assertTrue(doc in reloaded_docs)
 
+    def test_dump_cursor(self):
+        db = self.db
+
+        db.drop_collection("test")
+        docs = [{"_id": i, "bin": Binary(b("\x00\x01"))} for i in range(150)]
+        db.test.insert(docs)
+
+        out = StringIO()
+        json_util.dump_cursor(db.test.find().sort("_id").batch_size(40), out)
+        self.assertEqual(docs, json_util.loads(out.getvalue()))
+
+        out = StringIO()
+        json_util.dump_cursor(db.test.find().sort("_id"), out,
+                              json_lines=True)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(150, len(lines))
+        self.assertEqual(docs, [json_util.loads(line) for line in lines])
+
+        out = StringIO()
+        json_util.dump_cursor(db.test.find({"_id": -1}), out)
+        self.assertEqual("[]", out.getvalue())
+
+
+class TestExtendedJSON(unittest.TestCase):
+
+    def setUp(self):
+        if not json_util.json_lib:
+            raise SkipTest("No json or simplejson module")
+
+    def test_bson_to_json(self):
+        doc = SON([("a", 1), ("b", [1.5, "x", None, True]),
+                   ("c", SON([("d", 2 ** 40)]))])
+        self.assertEqual('{"a": 1, "b": [1.5, "x", null, true], '
+                         '"c": {"d": 1099511627776}}',
+                         json_util.bson_to_json(BSON.encode(doc)))
+
+        doc = {"id": ObjectId(),
+               "date": datetime.datetime(2009, 12, 9, 15, 49, 45, 191000,
+                                         utc),
+               "bin": Binary(b("\x00\x01\x02\x03\x04")),
+               "md5": Binary(b("\x00\x01"), MD5_SUBTYPE),
+               "code": Code("function x() { return 1; }"),
+               "scope": Code("function y() { return z; }", z=2),
+               "ref": DBRef("foo", 5, "db"),
+               "min": MinKey(),
+               "max": MaxKey(),
+               "float": -0.1,
+               "text": u"\u00e9\n\"\\\U0001d11e\x7f"}
+        if bson.has_uuid():
+            doc["uuid"] = bson.uuid.UUID(
+                "f47ac10b-58cc-4372-a567-0e02b2c3d479")
+        text = json_util.bson_to_json(BSON.encode(doc))
+        self.assertEqual(doc, json_util.loads(text))
+        self.assertEqual(json_util.json.loads(json_util.dumps(doc)),
+                         json_util.json.loads(text))
+
+        regex = json_util.loads(json_util.bson_to_json(
+            BSON.encode({"r": re.compile("a*b", re.I | re.M | re.X)})))["r"]
+        self.assertEqual("a*b", regex.pattern)
+        self.assertEqual(re.I | re.M, regex.flags & (re.I | re.M | re.X))
+
+    def test_bson_to_json_invalid(self):
+        data = BSON.encode({"a": 1})
+        self.assertRaises(bson.InvalidBSON, json_util.bson_to_json, data[:-1])
+        self.assertRaises(bson.InvalidBSON, json_util.bson_to_json,
+                          data + data)
+
+    def test_json_to_bson(self):
+        doc = SON([("b", 1), ("a", [1.5, "x", None, False]),
+                   ("_id", ObjectId()),
+                   ("date", datetime.datetime(2009, 12, 9, 15, 49, 45,
+                                              191000, utc)),
+                   ("bin", Binary(b("\x00\x01\x02\x03\x04"))),
+                   ("old", Binary(b("\x00\x01"), 2)),
+                   ("code", Code("function x() { return 1; }")),
+                   ("scope", Code("function y() { return z; }", z=2)),
+                   ("ref", DBRef("foo", ObjectId(), "db")),
+                   ("min", MinKey()),
+                   ("big", 2 ** 40),
+                   ("text", u"\u00e9\n\"\U0001d11e")])
+        if bson.has_uuid():
+            doc["uuid"] = bson.uuid.UUID(
+                "f47ac10b-58cc-4372-a567-0e02b2c3d479")
+        encoded = json_util.json_to_bson(json_util.bson_to_json(
+            BSON.encode(doc)))
+        self.assertTrue(isinstance(encoded, BSON))
+        # _id is moved to the front, like BSON.encode does.
+        self.assertEqual(BSON.encode(doc), encoded)
+
+        self.assertEqual({"x": 1, "y": -2 ** 62, "z": 1e100},
+                         json_util.json_to_bson(
+                             '{"x": 1, "y": -4611686018427387904, '
+                             '"z": 1e100}').decode())
+        self.assertEqual({u"\u00e9": u"\u00e9"},
+                         json_util.json_to_bson(
+                             u'{"\u00e9": "\\u00e9"}').decode())
+        self.assertEqual({"d": datetime.datetime(1970, 1, 1, 0, 0, 1, 500000,
+                                                  utc)},
+                         json_util.json_to_bson(
+                             '{"d": {"$date": "1500.5"}}').decode(
+                                 tz_aware=True))
+
+    def test_json_to_bson_invalid(self):
+        self.assertRaises(ValueError, json_util.json_to_bson, '')
+        self.assertRaises(ValueError, json_util.json_to_bson, '{"a": }')
+        self.assertRaises(ValueError, json_util.json_to_bson, '{"a": 1} 2')
+        self.assertRaises(ValueError, json_util.json_to_bson, '{"a": "b')
+        self.assertRaises(InvalidDocument, json_util.json_to_bson, '[1]')
+        self.assertRaises(InvalidDocument, json_util.json_to_bson,
+                          '{"$oid": "4fb1a2c3d4e5f60718293a4b"}')
+        self.assertRaises(InvalidDocument, json_util.json_to_bson,
+                          '{"a\\u0000": 1}')
+        self.assertRaises(InvalidId, json_util.json_to_bson,
+                          '{"a": {"$oid": "x"}}')
+        self.assertRaises(OverflowError, json_util.json_to_bson,
+                          '{"a": 9223372036854775808}')
+
+    def test_backends_agree(self):
+        # The pure Python versions give the same results as the C ones.
+        doc = SON([("r", re.compile("a.b", re.I | re.M)),
+                   ("bin", Binary(b("abc"), 5)),
+                   ("ts", Timestamp(5, 6)),
+                   ("code", Code("function y() { return z; }", z=2)),
+                   ("ref", DBRef("foo", ObjectId(), "db")),
+                   ("date", datetime.datetime(2009, 12, 9, 15, 49, 45,
+                                              191000, utc)),
+                   ("list", [1, SON([("a", 2.5)]), None, True]),
+                   ("text", u"\u00e9\U0001d11e"),
+                   ("min", MinKey())])
+        data = BSON.encode(doc)
+        text = json_util._py_bson_to_json(data, OLD_UUID_SUBTYPE, None)
+        self.assertEqual(text, json_util.bson_to_json(data))
+        self.assertEqual(json_util._py_json_to_bson(text, OLD_UUID_SUBTYPE),
+                         json_util.json_to_bson(text))
+        self.assertTrue(text.startswith('{"r": {"$regex": "a.b", '
+                                        '"$options": "im"}, "bin": '
+                                        '{"$binary": "YWJj", "$type": 5}, '
+                                        '"ts": {"t": 5, "i": 6}, '
+                                        '"code": {"$code": '))
+
+        for bad, error in (('{"a": "\\ud83d"}', InvalidStringData),
+                           ('{"a": ["\\ude00"]}', InvalidStringData),
+                           ('{"\\ud83dx": 1}', InvalidStringData),
+                           (u'{"a": "\ud83d"}', InvalidStringData),
+                           ('{"$oid": "5555"}', InvalidDocument),
+                           ('{"a": 1, "$date": 5}', InvalidDocument),
+                           ('{"a": {"$oid": "5555"}}', InvalidId)):
+            self.assertRaises(error, json_util._py_json_to_bson, bad,
+                              OLD_UUID_SUBTYPE)
+            self.assertRaises(error, json_util.json_to_bson, bad)
+        self.assertEqual({"a": u"\U0001d11e"},
+                         json_util.json_to_bson(
+                             '{"a": "\\ud834\\udd1e"}').decode())
+
+    def test_load_json_lines(self):
+        oid = ObjectId()
+        lines = [b('{"_id": {"$oid": "%s"}, "x": 1}\n' % (oid,)),
+                 b('\n'),
+                 b('{"d": {"$date": 1500}}')]
+        docs = list(json_util.load_json_lines(lines))
+        self.assertEqual(2, len(docs))
+        for doc in docs:
+            self.assertTrue(isinstance(doc, BSON))
+        self.assertEqual({"_id": oid, "x": 1}, docs[0].decode())
+        self.assertEqual({"d": datetime.datetime(1970, 1, 1, 0, 0, 1, 500000,
+                                                  utc)},
+                         docs[1].decode(tz_aware=True))
+        self.assertRaises(ValueError, list,
+                          json_util.load_json_lines([b('{"a": 1}'),
+                                                     b('{"a": ')]))
+
 if __name__ == "__main__":
     unittest.main()
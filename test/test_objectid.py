@@ -191,5 +191,31 @@ class TestObjectId(unittest.TestCase):
         self.assertTrue(ObjectId.is_valid(b("123456789012")))
         self.assertTrue(ObjectId.is_valid("123456789012123456789012"))
 
+    def test_batch(self):
+        self.assertEqual([], ObjectId.batch(0))
+        self.assertRaises(TypeError, ObjectId.batch, 1.0)
+        self.assertRaises(ValueError, ObjectId.batch, -1)
+
+        oids = ObjectId.batch(100) + ObjectId.batch(1)
+        self.assertEqual(101, len(set(oids)))
+        prefix = oids[0].binary[4:9]
+        for previous, oid in zip(oids, oids[1:]):
+            self.assertTrue(isinstance(oid, ObjectId))
+            self.assertEqual(prefix, oid.binary[4:9])
+            self.assertEqual((int(str(previous)[-6:], 16) + 1) % 0xFFFFFF,
+                             int(str(oid)[-6:], 16))
+        self.assertEqual(oids[0], ObjectId(str(oids[0])))
+        self.assertTrue(oids[0].generation_time <= ObjectId().generation_time)
+
+        class MyObjectId(ObjectId):
+            pass
+
+        self.assertTrue(isinstance(MyObjectId.batch(1)[0], MyObjectId))
+
+    def test_hex_case(self):
+        self.assertEqual(ObjectId("1234567890abcdef12345678"),
+                         ObjectId("1234567890ABCDEF12345678"))
+        self.assertRaises(InvalidId, ObjectId, u"1234567890abcdef1234567\xe9")
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,165 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the raw_bson module."""
+
+import datetime
+import unittest
+import sys
+sys.path[0:0] = [""]
+
+from bson import BSON, decode_all
+from bson.binary import Binary
+from bson.code import Code
+from bson.dbref import DBRef
+from bson.errors import InvalidBSON, InvalidDocument
+from bson.objectid import ObjectId
+from bson.py3compat import b
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+from bson.tz_util import utc
+from pymongo import message
+
+
+class TestRawBSONDocument(unittest.TestCase):
+
+    def setUp(self):
+        self.document = SON([("_id", ObjectId()),
+                             ("name", u"Sherlock"),
+                             ("address", SON([("street", u"Baker Street"),
+                                              ("number", 221)])),
+                             ("tags", [1, {"a": 2}, u"three"]),
+                             ("born", datetime.datetime(1854, 1, 6)),
+                             ("data", Binary(b("\x00\x01"), 128)),
+                             ("code", Code("x", {"y": 1})),
+                             ("ref", DBRef("coll", 5))])
+        self.bson = BSON.encode(self.document)
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, RawBSONDocument, u"not bytes")
+        self.assertRaises(InvalidBSON, RawBSONDocument, b("\x05\x00\x00"))
+        self.assertRaises(InvalidBSON, RawBSONDocument,
+                          b("\x05\x00\x00\x00\x01"))
+        self.assertRaises(InvalidBSON, RawBSONDocument,
+                          b("\x06\x00\x00\x00\x00"))
+
+    def test_raw(self):
+        raw = RawBSONDocument(self.bson)
+        self.assertEqual(self.bson, raw.raw)
+        self.assertEqual(self.document, raw)
+        self.assertEqual(RawBSONDocument(self.bson), raw)
+
+    def test_mapping(self):
+        raw = RawBSONDocument(self.bson)
+        self.assertEqual(list(self.document.keys()), raw.keys())
+        self.assertEqual(list(self.document.keys()), list(raw))
+        self.assertEqual(len(self.document), len(raw))
+        self.assertTrue("name" in raw)
+        self.assertFalse("missing" in raw)
+        self.assertEqual(u"Sherlock", raw["name"])
+        self.assertEqual(u"Sherlock", raw.get("name"))
+        self.assertEqual(None, raw.get("missing"))
+        self.assertRaises(KeyError, lambda: raw["missing"])
+        self.assertEqual(self.document["_id"], raw["_id"])
+        self.assertEqual(self.document["data"], raw["data"])
+        self.assertEqual(self.document["code"], raw["code"])
+        self.assertEqual(self.document["born"], raw["born"])
+        self.assertEqual(list(self.document.items())[:2], raw.items()[:2])
+
+    def test_duplicate_keys(self):
+        # {"a": 1, "b": 3, "a": 2}
+        data = b("\x1a\x00\x00\x00\x10a\x00\x01\x00\x00\x00"
+                 "\x10b\x00\x03\x00\x00\x00\x10a\x00\x02\x00\x00\x00"
+                 "\x00")
+        raw = RawBSONDocument(data)
+        decoded = BSON(data).decode(as_class=SON)
+        self.assertEqual(2, len(raw))
+        self.assertEqual([u"a", u"b"], list(raw))
+        self.assertEqual([(u"a", 2), (u"b", 3)], raw.items())
+        self.assertEqual(list(decoded.items()), raw.items())
+        self.assertEqual(decoded, raw.to_dict())
+
+    def test_nested_documents_are_raw(self):
+        raw = RawBSONDocument(self.bson)
+        self.assertTrue(isinstance(raw["address"], RawBSONDocument))
+        self.assertEqual(221, raw["address"]["number"])
+        self.assertTrue(isinstance(raw["tags"], list))
+        self.assertTrue(isinstance(raw["tags"][1], RawBSONDocument))
+        self.assertEqual(2, raw["tags"][1]["a"])
+        self.assertTrue(isinstance(raw["ref"], RawBSONDocument))
+        self.assertEqual(DBRef("coll", 5).as_doc(), raw["ref"])
+
+    def test_tz_aware(self):
+        raw = RawBSONDocument(self.bson, tz_aware=True)
+        self.assertEqual(utc, raw["born"].tzinfo)
+
+    def test_to_dict(self):
+        raw = RawBSONDocument(self.bson)
+        doc = raw.to_dict()
+        self.assertTrue(isinstance(doc, dict))
+        self.assertTrue(isinstance(doc["address"], dict))
+        self.assertEqual(self.document, doc)
+
+    def test_decode(self):
+        raw = self.bson.decode(as_class=RawBSONDocument)
+        self.assertTrue(isinstance(raw, RawBSONDocument))
+        self.assertEqual(self.bson, raw.raw)
+
+    def test_decode_all(self):
+        second = BSON.encode({"x": 1})
+        docs = decode_all(self.bson + second, RawBSONDocument)
+        self.assertEqual(2, len(docs))
+        self.assertEqual(self.bson, docs[0].raw)
+        self.assertEqual(second, docs[1].raw)
+        self.assertEqual(1, docs[1]["x"])
+
+    def test_encode(self):
+        raw = RawBSONDocument(self.bson)
+        self.assertEqual(self.bson, BSON.encode(raw))
+        self.assertEqual(self.bson, BSON.encode(self.bson))
+        # Encoded documents are copied, not checked.
+        dollar = BSON.encode({"$x": 1})
+        self.assertEqual(dollar, BSON.encode(dollar, check_keys=True))
+        self.assertRaises(InvalidDocument, BSON.encode, BSON(b("\x06\x00")))
+        self.assertRaises(InvalidDocument, BSON.encode,
+                          BSON(b("\x06\x00\x00\x00\x00")))
+
+    def test_encode_embedded(self):
+        raw = RawBSONDocument(self.bson)
+        self.assertEqual(BSON.encode({"a": [self.document],
+                                      "b": {"c": self.document}}),
+                         BSON.encode({"a": [raw], "b": {"c": raw}}))
+        self.assertEqual({"x": self.document},
+                         BSON.encode({"x": raw}).decode(as_class=SON))
+
+    def test_insert_message(self):
+        raw = RawBSONDocument(self.bson)
+        expected = message.insert("db.coll", [self.document] * 2,
+                                  False, False, {}, False, 3)[1][8:]
+        for docs in ([raw, raw], [self.bson, raw]):
+            self.assertEqual(expected, message.insert("db.coll", docs, True,
+                                                      False, {}, False,
+                                                      3)[1][8:])
+
+    def test_subclass(self):
+        class MyRawDocument(RawBSONDocument):
+            pass
+
+        doc = decode_all(self.bson, MyRawDocument)[0]
+        self.assertTrue(isinstance(doc, MyRawDocument))
+        self.assertTrue(isinstance(doc["address"], MyRawDocument))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the record module."""
+
+import copy
+import pickle
+import unittest
+import sys
+sys.path[0:0] = [""]
+
+from bson import BSON, decode_all
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from bson.record import Record, record_class
+from bson.son import SON
+
+Person = record_class("Person", ["_id", "name", "address", "tags"])
+Address = record_class("Address", ["street"], overflow=False)
+
+
+class TestRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.document = SON([("name", u"Sherlock"),
+                             ("_id", ObjectId()),
+                             ("address", SON([("street", u"Baker Street"),
+                                              ("number", 221)])),
+                             ("tags", [1, {"a": 2}]),
+                             ("born", 1854)])
+        self.bson = BSON.encode(self.document)
+
+    def test_record_class(self):
+        self.assertTrue(issubclass(Person, Record))
+        self.assertEqual(("_id", "name", "address", "tags"), Person._fields)
+        self.assertRaises(ValueError, record_class, "R", ["a", "a"])
+        self.assertRaises(TypeError, record_class, "R", ["a", 1])
+
+    def test_mapping(self):
+        person = Person(name=u"Mike", born=1980)
+        self.assertEqual(u"Mike", person["name"])
+        self.assertEqual(u"Mike", person.name)
+        self.assertEqual(1980, person["born"])
+        self.assertRaises(KeyError, person.__getitem__, "_id")
+        self.assertRaises(AttributeError, getattr, person, "_id")
+        self.assertEqual(None, person.get("tags"))
+        self.assertTrue("name" in person)
+        self.assertFalse("tags" in person)
+        self.assertEqual(2, len(person))
+        self.assertEqual(["name", "born"], person.keys())
+        self.assertEqual({"name": u"Mike", "born": 1980}, person.to_dict())
+        self.assertEqual({"name": u"Mike", "born": 1980}, person)
+        self.assertEqual(Person(name=u"Mike", born=1980), person)
+        self.assertNotEqual(Person(name=u"Mike"), person)
+        try:
+            person["name"] = u"Bob"
+        except TypeError:
+            pass
+        else:
+            self.fail("records should be read-only")
+        self.assertEqual(person, pickle.loads(pickle.dumps(person)))
+        self.assertEqual(person, copy.deepcopy(person))
+
+        closed = Address(street=u"Baker Street", number=221)
+        self.assertEqual({"street": u"Baker Street"}, closed)
+
+    def test_decode(self):
+        for person in (BSON(self.bson).decode(as_class=Person),
+                       decode_all(self.bson, Person)[0]):
+            self.assertTrue(isinstance(person, Person))
+            self.assertEqual(self.document, person)
+            self.assertEqual(["_id", "name", "address", "tags", "born"],
+                             person.keys())
+            self.assertTrue(type(person["address"]) is dict)
+
+        Nested = record_class("Nested", ["name", "address"], overflow=False,
+                              document_class=Address)
+        nested = decode_all(self.bson, Nested)[0]
+        self.assertEqual({"name": u"Sherlock",
+                          "address": {"street": u"Baker Street"}}, nested)
+        self.assertTrue(isinstance(nested["address"], Address))
+
+        projected = decode_all(self.bson, Person,
+                               fields=["name", "address.number"])[0]
+        self.assertEqual({"name": u"Sherlock", "address": {"number": 221}},
+                         projected)
+
+        Refs = record_class("Refs", ["ref"], document_class=Address)
+        data = BSON.encode({"ref": DBRef("coll", 5)})
+        self.assertTrue(isinstance(decode_all(data, Refs)[0]["ref"],
+                                   Address))
+
+    def test_encode(self):
+        person = decode_all(self.bson, Person)[0]
+        data = BSON.encode(person)
+        # _id is still written first.
+        self.assertEqual(BSON.encode(self.document.to_dict()).decode(),
+                         data.decode())
+        self.assertEqual(self.bson[4:4 + 18], data[4:4 + 18])
+        self.assertEqual({"person": self.document},
+                         BSON.encode({"person": person}).decode())
+        self.assertEqual({"a": [{"street": u"x"}]},
+                         BSON.encode({"a": [Address(street=u"x")]}).decode())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the regex module."""
+
+import re
+import unittest
+import sys
+sys.path[0:0] = [""]
+
+from bson import BSON, decode_all, decode_iter
+from bson import regex
+from bson.raw_bson import RawBSONDocument
+from bson.regex import Regex, str_flags_to_int
+
+
+class TestRegex(unittest.TestCase):
+
+    def test_regex(self):
+        r = Regex(u"a*b", re.IGNORECASE | re.MULTILINE)
+        self.assertEqual(u"a*b", r.pattern)
+        self.assertEqual(re.IGNORECASE | re.MULTILINE, r.flags)
+        self.assertEqual(r, Regex(u"a*b", "im"))
+        self.assertNotEqual(r, Regex(u"a*b"))
+        self.assertEqual(hash(r), hash(Regex(u"a*b", "mi")))
+        self.assertEqual(r, eval(repr(r)))
+        self.assertEqual(r, Regex.from_native(re.compile(u"a*b", re.I | re.M)))
+        self.assertEqual(re.compile(u"a*b", re.I | re.M), r.try_compile())
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, Regex, 5)
+        self.assertRaises(TypeError, Regex, u"a", 1.5)
+        self.assertRaises(re.error, Regex(u"(").try_compile)
+
+    def test_str_flags_to_int(self):
+        self.assertEqual(0, str_flags_to_int(""))
+        self.assertEqual(re.DOTALL | re.VERBOSE | re.UNICODE,
+                         str_flags_to_int("sxu"))
+        self.assertEqual(re.LOCALE, str_flags_to_int("lz"))
+
+    def test_encode(self):
+        self.assertEqual(BSON.encode({"r": re.compile(u"a*b", re.I)}),
+                         BSON.encode({"r": Regex(u"a*b", re.I)}))
+        self.assertEqual(BSON.encode({"r": re.compile(u"a*b", re.I)}),
+                         BSON.encode({"r": Regex(u"a*b", "i")}))
+
+    def test_decode_without_compiling(self):
+        doc = {"r": Regex(u"^route/\\d+$", "im"), "a": [Regex(u"x")]}
+        data = BSON.encode(doc)
+        self.assertEqual(doc, data.decode(compile_re=False))
+        self.assertEqual([doc], decode_all(data, compile_re=False))
+        self.assertEqual([doc], list(decode_iter(data, compile_re=False)))
+        raw = data.decode(as_class=RawBSONDocument, compile_re=False)
+        self.assertEqual(doc["r"], raw["r"])
+        self.assertEqual(doc, raw.to_dict())
+
+        decoded = data.decode()
+        self.assertEqual(re.compile(u"^route/\\d+$", re.I | re.M),
+                         decoded["r"])
+        self.assertEqual([re.compile(u"x")], decoded["a"])
+
+    def test_cache(self):
+        data = BSON.encode({"r": Regex(u"cached", "i")})
+        first = data.decode()["r"]
+        self.assertTrue(first is data.decode()["r"])
+        self.assertTrue(first is decode_all(data)[0]["r"])
+
+        for i in range(regex._CACHE_SIZE * 2):
+            BSON.encode({"r": Regex(u"pattern %d" % (i,))}).decode()
+        self.assertTrue(len(regex._cache) <= regex._CACHE_SIZE)
+        # Recently used patterns stay in the cache.
+        self.assertTrue((u"pattern %d" % (regex._CACHE_SIZE * 2 - 1,), 0)
+                        in regex._cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the type_registry module."""
+
+import decimal
+import unittest
+import sys
+sys.path[0:0] = [""]
+
+from bson import BSON, decode_all, decode_iter
+from bson.binary import Binary
+from bson.errors import InvalidDocument
+from bson.py3compat import b
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
+from bson.type_registry import TypeRegistry
+
+DECIMAL_SUBTYPE = 128
+
+
+def encode_decimal(value):
+    return Binary(b(str(value)), DECIMAL_SUBTYPE)
+
+
+def decode_decimal(value):
+    if value.subtype == DECIMAL_SUBTYPE:
+        return decimal.Decimal(value.decode("utf-8"))
+    return value
+
+
+class MyDecimal(decimal.Decimal):
+    pass
+
+
+class TestTypeRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = TypeRegistry({decimal.Decimal: encode_decimal},
+                                     {Binary: decode_decimal})
+        self.document = SON([("a", decimal.Decimal("1.5")),
+                             ("b", [decimal.Decimal("2"), 3]),
+                             ("c", {"d": decimal.Decimal("-4.25")}),
+                             ("e", Binary(b("\x00\x01")))])
+
+    def test_register(self):
+        registry = TypeRegistry()
+        self.assertRaises(TypeError, registry.register_encoder,
+                          "Decimal", encode_decimal)
+        self.assertRaises(TypeError, registry.register_encoder,
+                          decimal.Decimal, None)
+        self.assertRaises(TypeError, registry.register_decoder,
+                          Binary, "not callable")
+        self.assertRaises(TypeError, TypeRegistry, {1: encode_decimal})
+        registry.register_encoder(decimal.Decimal, encode_decimal)
+        registry.register_decoder(Binary, decode_decimal)
+        self.assertEqual(encode_decimal, registry._encoders[decimal.Decimal])
+        self.assertEqual(decode_decimal, registry._decoders[Binary])
+
+    def test_round_trip(self):
+        encoded = BSON.encode(self.document, type_registry=self.registry)
+        self.assertEqual(self.document,
+                         encoded.decode(type_registry=self.registry))
+        self.assertEqual([self.document],
+                         decode_all(encoded, type_registry=self.registry))
+        self.assertEqual([self.document],
+                         list(decode_iter(encoded,
+                                          type_registry=self.registry)))
+
+        decoded = encoded.decode()
+        self.assertEqual(encode_decimal(decimal.Decimal("1.5")), decoded["a"])
+        self.assertEqual(encode_decimal(decimal.Decimal("-4.25")),
+                         decoded["c"]["d"])
+
+    def test_fields(self):
+        encoded = BSON.encode(self.document, type_registry=self.registry)
+        self.assertEqual([{"c": {"d": decimal.Decimal("-4.25")}}],
+                         decode_all(encoded, fields=["c.d"],
+                                    type_registry=self.registry))
+
+    def test_subclass(self):
+        encoded = BSON.encode({"a": MyDecimal("7")},
+                              type_registry=self.registry)
+        self.assertEqual({"a": decimal.Decimal("7")},
+                         encoded.decode(type_registry=self.registry))
+
+    def test_encode_into(self):
+        buf = bytearray()
+        BSON.encode_into([self.document], buf, type_registry=self.registry)
+        self.assertEqual(BSON.encode(self.document,
+                                     type_registry=self.registry),
+                         bytes(buf))
+
+    def test_unknown_type(self):
+        self.assertRaises(InvalidDocument, BSON.encode, self.document)
+        self.assertRaises(InvalidDocument, BSON.encode, self.document,
+                          type_registry=TypeRegistry())
+
+    def test_encoder_returns_same_type(self):
+        registry = TypeRegistry({decimal.Decimal: lambda value: value})
+        self.assertRaises(InvalidDocument, BSON.encode, self.document,
+                          type_registry=registry)
+
+    def test_document_decoder(self):
+        registry = TypeRegistry(decoders={dict: lambda value: len(value)})
+        encoded = BSON.encode({"a": {"b": 1, "c": 2}, "d": [{}]})
+        self.assertEqual({"a": 2, "d": [0]},
+                         encoded.decode(type_registry=registry))
+
+    def test_raw_document(self):
+        encoded = BSON.encode(self.document, type_registry=self.registry)
+        raw = encoded.decode(RawBSONDocument, type_registry=self.registry)
+        self.assertEqual(encode_decimal(decimal.Decimal("1.5")), raw["a"])
+
+    def test_not_a_registry(self):
+        self.assertRaises(TypeError, BSON.encode, {}, type_registry={})
+        encoded = BSON.encode({})
+        self.assertRaises(TypeError, encoded.decode, type_registry={})
+        self.assertRaises(TypeError, decode_all, encoded, type_registry={})
+
+
+if __name__ == "__main__":
+    unittest.main()
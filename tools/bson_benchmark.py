@@ -0,0 +1,333 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""BSON encoding and decoding benchmarks.
+
+Doesn't need a server. Times encoding and decoding a fixed corpus of
+document shapes with the C codec (if it's built) and the pure Python
+codec, each in its own process so that the C extension can be hidden
+from the pure Python run.
+
+Each benchmark is warmed up, then timed in several samples of enough
+operations to run for at least ``--min-time`` seconds. The median is
+reported as operations and bytes per second, along with the relative
+spread of the samples. With Python 3.4+ the memory allocated by one
+operation (peak bytes, and blocks still allocated afterwards) is
+reported too.
+
+``--json FILE`` writes the results as JSON. A file written that way can
+be passed back as ``--baseline FILE``: every benchmark more than
+``--tolerance`` slower than the baseline is reported, and the exit
+status is 1. Baselines are only comparable on the same machine and
+Python, so record one there before changing the codec::
+
+  python tools/bson_benchmark.py --json baseline.json
+  # ... change the codec, rebuild ...
+  python tools/bson_benchmark.py --baseline baseline.json
+"""
+
+import os
+import subprocess
+import sys
+sys.path[0:0] = [""]
+
+import datetime
+import timeit
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Assigned in main(), once we know whether to hide the C extension.
+bson = None
+
+batch_size = 100
+
+
+def make_corpus():
+    """The documents to benchmark, by shape. Always the same documents,
+    so that results can be compared between runs.
+    """
+    from bson.binary import Binary
+    from bson.objectid import ObjectId
+    from bson.py3compat import b
+
+    oid = ObjectId("4fa0b2c3d4e5f60718293a4b")
+    when = datetime.datetime(2012, 5, 1, 12, 30, 15, 250000)
+
+    flat = {"_id": oid,
+            "name": "benchmark",
+            "count": 5,
+            "big": 2 ** 40,
+            "ratio": 5.05,
+            "ok": True,
+            "nothing": None,
+            "when": when}
+
+    nested = {"leaf": 1}
+    for i in range(30):
+        nested = {"level": i, "child": nested}
+
+    wide = dict([("field%03d" % i, i) for i in range(500)])
+
+    arrays = {"ints": list(range(500)),
+              "floats": [i * 0.5 for i in range(500)],
+              "strings": ["item %d" % i for i in range(100)],
+              "matrix": [list(range(10)) for _ in range(20)]}
+
+    blob = b("").join([b(chr(i)) for i in range(256)])
+    binary = {"small": [Binary(blob[:16]) for _ in range(50)],
+              "large": Binary(blob * 256)}
+
+    dates = {"dates": [when + datetime.timedelta(seconds=i)
+                       for i in range(500)]}
+
+    return [("flat", flat),
+            ("nested", nested),
+            ("wide", wide),
+            ("arrays", arrays),
+            ("binary", binary),
+            ("dates", dates)]
+
+
+def make_benchmarks(corpus):
+    """A (name, function, bytes processed per call) tuple for each
+    benchmark.
+    """
+    BSON = bson.BSON
+    benchmarks = []
+    for shape, document in corpus:
+        data = BSON.encode(document)
+        batch = data * batch_size
+        benchmarks.append(("encode %s" % shape,
+                           lambda document=document: BSON.encode(document),
+                           len(data)))
+        benchmarks.append(("decode %s" % shape,
+                           lambda data=data: data.decode(),
+                           len(data)))
+        benchmarks.append(("decode_all %s (batches of %d)" %
+                           (shape, batch_size),
+                           lambda batch=batch: bson.decode_all(batch),
+                           len(batch)))
+    return benchmarks
+
+
+def run_loops(function, number):
+    """Call `function` `number` times, returning the time taken.
+    """
+    start = timeit.default_timer()
+    for _ in range(number):
+        function()
+    return timeit.default_timer() - start
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def stdev(values):
+    mean = sum(values) / float(len(values))
+    return (sum([(v - mean) ** 2 for v in values]) /
+            max(len(values) - 1, 1)) ** 0.5
+
+
+def allocations(function):
+    """The peak bytes allocated while calling `function` once, and the
+    number of those allocations its result still holds. (None, None)
+    without tracemalloc.
+    """
+    if tracemalloc is None:
+        return None, None
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+        blocks = len(tracemalloc.take_snapshot().traces)
+        del result
+    finally:
+        tracemalloc.stop()
+    return peak, blocks
+
+
+def measure(function, size, samples, min_time, warmup):
+    """Time `function`, returning a dict of results.
+    """
+    # Warm up caches, then find how many calls fill min_time.
+    deadline = timeit.default_timer() + warmup
+    while timeit.default_timer() < deadline:
+        function()
+    number = 1
+    while run_loops(function, number) < min_time:
+        number *= 2
+
+    rates = []
+    for _ in range(samples):
+        rates.append(number / run_loops(function, number))
+    ops = median(rates)
+    alloc_bytes, alloc_blocks = allocations(function)
+    return {"ops_per_sec": ops,
+            "bytes_per_sec": ops * size,
+            "rsd": stdev(rates) / (sum(rates) / len(rates)),
+            "samples": samples,
+            "loops": number,
+            "alloc_bytes": alloc_bytes,
+            "alloc_blocks": alloc_blocks}
+
+
+def run(options, codec):
+    """Run the benchmarks with `codec` in this process.
+    """
+    global bson
+    if codec == "python":
+        sys.modules["bson._cbson"] = None
+        sys.modules["pymongo._cmessage"] = None
+    import bson as bson_module
+    bson = bson_module
+    if codec == "c" and not bson.has_c():
+        raise SystemExit("the C extension isn't built")
+
+    results = {}
+    for name, function, size in make_benchmarks(make_corpus()):
+        if options.filter and options.filter not in name:
+            continue
+        results[name] = measure(function, size, options.samples,
+                                options.min_time, options.warmup)
+    return results
+
+
+def run_all(options):
+    """Run the benchmarks with each codec in a child process.
+    """
+    results = {}
+    for codec in options.codecs:
+        command = [sys.executable, os.path.abspath(__file__),
+                   "--child", codec,
+                   "--samples", str(options.samples),
+                   "--min-time", str(options.min_time),
+                   "--warmup", str(options.warmup)]
+        if options.filter:
+            command.extend(["--filter", options.filter])
+        child = subprocess.Popen(command, stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        if child.returncode:
+            if codec == "c":
+                print("skipping the C codec: not built")
+                continue
+            raise SystemExit(child.returncode)
+        results[codec] = json.loads(output.decode("utf-8"))
+    return results
+
+
+def report(results, baseline, tolerance):
+    """Print `results`, comparing them with `baseline`. Returns the
+    number of regressions.
+    """
+    regressions = 0
+    for codec in sorted(results):
+        print("%s codec:" % codec)
+        print("%-44s %12s %10s %6s %10s %7s" %
+              ("benchmark", "ops/sec", "MB/sec", "rsd", "alloc KB",
+               "change"))
+        for name in sorted(results[codec]):
+            result = results[codec][name]
+            alloc = "-"
+            if result["alloc_bytes"] is not None:
+                alloc = "%.1f" % (result["alloc_bytes"] / 1024.0)
+            change = ""
+            try:
+                old = baseline[codec][name]["ops_per_sec"]
+            except (KeyError, TypeError):
+                pass
+            else:
+                ratio = result["ops_per_sec"] / old - 1
+                change = "%+.1f%%" % (ratio * 100)
+                if ratio < -tolerance:
+                    change += " REGRESSED"
+                    regressions += 1
+            print("%-44s %12.0f %10.1f %5.1f%% %10s %7s" %
+                  (name, result["ops_per_sec"],
+                   result["bytes_per_sec"] / (1024.0 * 1024.0),
+                   result["rsd"] * 100, alloc, change))
+        print("")
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--codec", choices=["c", "python", "all"],
+                      default="all",
+                      help="c, python or all [default: %default]")
+    parser.add_option("--samples", type="int", default=7,
+                      help="timed samples per benchmark [default: %default]")
+    parser.add_option("--min-time", type="float", default=0.1,
+                      dest="min_time",
+                      help="minimum seconds per sample [default: %default]")
+    parser.add_option("--warmup", type="float", default=0.2,
+                      help="seconds of warmup per benchmark "
+                      "[default: %default]")
+    parser.add_option("--filter", default=None,
+                      help="only run benchmarks whose names contain FILTER")
+    parser.add_option("--json", default=None, metavar="FILE",
+                      help="write the results to FILE as JSON")
+    parser.add_option("--baseline", default=None, metavar="FILE",
+                      help="compare with results written by --json")
+    parser.add_option("--tolerance", type="float", default=0.1,
+                      help="slowdown reported as a regression "
+                      "[default: %default]")
+    parser.add_option("--child", default=None, help="internal")
+    options, _ = parser.parse_args()
+
+    if options.child:
+        sys.stdout.write(json.dumps(run(options, options.child)))
+        return
+
+    if options.codec == "all":
+        options.codecs = ["c", "python"]
+    else:
+        options.codecs = [options.codec]
+    results = run_all(options)
+
+    baseline = None
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+    regressions = report(results, baseline, options.tolerance)
+
+    if options.json:
+        f = open(options.json, "w")
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if regressions:
+        print("%d benchmarks regressed by more than %d%%" %
+              (regressions, options.tolerance * 100))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Copyright 2012 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Insert JSON Lines files, one extended JSON document per line, into a
+collection.
+
+Usage: python tools/import_json_lines.py [options] db.collection [file ...]
+
+Reads standard input if no files are given. The documents are converted
+straight to BSON and sent in batches with
+:meth:`~pymongo.collection.Collection.insert_json_lines`.
+"""
+
+import sys
+sys.path[0:0] = [""]
+
+from optparse import OptionParser
+
+from pymongo.connection import Connection
+
+
+def main():
+    parser = OptionParser(
+        usage="%prog [options] db.collection [file ...]")
+    parser.add_option("--host", default="localhost",
+                      help="the host to connect to [default: %default]")
+    parser.add_option("--port", type="int", default=27017,
+                      help="the port to connect to [default: %default]")
+    parser.add_option("--safe", action="store_true", default=False,
+                      help="check each batch of inserts for errors")
+    parser.add_option("--continue-on-error", action="store_true",
+                      default=False, dest="continue_on_error",
+                      help="keep inserting a batch after an error")
+    options, args = parser.parse_args()
+    if not args or "." not in args[0]:
+        parser.error("a collection, as db.collection, is required")
+
+    db_name, collection_name = args[0].split(".", 1)
+    collection = Connection(options.host, options.port)[db_name][
+        collection_name]
+
+    if len(args) == 1:
+        # Read bytes, which are parsed as UTF-8.
+        files = [getattr(sys.stdin, "buffer", sys.stdin)]
+    else:
+        files = args[1:]
+
+    count = 0
+    for f in files:
+        if isinstance(f, basestring):
+            f = open(f, "rb")
+        try:
+            count += collection.insert_json_lines(
+                f, safe=options.safe,
+                continue_on_error=options.continue_on_error)
+        finally:
+            f.close()
+    print("inserted %d documents into %s" % (count, collection.full_name))
+
+
+if __name__ == "__main__":
+    main()